@@ -0,0 +1,154 @@
+"""Module that contains wrapper functions for ``ANTs``' ``N4BiasFieldCorrection``."""
+import os
+
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+from commandio.command import Command
+from commandio.logutil import LogFile
+from commandio.workdir import WorkDir
+
+from dwi_preproc.utils.hashing import cache_key, is_cached
+from dwi_preproc.utils.niio import NiiFile, image, intermediate_path
+from dwi_preproc.utils.util import available_cores, run_command, update_json
+
+# Shared (lazily created) executor for non-blocking N4 jobs
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+
+def n4(
+    img: Union[image, str],
+    outdir: str,
+    mask: Optional[Union[image, str]] = None,
+    shrink_factor: int = 4,
+    convergence: Sequence[int] = (50, 50, 50, 50),
+    threshold: float = 1e-7,
+    bspline_distance: Optional[float] = None,
+    threads: Optional[int] = None,
+    use_cache: bool = True,
+    verbose: bool = False,
+    log: Optional[LogFile] = None,
+) -> Tuple[image, image]:
+    """Performs bias field correction of some input NIFTI image.
+
+    Wrapper function for ``ANTs``' ``N4BiasFieldCorrection``.
+
+    The outputs are cached: a JSON file records the hash of the inputs (and the
+    parameters) used to write the outputs, and the command is not run again if
+    the outputs exist and the recorded hash matches.
+
+    NOTE:
+        * The number of threads is set using the ``ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS`` environmental variable of the (private) environment of the command, so that concurrent jobs (see ``n4_submit``) do not share, or modify, the environment of this process.
+        * ``N4BiasFieldCorrection`` is resolved using the system path, so any executable with the same interface (e.g. a test double) may be used in its place.
+
+    Usage example:
+        >>> corrected, bias = n4(img="mean_b0.nii.gz",
+        ...                      outdir="N4",
+        ...                      shrink_factor=4,
+        ...                      convergence=(50, 50, 50, 50),
+        ...                      threads=2)
+        ...
+
+    Args:
+        img: Input image file.
+        outdir: Output directory.
+        mask: Mask image file. Defaults to None.
+        shrink_factor: Image shrink factor. Defaults to 4.
+        convergence: Number of iterations for each resolution level. Defaults to (50, 50, 50, 50).
+        threshold: Convergence threshold. Defaults to 1e-7.
+        bspline_distance: B-spline mesh distance (mm). Defaults to None.
+        threads: Number of threads. Defaults to None (number of allocated cores).
+        use_cache: Use cached outputs (if they exist). Defaults to True.
+        verbose: Enable verbose output. Defaults to False.
+        log: ``LogFile`` object for logging purposes. Defaults to None.
+
+    Raises:
+        RuntimeError: Exception that is raised if ``N4BiasFieldCorrection`` fails.
+
+    Returns:
+        * Bias field corrected image.
+        * Bias field.
+    """
+    with NiiFile(src=img, assert_exists=True, validate_nifti=True) as n:
+        with WorkDir(src=outdir) as _:
+            img: image = n.abspath()
+            _, basename, _ = n.file_parts()
+
+    if mask:
+        with NiiFile(src=mask, assert_exists=True) as m:
+            mask: image = m.abspath()
+
+    out_img: image = os.path.abspath(intermediate_path(os.path.join(outdir, f"{basename}_n4.nii.gz")))
+    bias_img: image = os.path.abspath(intermediate_path(os.path.join(outdir, f"{basename}_n4_bias.nii.gz")))
+    record: str = os.path.join(outdir, f"{basename}_n4.json")
+
+    params: Dict[str, Any] = {
+        "shrink_factor": int(shrink_factor),
+        "convergence": [int(i) for i in convergence],
+        "threshold": float(threshold),
+        "bspline_distance": bspline_distance,
+    }
+    key: str = cache_key(files=[img, mask], params=params)
+
+    if use_cache and is_cached(key=key, record=record, outputs=[out_img, bias_img]):
+        if log:
+            log.info(f"Using cached N4 outputs:\t{out_img}")
+        return out_img, bias_img
+
+    iters: str = "x".join(str(i) for i in params["convergence"])
+    cmd_str: str = f"N4BiasFieldCorrection -d 3 -i {img} -s {params['shrink_factor']} -c [{iters},{threshold}] -o [{out_img},{bias_img}]"
+
+    if mask:
+        cmd_str: str = f"{cmd_str} -x {mask}"
+
+    if bspline_distance:
+        cmd_str: str = f"{cmd_str} -b [{bspline_distance}]"
+
+    if verbose:
+        cmd_str: str = f"{cmd_str} -v 1"
+
+    cmd: Command = Command(cmd_str)
+    cmd.check_dependency()
+    threads: int = max(int(threads or available_cores()), 1)
+    run_command(cmd_str, env={"ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS": str(threads)}, log=log)
+
+    update_json(json_file=record, dictionary={"CacheKey": key, "Parameters": params})
+
+    return out_img, bias_img
+
+
+def n4_submit(*args, executor: Optional[Executor] = None, **kwargs) -> Future:
+    """Submits a (non-blocking) bias field correction job.
+
+    Accepts the same arguments as ``n4``. This allows bias field correction to
+    run concurrently with other stages (e.g. on the mean b0 while ``topup`` is
+    running).
+
+    NOTE:
+        The pipeline (``dwi_preproc.sh``) intentionally runs ``n4`` sequentially (``dwProc.py n4``):
+        when ``topup`` runs, the eddy brain mask is created from the ``topup`` corrected (hifi) b0,
+        which only exists once ``topup`` and ``applytopup`` are done (a bias field estimated on the
+        distorted mean b0 would not match its geometry), and when ``topup`` does not run, there is
+        no stage to overlap with. This function is for callers that do have such a stage.
+
+    Usage example:
+        >>> job = n4_submit(img="mean_b0.nii.gz", outdir="N4", threads=2)
+        >>> # ... run topup ...
+        >>> corrected, bias = job.result()
+
+    Args:
+        executor: Executor to submit the job to. Defaults to None (a shared thread pool).
+        *args: Positional arguments passed to ``n4``.
+        **kwargs: Keyword arguments passed to ``n4``.
+
+    Returns:
+        ``Future`` whose result is the output of ``n4``.
+    """
+    global _EXECUTOR
+
+    if executor is None:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=max(os.cpu_count() or 1, 2), thread_name_prefix="n4")
+        executor: Executor = _EXECUTOR
+
+    return executor.submit(n4, *args, **kwargs)
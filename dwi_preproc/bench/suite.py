@@ -0,0 +1,412 @@
+"""Benchmark suite of the main (native) processing paths.
+
+Benchmarks are run on a synthetic dataset (see ``dwi_preproc.bench.synth``),
+and the results are stored per commit so that they can be compared across
+commits. Two tiers are defined: ``quick`` (small dataset, intended for CI) and
+``large`` (cohort-scale dataset).
+"""
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import nibabel as nib
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.bench.synth import make_bids_dataset
+
+# Benchmark tiers: dataset parameters, and the number of timed repeats of each benchmark
+TIERS: Dict[str, Dict[str, Any]] = {
+    "quick": {
+        "n_subjects": 2,
+        "shape": (32, 32, 16),
+        "shells": {0: 2, 1000: 12},
+        "mb_factor": 2,
+        "repeats": 5,
+    },
+    "large": {
+        "n_subjects": 24,
+        "shape": (96, 96, 60),
+        "shells": {0: 8, 1000: 32, 2000: 64},
+        "mb_factor": 3,
+        "repeats": 3,
+    },
+}
+
+# Registered benchmarks: name -> function (of the dataset context)
+_BENCHMARKS: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+
+
+def benchmark(name: str) -> Callable:
+    """Decorator that registers a benchmark.
+
+    The benchmark function is called with the dataset context (``root``, ``dwis``, ``tmp``) and is timed as a whole.
+
+    Args:
+        name: Benchmark name.
+
+    Returns:
+        Decorator.
+    """
+    def register(func: Callable[[Dict[str, Any]], Any]) -> Callable[[Dict[str, Any]], Any]:
+        _BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+@benchmark("niio.header_read")
+def _bench_header_read(ctx: Dict[str, Any]) -> None:
+    """Reads the NIFTI header of every DWI of the dataset."""
+    for dwi in ctx["dwis"]:
+        nib.load(dwi).header.get_zooms()
+
+
+@benchmark("niio.nii_file_validate")
+def _bench_nii_file(ctx: Dict[str, Any]) -> None:
+    """Validates every DWI of the dataset (``NiiFile``)."""
+    from dwi_preproc.utils.niio import NiiFile
+
+    for dwi in ctx["dwis"]:
+        with NiiFile(src=dwi, assert_exists=True, validate_nifti=True) as n:
+            n.file_parts()
+
+
+@benchmark("niio.iter_volumes")
+def _bench_iter_volumes(ctx: Dict[str, Any]) -> None:
+    """Streams all of the volumes of a DWI."""
+    from dwi_preproc.utils.niio import iter_volumes
+
+    for _ in iter_volumes(ctx["dwis"][0]):
+        pass
+
+
+@benchmark("niio.extract_volumes")
+def _bench_extract_volumes(ctx: Dict[str, Any]) -> None:
+    """Extracts every other volume of a DWI."""
+    from dwi_preproc.utils.niio import extract_volumes
+
+    nvols: int = nib.load(ctx["dwis"][0]).shape[3]
+    extract_volumes(ctx["dwis"][0], os.path.join(ctx["tmp"], "extract.nii.gz"), idx=range(0, nvols, 2))
+
+
+@benchmark("niio.gzip_read")
+def _bench_gzip_read(ctx: Dict[str, Any]) -> None:
+    """Reads (decompresses) all of the data of a DWI."""
+    np.asarray(nib.load(ctx["dwis"][0]).dataobj)
+
+
+@benchmark("niio.gzip_write")
+def _bench_gzip_write(ctx: Dict[str, Any]) -> None:
+    """Compresses an uncompressed DWI (``to_nifti_gz``)."""
+    from dwi_preproc.utils.niio import to_nifti_gz
+
+    src: str = os.path.join(ctx["tmp"], "uncompressed.nii")
+    if not os.path.exists(src):
+        nib.save(nib.load(ctx["dwis"][0]), src)
+    to_nifti_gz(src, os.path.join(ctx["tmp"], "compressed.nii.gz"))
+
+
+@benchmark("sliceorder.write_slice_order")
+def _bench_slice_order(ctx: Dict[str, Any]) -> None:
+    """Generates the slice orders of a range of slice numbers, multi-band factors and modes."""
+    from dwi_preproc.diffusion.dwi.sliceorder import write_slice_order
+
+    for slices in range(24, 97, 12):
+        for mb in (1, 2, 3, 4):
+            for mode in ("interleaved", "default", "single-shot"):
+                write_slice_order(slices, mb_factor=mb, mode=mode, return_mat=True)
+
+
+@benchmark("bids.index")
+def _bench_bids_index(ctx: Dict[str, Any]) -> None:
+    """Parses (indexes) every BIDS image of the dataset (``BIDSInfo``)."""
+    from dwi_preproc.bids.bidsinfo import BIDSInfo
+
+    for dwi in sorted(glob.glob(os.path.join(ctx["root"], "sub-*", "ses-*", "dwi", "*_dwi.nii*"))):
+        BIDSInfo(dwi)
+
+
+@benchmark("prescreen.volume_stats")
+def _bench_volume_stats(ctx: Dict[str, Any]) -> None:
+    """Computes the slice-wise and volume-wise intensities of a DWI (pre-screening)."""
+    from dwi_preproc.diffusion.dwi.btable import read_bvals
+    from dwi_preproc.diffusion.dwi.prescreen import volume_stats
+
+    dwi: str = ctx["dwis"][0]
+    volume_stats(dwi, read_bvals(_sibling(dwi, ".bval")))
+
+
+@benchmark("b0select.select_b0s")
+def _bench_select_b0s(ctx: Dict[str, Any]) -> None:
+    """Selects the b0s of a DWI and its rPE b0s."""
+    from dwi_preproc.diffusion.dwi.b0select import select_b0s
+
+    dwi: str = ctx["dwis"][0]
+    rpe: List[str] = glob.glob(os.path.join(os.path.dirname(dwi), "*_acq-AP_*_dwi.nii*"))
+    select_b0s(imgs=[dwi] + rpe[:1], bvals=[_sibling(dwi, ".bval")] + [None] * len(rpe[:1]), out=os.path.join(ctx["tmp"], "b0s.nii.gz"))
+
+
+@benchmark("denoise.mppca")
+def _bench_mppca(ctx: Dict[str, Any]) -> None:
+    """Denoises a DWI (MP-PCA)."""
+    from dwi_preproc.diffusion.dwi.denoise import mppca
+
+    mppca(ctx["dwis"][0], outdir=os.path.join(ctx["tmp"], "denoise"), n_procs=2)
+
+
+@benchmark("drift.correct_drift")
+def _bench_correct_drift(ctx: Dict[str, Any]) -> None:
+    """Corrects the signal drift of a DWI (linear model, as the quick tier only has 2 b0s)."""
+    from dwi_preproc.diffusion.dwi.drift import correct_drift
+
+    dwi: str = ctx["dwis"][0]
+    correct_drift(dwi, bvals=_sibling(dwi, ".bval"), out=os.path.join(ctx["tmp"], "dwi_drift.nii.gz"), order=1)
+
+
+def run(
+    tier: str = "quick",
+    workdir: Optional[str] = None,
+    select: Optional[Sequence[str]] = None,
+    repeats: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Runs the benchmark suite.
+
+    Each benchmark is run once (untimed, to warm up caches), and then timed for
+    the number of repeats of the tier. The synthetic dataset of a tier is
+    generated once in the working directory, and is reused by later runs.
+
+    Usage example:
+        >>> results = run("quick")
+        >>> save_results(results, "bench_results")
+        "abspath/to/bench_results/quick/1a2b3c4.json"
+
+    Args:
+        tier: Benchmark tier (``quick``, or ``large``). Defaults to 'quick'.
+        workdir: Working directory of the synthetic dataset. Defaults to None (temporary directory, removed once complete).
+        select: Names (or name prefixes, e.g. ``niio``) of the benchmarks to run. Defaults to None (all benchmarks).
+        repeats: Number of timed repeats. Defaults to None (that of the tier).
+
+    Raises:
+        KeyError: Exception that is raised if the tier does not exist.
+
+    Returns:
+        Dictionary of results (commit, environment, and the timings of each benchmark).
+    """
+    if tier not in TIERS:
+        raise KeyError(f"Invalid benchmark tier '{tier}'. Valid tiers include: {', '.join(TIERS)}")
+
+    params: Dict[str, Any] = dict(TIERS[tier])
+    repeats: int = repeats or params["repeats"]
+    params.pop("repeats")
+
+    tmp_root: Union[str, None] = None if workdir else tempfile.mkdtemp(prefix="dwi_preproc_bench_")
+    root: str = os.path.abspath(os.path.join(workdir or tmp_root, f"synth_{tier}"))
+
+    try:
+        t0: float = time.perf_counter()
+        dwis: List[str] = _dataset(root, params)
+        setup: float = time.perf_counter() - t0
+
+        ctx: Dict[str, Any] = {"root": root, "dwis": dwis, "tmp": os.path.join(root, "tmp")}
+        os.makedirs(ctx["tmp"], exist_ok=True)
+
+        results: Dict[str, Dict[str, float]] = {}
+        for name, func in _BENCHMARKS.items():
+            if select and not any(name == s or name.startswith(f"{s}.") for s in select):
+                continue
+            func(ctx)
+            times: List[float] = []
+            for _ in range(repeats):
+                t0: float = time.perf_counter()
+                func(ctx)
+                times.append(time.perf_counter() - t0)
+            results[name] = {
+                "min": float(np.min(times)),
+                "median": float(np.median(times)),
+                "mean": float(np.mean(times)),
+                "repeats": repeats,
+            }
+    finally:
+        if tmp_root:
+            shutil.rmtree(tmp_root, ignore_errors=True)
+
+    commit, dirty = _commit()
+
+    return {
+        "Commit": commit,
+        "Dirty": dirty,
+        "Timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "Tier": tier,
+        "Dataset": {k: (list(v) if isinstance(v, tuple) else v) for k, v in params.items()},
+        "DatasetSetup": setup,
+        "Python": sys.version.split()[0],
+        "Platform": platform.platform(),
+        "CPUs": os.cpu_count(),
+        "Results": results,
+    }
+
+
+def save_results(results: Dict[str, Any], outdir: str) -> file:
+    """Saves benchmark results as ``<outdir>/<tier>/<commit>.json`` (a ``-dirty`` suffix is added for uncommitted changes).
+
+    Args:
+        results: Dictionary of results.
+        outdir: Output (results) directory.
+
+    Returns:
+        Output JSON file.
+    """
+    outdir: str = os.path.join(outdir, results["Tier"])
+    os.makedirs(outdir, exist_ok=True)
+
+    name: str = results["Commit"] + ("-dirty" if results["Dirty"] else "")
+    out: str = os.path.join(outdir, f"{name}.json")
+
+    with open(out, "w") as f:
+        json.dump(results, f, indent=4)
+
+    return os.path.abspath(out)
+
+
+def compare(base: Union[Dict[str, Any], file, str], new: Union[Dict[str, Any], file, str], threshold: float = 0.1) -> List[Tuple[str, float, float, float, str]]:
+    """Compares the (median) timings of two benchmark results.
+
+    Args:
+        base: Baseline results (dictionary, or JSON file).
+        new: New results (dictionary, or JSON file).
+        threshold: Relative change above which a benchmark is considered to be slower (or faster). Defaults to 0.1.
+
+    Returns:
+        List of (name, baseline median, new median, ratio, verdict) for the benchmarks of both results, where verdict is ``slower``, ``faster`` or ``same``.
+    """
+    base: Dict[str, Any] = _load(base)
+    new: Dict[str, Any] = _load(new)
+    rows: List[Tuple[str, float, float, float, str]] = []
+
+    for name in sorted(set(base["Results"]) & set(new["Results"])):
+        b: float = base["Results"][name]["median"]
+        n: float = new["Results"][name]["median"]
+        ratio: float = n / b if b > 0 else float("inf")
+        verdict: str = "slower" if ratio > 1 + threshold else "faster" if ratio < 1 - threshold else "same"
+        rows.append((name, b, n, ratio, verdict))
+
+    return rows
+
+
+def format_results(results: Dict[str, Any]) -> str:
+    """Formats benchmark results as a (plain text) table.
+
+    Args:
+        results: Dictionary of results.
+
+    Returns:
+        Formatted table.
+    """
+    lines: List[str] = [f"{results['Tier']} @ {results['Commit']}{'-dirty' if results['Dirty'] else ''}", f"{'benchmark':<32}{'min (s)':>12}{'median (s)':>12}"]
+    for name, r in results["Results"].items():
+        lines.append(f"{name:<32}{r['min']:>12.4f}{r['median']:>12.4f}")
+
+    return "\n".join(lines)
+
+
+def format_comparison(rows: List[Tuple[str, float, float, float, str]]) -> str:
+    """Formats a comparison of benchmark results as a (plain text) table.
+
+    Args:
+        rows: Comparison rows (see ``compare``).
+
+    Returns:
+        Formatted table.
+    """
+    lines: List[str] = [f"{'benchmark':<32}{'base (s)':>12}{'new (s)':>12}{'ratio':>8}  verdict"]
+    for name, b, n, ratio, verdict in rows:
+        lines.append(f"{name:<32}{b:>12.4f}{n:>12.4f}{ratio:>8.2f}  {verdict}")
+
+    return "\n".join(lines)
+
+
+def _dataset(root: str, params: Dict[str, Any]) -> List[str]:
+    """Generates (or reuses) the synthetic dataset of a tier.
+
+    Args:
+        root: Dataset directory.
+        params: Dataset parameters.
+
+    Returns:
+        List of the DWIs of the dataset.
+    """
+    record: str = os.path.join(root, "synth_params.json")
+    key: str = json.dumps({k: (list(v) if isinstance(v, tuple) else v) for k, v in params.items()}, sort_keys=True, default=str)
+
+    if os.path.exists(record):
+        with open(record) as f:
+            cached: Dict[str, Any] = json.load(f)
+        if cached.get("Params") == key and all(os.path.exists(d) for d in cached.get("DWIs", [])):
+            return cached["DWIs"]
+        shutil.rmtree(root, ignore_errors=True)
+
+    dwis: List[str] = make_bids_dataset(root, **params)
+
+    with open(record, "w") as f:
+        json.dump({"Params": key, "DWIs": dwis}, f, indent=4)
+
+    return dwis
+
+
+def _commit() -> Tuple[str, bool]:
+    """Current (short) commit hash of the repository, and whether there are uncommitted changes.
+
+    Returns:
+        * Commit hash (``unknown`` if not in a git repository).
+        * True if there are uncommitted changes, False otherwise.
+    """
+    repo: str = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    try:
+        commit: str = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo, capture_output=True, text=True, check=True).stdout.strip()
+        status: str = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+    return commit, bool(status.strip())
+
+
+def _sibling(img: str, ext: str) -> str:
+    """Replaces the (NIFTI) file extension of an image (e.g. to find its ``.bval`` file).
+
+    Args:
+        img: Input image.
+        ext: New file extension.
+
+    Returns:
+        File path.
+    """
+    for suffix in (".nii.gz", ".nii"):
+        if img.endswith(suffix):
+            return img[: -len(suffix)] + ext
+    return img + ext
+
+
+def _load(results: Union[Dict[str, Any], file, str]) -> Dict[str, Any]:
+    """Loads benchmark results (from a JSON file).
+
+    Args:
+        results: Dictionary of results, or JSON file.
+
+    Returns:
+        Dictionary of results.
+    """
+    if isinstance(results, dict):
+        return results
+
+    with open(results) as f:
+        return json.load(f)
@@ -0,0 +1,234 @@
+"""Synthetic (custom BIDS) DWI dataset generator, used for benchmarking.
+
+The DWIs are simulated from a single tensor model of a (brain-like) ellipsoid,
+with interspersed b0s and Rician noise, so that every native processing stage
+can be run on them.
+"""
+import os
+import json
+import numpy as np
+import nibabel as nib
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from dwi_preproc.diffusion.dwi.btable import write_bvals, write_bvecs
+from dwi_preproc.diffusion.dwi.sliceorder import write_slice_order
+
+# Axial and radial diffusivities (mm^2/s) of the simulated tensors
+_D_AXIAL: float = 1.7e-3
+_D_RADIAL: float = 0.4e-3
+
+# b0 signal intensity (and Rician noise level is relative to it)
+_S0: float = 1000.0
+
+# Default JSON sidecar fields (custom BIDS, Philips specific fields included)
+_SIDECAR: Dict[str, Any] = {
+    "Manufacturer": "Philips",
+    "MagneticFieldStrength": 3,
+    "RepetitionTime": 5.0,
+    "EchoTime": 0.09,
+    "PhaseEncodingDirection": "j-",
+    "TotalReadoutTime": 0.05,
+    "WaterFatShift": 20.0,
+    "EchoTrainLength": 35,
+    "AccelerationFactor": 2,
+}
+
+
+def gradient_table(shells: Dict[int, int], seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Generates a (multi-shell) gradient table with interspersed b0s.
+
+    The directions of each shell are uniformly distributed on the sphere (Fibonacci lattice, randomly rotated for each shell).
+
+    Args:
+        shells: Dictionary that maps each b-value (0 for b0s) to its number of volumes.
+        seed: Random seed. Defaults to 0.
+
+    Returns:
+        * 1-dimensional numpy array of b-values.
+        * 3 x N numpy array of b-vectors.
+    """
+    rng: np.random.Generator = np.random.default_rng(seed)
+
+    dwis: List[Tuple[int, np.ndarray]] = []
+    for b, n in sorted(shells.items()):
+        if b <= 0 or n <= 0:
+            continue
+        i: np.ndarray = np.arange(n) + 0.5
+        z: np.ndarray = 1 - 2 * i / n
+        phi: np.ndarray = np.pi * (1 + 5 ** 0.5) * i
+        dirs: np.ndarray = np.stack([np.sqrt(1 - z ** 2) * np.cos(phi), np.sqrt(1 - z ** 2) * np.sin(phi), z])
+        rot, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+        dwis.extend((b, v) for v in (rot @ dirs).T)
+
+    # Interleave the diffusion weighted volumes (in random order) with evenly spaced b0s
+    order: np.ndarray = rng.permutation(len(dwis))
+    n_b0: int = max(int(shells.get(0, 0)), 0)
+    slots: np.ndarray = np.linspace(0, len(dwis), n_b0, endpoint=False).astype(int) if n_b0 else np.array([], dtype=int)
+
+    bvals: List[float] = []
+    bvecs: List[np.ndarray] = []
+    for n, k in enumerate(order):
+        for _ in range(int(np.sum(slots == n))):
+            bvals.append(0)
+            bvecs.append(np.zeros(3))
+        bvals.append(dwis[k][0])
+        bvecs.append(dwis[k][1])
+
+    if not dwis:
+        bvals, bvecs = [0] * n_b0, [np.zeros(3)] * n_b0
+
+    return np.asarray(bvals, dtype=float), np.asarray(bvecs, dtype=float).T.reshape(3, -1)
+
+
+def synth_dwi(
+    shape: Tuple[int, int, int],
+    bvals: np.ndarray,
+    bvecs: np.ndarray,
+    noise: float = 0.02,
+    seed: int = 0,
+) -> np.ndarray:
+    """Simulates a DWI of a (brain-like) ellipsoid with a smoothly varying fibre orientation field.
+
+    Args:
+        shape: Matrix size (x, y, z).
+        bvals: 1-dimensional numpy array of b-values.
+        bvecs: 3 x N numpy array of b-vectors.
+        noise: Rician noise level, relative to the b0 signal intensity. Defaults to 0.02.
+        seed: Random seed. Defaults to 0.
+
+    Returns:
+        4D ``int16`` numpy array (x, y, z, volumes).
+    """
+    rng: np.random.Generator = np.random.default_rng(seed)
+    grid: np.ndarray = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij"))
+
+    r: np.ndarray = np.sqrt(np.sum((grid / np.array([0.8, 0.9, 0.8])[:, None, None, None]) ** 2, axis=0))
+    s0: np.ndarray = np.where(r < 1, _S0 * (0.6 + 0.4 * (1 - r)), 0).astype(np.float32)
+
+    # Fibre orientation field (circumferential in the axial plane, with an inferior-superior component)
+    v: np.ndarray = np.stack([-grid[1], grid[0], 0.5 * np.ones(shape)])
+    v /= np.linalg.norm(v, axis=0, keepdims=True)
+
+    out: np.ndarray = np.empty(tuple(shape) + (len(bvals),), dtype=np.int16)
+    sigma: float = noise * _S0
+
+    for n, (b, g) in enumerate(zip(bvals, bvecs.T)):
+        adc: np.ndarray = _D_RADIAL + (_D_AXIAL - _D_RADIAL) * np.tensordot(g, v, axes=1) ** 2
+        sig: np.ndarray = s0 * np.exp(-b * adc)
+        sig: np.ndarray = np.sqrt((sig + sigma * rng.standard_normal(shape)) ** 2 + (sigma * rng.standard_normal(shape)) ** 2)
+        out[..., n] = np.clip(np.rint(sig), 0, np.iinfo(np.int16).max)
+
+    return out
+
+
+def make_bids_dataset(
+    root: str,
+    n_subjects: int = 2,
+    n_sessions: int = 1,
+    shape: Tuple[int, int, int] = (32, 32, 16),
+    shells: Optional[Dict[int, int]] = None,
+    mb_factor: int = 1,
+    rpe_b0: bool = True,
+    compress: bool = True,
+    sidecar: Optional[Dict[str, Any]] = None,
+    noise: float = 0.02,
+    seed: int = 0,
+) -> List[str]:
+    """Generates a synthetic (custom BIDS) DWI dataset.
+
+    Files are named ``sub-<sub>/ses-<ses>/dwi/sub-<sub>_ses-<ses>_acq-PA_dirs-<dirs>_bval-<bval>_run-01_dwi``
+    (with their ``.bval``, ``.bvec`` and ``.json`` files), and the (optional) rPE b0s use ``acq-AP``.
+
+    Usage example:
+        >>> dwis = make_bids_dataset("synth", n_subjects=4, shape=(64, 64, 40), shells={0: 6, 1000: 30, 2000: 30}, mb_factor=2)
+        >>> dwis[0]
+        "abspath/to/synth/sub-001/ses-001/dwi/sub-001_ses-001_acq-PA_dirs-60_bval-2000_run-01_dwi.nii.gz"
+
+    Args:
+        root: Output (BIDS) directory.
+        n_subjects: Number of subjects. Defaults to 2.
+        n_sessions: Number of sessions (per subject). Defaults to 1.
+        shape: Matrix size (x, y, z). Defaults to (32, 32, 16).
+        shells: Dictionary that maps each b-value (0 for b0s) to its number of volumes. Defaults to None ({0: 2, 1000: 12}).
+        mb_factor: Multi-band factor (the number of slices should be divisible by it). Defaults to 1.
+        rpe_b0: Also write a reverse phase encoded b0 image (2 volumes) for each DWI. Defaults to True.
+        compress: Write compressed (``.nii.gz``) images. Defaults to True.
+        sidecar: Additional (or overriding) JSON sidecar fields. Defaults to None.
+        noise: Rician noise level, relative to the b0 signal intensity. Defaults to 0.02.
+        seed: Random seed. Defaults to 0.
+
+    Returns:
+        List of the DWIs of the dataset.
+    """
+    shells: Dict[int, int] = shells or {0: 2, 1000: 12}
+    ext: str = ".nii.gz" if compress else ".nii"
+    zooms: Tuple[float, ...] = (2.0, 2.0, 2.0)
+    affine: np.ndarray = np.diag(zooms + (1.0,))
+    affine[:3, 3] = -np.array(shape) * np.array(zooms) / 2
+
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, "dataset_description.json"), "w") as f:
+        json.dump({"Name": "dwi_preproc synthetic dataset", "BIDSVersion": "1.6.0"}, f, indent=4)
+
+    tr: float = float((sidecar or {}).get("RepetitionTime", _SIDECAR["RepetitionTime"]))
+    slspec: np.ndarray = write_slice_order(shape[2], mb_factor=mb_factor, mode="interleaved", return_mat=True).reshape(-1, mb_factor)
+    timing: np.ndarray = np.zeros(shape[2])
+    for n, group in enumerate(slspec):
+        timing[group] = n * tr / len(slspec)
+
+    meta: Dict[str, Any] = {
+        **_SIDECAR,
+        "MultiBandFactor": mb_factor,
+        "MultibandAccelerationFactor": mb_factor,
+        "SliceTiming": [round(float(t), 4) for t in timing],
+        **(sidecar or {}),
+    }
+
+    n_dirs: int = sum(n for b, n in shells.items() if b > 0)
+    bval_label: int = max(shells)
+    dwis: List[str] = []
+
+    for sub in range(1, n_subjects + 1):
+        for ses in range(1, n_sessions + 1):
+            subdir: str = os.path.join(root, f"sub-{sub:03d}", f"ses-{ses:03d}", "dwi")
+            os.makedirs(subdir, exist_ok=True)
+            prefix: str = f"sub-{sub:03d}_ses-{ses:03d}"
+            rs: int = seed + 1000 * sub + ses
+
+            bvals, bvecs = gradient_table(shells, seed=rs)
+            name: str = os.path.join(subdir, f"{prefix}_acq-PA_dirs-{n_dirs}_bval-{bval_label}_run-01_dwi")
+            _write_series(name, ext, synth_dwi(shape, bvals, bvecs, noise=noise, seed=rs), affine, bvals, bvecs, meta)
+            dwis.append(os.path.abspath(name + ext))
+
+            if rpe_b0:
+                b0_bvals, b0_bvecs = np.zeros(2), np.zeros((3, 2))
+                name: str = os.path.join(subdir, f"{prefix}_acq-AP_dirs-0_bval-0_run-01_dwi")
+                _write_series(name, ext, synth_dwi(shape, b0_bvals, b0_bvecs, noise=noise, seed=rs + 1), affine, b0_bvals, b0_bvecs, {**meta, "PhaseEncodingDirection": "j"})
+
+    return dwis
+
+
+def _write_series(name: str, ext: str, data: np.ndarray, affine: np.ndarray, bvals: np.ndarray, bvecs: np.ndarray, meta: Dict[str, Any]) -> None:
+    """Writes a DWI series (image, b-values, b-vectors and JSON sidecar).
+
+    Args:
+        name: Output file name (without an extension).
+        ext: Image file extension.
+        data: Image data.
+        affine: Image affine.
+        bvals: 1-dimensional numpy array of b-values.
+        bvecs: 3 x N numpy array of b-vectors.
+        meta: JSON sidecar fields.
+    """
+    nii: nib.Nifti1Image = nib.Nifti1Image(data, affine)
+    nii.header.set_xyzt_units("mm", "sec")
+    nib.save(nii, name + ext)
+
+    write_bvals(bvals, name + ".bval")
+    write_bvecs(bvecs, name + ".bvec")
+
+    with open(name + ".json", "w") as f:
+        json.dump(meta, f, indent=4)
+
+    return None
@@ -0,0 +1,299 @@
+"""Detection of duplicate (and near-duplicate) DWI acquisitions of a BIDS dataset.
+
+Re-exported (or re-converted) copies of the same acquisition are found in two passes:
+    1. Candidates are grouped (cheaply) by their header and JSON sidecar
+       fingerprint (image dimensions, voxel size, ``AcquisitionTime`` and
+       ``SeriesNumber``).
+    2. Duplicates are confirmed within each group: by (decoded) content hashes
+       (identical copies), or by the correlation of a few sampled volumes
+       (near-duplicates, e.g. re-converted with a different data type or scaling).
+"""
+import os
+import glob
+import json
+import numpy as np
+import nibabel as nib
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.bids.bidsinfo import BIDSInfo
+from dwi_preproc.utils.hashing import hash_files
+from dwi_preproc.utils.niio import NiiFile, image, iter_volumes
+
+# JSON sidecar fields of the fingerprint
+_SIDECAR_FIELDS: Tuple[str, ...] = ("AcquisitionTime", "SeriesNumber")
+
+# Minimum correlation of the sampled volumes of near-duplicates
+_CORR_THRESH: float = 0.999
+
+
+def fingerprint(img: Union[image, str]) -> Dict[str, Any]:
+    """Computes the (header and JSON sidecar) fingerprint of a BIDS image.
+
+    The fingerprint only requires the image header and sidecar to be read.
+    ``AcquisitionTime`` is normalized to seconds (rounded), so that the
+    different formats of DICOM converters match.
+
+    Args:
+        img: Input BIDS image.
+
+    Returns:
+        Dictionary of the fingerprint fields (``Subject``, ``Session``, ``Shape``, ``Zooms``, ``AcquisitionTime`` and ``SeriesNumber``).
+    """
+    info: BIDSInfo = BIDSInfo(img)
+    nii: nib.Nifti1Image = nib.load(info.img)
+    meta: Dict[str, Any] = info.bids or {}
+
+    fp: Dict[str, Any] = {
+        "Subject": info.sub,
+        "Session": info.ses,
+        "Shape": list(nii.shape),
+        "Zooms": [round(float(z), 3) for z in nii.header.get_zooms()[:3]],
+    }
+
+    for field in _SIDECAR_FIELDS:
+        fp[field] = meta.get(field)
+
+    fp["AcquisitionTime"] = _seconds(fp["AcquisitionTime"])
+
+    return fp
+
+
+def find_duplicates(
+    imgs: Sequence[Union[image, str]],
+    threshold: float = _CORR_THRESH,
+    n_samples: int = 3,
+    across_subjects: bool = False,
+    hash_cache_dir: Optional[str] = None,
+    max_workers: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Finds the clusters of duplicate (and near-duplicate) images.
+
+    Images with the same fingerprint are candidates. Candidates with the same
+    (decoded) content hash are ``identical``, and candidates (with the same
+    b-values) whose sampled volumes are correlated (above the threshold) are
+    ``near`` duplicates. The image that is kept for each cluster is the first
+    by run number (then path).
+
+    Usage example:
+        >>> clusters = find_duplicates(glob.glob("rawdata/sub-*/ses-*/dwi/*_dwi.nii.gz"))
+        >>> clusters[0]["Keep"], [d["Path"] for d in clusters[0]["Duplicates"]]
+        ("abspath/to/rawdata/sub-001/ses-001/dwi/sub-001_ses-001_run-01_dwi.nii.gz", ["abspath/to/rawdata/sub-001/ses-001/dwi/sub-001_ses-001_run-02_dwi.nii.gz"])
+
+    Args:
+        imgs: Input BIDS images.
+        threshold: Minimum correlation of the sampled volumes of near-duplicates. Defaults to 0.999.
+        n_samples: Number of (evenly spaced) volumes that are sampled. Defaults to 3.
+        across_subjects: Also compare the images of different subjects (and sessions). Defaults to False.
+        hash_cache_dir: Directory of the on-disk hash cache (see ``dwi_preproc.utils.hashing.content_hash``). Defaults to None.
+        max_workers: Number of hashing threads. Defaults to None.
+
+    Returns:
+        List of clusters (``Keep``, ``Duplicates`` (``Path``, ``Match``, and ``Correlation``), and ``Fingerprint``).
+    """
+    imgs: List[str] = sorted(set(os.path.abspath(i) for i in imgs))
+    fps: Dict[str, Dict[str, Any]] = {i: fingerprint(i) for i in imgs}
+
+    groups: Dict[str, List[str]] = {}
+    for img, fp in fps.items():
+        key: Dict[str, Any] = {k: v for k, v in fp.items() if not across_subjects or k not in ("Subject", "Session")}
+        groups.setdefault(json.dumps(key, sort_keys=True), []).append(img)
+
+    candidates: List[List[str]] = [g for g in groups.values() if len(g) > 1]
+    hashes: Dict[str, str] = hash_files([i for g in candidates for i in g], cache_dir=hash_cache_dir, max_workers=max_workers)
+
+    clusters: List[Dict[str, Any]] = []
+
+    for group in candidates:
+        parent: Dict[str, str] = {i: i for i in group}
+
+        # Identical (decoded) content
+        by_hash: Dict[str, List[str]] = {}
+        for img in group:
+            by_hash.setdefault(hashes[img], []).append(img)
+
+        for same in by_hash.values():
+            for img in same[1:]:
+                _union(parent, same[0], img)
+
+        # Near-duplicates: the (distinct) representatives of each hash are compared
+        reps: List[str] = [same[0] for same in by_hash.values()]
+        rep_of: Dict[str, str] = {img: same[0] for same in by_hash.values() for img in same}
+        samples: Dict[str, np.ndarray] = {}
+        corr: Dict[Tuple[str, str], float] = {}
+
+        def _corr(a: str, b: str) -> float:
+            """Correlation of the sampled volumes of two (representative) images."""
+            for img in (a, b):
+                if img not in samples:
+                    samples[img] = _sample(img, n_samples=n_samples)
+            if (a, b) not in corr:
+                corr[(a, b)] = corr[(b, a)] = _correlation(samples[a], samples[b])
+            return corr[(a, b)]
+
+        for n, a in enumerate(reps):
+            for b in reps[n + 1:]:
+                if _find(parent, a) == _find(parent, b) or not _same_bvals(a, b):
+                    continue
+                if _corr(a, b) >= threshold:
+                    _union(parent, a, b)
+
+        members: Dict[str, List[str]] = {}
+        for img in group:
+            members.setdefault(_find(parent, img), []).append(img)
+
+        for imgs_ in members.values():
+            if len(imgs_) < 2:
+                continue
+            imgs_: List[str] = sorted(imgs_, key=_run_order)
+            keep: str = imgs_[0]
+            clusters.append({
+                "Keep": keep,
+                "Duplicates": [
+                    {
+                        "Path": img,
+                        "Match": "identical" if hashes[img] == hashes[keep] else "near",
+                        "Correlation": 1.0 if hashes[img] == hashes[keep] else round(_corr(rep_of[keep], rep_of[img]), 6),
+                    }
+                    for img in imgs_[1:]
+                ],
+                "Fingerprint": fps[keep],
+            })
+
+    return sorted(clusters, key=lambda c: c["Keep"])
+
+
+def find_dwis(bids_dir: str) -> List[str]:
+    """Finds the DWIs (``sub-<sub>[/ses-<ses>]/dwi/*_dwi.nii[.gz]``) of a BIDS dataset.
+
+    Args:
+        bids_dir: BIDS (raw data) directory.
+
+    Returns:
+        List of DWIs.
+    """
+    imgs: List[str] = []
+    for pattern in ("sub-*/ses-*/dwi/*_dwi.nii*", "sub-*/dwi/*_dwi.nii*"):
+        imgs.extend(glob.glob(os.path.join(bids_dir, pattern)))
+    return sorted(os.path.abspath(i) for i in imgs)
+
+
+def dedup_dataset(
+    bids_dir: str,
+    out: Union[file, str],
+    skip_list: Optional[Union[file, str]] = None,
+    **kwargs: Any,
+) -> Tuple[file, Union[file, None]]:
+    """Finds the duplicate DWIs of a BIDS dataset, and writes the report (and the list of redundant runs).
+
+    The list of redundant runs contains the (absolute) path of each duplicate
+    (one per line), so that batch submissions can skip them.
+
+    Usage example:
+        >>> report, skip = dedup_dataset("rawdata", "rawdata/code/duplicates.json", skip_list="rawdata/code/duplicates.skip.txt")
+
+    Args:
+        bids_dir: BIDS (raw data) directory.
+        out: Output JSON report.
+        skip_list: Output list of redundant runs. Defaults to None.
+        **kwargs: Keyword arguments of ``find_duplicates``.
+
+    Returns:
+        * Output JSON report.
+        * Output list of redundant runs (if any).
+    """
+    imgs: List[str] = find_dwis(bids_dir)
+    clusters: List[Dict[str, Any]] = find_duplicates(imgs, **kwargs)
+
+    report: Dict[str, Any] = {
+        "BIDSDir": os.path.abspath(bids_dir),
+        "Images": len(imgs),
+        "Clusters": clusters,
+        "Redundant": sum(len(c["Duplicates"]) for c in clusters),
+    }
+
+    out: str = os.path.abspath(out)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=4)
+
+    if skip_list:
+        skip_list: str = os.path.abspath(skip_list)
+        with open(skip_list, "w") as f:
+            for c in clusters:
+                for d in c["Duplicates"]:
+                    f.write(d["Path"] + "\n")
+
+    return out, skip_list
+
+
+def _sample(img: str, n_samples: int = 3) -> np.ndarray:
+    """Reads (evenly spaced) sampled volumes of an image (streamed, one volume at a time)."""
+    nii: nib.Nifti1Image = nib.load(img)
+    n_vols: int = nii.shape[3] if len(nii.shape) > 3 else 1
+    idx: np.ndarray = np.unique(np.linspace(0, n_vols - 1, max(int(n_samples), 1)).round().astype(int))
+    return np.stack(list(iter_volumes(img, idx=idx)), axis=-1)
+
+
+def _correlation(a: np.ndarray, b: np.ndarray) -> float:
+    """Minimum (Pearson) correlation of the sampled volumes of two images (within their non-zero voxels)."""
+    if a.shape != b.shape:
+        return 0.0
+
+    r: List[float] = []
+    for i in range(a.shape[-1]):
+        x, y = a[..., i].ravel(), b[..., i].ravel()
+        keep: np.ndarray = (x != 0) | (y != 0)
+        x, y = x[keep].astype(np.float64), y[keep].astype(np.float64)
+        if len(x) < 2 or x.std() == 0 or y.std() == 0:
+            r.append(1.0 if np.array_equal(x, y) else 0.0)
+        else:
+            r.append(float(np.corrcoef(x, y)[0, 1]))
+
+    return min(r)
+
+
+def _same_bvals(a: str, b: str) -> bool:
+    """Checks if the b-values of two DWIs (if any) are the same."""
+    bvals: List[Union[np.ndarray, None]] = []
+    for img in (a, b):
+        bval: str = NiiFile(src=img).rm_ext() + ".bval"
+        bvals.append(np.loadtxt(bval, ndmin=1) if os.path.exists(bval) else None)
+
+    if bvals[0] is None or bvals[1] is None:
+        return bvals[0] is None and bvals[1] is None
+
+    return bvals[0].shape == bvals[1].shape and bool(np.allclose(bvals[0], bvals[1], atol=5))
+
+
+def _run_order(img: str) -> Tuple[int, str]:
+    """Sort key of images: run number, then path."""
+    run: Union[str, None] = BIDSInfo(img).run
+    return (int(run) if run and run.isdigit() else 0, img)
+
+
+def _seconds(t: Any) -> Optional[int]:
+    """Converts an acquisition time (``HH:MM:SS[.ffffff]``) to (rounded) seconds."""
+    if not isinstance(t, str) or t.count(":") != 2:
+        return None
+    try:
+        h, m, s = t.split(":")
+        return int(round(int(h) * 3600 + int(m) * 60 + float(s)))
+    except ValueError:
+        return None
+
+
+def _find(parent: Dict[str, str], i: str) -> str:
+    """Finds the root of a (union-find) set."""
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def _union(parent: Dict[str, str], a: str, b: str) -> None:
+    """Merges the (union-find) sets of two elements."""
+    parent[_find(parent, b)] = _find(parent, a)
+    return None
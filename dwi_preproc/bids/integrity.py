@@ -0,0 +1,345 @@
+"""Integrity validation of the (DWI) series of a BIDS dataset, before any processing.
+
+Truncated (or corrupt) files, e.g. from interrupted transfers, are otherwise
+only detected once some (long) stage fails. Each series (image, and its
+``.bval``, ``.bvec`` and ``.json`` sidecars) is checked for:
+    * The integrity of the image: the gzip stream is read to its end, so that
+      its CRC and length are verified, and the (decompressed) size must hold
+      the voxel data described by the header.
+    * The consistency of the b-table: the number of b-values, b-vectors and
+      volumes must be the same.
+    * The JSON sidecar must be parseable.
+
+Verdicts are cached on disk (see ``dwi_preproc.utils.statcache``), keyed on
+the (device, inode, size, modification time) of each file of the series, so
+that only new (or changed) files are read.
+"""
+import os
+import glob
+import gzip
+import json
+import zlib
+import numpy as np
+import nibabel as nib
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.diffusion.dwi.btable import read_bvals, read_bvecs
+from dwi_preproc.utils.niio import NiiFile, image
+from dwi_preproc.utils.statcache import read_stat_cache, stat_cache_dir, stat_key, write_stat_cache
+from dwi_preproc.utils.util import available_cores
+
+# Read (decompressed) images in 1 MB chunks
+_CHUNK_SIZE: int = 1024 ** 2
+
+# Version of the checks (part of the cache keys, so that verdicts of older checks are not used)
+_CHECKS_VERSION: str = "dwi_preproc:integrity:v1"
+
+# Sidecar files of a series: role -> extension
+_SIDECARS: Dict[str, str] = {"bval": ".bval", "bvec": ".bvec", "json": ".json"}
+
+
+def check_image(img: Union[image, str]) -> Tuple[List[str], Union[int, None]]:
+    """Checks the integrity of a NIFTI image, by reading all of its (compressed) data in a streamed manner (bounded memory).
+
+    Compressed images are decompressed to the end of the gzip stream, so that
+    its CRC and (uncompressed) length are verified. The (decompressed) size
+    must at least be the voxel offset plus the size of the voxel data
+    described by the header.
+
+    Args:
+        img: Input NIFTI image.
+
+    Returns:
+        * List of errors (empty if the image is valid).
+        * Number of volumes (``None`` if the header can not be read).
+    """
+    img: str = str(img)
+
+    try:
+        nii: nib.Nifti1Image = nib.load(img)
+    except Exception as error:
+        return [f"Invalid NIFTI header: {error}"], None
+
+    shape: Tuple[int, ...] = nii.shape
+    n_vols: int = int(shape[3]) if len(shape) > 3 else 1
+
+    if not shape or min(shape) < 1:
+        return [f"Invalid image dimensions: {shape}"], n_vols
+
+    expected: int = int(nii.dataobj.offset) + int(np.prod(shape)) * nii.header.get_data_dtype().itemsize
+
+    if not img.endswith(".gz"):
+        size: int = os.path.getsize(img)
+        if size < expected:
+            return [f"Truncated image data ({expected - size} bytes missing)"], n_vols
+        return [], n_vols
+
+    size: int = 0
+    buf: bytearray = bytearray(_CHUNK_SIZE)
+
+    try:
+        with gzip.open(img, "rb") as f:
+            while True:
+                n: int = f.readinto(buf)
+                if not n:
+                    break
+                size += n
+    except EOFError:
+        return [f"Truncated gzip stream (ended before its end-of-stream marker, {expected} bytes expected)"], n_vols
+    except (gzip.BadGzipFile, zlib.error) as error:
+        return [f"Corrupt gzip stream: {error}"], n_vols
+
+    if size < expected:
+        return [f"Truncated image data ({expected - size} bytes missing)"], n_vols
+
+    return [], n_vols
+
+
+def check_btable(bval: Union[file, str], bvec: Union[file, str], n_vols: Optional[int] = None) -> List[str]:
+    """Checks the consistency of a b-table (and the number of volumes of its DWI).
+
+    Args:
+        bval: Input b-value file.
+        bvec: Input b-vector file.
+        n_vols: Number of volumes of the DWI. Defaults to None (not checked).
+
+    Returns:
+        List of errors (empty if the b-table is consistent).
+    """
+    errors: List[str] = []
+    bvals: Union[np.ndarray, None] = None
+    bvecs: Union[np.ndarray, None] = None
+
+    try:
+        bvals: np.ndarray = read_bvals(bval)
+        if not np.all(np.isfinite(bvals)) or np.any(bvals < 0):
+            errors.append(f"Invalid b-values (negative, or not finite): {bval}")
+    except (ValueError, OSError) as error:
+        errors.append(f"Unreadable b-value file: {error}")
+
+    try:
+        bvecs: np.ndarray = read_bvecs(bvec)
+        if bvecs.shape[0] != 3:
+            errors.append(f"b-vectors are not a 3 x N matrix ({bvecs.shape[0]} x {bvecs.shape[1]}): {bvec}")
+        elif not np.all(np.isfinite(bvecs)):
+            errors.append(f"Invalid b-vectors (not finite): {bvec}")
+    except (ValueError, OSError) as error:
+        errors.append(f"Unreadable b-vector file: {error}")
+
+    if bvals is not None and bvecs is not None and len(bvals) != bvecs.shape[-1]:
+        errors.append(f"Number of b-values ({len(bvals)}) and b-vectors ({bvecs.shape[-1]}) differ")
+
+    if n_vols is not None:
+        if bvals is not None and len(bvals) != n_vols:
+            errors.append(f"Number of b-values ({len(bvals)}) and volumes ({n_vols}) differ")
+        if bvecs is not None and bvecs.shape[-1] != n_vols:
+            errors.append(f"Number of b-vectors ({bvecs.shape[-1]}) and volumes ({n_vols}) differ")
+
+    return errors
+
+
+def check_json(src: Union[file, str]) -> List[str]:
+    """Checks that a JSON (sidecar) file is parseable (as a JSON object).
+
+    Args:
+        src: Input JSON file.
+
+    Returns:
+        List of errors (empty if the JSON file is valid).
+    """
+    try:
+        with open(src) as f:
+            data: Any = json.load(f)
+    except (json.JSONDecodeError, UnicodeDecodeError, OSError) as error:
+        return [f"Unparseable JSON file: {error}"]
+
+    if not isinstance(data, dict):
+        return [f"JSON file is not an object: {src}"]
+
+    return []
+
+
+def validate_series(
+    img: Union[image, str],
+    bval: Optional[Union[file, str]] = None,
+    bvec: Optional[Union[file, str]] = None,
+    sidecar: Optional[Union[file, str]] = None,
+    cache_dir: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Validates a series (image, b-table and JSON sidecar), using the cached verdict of unchanged files.
+
+    Usage example:
+        >>> verdict = validate_series("sub-001_dwi.nii.gz", bval="sub-001_dwi.bval", bvec="sub-001_dwi.bvec", sidecar="sub-001_dwi.json")
+        >>> verdict["Valid"], verdict["Errors"]
+        (False, ["Truncated gzip stream (ended before its end-of-stream marker, 2097504 bytes expected)"])
+
+    Args:
+        img: Input NIFTI image.
+        bval: Input b-value file (checked with ``bvec``). Defaults to None.
+        bvec: Input b-vector file (checked with ``bval``). Defaults to None.
+        sidecar: Input JSON sidecar. Defaults to None.
+        cache_dir: Directory of the on-disk verdict cache. Defaults to None (``$DWI_PREPROC_CACHE/verdicts``, or ``~/.cache/dwi_preproc/verdicts``). An empty string disables it.
+
+    Returns:
+        Verdict (``Image``, ``Files``, ``Valid``, ``Errors``, and ``Cached``).
+    """
+    files: Dict[str, str] = {"img": os.path.abspath(img)}
+    for role, f in (("bval", bval), ("bvec", bvec), ("json", sidecar)):
+        if f:
+            files[role] = os.path.abspath(f)
+
+    verdict: Dict[str, Any] = {"Image": files["img"], "Files": files, "Valid": False, "Errors": [], "Cached": False}
+
+    missing: List[str] = [f for f in files.values() if not os.path.isfile(f)]
+    if missing:
+        verdict["Errors"] = [f"Missing file: {f}" for f in missing]
+        return verdict
+
+    cache_dir: str = stat_cache_dir("verdicts", cache_dir)
+    key: str = stat_key(files, tag=_CHECKS_VERSION)
+    cached: Any = read_stat_cache(key, cache_dir)
+
+    if isinstance(cached, dict) and isinstance(cached.get("Errors"), list):
+        verdict["Errors"] = cached["Errors"]
+        verdict["Valid"] = not verdict["Errors"]
+        verdict["Cached"] = True
+        return verdict
+
+    errors, n_vols = check_image(files["img"])
+
+    if "bval" in files and "bvec" in files:
+        errors.extend(check_btable(files["bval"], files["bvec"], n_vols=n_vols))
+
+    if "json" in files:
+        errors.extend(check_json(files["json"]))
+
+    verdict["Errors"] = errors
+    verdict["Valid"] = not errors
+
+    write_stat_cache(key, {"Files": files, "Errors": errors}, cache_dir)
+
+    return verdict
+
+
+def find_series(bids_dir: str) -> List[Tuple[str, Union[str, None], Union[str, None], Union[str, None]]]:
+    """Finds the series (images, and their ``.bval``, ``.bvec`` and ``.json`` sidecars, if any) of a BIDS dataset.
+
+    Args:
+        bids_dir: BIDS (raw data) directory.
+
+    Returns:
+        List of series (image, b-value file, b-vector file, and JSON sidecar).
+    """
+    imgs: List[str] = []
+    for pattern in ("sub-*/ses-*/*/*.nii*", "sub-*/*/*.nii*"):
+        imgs.extend(glob.glob(os.path.join(bids_dir, pattern)))
+
+    series: List[Tuple[str, Union[str, None], Union[str, None], Union[str, None]]] = []
+    for img in sorted(set(os.path.abspath(i) for i in imgs if i.endswith((".nii", ".nii.gz")))):
+        name: str = NiiFile(src=img).rm_ext()
+        sidecars: List[Union[str, None]] = [name + ext if os.path.isfile(name + ext) else None for ext in _SIDECARS.values()]
+        series.append((img, *sidecars))
+
+    return series
+
+
+def validate_files(
+    series: Sequence[Tuple[str, Optional[str], Optional[str], Optional[str]]],
+    cache_dir: Optional[str] = None,
+    max_workers: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Validates several series concurrently (see ``validate_series``).
+
+    Series are validated by a pool of threads (decompression releases the
+    GIL), largest images first, so that the slowest ones do not start last.
+
+    Args:
+        series: Input series (image, b-value file, b-vector file, and JSON sidecar).
+        cache_dir: Directory of the on-disk verdict cache (see ``validate_series``). Defaults to None.
+        max_workers: Number of threads. Defaults to None (number of allocated cores, up to 8).
+
+    Returns:
+        List of verdicts (in the order of the input series).
+    """
+    series: List[Tuple[str, Optional[str], Optional[str], Optional[str]]] = [tuple(s) + (None,) * (4 - len(s)) for s in series]
+    max_workers: int = max(int(max_workers or min(available_cores(), 8)), 1)
+
+    def _validate(s: Tuple[str, Optional[str], Optional[str], Optional[str]]) -> Dict[str, Any]:
+        return validate_series(s[0], bval=s[1], bvec=s[2], sidecar=s[3], cache_dir=cache_dir)
+
+    if len(series) <= 1 or max_workers == 1:
+        return [_validate(s) for s in series]
+
+    order: List[int] = sorted(range(len(series)), key=lambda i: -_size(series[i][0]))
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(series))) as pool:
+        verdicts: List[Dict[str, Any]] = list(pool.map(lambda i: _validate(series[i]), order))
+
+    out: List[Union[Dict[str, Any], None]] = [None] * len(series)
+    for i, verdict in zip(order, verdicts):
+        out[i] = verdict
+
+    return out
+
+
+def validate_dataset(
+    bids_dir: str,
+    out: Optional[Union[file, str]] = None,
+    invalid_list: Optional[Union[file, str]] = None,
+    cache_dir: Optional[str] = None,
+    max_workers: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Validates the series of a BIDS dataset, and writes the report (and the list of invalid images).
+
+    The list of invalid images contains the (absolute) path of each image
+    whose series is invalid (one per line), so that batch submissions can skip them.
+
+    Usage example:
+        >>> report = validate_dataset("rawdata", out="rawdata/code/validation.json", invalid_list="rawdata/code/invalid.txt")
+        >>> report["Invalid"]
+        1
+
+    Args:
+        bids_dir: BIDS (raw data) directory.
+        out: Output JSON report. Defaults to None.
+        invalid_list: Output list of invalid images. Defaults to None.
+        cache_dir: Directory of the on-disk verdict cache (see ``validate_series``). Defaults to None.
+        max_workers: Number of threads. Defaults to None.
+
+    Returns:
+        Report (``BIDSDir``, ``Series``, ``Checked``, ``Invalid``, and the ``Errors`` of each invalid image).
+    """
+    verdicts: List[Dict[str, Any]] = validate_files(find_series(bids_dir), cache_dir=cache_dir, max_workers=max_workers)
+
+    report: Dict[str, Any] = {
+        "BIDSDir": os.path.abspath(bids_dir),
+        "Series": len(verdicts),
+        "Checked": sum(not v["Cached"] for v in verdicts),
+        "Invalid": sum(not v["Valid"] for v in verdicts),
+        "Errors": {v["Image"]: v["Errors"] for v in verdicts if not v["Valid"]},
+    }
+
+    if out:
+        out: str = os.path.abspath(out)
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        with open(out, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if invalid_list:
+        with open(invalid_list, "w") as f:
+            for img in report["Errors"]:
+                f.write(img + "\n")
+
+    return report
+
+
+def _size(src: str) -> int:
+    """Size of a file (0 if it does not exist)."""
+    try:
+        return os.path.getsize(src)
+    except OSError:
+        return 0
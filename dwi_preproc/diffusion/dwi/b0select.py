@@ -0,0 +1,220 @@
+"""Ranks and selects the most consistent b0 volumes for use with ``FSL``'s ``topup``.
+"""
+import os
+import numpy as np
+import nibabel as nib
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.diffusion.dwi.btable import b0_indices, read_bvals
+from dwi_preproc.utils.niio import NiiFile, image, intermediate_path, iter_volumes, save_image
+from dwi_preproc.utils.util import update_json
+
+
+def load_volumes(img: Union[image, str], idx: np.ndarray) -> np.ndarray:
+    """Streams a subset of volumes from a 4D NIFTI image.
+
+    Volumes are read one at a time (in ascending order) so that only the
+    requested volumes are held in memory.
+
+    Args:
+        img: Input 4D NIFTI image.
+        idx: Volume indices to read (unique, in ascending order; see ``iter_volumes``).
+
+    Returns:
+        Numpy array of shape (n volumes, x, y, z).
+    """
+    return np.stack(list(iter_volumes(img, idx=idx)), axis=0)
+
+
+def b0_scores(vols: np.ndarray, frac: float = 0.1) -> Tuple[np.ndarray, np.ndarray]:
+    """Computes consistency scores for a stack of b0 volumes.
+
+    Two scores are computed over the (rough) foreground of the mean b0:
+        * The mean pairwise (Pearson) correlation of each volume with all other volumes.
+        * The robust z-score of the mean foreground intensity of each volume.
+
+    Args:
+        vols: Numpy array of shape (n volumes, x, y, z).
+        frac: Fraction of the (99th percentile) mean b0 intensity used to define the foreground. Defaults to 0.1.
+
+    Returns:
+        * Mean pairwise correlation for each volume.
+        * Robust intensity z-score for each volume.
+    """
+    n: int = vols.shape[0]
+    mean: np.ndarray = vols.mean(axis=0)
+    mask: np.ndarray = mean > frac * np.percentile(mean, 99)
+
+    x: np.ndarray = vols[:, mask].astype(np.float64)
+    intensity: np.ndarray = x.mean(axis=1)
+
+    if n < 2:
+        return np.ones(n), np.zeros(n)
+
+    x -= intensity[:, np.newaxis]
+    x /= np.linalg.norm(x, axis=1, keepdims=True) + np.finfo(float).eps
+    corr: np.ndarray = (x @ x.T).sum(axis=1) - 1
+    corr /= n - 1
+
+    return corr, _robust_z(intensity, min_scale=0.01 * np.median(intensity))
+
+
+def select_b0s(
+    imgs: List[Union[image, str]],
+    bvals: List[Optional[Union[file, str]]],
+    out: Union[image, str],
+    acqp: Optional[Union[file, str]] = None,
+    max_vols: int = 3,
+    n_std: float = 3.0,
+    average: bool = True,
+    b0_thresh: float = 50,
+    qc_json: Optional[Union[file, str]] = None,
+) -> Tuple[image, Union[file, None]]:
+    """Selects the most consistent subset of b0s for each phase-encode direction to build a compact ``topup`` input.
+
+    Each input image corresponds to one phase-encode direction (e.g. the DWI and
+    the rPE B0). The b0s are located using the b-values (wherever they occur in
+    the series) - images without a b-value file are assumed to only contain b0s.
+    Volumes whose correlation or intensity scores are outliers (beyond ``n_std``
+    robust standard deviations) are rejected, and the ``max_vols`` most correlated
+    of the remaining volumes are kept.
+
+    NOTE:
+        If ``average`` is True, the output has one (mean) volume per phase-encode direction,
+        which matches an acqp file with one row per direction. Otherwise, all selected volumes
+        are merged and, should ``acqp`` be provided, a matching ``topup`` datain file is written.
+
+    Usage example:
+        >>> b0s, datain = select_b0s(imgs=["dwi.nii.gz", "rPE_b0.nii.gz"],
+        ...                          bvals=["dwi.bval", None],
+        ...                          out="Topup/B0s.nii.gz",
+        ...                          qc_json="b0_selection.json")
+        ...
+
+    Args:
+        imgs: Input images, one per phase-encode direction.
+        bvals: Corresponding b-value files (or ``None``).
+        out: Output b0 image.
+        acqp: Acquisition parameter file (one row per input image). Defaults to None.
+        max_vols: Maximum number of b0s selected for each phase-encode direction. Defaults to 3.
+        n_std: Number of robust standard deviations for outlier rejection. Defaults to 3.0.
+        average: Average the selected b0s for each phase-encode direction. Defaults to True.
+        b0_thresh: b-values less than or equal to this value are considered to be b0s. Defaults to 50.
+        qc_json: Output JSON file to record the selection in. Defaults to None.
+
+    Raises:
+        IndexError: Exception that is raised if a different number of ``imgs`` and ``bvals`` are provided.
+        ValueError: Exception that is raised if the input images do not share the same image grid, or if an image has no b0s.
+
+    Returns:
+        * Output b0 image.
+        * ``topup`` datain file (if written), otherwise ``None``.
+    """
+    if len(imgs) != len(bvals):
+        raise IndexError("Inputs for 'imgs' and 'bvals' are of different lengths.")
+
+    ref: Union[nib.Nifti1Image, None] = None
+    stack: List[np.ndarray] = []
+    counts: List[int] = []
+    qc: Dict[str, Any] = {}
+
+    for n, (img, bval) in enumerate(zip(imgs, bvals)):
+        with NiiFile(src=img, assert_exists=True) as nii:
+            img: image = nii.abspath()
+
+        hdr: nib.Nifti1Image = nib.load(img)
+        if ref is None:
+            ref: nib.Nifti1Image = hdr
+        elif hdr.shape[:3] != ref.shape[:3]:
+            raise ValueError(
+                f"The image {img} does not share the same image grid as {ref.get_filename()}."
+            )
+
+        if bval is not None:
+            idx: np.ndarray = b0_indices(read_bvals(bval), b0_thresh=b0_thresh)
+            if len(idx) == 0:
+                raise ValueError(f"The image {img} has no b0s (b-values less than or equal to {b0_thresh}) in {bval}.")
+        else:
+            idx: np.ndarray = np.arange(hdr.shape[3] if len(hdr.shape) > 3 else 1)
+
+        vols: np.ndarray = load_volumes(img, idx)
+        corr, z = b0_scores(vols)
+        keep: np.ndarray = _select(corr=corr, z=z, max_vols=max_vols, n_std=n_std)
+
+        if average:
+            stack.append(vols[keep].mean(axis=0, keepdims=True))
+            counts.append(1)
+        else:
+            stack.append(vols[keep])
+            counts.append(len(keep))
+
+        qc[f"Direction{n + 1}"] = {
+            "Image": img,
+            "Volumes": idx.tolist(),
+            "Correlation": np.round(corr, 6).tolist(),
+            "IntensityZ": np.round(z, 6).tolist(),
+            "Selected": idx[keep].tolist(),
+        }
+
+    out: image = intermediate_path(out)
+    data: np.ndarray = np.moveaxis(np.concatenate(stack, axis=0), 0, -1)
+    nii: nib.Nifti1Image = nib.Nifti1Image(data, ref.affine, ref.header)
+    nii.set_data_dtype(np.float32)
+    out: image = save_image(nii, out)
+
+    datain: Union[file, None] = None
+    if acqp is not None and not average:
+        rows: np.ndarray = np.loadtxt(acqp, ndmin=2)
+        datain: str = os.path.join(os.path.dirname(os.path.abspath(out)), "topup_datain.txt")
+        np.savetxt(datain, np.repeat(rows[: len(counts)], counts, axis=0), fmt="%g")
+        datain: str = os.path.abspath(datain)
+
+    if qc_json is not None:
+        update_json(json_file=qc_json, dictionary={"B0Selection": qc})
+
+    return os.path.abspath(out), datain
+
+
+def _robust_z(x: np.ndarray, min_scale: float = 0.0) -> np.ndarray:
+    """Computes robust (median/MAD) z-scores.
+
+    Args:
+        x: 1-dimensional numpy array.
+        min_scale: Lower bound for the (scaled) MAD, so that near identical values are not reported as outliers. Defaults to 0.0.
+
+    Returns:
+        Robust z-scores (zeros if the scale is 0).
+    """
+    med: float = np.median(x)
+    mad: float = max(1.4826 * np.median(np.abs(x - med)), abs(min_scale))
+
+    if mad == 0:
+        return np.zeros_like(x, dtype=float)
+
+    return (x - med) / mad
+
+
+def _select(corr: np.ndarray, z: np.ndarray, max_vols: int = 3, n_std: float = 3.0) -> np.ndarray:
+    """Selects the most correlated non-outlier volumes.
+
+    Args:
+        corr: Mean pairwise correlation for each volume.
+        z: Robust intensity z-score for each volume.
+        max_vols: Maximum number of volumes to select. Defaults to 3.
+        n_std: Number of robust standard deviations for outlier rejection. Defaults to 3.0.
+
+    Returns:
+        Sorted indices of the selected volumes (at least one volume is always selected).
+    """
+    ok: np.ndarray = (np.abs(z) <= n_std) & (_robust_z(corr, min_scale=0.005) >= -n_std)
+
+    if not ok.any():
+        ok[np.argmax(corr)] = True
+
+    candidates: np.ndarray = np.flatnonzero(ok)
+    ranked: np.ndarray = candidates[np.argsort(-corr[candidates], kind="stable")]
+
+    return np.sort(ranked[: max(int(max_vols), 1)])
@@ -0,0 +1,271 @@
+"""Native brain masking of (mean) b0 images, used as a fast alternative to ``FSL``'s ``bet`` for the eddy mask.
+
+The mask is estimated with vectorized (``numpy``) operations only:
+    1. The image is smoothed (3 x 3 x 3 box filter), and thresholded (Otsu's threshold of the non-zero voxels).
+    2. A morphological opening (with the largest connected component kept
+       between the erosion and dilation) removes the (thin) connections to
+       non-brain tissue.
+    3. The holes of the mask are filled, and its surface is smoothed (closing).
+"""
+import os
+import numpy as np
+import nibabel as nib
+
+from typing import Any, Dict, Optional, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.utils.niio import NiiFile, image, iter_volumes, save_image
+from dwi_preproc.utils.util import update_json
+
+
+def estimate_mask(data: np.ndarray, thresh_scale: float = 1.0, n_erode: int = 2) -> np.ndarray:
+    """Estimates the brain mask of a (mean) b0 volume.
+
+    Args:
+        data: 3D (mean) b0 volume.
+        thresh_scale: Scale of the (Otsu) intensity threshold (larger values give smaller masks). Defaults to 1.0.
+        n_erode: Number of erosions (and dilations) of the morphological opening. Defaults to 2.
+
+    Raises:
+        ValueError: Exception that is raised if the volume is not 3D, or has no non-zero voxels.
+
+    Returns:
+        3D boolean numpy array of the brain mask.
+    """
+    if data.ndim != 3:
+        raise ValueError(f"Expected a 3D volume, got an array of shape {data.shape}.")
+
+    data: np.ndarray = np.nan_to_num(np.asarray(data, dtype=np.float32))
+    if not np.any(data > 0):
+        raise ValueError("The volume has no non-zero voxels.")
+
+    smooth: np.ndarray = _box_smooth(data)
+    msk: np.ndarray = smooth > thresh_scale * otsu_threshold(smooth[smooth > 0])
+
+    # Pad, so that morphological operations treat the outside of the volume as background
+    pad: int = int(n_erode) + 2
+    msk: np.ndarray = np.pad(msk, pad, mode="constant", constant_values=False)
+
+    opened: np.ndarray = _largest_component(_erode(msk, n_erode))
+    msk: np.ndarray = _dilate(opened, n_erode) & msk
+    msk: np.ndarray = _largest_component(msk)
+    msk: np.ndarray = _fill_holes(_erode(_dilate(_fill_holes(msk), 1), 1))
+
+    return msk[pad:-pad, pad:-pad, pad:-pad]
+
+
+def otsu_threshold(x: np.ndarray, bins: int = 256) -> float:
+    """Otsu's threshold (the threshold that maximizes the between-class variance) of some intensities.
+
+    The intensities are clipped to their 99.5th percentile, so that a few bright voxels do not compress the histogram.
+
+    Args:
+        x: Input intensities.
+        bins: Number of histogram bins. Defaults to 256.
+
+    Returns:
+        Threshold.
+    """
+    x: np.ndarray = np.asarray(x, dtype=np.float64).ravel()
+    x: np.ndarray = np.minimum(x, np.percentile(x, 99.5))
+
+    counts, edges = np.histogram(x, bins=bins)
+    centres: np.ndarray = (edges[:-1] + edges[1:]) / 2
+
+    w0: np.ndarray = np.cumsum(counts)
+    w1: np.ndarray = w0[-1] - w0
+    s0: np.ndarray = np.cumsum(counts * centres)
+    m0: np.ndarray = s0 / np.maximum(w0, 1)
+    m1: np.ndarray = (s0[-1] - s0) / np.maximum(w1, 1)
+
+    return float(centres[np.argmax(w0 * w1 * (m0 - m1) ** 2)])
+
+
+def dice(a: np.ndarray, b: np.ndarray) -> float:
+    """Dice coefficient (overlap) of two masks.
+
+    Args:
+        a: Boolean numpy array.
+        b: Boolean numpy array.
+
+    Returns:
+        Dice coefficient (1 for identical masks, 1 for two empty masks).
+    """
+    a, b = np.asarray(a, dtype=bool), np.asarray(b, dtype=bool)
+    total: int = int(a.sum() + b.sum())
+    return 2.0 * float(np.logical_and(a, b).sum()) / total if total else 1.0
+
+
+def mask_overlap(mask: Union[image, str], ref: Union[image, str]) -> Dict[str, Any]:
+    """Compares a brain mask to a reference mask (e.g. that of ``bet``).
+
+    Args:
+        mask: Input brain mask.
+        ref: Reference brain mask.
+
+    Raises:
+        ValueError: Exception that is raised if the masks do not share the same image grid.
+
+    Returns:
+        Dictionary of the overlap (``Dice``, ``Jaccard``) and volumes (in mL) of the masks.
+    """
+    a_nii: nib.Nifti1Image = nib.load(mask)
+    b_nii: nib.Nifti1Image = nib.load(ref)
+
+    if a_nii.shape[:3] != b_nii.shape[:3]:
+        raise ValueError(f"The masks do not share the same image grid: {a_nii.shape} != {b_nii.shape}")
+
+    a: np.ndarray = np.asarray(a_nii.dataobj) > 0
+    b: np.ndarray = np.asarray(b_nii.dataobj) > 0
+    voxel: float = float(np.prod(a_nii.header.get_zooms()[:3])) / 1000
+    union: int = int(np.logical_or(a, b).sum())
+
+    return {
+        "Mask": os.path.abspath(mask),
+        "Reference": os.path.abspath(ref),
+        "Dice": round(dice(a, b), 4),
+        "Jaccard": round(float(np.logical_and(a, b).sum()) / union if union else 1.0, 4),
+        "VolumeMask": round(float(a.sum()) * voxel, 2),
+        "VolumeReference": round(float(b.sum()) * voxel, 2),
+    }
+
+
+def brain_mask(
+    img: Union[image, str],
+    out: Union[image, str],
+    thresh_scale: float = 1.0,
+    n_erode: int = 2,
+    ref: Optional[Union[image, str]] = None,
+    overlap: Optional[Union[file, str]] = None,
+) -> Tuple[image, image]:
+    """Estimates the brain mask of a (mean) b0 image, and writes the brain extracted image and the mask (``bet`` naming).
+
+    The volumes of 4D images are averaged (streamed, one volume at a time).
+
+    Usage example:
+        >>> brain, mask = brain_mask(img="N4/mean_B0s_PA_n4.nii.gz",
+        ...                          out="Eddy/sub-001_hifi_brain",
+        ...                          ref="Eddy/MaskCheck/sub-001_bet_brain_mask.nii.gz",
+        ...                          overlap="dwi.misc/brain_mask_overlap.json")
+        ...
+
+    Args:
+        img: Input (mean) b0 image.
+        out: Output brain extracted image (the mask is written to ``<out>_mask``).
+        thresh_scale: Scale of the (Otsu) intensity threshold (larger values give smaller masks). Defaults to 1.0.
+        n_erode: Number of erosions (and dilations) of the morphological opening. Defaults to 2.
+        ref: Reference brain mask (e.g. that of ``bet``) to compare the mask to. Defaults to None.
+        overlap: Output JSON file to record the overlap with the reference mask in. Defaults to None.
+
+    Returns:
+        * Brain extracted image.
+        * Brain mask.
+    """
+    with NiiFile(src=img, assert_exists=True) as nii:
+        img: image = nii.abspath()
+
+    ref_nii: nib.Nifti1Image = nib.load(img)
+
+    mean: Union[np.ndarray, None] = None
+    n: int = 0
+    for vol in iter_volumes(img):
+        mean: np.ndarray = vol if mean is None else mean + vol
+        n += 1
+    mean: np.ndarray = mean / n
+
+    msk: np.ndarray = estimate_mask(mean, thresh_scale=thresh_scale, n_erode=n_erode)
+
+    name: str = NiiFile(src=out).rm_ext()
+    hdr: nib.Nifti1Header = ref_nii.header.copy()
+
+    brain_nii: nib.Nifti1Image = nib.Nifti1Image((mean * msk).astype(np.float32), ref_nii.affine, hdr)
+    brain_nii.set_data_dtype(np.float32)
+    out_brain: image = save_image(brain_nii, f"{name}.nii.gz", quantize=False)
+
+    mask_nii: nib.Nifti1Image = nib.Nifti1Image(msk.astype(np.uint8), ref_nii.affine, hdr)
+    mask_nii.set_data_dtype(np.uint8)
+    out_mask: image = save_image(mask_nii, f"{name}_mask.nii.gz", quantize=False)
+
+    if ref:
+        result: Dict[str, Any] = mask_overlap(out_mask, ref)
+        if overlap:
+            update_json(overlap, result)
+
+    return out_brain, out_mask
+
+
+def _box_smooth(data: np.ndarray) -> np.ndarray:
+    """Smooths a volume with a (separable) 3 x 3 x 3 box filter (edges are replicated)."""
+    out: np.ndarray = data
+    for axis in range(3):
+        p: np.ndarray = np.pad(out, [(1, 1) if a == axis else (0, 0) for a in range(3)], mode="edge")
+        n: int = p.shape[axis]
+        out: np.ndarray = (p.take(range(0, n - 2), axis=axis) + p.take(range(1, n - 1), axis=axis) + p.take(range(2, n), axis=axis)) / 3
+    return out
+
+
+def _dilate(msk: np.ndarray, n: int = 1) -> np.ndarray:
+    """Binary dilation (6-connected structuring element), repeated ``n`` times."""
+    out: np.ndarray = msk.copy()
+    for _ in range(int(n)):
+        src: np.ndarray = out.copy()
+        out[1:] |= src[:-1]
+        out[:-1] |= src[1:]
+        out[:, 1:] |= src[:, :-1]
+        out[:, :-1] |= src[:, 1:]
+        out[:, :, 1:] |= src[:, :, :-1]
+        out[:, :, :-1] |= src[:, :, 1:]
+    return out
+
+
+def _erode(msk: np.ndarray, n: int = 1) -> np.ndarray:
+    """Binary erosion (6-connected structuring element), repeated ``n`` times."""
+    return ~_dilate(~msk, n)
+
+
+def _label(msk: np.ndarray) -> np.ndarray:
+    """Labels the (6-connected) components of a mask.
+
+    Each voxel is labelled by the largest (flat) index of its component: the
+    labels are propagated to the neighbours (maximum), and shortcut by pointer
+    jumping (the label of a voxel is replaced by the label of its label), until
+    they converge. Background voxels are labelled -1.
+    """
+    lab: np.ndarray = np.where(msk, np.arange(msk.size, dtype=np.int64).reshape(msk.shape), -1)
+    flat_msk: np.ndarray = msk.ravel()
+
+    while True:
+        new: np.ndarray = lab.copy()
+        np.maximum(new[1:], lab[:-1], out=new[1:])
+        np.maximum(new[:-1], lab[1:], out=new[:-1])
+        np.maximum(new[:, 1:], lab[:, :-1], out=new[:, 1:])
+        np.maximum(new[:, :-1], lab[:, 1:], out=new[:, :-1])
+        np.maximum(new[:, :, 1:], lab[:, :, :-1], out=new[:, :, 1:])
+        np.maximum(new[:, :, :-1], lab[:, :, 1:], out=new[:, :, :-1])
+        new[~msk] = -1
+
+        flat: np.ndarray = new.ravel()
+        flat[flat_msk] = flat[flat[flat_msk]]
+
+        if np.array_equal(new, lab):
+            return lab
+        lab: np.ndarray = new
+
+
+def _largest_component(msk: np.ndarray) -> np.ndarray:
+    """Keeps the largest (6-connected) component of a mask."""
+    if not msk.any():
+        return msk
+    lab: np.ndarray = _label(msk)
+    labels, counts = np.unique(lab[msk], return_counts=True)
+    return lab == labels[np.argmax(counts)]
+
+
+def _fill_holes(msk: np.ndarray) -> np.ndarray:
+    """Fills the holes of a mask (background components that do not touch the border of the volume)."""
+    bg: np.ndarray = _label(~msk)
+    border: np.ndarray = np.unique(np.concatenate([
+        bg[[0, -1]].ravel(), bg[:, [0, -1]].ravel(), bg[:, :, [0, -1]].ravel()
+    ]))
+    return msk | ~np.isin(bg, border)
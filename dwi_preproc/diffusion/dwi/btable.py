@@ -0,0 +1,107 @@
+"""Reads, and writes diffusion b-tables (``FSL`` formatted bval and bvec files).
+"""
+import os
+import numpy as np
+
+from typing import Dict, Union
+
+from commandio.fileio import file
+
+
+def read_bvals(bval: Union[file, str]) -> np.ndarray:
+    """Reads an ``FSL`` formatted b-value file.
+
+    Args:
+        bval: Input b-value file.
+
+    Returns:
+        1-dimensional numpy array of b-values.
+    """
+    bval: str = os.path.abspath(bval)
+    return np.loadtxt(bval, ndmin=1).ravel()
+
+
+def read_bvecs(bvec: Union[file, str]) -> np.ndarray:
+    """Reads an ``FSL`` formatted b-vector file.
+
+    NOTE:
+        b-vector files stored as N x 3 matrices are transposed.
+
+    Args:
+        bvec: Input b-vector file.
+
+    Returns:
+        3 x N numpy array of b-vectors.
+    """
+    bvec: str = os.path.abspath(bvec)
+    bvecs: np.ndarray = np.loadtxt(bvec, ndmin=2)
+
+    if bvecs.shape[0] != 3 and bvecs.shape[1] == 3:
+        bvecs: np.ndarray = bvecs.T
+
+    return bvecs
+
+
+def write_bvals(bvals: np.ndarray, out_file: Union[file, str]) -> str:
+    """Writes an ``FSL`` formatted b-value file (single row).
+
+    Args:
+        bvals: 1-dimensional numpy array of b-values.
+        out_file: Output b-value file.
+
+    Returns:
+        Output b-value file.
+    """
+    np.savetxt(out_file, np.asarray(bvals).reshape(1, -1), fmt="%g")
+    return os.path.abspath(out_file)
+
+
+def write_bvecs(bvecs: np.ndarray, out_file: Union[file, str]) -> str:
+    """Writes an ``FSL`` formatted b-vector file (3 x N).
+
+    Args:
+        bvecs: 3 x N numpy array of b-vectors.
+        out_file: Output b-vector file.
+
+    Returns:
+        Output b-vector file.
+    """
+    np.savetxt(out_file, np.asarray(bvecs).reshape(3, -1), fmt="%.10g")
+    return os.path.abspath(out_file)
+
+
+def b0_indices(bvals: np.ndarray, b0_thresh: float = 50) -> np.ndarray:
+    """Finds the (volume) indices of the b0s, wherever they occur in the series.
+
+    Args:
+        bvals: 1-dimensional numpy array of b-values.
+        b0_thresh: b-values less than or equal to this value are considered to be b0s. Defaults to 50.
+
+    Returns:
+        1-dimensional numpy array of b0 volume indices.
+    """
+    return np.flatnonzero(np.asarray(bvals) <= b0_thresh)
+
+
+def shells(bvals: np.ndarray, b0_thresh: float = 50, tol: float = 100) -> Dict[int, np.ndarray]:
+    """Groups volumes by (rounded) b-value shell.
+
+    Usage example:
+        >>> shells(np.array([0, 995, 1000, 2005, 5]))
+        {0: array([0, 4]), 1000: array([1, 2]), 2000: array([3])}
+
+    Args:
+        bvals: 1-dimensional numpy array of b-values.
+        b0_thresh: b-values less than or equal to this value are considered to be b0s. Defaults to 50.
+        tol: b-values are rounded to the nearest multiple of this value. Defaults to 100.
+
+    Returns:
+        Dictionary that maps each shell to its volume indices.
+    """
+    bvals: np.ndarray = np.asarray(bvals, dtype=float)
+    rounded: np.ndarray = (np.round(bvals / tol) * tol).astype(int)
+    rounded[bvals <= b0_thresh] = 0
+
+    return {
+        int(b): np.flatnonzero(rounded == b) for b in np.unique(rounded)
+    }
@@ -0,0 +1,275 @@
+"""Marchenko-Pastur principal component analysis (MP-PCA) denoising of diffusion weighted images.
+
+NOTE:
+    Reference: Veraart, J., Novikov, D.S., Christiaens, D., Ades-aron, B., Sijbers, J., & Fieremans, E. (2016). Denoising of diffusion MRI using random matrix theory. NeuroImage, 142, 394-406.
+"""
+import os
+import numpy as np
+import nibabel as nib
+
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Dict, Optional, Tuple, Union
+
+from commandio.workdir import WorkDir
+
+from dwi_preproc.utils.niio import NiiFile, image, save_image
+from dwi_preproc.utils.shmstore import SharedRef, SharedVolumeStore, attach
+
+
+def mppca(
+    dwi: Union[image, str],
+    outdir: str,
+    mask: Optional[Union[image, str]] = None,
+    extent: Optional[int] = None,
+    n_procs: Optional[int] = None,
+    mem_limit: int = 2048,
+) -> Tuple[image, image]:
+    """Denoises a DWI using MP-PCA.
+
+    The (spatially padded) image is split into overlapping slabs along the
+    z-axis, which are processed in a process pool. Within each slab, the
+    sliding 3D patches are denoised in batches of eigen-decompositions, and the
+    denoised signal of the patch centre voxel is kept.
+
+    NOTE:
+        * The padded image is published to shared memory once, and the worker processes read their slabs from it (rather than each slab being copied to the workers).
+        * The memory limit bounds the size of the slabs and the patch batches across all worker processes (the input image is held in memory by the parent process).
+        * Voxels outside of the mask (if provided) are left unchanged, and have a noise level of 0.
+
+    Usage example:
+        >>> dwi, sigma = mppca(dwi="dwi.nii.gz",
+        ...                    outdir="Denoise",
+        ...                    n_procs=4,
+        ...                    mem_limit=2048)
+        ...
+
+    Args:
+        dwi: Input DWI.
+        outdir: Output directory.
+        mask: Brain mask. Defaults to None.
+        extent: Patch size (odd). Defaults to None (the smallest odd patch size with at least as many voxels as volumes, and no less than 5).
+        n_procs: Number of worker processes. Defaults to None (number of CPUs).
+        mem_limit: Memory limit (in MB) for the slabs and patch batches. Defaults to 2048.
+
+    Raises:
+        ValueError: Exception that is raised if the patch size is not odd, or if the mask does not share the image grid of the DWI.
+
+    Returns:
+        * Denoised DWI.
+        * Noise level (sigma) map.
+    """
+    with NiiFile(src=dwi, assert_exists=True, validate_nifti=True) as n:
+        with WorkDir(src=outdir) as _:
+            dwi: image = n.abspath()
+            _, basename, _ = n.file_parts()
+
+    nii: nib.Nifti1Image = nib.load(dwi)
+    data: np.ndarray = np.asarray(nii.dataobj, dtype=np.float32)
+    nvols: int = data.shape[3]
+
+    if extent is None:
+        extent: int = 5
+        while extent ** 3 < nvols:
+            extent += 2
+
+    if extent % 2 == 0:
+        raise ValueError(f"The patch size ({extent}) must be odd.")
+
+    if mask is not None:
+        msk: np.ndarray = np.asarray(nib.load(mask).dataobj) > 0
+        if msk.shape != data.shape[:3]:
+            raise ValueError(f"The mask {mask} does not share the same image grid as {dwi}.")
+    else:
+        msk: np.ndarray = np.ones(data.shape[:3], dtype=bool)
+
+    n_procs: int = max(int(n_procs or os.cpu_count() or 1), 1)
+    mem_bytes: int = int(mem_limit) * 1024 ** 2 // n_procs
+
+    # Pad spatially so that every voxel has a full patch
+    h: int = extent // 2
+
+    out: np.ndarray = data.copy()
+    sigma: np.ndarray = np.zeros(data.shape[:3], dtype=np.float32)
+
+    # The store is entered before the image is published, so that its segments are released on error
+    with SharedVolumeStore() as store:
+        ref: SharedRef = store.publish("padded", np.pad(data, [(h, h)] * 3 + [(0, 0)], mode="reflect"))
+        thickness, batch = _slab_size(shape=ref.shape, extent=extent, mem_bytes=mem_bytes)
+
+        with ProcessPoolExecutor(max_workers=n_procs) as pool:
+            pending: Dict[Future, Tuple[int, int]] = {}
+            for z0 in range(0, data.shape[2], thickness):
+                z1: int = min(z0 + thickness, data.shape[2])
+                if not msk[..., z0:z1].any():
+                    continue
+
+                # Bound the number of slabs in flight
+                if len(pending) >= n_procs:
+                    _collect(pending=pending, out=out, sigma=sigma, msk=msk, wait_all=False)
+
+                fut: Future = pool.submit(
+                    _denoise_slab,
+                    ref,
+                    (z0, z1 + 2 * h),
+                    msk[..., z0:z1],
+                    extent,
+                    batch,
+                )
+                pending[fut] = (z0, z1)
+
+            _collect(pending=pending, out=out, sigma=sigma, msk=msk, wait_all=True)
+
+    out_dwi: str = os.path.join(outdir, f"{basename}_denoised.nii.gz")
+    out_sigma: str = os.path.join(outdir, f"{basename}_sigma.nii.gz")
+
+    dwi_nii: nib.Nifti1Image = nib.Nifti1Image(out, nii.affine, nii.header)
+    dwi_nii.set_data_dtype(np.float32)
+    out_dwi: image = save_image(dwi_nii, out_dwi)
+
+    sigma_nii: nib.Nifti1Image = nib.Nifti1Image(sigma, nii.affine, nii.header)
+    sigma_nii.set_data_dtype(np.float32)
+    out_sigma: image = save_image(sigma_nii, out_sigma, quantize=False)
+
+    return out_dwi, out_sigma
+
+
+def mp_threshold(eigvals: np.ndarray, m: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the number of noise components and the noise variance from the Marchenko-Pastur distribution.
+
+    Args:
+        eigvals: Eigenvalues of the (batched) Gram matrices in ascending order, as an array of shape (batch, r).
+        m: The larger dimension of the patch matrices (i.e. ``max(n volumes, n voxels)``).
+
+    Returns:
+        * Number of noise components for each patch.
+        * Noise variance for each patch.
+    """
+    lam: np.ndarray = np.clip(eigvals, 0, None) / m
+    p1: np.ndarray = np.arange(1, lam.shape[1] + 1)
+
+    sigsq1: np.ndarray = np.cumsum(lam, axis=1) / p1
+    sigsq2: np.ndarray = (lam - lam[:, :1]) / (4 * np.sqrt(p1 / m))
+    noise: np.ndarray = sigsq2 < sigsq1
+
+    # Index of the last eigenvalue that is consistent with noise
+    any_noise: np.ndarray = noise.any(axis=1)
+    cutoff: np.ndarray = np.where(any_noise, lam.shape[1] - np.argmax(noise[:, ::-1], axis=1), 0)
+
+    rows: np.ndarray = np.arange(lam.shape[0])
+    sigma2: np.ndarray = np.where(any_noise, sigsq1[rows, np.maximum(cutoff - 1, 0)], 0.0)
+
+    return cutoff, sigma2
+
+
+def _denoise_patches(x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Denoises the centre voxel of a batch of patch matrices.
+
+    Args:
+        x: Patch matrices of shape (batch, n volumes, n voxels).
+
+    Returns:
+        * Denoised centre voxel signals of shape (batch, n volumes).
+        * Noise level (sigma) for each patch.
+    """
+    x: np.ndarray = x.astype(np.float64)
+    n, m = x.shape[1:]
+    c: int = m // 2
+    centre: np.ndarray = x[:, :, c]
+
+    if n <= m:
+        w, u = np.linalg.eigh(x @ x.transpose(0, 2, 1))
+        cutoff, sigma2 = mp_threshold(w, m=m)
+        keep: np.ndarray = np.arange(n)[np.newaxis] >= cutoff[:, np.newaxis]
+        coef: np.ndarray = np.einsum("bij,bi->bj", u, centre) * keep
+        signal: np.ndarray = np.einsum("bij,bj->bi", u, coef)
+    else:
+        w, v = np.linalg.eigh(x.transpose(0, 2, 1) @ x)
+        cutoff, sigma2 = mp_threshold(w, m=n)
+        keep: np.ndarray = np.arange(m)[np.newaxis] >= cutoff[:, np.newaxis]
+        proj: np.ndarray = np.einsum("bj,bij->bi", v[:, c, :] * keep, v)
+        signal: np.ndarray = np.einsum("bij,bj->bi", x, proj)
+
+    return signal, np.sqrt(sigma2)
+
+
+def _denoise_slab(ref: SharedRef, zrange: Tuple[int, int], msk: np.ndarray, extent: int, batch: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Denoises the (masked) voxels of a padded slab (worker function).
+
+    Args:
+        ref: Reference to the (shared) padded image.
+        zrange: First and last + 1 (padded) slices of the slab, such that the slab has shape (x + 2h, y + 2h, z + 2h, n volumes).
+        msk: Mask of the (unpadded) slab voxels of shape (x, y, z).
+        extent: Patch size.
+        batch: Number of patches per batch.
+
+    Returns:
+        * Denoised signals of the masked voxels, of shape (n masked voxels, n volumes).
+        * Noise level (sigma) of the masked voxels.
+    """
+    slab: np.ndarray = attach(ref)[:, :, zrange[0] : zrange[1]]
+    windows: np.ndarray = np.lib.stride_tricks.sliding_window_view(
+        slab, (extent, extent, extent), axis=(0, 1, 2)
+    )
+    ix, iy, iz = np.nonzero(msk)
+
+    signal: np.ndarray = np.empty((len(ix), slab.shape[3]), dtype=np.float32)
+    sigma: np.ndarray = np.empty(len(ix), dtype=np.float32)
+
+    for b in range(0, len(ix), batch):
+        s: slice = slice(b, b + batch)
+        x: np.ndarray = windows[ix[s], iy[s], iz[s]].reshape(-1, slab.shape[3], extent ** 3)
+        signal[s], sigma[s] = _denoise_patches(x)
+
+    return signal, sigma
+
+
+def _collect(pending: Dict[Future, Tuple[int, int]], out: np.ndarray, sigma: np.ndarray, msk: np.ndarray, wait_all: bool = False) -> None:
+    """Collects finished slabs from the process pool into the output arrays.
+
+    Args:
+        pending: Dictionary that maps pending futures to the (first, last + 1) slices of their slab.
+        out: Output (denoised) data array.
+        sigma: Output noise level array.
+        msk: Mask array.
+        wait_all: Wait for all pending slabs, otherwise wait for (at least) one slab.
+    """
+    done, _ = wait(list(pending), return_when=ALL_COMPLETED if wait_all else FIRST_COMPLETED)
+
+    for fut in done:
+        z0, z1 = pending.pop(fut)
+        signal, sig = fut.result()
+        ix, iy, iz = np.nonzero(msk[..., z0:z1])
+        out[ix, iy, iz + z0] = signal
+        sigma[ix, iy, iz + z0] = sig
+
+    return None
+
+
+def _slab_size(shape: Tuple[int, ...], extent: int, mem_bytes: int) -> Tuple[int, int]:
+    """Computes the slab thickness and patch batch size for a (per worker) memory budget.
+
+    Half of the budget is used for the slab (input and output), and the other half for the patch batches.
+
+    Args:
+        shape: Shape of the padded 4D image.
+        extent: Patch size.
+        mem_bytes: Memory budget (in bytes) for each worker process.
+
+    Returns:
+        * Slab thickness (number of slices).
+        * Number of patches per batch.
+    """
+    nx, ny, nz, nvols = shape
+    h: int = extent // 2
+
+    # float32 input slice (padded) and float32 output slice
+    slice_bytes: int = nx * ny * nvols * 4 * 2
+    thickness: int = (mem_bytes // 2) // slice_bytes - 2 * h
+    thickness: int = int(np.clip(thickness, 1, nz - 2 * h))
+
+    # float32 patches, float64 copy, Gram matrices and eigenvectors
+    m: int = extent ** 3
+    patch_bytes: int = nvols * m * (4 + 8) + 2 * min(nvols, m) ** 2 * 8
+    batch: int = max(int((mem_bytes // 2) // patch_bytes), 1)
+
+    return thickness, batch
@@ -0,0 +1,140 @@
+"""Correction of the (global) signal drift of DWIs, using the interspersed b0 volumes.
+
+The in-mask mean intensity of the b0s (located using the b-values, wherever
+they occur in the series) is fitted with a linear, or quadratic, function of
+the volume index. Each volume is then rescaled so that the fitted signal is
+that of the first b0.
+
+NOTE:
+    Reference: Vos, S.B., Tax, C.M.W., Luijten, P.R., Ourselin, S., Leemans, A., & Froeling, M. (2017). The importance of correcting for signal drift in diffusion MRI. Magnetic Resonance in Medicine, 77(1), 285-299.
+"""
+import os
+import json
+import numpy as np
+import nibabel as nib
+
+from typing import Any, Dict, Optional, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.diffusion.dwi.brainmask import estimate_mask
+from dwi_preproc.diffusion.dwi.btable import b0_indices, read_bvals
+from dwi_preproc.utils.niio import NiiFile, image, intermediate_path, iter_volumes, scale_volumes
+
+
+def fit_drift(idx: np.ndarray, signal: np.ndarray, n_vols: int, order: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """Fits the drift model (a polynomial of the volume index) to the b0 signal.
+
+    Args:
+        idx: Volume indices of the b0s.
+        signal: (In-mask) mean intensity of the b0s.
+        n_vols: Number of volumes of the DWI.
+        order: Order of the drift model (1: linear, 2: quadratic). Defaults to 2.
+
+    Raises:
+        ValueError: Exception that is raised if the order is not 1 or 2, or if there are too few b0s for the order of the model.
+
+    Returns:
+        * Polynomial coefficients (highest order first, as in ``numpy.polyfit``).
+        * Scale factor of each volume (the fitted signal of the first b0 divided by the fitted signal of the volume).
+    """
+    if order not in (1, 2):
+        raise ValueError(f"Invalid order of the drift model: {order}. Valid orders include: 1 (linear), or 2 (quadratic).")
+
+    idx: np.ndarray = np.asarray(idx, dtype=np.float64)
+    if len(idx) < order + 1:
+        raise ValueError(f"At least {order + 1} b0s are required for a drift model of order {order} ({len(idx)} found).")
+
+    coef: np.ndarray = np.polyfit(idx, np.asarray(signal, dtype=np.float64), deg=order)
+    fitted: np.ndarray = np.polyval(coef, np.arange(n_vols))
+
+    return coef, np.polyval(coef, idx[0]) / fitted
+
+
+def correct_drift(
+    dwi: Union[image, str],
+    bvals: Union[file, str],
+    out: Union[image, str],
+    model: Optional[Union[file, str]] = None,
+    mask: Optional[Union[image, str]] = None,
+    order: int = 2,
+    b0_thresh: float = 50,
+) -> Tuple[image, file]:
+    """Corrects the signal drift of a DWI, and writes the drift model to a JSON sidecar.
+
+    Only the b0s are read to fit the model, and the DWI is then rescaled in a
+    single streamed pass (one volume at a time), so the 4D image is never
+    held in memory. Without a brain mask, the brain mask of the mean b0 is
+    estimated natively (see ``dwi_preproc.diffusion.dwi.brainmask.estimate_mask``).
+
+    Usage example:
+        >>> dwi, model = correct_drift(dwi="dwi.nii.gz",
+        ...                            bvals="dwi.bval",
+        ...                            out="Drift/dwi_drift.nii.gz",
+        ...                            model="dwi.misc/signal_drift.json")
+        ...
+
+    Args:
+        dwi: Input DWI.
+        bvals: Corresponding b-value file.
+        out: Output (drift corrected) DWI.
+        model: Output JSON sidecar of the drift model. Defaults to None (``<out>.json``).
+        mask: Brain mask. Defaults to None.
+        order: Order of the drift model (1: linear, 2: quadratic). Defaults to 2.
+        b0_thresh: b-values less than or equal to this value are considered to be b0s. Defaults to 50.
+
+    Raises:
+        ValueError: Exception that is raised if the number of b-values does not match the number of volumes,
+            if the mask does not share the image grid of the DWI, or if there are too few b0s for the order of the model.
+
+    Returns:
+        * Output (drift corrected) DWI.
+        * Output JSON sidecar of the drift model.
+    """
+    with NiiFile(src=dwi, assert_exists=True) as nii:
+        dwi: image = nii.abspath()
+
+    ref: nib.Nifti1Image = nib.load(dwi)
+    n_vols: int = ref.shape[3] if len(ref.shape) > 3 else 1
+
+    bval: np.ndarray = read_bvals(bvals)
+    if len(bval) != n_vols:
+        raise ValueError(f"The number of b-values ({len(bval)}) does not match the number of volumes ({n_vols}) of: {dwi}")
+
+    idx: np.ndarray = b0_indices(bval, b0_thresh=b0_thresh)
+    if len(idx) < order + 1:
+        raise ValueError(f"At least {order + 1} b0s are required for a drift model of order {order} ({len(idx)} found): {dwi}")
+
+    b0s: np.ndarray = np.stack(list(iter_volumes(dwi, idx=idx)), axis=0)
+
+    if mask:
+        msk: np.ndarray = np.asarray(nib.load(mask).dataobj) > 0
+        if msk.shape != b0s.shape[1:]:
+            raise ValueError(f"The mask {mask} does not share the same image grid as {dwi}.")
+    else:
+        msk: np.ndarray = estimate_mask(b0s.mean(axis=0))
+
+    signal: np.ndarray = b0s[:, msk].mean(axis=1, dtype=np.float64)
+    coef, scale = fit_drift(idx=idx, signal=signal, n_vols=n_vols, order=order)
+
+    out: image = scale_volumes(dwi, intermediate_path(out), scale=scale)
+    model: str = os.path.abspath(model or NiiFile(src=out).rm_ext() + ".json")
+
+    fitted: np.ndarray = np.polyval(coef, np.arange(n_vols))
+    record: Dict[str, Any] = {
+        "Image": dwi,
+        "Order": order,
+        "Coefficients": coef.tolist(),
+        "B0Volumes": idx.tolist(),
+        "B0Signal": np.round(signal, 4).tolist(),
+        "ReferenceVolume": int(idx[0]),
+        "Mask": os.path.abspath(mask) if mask else "native",
+        "MaskVoxels": int(msk.sum()),
+        "DriftPercent": round(100 * float(fitted[-1] - fitted[idx[0]]) / float(fitted[idx[0]]), 4),
+        "Scale": np.round(scale, 6).tolist(),
+    }
+
+    with open(model, "w") as f:
+        json.dump(record, f, indent=4)
+
+    return out, model
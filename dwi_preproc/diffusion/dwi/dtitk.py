@@ -0,0 +1,224 @@
+"""Native conversion of ``FSL``'s ``dtifit`` tensor images to ``DTI-TK`` compatible tensor images.
+
+This is equivalent to ``DTI-TK``'s ``fsl_to_dtitk`` script (``DTI-TK`` is not required).
+"""
+import os
+import numpy as np
+import nibabel as nib
+
+from typing import Dict, Optional, Tuple, Union
+
+from dwi_preproc.utils.niio import NiiFile, image, iter_volumes
+
+# NIFTI intent code of symmetric matrices (NIFTI_INTENT_SYMMATRIX)
+_INTENT_SYMMATRIX: int = 1005
+
+# Order of the (lower triangular) DTI-TK components, as indices of the (upper triangular) dtifit components:
+#   dtifit: Dxx, Dxy, Dxz, Dyy, Dyz, Dzz
+#   DTI-TK: Dxx, Dxy, Dyy, Dxz, Dyz, Dzz
+_DTITK_ORDER: Tuple[int, ...] = (0, 1, 3, 2, 4, 5)
+
+# Diffusivities (mm^2/s) are scaled to the units expected by DTI-TK (um^2/ms)
+_DTITK_SCALE: float = 1000.0
+
+# Tensors with a (Frobenius) norm above this value (um^2/ms) are considered outliers (as in fsl_to_dtitk)
+_NORM_THRESH: float = 100.0
+
+
+class TensorConversionError(Exception):
+    """Exception intended for invalid tensor images, or failed tensor conversions."""
+    pass
+
+
+def fsl_to_dtitk(
+    tensor: Union[image, str],
+    out: Union[image, str],
+    scale: Optional[float] = None,
+    zero_origin: bool = True,
+    norm_thresh: float = _NORM_THRESH,
+) -> Tuple[image, Dict[str, float]]:
+    """Converts a ``dtifit`` tensor image (``--save_tensor``) to a ``DTI-TK`` compatible tensor image.
+
+    The six (upper triangular) tensor components are read in a single streamed
+    pass (one component at a time), and the output is written as a 5D
+    (x, y, z, 1, 6) ``float32`` NIFTI image with the ``NIFTI_INTENT_SYMMATRIX``
+    intent code and the (lower triangular) component order of ``DTI-TK``.
+
+    As with ``fsl_to_dtitk``:
+        * Diffusivities are scaled from mm^2/s to um^2/ms.
+        * Tensors are made positive semi-definite (negative eigenvalues are set to 0).
+        * Outlier tensors (with a norm above ``norm_thresh``) are set to 0.
+        * The origin of the image is set to (0, 0, 0).
+
+    Usage example:
+        >>> out, stats = fsl_to_dtitk("Tensor/sub-001_tensor.nii.gz", "DTI-TK/sub-001_dtitk.nii.gz")
+        >>> stats["outliers"]
+        12
+
+    Args:
+        tensor: Input ``dtifit`` tensor image (6 volumes).
+        out: Output ``DTI-TK`` tensor image.
+        scale: Scale factor of the diffusivities. Defaults to None (1000 if the diffusivities are in mm^2/s, 1 otherwise).
+        zero_origin: Set the origin of the image to (0, 0, 0). Defaults to True.
+        norm_thresh: Tensors with a norm (um^2/ms) above this value are set to 0. Defaults to 100.
+
+    Raises:
+        TensorConversionError: Exception that is raised if the input is not a tensor image, or the output is not valid.
+
+    Returns:
+        * Output ``DTI-TK`` tensor image.
+        * Dictionary of conversion statistics (``scale``, number of ``voxels``, ``non_spd`` and ``outliers`` tensors).
+    """
+    with NiiFile(src=tensor, assert_exists=True, validate_nifti=True) as n:
+        tensor: str = n.abspath()
+
+    out: str = NiiFile(src=out).rm_ext() + ".nii.gz"
+    nii: nib.Nifti1Image = nib.load(tensor)
+
+    if len(nii.shape) != 4 or nii.shape[3] != 6:
+        raise TensorConversionError(f"Input image is not a (6 component) tensor image: {tensor} {nii.shape}")
+
+    comps: np.ndarray = np.stack(list(iter_volumes(tensor)), axis=-1)[..., _DTITK_ORDER]
+    msk: np.ndarray = np.any(comps != 0, axis=-1)
+
+    if scale is None:
+        scale: float = _detect_scale(comps[msk])
+
+    vox: np.ndarray = comps[msk] * scale
+    vox, non_spd = _make_spd(vox)
+
+    norm: np.ndarray = np.sqrt(np.sum(vox ** 2, axis=1) + np.sum(vox[:, [1, 3, 4]] ** 2, axis=1))
+    outliers: np.ndarray = ~np.isfinite(norm) | (norm > norm_thresh)
+    vox[outliers] = 0
+
+    comps[...] = 0
+    comps[msk] = vox
+
+    affine: np.ndarray = nii.affine.copy()
+    if zero_origin:
+        affine[:3, 3] = 0
+
+    hdr: nib.Nifti1Header = nib.Nifti1Header()
+    hdr.set_data_dtype(np.float32)
+    hdr.set_intent(_INTENT_SYMMATRIX)
+    hdr.set_xyzt_units("mm")
+
+    dtitk: nib.Nifti1Image = nib.Nifti1Image(comps[:, :, :, np.newaxis, :], affine, header=hdr)
+    dtitk.set_qform(affine, code=1)
+    dtitk.set_sform(affine, code=1)
+    nib.save(dtitk, out)
+
+    validate_dtitk(out, n_voxels=int(msk.sum()))
+
+    stats: Dict[str, float] = {
+        "scale": float(scale),
+        "voxels": int(msk.sum()),
+        "non_spd": int(non_spd),
+        "outliers": int(outliers.sum()),
+    }
+
+    return os.path.abspath(out), stats
+
+
+def validate_dtitk(src: Union[image, str], n_voxels: Optional[int] = None) -> bool:
+    """Validates a ``DTI-TK`` tensor image (shape, data type, intent code, and finite positive semi-definite tensors).
+
+    Args:
+        src: Input ``DTI-TK`` tensor image.
+        n_voxels: Expected maximum number of non-zero tensors. Defaults to None.
+
+    Raises:
+        TensorConversionError: Exception that is raised if the tensor image is not valid.
+
+    Returns:
+        True if the tensor image is valid.
+    """
+    nii: nib.Nifti1Image = nib.load(src)
+    hdr: nib.Nifti1Header = nii.header
+
+    if len(nii.shape) != 5 or nii.shape[3:] != (1, 6):
+        raise TensorConversionError(f"Invalid DTI-TK tensor image shape {nii.shape}, expected (x, y, z, 1, 6): {src}")
+
+    if hdr.get_intent()[0] != "symmetric matrix":
+        raise TensorConversionError(f"Invalid intent code {hdr.get_intent()[0]}, expected 'symmetric matrix': {src}")
+
+    if hdr.get_data_dtype() != np.float32:
+        raise TensorConversionError(f"Invalid data type {hdr.get_data_dtype()}, expected float32: {src}")
+
+    comps: np.ndarray = np.asarray(nii.dataobj, dtype=np.float32)[:, :, :, 0, :]
+    vox: np.ndarray = comps[np.any(comps != 0, axis=-1)]
+
+    if not np.all(np.isfinite(vox)):
+        raise TensorConversionError(f"The DTI-TK tensor image contains non-finite tensors: {src}")
+
+    if n_voxels is not None and len(vox) > n_voxels:
+        raise TensorConversionError(f"The DTI-TK tensor image contains more non-zero tensors ({len(vox)}) than expected ({n_voxels}): {src}")
+
+    if len(vox) and np.linalg.eigvalsh(_to_matrix(vox)).min() < -1e-4:
+        raise TensorConversionError(f"The DTI-TK tensor image contains tensors that are not positive semi-definite: {src}")
+
+    return True
+
+
+def _detect_scale(vox: np.ndarray) -> float:
+    """Detects the scale factor of the diffusivities from the median (tensor) trace.
+
+    The trace of brain tissue is approximately 2e-3 mm^2/s (i.e. 2 um^2/ms).
+
+    Args:
+        vox: Tensor components (voxels x 6) in the ``DTI-TK`` order.
+
+    Returns:
+        Scale factor (1000, or 1).
+    """
+    if len(vox) == 0:
+        return _DTITK_SCALE
+
+    trace: float = float(np.median(vox[:, 0] + vox[:, 2] + vox[:, 5]))
+
+    return _DTITK_SCALE if abs(trace) < 0.1 else 1.0
+
+
+def _make_spd(vox: np.ndarray) -> Tuple[np.ndarray, int]:
+    """Makes tensors positive semi-definite (negative eigenvalues are set to 0).
+
+    Args:
+        vox: Tensor components (voxels x 6) in the ``DTI-TK`` order.
+
+    Returns:
+        * Tensor components (voxels x 6) in the ``DTI-TK`` order.
+        * Number of tensors that were not positive semi-definite.
+    """
+    if len(vox) == 0:
+        return vox, 0
+
+    evals, evecs = np.linalg.eigh(_to_matrix(vox))
+    bad: np.ndarray = (evals < 0).any(axis=1)
+
+    if bad.any():
+        evals: np.ndarray = np.clip(evals[bad], 0, None)
+        mat: np.ndarray = np.einsum("nij,nj,nkj->nik", evecs[bad], evals, evecs[bad])
+        vox[bad] = mat[:, [0, 1, 1, 2, 2, 2], [0, 0, 1, 0, 1, 2]]
+
+    return vox, int(bad.sum())
+
+
+def _to_matrix(vox: np.ndarray) -> np.ndarray:
+    """Converts (lower triangular) tensor components to symmetric 3 x 3 matrices.
+
+    Args:
+        vox: Tensor components (voxels x 6) in the ``DTI-TK`` order (Dxx, Dxy, Dyy, Dxz, Dyz, Dzz).
+
+    Returns:
+        Symmetric matrices (voxels x 3 x 3).
+    """
+    xx, xy, yy, xz, yz, zz = (vox[:, i].astype(np.float64) for i in range(6))
+
+    return np.stack(
+        [
+            np.stack([xx, xy, xz], axis=-1),
+            np.stack([xy, yy, yz], axis=-1),
+            np.stack([xz, yz, zz], axis=-1),
+        ],
+        axis=-2,
+    )
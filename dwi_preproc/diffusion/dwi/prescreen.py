@@ -0,0 +1,201 @@
+"""Streaming (pre-``eddy``) volume outlier screening for diffusion weighted images.
+"""
+import os
+import warnings
+import numpy as np
+import nibabel as nib
+
+from typing import Dict, Optional, Tuple, Union
+
+from commandio.fileio import file
+from commandio.workdir import WorkDir
+
+from dwi_preproc.diffusion.dwi.btable import (
+    b0_indices,
+    read_bvals,
+    read_bvecs,
+    shells,
+    write_bvals,
+    write_bvecs,
+)
+from dwi_preproc.utils.niio import NiiFile, image, extract_volumes, intermediate_path, iter_volumes
+from dwi_preproc.utils.util import update_json
+
+
+def volume_stats(dwi: Union[image, str], bvals: np.ndarray, frac: float = 0.1, b0_thresh: float = 50) -> Tuple[np.ndarray, np.ndarray]:
+    """Computes the slice-wise and volume-wise (in-mask) mean intensities of a DWI in a single streamed pass.
+
+    The mask is the (rough) foreground of the first b0 volume.
+
+    Args:
+        dwi: Input DWI.
+        bvals: Corresponding b-values.
+        frac: Fraction of the (99th percentile) b0 intensity used to define the foreground. Defaults to 0.1.
+        b0_thresh: b-values less than or equal to this value are considered to be b0s. Defaults to 50.
+
+    Returns:
+        * Slice-wise mean intensities, as an (n volumes x n slices) array (slices without foreground voxels are ``NaN``).
+        * Volume-wise mean intensities.
+    """
+    b0s: np.ndarray = b0_indices(bvals, b0_thresh=b0_thresh)
+    first: int = int(b0s[0]) if len(b0s) else 0
+
+    b0: np.ndarray = next(iter_volumes(dwi, idx=[first]))
+    mask: np.ndarray = b0 > frac * np.percentile(b0, 99)
+    counts: np.ndarray = mask.sum(axis=(0, 1))
+
+    slice_means: np.ndarray = np.full((len(bvals), mask.shape[2]), np.nan)
+    vol_means: np.ndarray = np.empty(len(bvals))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for n, vol in enumerate(iter_volumes(dwi)):
+            sums: np.ndarray = np.where(mask, vol, 0).sum(axis=(0, 1), dtype=np.float64)
+            slice_means[n] = np.where(counts > 0, sums / counts, np.nan)
+            vol_means[n] = sums.sum() / max(counts.sum(), 1)
+
+    return slice_means, vol_means
+
+
+def screen_volumes(
+    dwi: Union[image, str],
+    bvals: Union[file, str],
+    bvecs: Union[file, str],
+    outdir: str,
+    index: Optional[Union[file, str]] = None,
+    report: Optional[Union[file, str]] = None,
+    n_std: float = 4.0,
+    slice_frac: float = 0.1,
+    drop: bool = False,
+    b0_thresh: float = 50,
+) -> Tuple[image, file, file, Union[file, None], file]:
+    """Screens a DWI for outlier (e.g. signal dropout or severe motion corrupted) volumes prior to ``eddy``.
+
+    The DWI is streamed once. For each shell, the robust (median/MAD) z-scores of
+    the in-mask volume mean intensities and of each slice mean intensity (across
+    the volumes of the shell) are computed. A volume is flagged if its volume-wise
+    z-score exceeds ``n_std``, or if more than ``slice_frac`` of its slices are
+    (low intensity) outliers.
+
+    NOTE:
+        * Shells with fewer than 3 volumes are not screened.
+        * Should ``drop`` be enabled, the flagged volumes are removed from the DWI, b-values, b-vectors (and index file) in a single streamed copy.
+
+    Usage example:
+        >>> dwi, bval, bvec, idx, rep = screen_volumes(dwi="dwi.nii.gz",
+        ...                                            bvals="dwi.bval",
+        ...                                            bvecs="dwi.bvec",
+        ...                                            outdir="Screen",
+        ...                                            drop=True)
+        ...
+
+    Args:
+        dwi: Input DWI.
+        bvals: Corresponding b-value file.
+        bvecs: Corresponding b-vector file.
+        outdir: Output directory.
+        index: ``eddy`` index file. Defaults to None.
+        report: Output JSON report. Defaults to None (``<outdir>/volume_screen.json``).
+        n_std: Number of robust standard deviations for outlier detection. Defaults to 4.0.
+        slice_frac: Fraction of outlier slices for a volume to be flagged. Defaults to 0.1.
+        drop: Remove the flagged volumes. Defaults to False.
+        b0_thresh: b-values less than or equal to this value are considered to be b0s. Defaults to 50.
+
+    Raises:
+        IndexError: Exception that is raised if the number of volumes does not match the b-table.
+
+    Returns:
+        * DWI (screened if ``drop`` is enabled).
+        * b-value file.
+        * b-vector file.
+        * Index file (if provided).
+        * JSON report.
+    """
+    with NiiFile(src=dwi, assert_exists=True, validate_nifti=True) as n:
+        with WorkDir(src=outdir) as _:
+            dwi: image = n.abspath()
+            _, basename, _ = n.file_parts()
+
+    bval: np.ndarray = read_bvals(bvals)
+    bvec: np.ndarray = read_bvecs(bvecs)
+    nvols: int = nib.load(dwi).shape[3]
+
+    if not (len(bval) == bvec.shape[1] == nvols):
+        raise IndexError(
+            f"The number of volumes ({nvols}), b-values ({len(bval)}) and b-vectors ({bvec.shape[1]}) do not match."
+        )
+
+    slice_means, vol_means = volume_stats(dwi, bval, b0_thresh=b0_thresh)
+
+    vol_z: np.ndarray = np.zeros(nvols)
+    bad_slices: np.ndarray = np.zeros(nvols, dtype=int)
+
+    groups: Dict[int, np.ndarray] = shells(bval, b0_thresh=b0_thresh)
+
+    for b, idx in groups.items():
+        if len(idx) < 3:
+            continue
+        vol_z[idx] = _robust_z(vol_means[idx])
+        slice_z: np.ndarray = _robust_z(slice_means[idx], axis=0)
+        bad_slices[idx] = (slice_z < -n_std).sum(axis=1)
+
+    nslices: int = int(np.isfinite(slice_means).any(axis=0).sum())
+    flagged: np.ndarray = np.flatnonzero(
+        (np.abs(vol_z) > n_std) | (bad_slices > slice_frac * nslices)
+    )
+
+    if report is None:
+        report: str = os.path.join(outdir, "volume_screen.json")
+
+    update_json(
+        json_file=report,
+        dictionary={
+            "VolumeScreen": {
+                "Image": dwi,
+                "NumVolumes": nvols,
+                "Shells": {str(b): len(i) for b, i in groups.items()},
+                "VolumeZ": np.round(vol_z, 3).tolist(),
+                "OutlierSlices": bad_slices.tolist(),
+                "Flagged": flagged.tolist(),
+                "FlaggedBvals": bval[flagged].tolist(),
+                "Dropped": bool(drop and len(flagged)),
+            }
+        },
+    )
+    report: str = os.path.abspath(report)
+
+    if not drop or not len(flagged):
+        return dwi, os.path.abspath(bvals), os.path.abspath(bvecs), (os.path.abspath(index) if index else None), report
+
+    keep: np.ndarray = np.setdiff1d(np.arange(nvols), flagged)
+    out: str = os.path.join(outdir, f"{basename}_screened")
+
+    out_dwi: image = extract_volumes(dwi, intermediate_path(f"{out}.nii.gz"), idx=keep)
+    out_bval: file = write_bvals(bval[keep], f"{out}.bval")
+    out_bvec: file = write_bvecs(bvec[:, keep], f"{out}.bvec")
+
+    out_idx: Union[file, None] = None
+    if index:
+        idx: np.ndarray = np.loadtxt(index, ndmin=1, dtype=int).ravel()
+        np.savetxt(f"{out}.idx", idx[keep].reshape(1, -1), fmt="%i")
+        out_idx: str = os.path.abspath(f"{out}.idx")
+
+    return out_dwi, out_bval, out_bvec, out_idx, report
+
+
+def _robust_z(x: np.ndarray, axis: Optional[int] = None) -> np.ndarray:
+    """Computes robust (median/MAD) z-scores, ignoring ``NaN`` values.
+
+    Args:
+        x: Input numpy array.
+        axis: Axis along which the median and MAD are computed. Defaults to None.
+
+    Returns:
+        Robust z-scores (0 where the MAD is 0 or the input is ``NaN``).
+    """
+    with warnings.catch_warnings(), np.errstate(invalid="ignore", divide="ignore"):
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        med: np.ndarray = np.nanmedian(x, axis=axis, keepdims=True)
+        mad: np.ndarray = 1.4826 * np.nanmedian(np.abs(x - med), axis=axis, keepdims=True)
+        z: np.ndarray = (x - med) / mad
+
+    return np.nan_to_num(z, nan=0.0, posinf=0.0, neginf=0.0)
@@ -0,0 +1,258 @@
+"""Cohort-level region of interest (ROI) statistics of (tensor) scalar maps.
+
+Per-label statistics are computed with vectorized (``bincount``) reductions,
+subjects are processed in parallel, and the statistics of each (map, atlas)
+pair are cached on disk.
+"""
+import os
+import glob
+import numpy as np
+import nibabel as nib
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.utils.hashing import content_hash
+from dwi_preproc.utils.niio import image
+
+# Statistics of each label (in table order)
+_STATS: Tuple[str, ...] = ("n_voxels", "mean", "median", "std", "min", "max")
+
+# Atlas label arrays loaded by the current (worker) process: atlas hash -> (labels, affine)
+_ATLAS: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+
+class RoiStatsError(Exception):
+    """Exception intended for scalar maps that do not match the atlas (label) image."""
+    pass
+
+
+def roi_stats(
+    scalar: Union[np.ndarray, image, str],
+    labels: Union[np.ndarray, image, str],
+) -> Dict[str, np.ndarray]:
+    """Computes the statistics of a scalar map within each label of a label (atlas) image.
+
+    Voxels with a label of 0 (background), and non-finite scalar values, are excluded.
+
+    Usage example:
+        >>> stats = roi_stats("Tensor/sub-001_FA.nii.gz", "atlas.nii.gz")
+        >>> stats["label"], stats["mean"]
+        (array([1, 2, 3]), array([0.45, 0.51, 0.38]))
+
+    Args:
+        scalar: Scalar map (array, or image).
+        labels: Label image (array, or image) on the same grid as the scalar map.
+
+    Raises:
+        RoiStatsError: Exception that is raised if the scalar map and label image have different shapes.
+
+    Returns:
+        Dictionary of columns: ``label``, ``n_voxels``, ``mean``, ``median``, ``std``, ``min`` and ``max``.
+    """
+    if not isinstance(scalar, np.ndarray):
+        scalar: np.ndarray = np.asarray(nib.load(scalar).dataobj, dtype=np.float64)
+
+    if not isinstance(labels, np.ndarray):
+        labels: np.ndarray = np.asarray(nib.load(labels).dataobj)
+
+    if scalar.shape[:3] != labels.shape[:3]:
+        raise RoiStatsError(f"The scalar map {scalar.shape} and label image {labels.shape} have different shapes.")
+
+    lab: np.ndarray = np.rint(labels[..., 0] if labels.ndim > 3 else labels).astype(np.int64).ravel()
+    val: np.ndarray = (scalar[..., 0] if scalar.ndim > 3 else scalar).astype(np.float64).ravel()
+
+    keep: np.ndarray = (lab > 0) & np.isfinite(val)
+    lab, val = lab[keep], val[keep]
+
+    present: np.ndarray = np.unique(lab)
+    stats: Dict[str, np.ndarray] = {"label": present}
+
+    if len(present) == 0:
+        stats.update({k: np.array([], dtype=np.float64) for k in _STATS})
+        return stats
+
+    counts: np.ndarray = np.bincount(lab)
+    sums: np.ndarray = np.bincount(lab, weights=val)
+    sqs: np.ndarray = np.bincount(lab, weights=val * val)
+
+    n: np.ndarray = counts[present].astype(np.float64)
+    mean: np.ndarray = sums[present] / n
+
+    # Sort by (label, value): the voxels of each label are then contiguous and ordered
+    order: np.ndarray = np.lexsort((val, lab))
+    val: np.ndarray = val[order]
+    start: np.ndarray = np.concatenate(([0], np.cumsum(counts[present])[:-1]))
+    end: np.ndarray = start + counts[present] - 1
+    mid: np.ndarray = start + (counts[present] - 1) // 2
+    mid_hi: np.ndarray = start + counts[present] // 2
+
+    stats["n_voxels"] = counts[present]
+    stats["mean"] = mean
+    stats["median"] = (val[mid] + val[mid_hi]) / 2
+    stats["std"] = np.sqrt(np.maximum(sqs[present] / n - mean * mean, 0))
+    stats["min"] = val[start]
+    stats["max"] = val[end]
+
+    return stats
+
+
+def subject_roi_stats(
+    scalar: Union[image, str],
+    atlas: Union[image, str],
+    atlas_hash: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+) -> Dict[str, np.ndarray]:
+    """Computes (or loads the cached) ROI statistics of a single scalar map.
+
+    Statistics are cached (as ``.npz`` files) per (scalar map hash, atlas hash),
+    so unchanged maps are not read again when the cohort table is rebuilt.
+
+    Args:
+        scalar: Scalar map.
+        atlas: Label (atlas) image on the same grid as the scalar map.
+        atlas_hash: Hash of the atlas. Defaults to None (the atlas is hashed).
+        cache_dir: Directory of the on-disk cache. Defaults to None.
+
+    Raises:
+        RoiStatsError: Exception that is raised if the scalar map is not on the same grid as the atlas.
+
+    Returns:
+        Dictionary of columns (see ``roi_stats``).
+    """
+    atlas_hash: str = atlas_hash or content_hash(atlas)
+    cached: Union[str, None] = None
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        cached: str = os.path.join(cache_dir, f"{content_hash(scalar)[:16]}_{atlas_hash[:16]}.npz")
+        if os.path.exists(cached):
+            with np.load(cached) as f:
+                return {k: f[k] for k in f.files}
+
+    if atlas_hash not in _ATLAS:
+        nii: nib.Nifti1Image = nib.load(atlas)
+        _ATLAS[atlas_hash] = (np.asarray(nii.dataobj), nii.affine)
+
+    labels, affine = _ATLAS[atlas_hash]
+    nii: nib.Nifti1Image = nib.load(scalar)
+
+    if not np.allclose(nii.affine, affine, atol=1e-3):
+        raise RoiStatsError(f"The scalar map is not on the same grid (affine) as the atlas: {scalar}")
+
+    stats: Dict[str, np.ndarray] = roi_stats(np.asarray(nii.dataobj, dtype=np.float64), labels)
+
+    if cached:
+        # Write atomically, as several worker processes may compute the same statistics
+        tmp: str = f"{cached[:-4]}.{os.getpid()}.npz"
+        np.savez(tmp, **stats)
+        os.replace(tmp, cached)
+
+    return stats
+
+
+def cohort_roi_stats(
+    jobs: Sequence[Dict[str, str]],
+    atlas: Union[image, str],
+    lut: Optional[Dict[int, str]] = None,
+    n_procs: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+) -> Dict[str, np.ndarray]:
+    """Computes the ROI statistics of a cohort, and aggregates them into a single (tidy) table.
+
+    Each row of the table holds the statistics of a single (subject, metric, label).
+
+    Usage example:
+        >>> table = cohort_roi_stats(jobs=[{"subject": "sub-001", "metric": "FA", "path": "sub-001/Tensor/sub-001_FA.nii.gz"},
+        ...                                {"subject": "sub-001", "metric": "MD", "path": "sub-001/Tensor/sub-001_MD.nii.gz"}],
+        ...                          atlas="JHU-ICBM-labels-1mm.nii.gz",
+        ...                          cache_dir="roi_cache")
+        >>> write_table(table, "roi_stats.tsv")
+        "abspath/to/roi_stats.tsv"
+
+    Args:
+        jobs: Dictionary for each scalar map with its ``subject``, ``metric`` and ``path``.
+        atlas: Label (atlas) image on the same grid as the scalar maps.
+        lut: Dictionary that maps each label to its name. Defaults to None.
+        n_procs: Number of worker processes. Defaults to None (number of CPUs).
+        cache_dir: Directory of the on-disk cache. Defaults to None.
+
+    Returns:
+        Dictionary of columns: ``subject``, ``metric``, ``label``, ``name`` (if a look-up table is provided), and the statistics of ``roi_stats``.
+    """
+    atlas_hash: str = content_hash(atlas)
+
+    with ProcessPoolExecutor(max_workers=n_procs) as pool:
+        futures: List[Any] = [
+            pool.submit(subject_roi_stats, scalar=job["path"], atlas=atlas, atlas_hash=atlas_hash, cache_dir=cache_dir)
+            for job in jobs
+        ]
+        results: List[Dict[str, np.ndarray]] = [f.result() for f in futures]
+
+    sizes: List[int] = [len(r["label"]) for r in results]
+    table: Dict[str, np.ndarray] = {
+        "subject": np.repeat([job["subject"] for job in jobs], sizes),
+        "metric": np.repeat([job["metric"] for job in jobs], sizes),
+        "label": np.concatenate([r["label"] for r in results]) if results else np.array([], dtype=np.int64),
+    }
+
+    if lut is not None:
+        table["name"] = np.array([lut.get(int(i), "n/a") for i in table["label"]])
+
+    for stat in _STATS:
+        table[stat] = np.concatenate([r[stat] for r in results]) if results else np.array([], dtype=np.float64)
+
+    return table
+
+
+def find_maps(derivative_dir: str, metrics: Sequence[str] = ("FA", "MD")) -> List[Dict[str, str]]:
+    """Finds the (``Tensor``) scalar maps of a pipeline derivatives directory.
+
+    The expected layout is ``<derivative_dir>/derivatives/sub-<sub>/ses-<ses>/<acq>/Tensor/<fit>_<metric>.nii.gz``.
+
+    Args:
+        derivative_dir: Parent derivatives directory.
+        metrics: Scalar maps (``dtifit`` output suffixes). Defaults to ('FA', 'MD').
+
+    Returns:
+        Dictionary for each scalar map with its ``subject`` (``sub-<sub>_<acq>``), ``metric`` and ``path``.
+    """
+    jobs: List[Dict[str, str]] = []
+
+    for tensor in sorted(glob.glob(os.path.join(derivative_dir, "derivatives", "sub-*", "*", "*", "Tensor"))):
+        acq: str = os.path.dirname(tensor)
+        sub: str = os.path.basename(os.path.dirname(os.path.dirname(acq)))
+        for metric in metrics:
+            for path in sorted(glob.glob(os.path.join(tensor, f"*_{metric}.nii*")))[:1]:
+                jobs.append({"subject": f"{sub}_{os.path.basename(acq)}", "metric": metric, "path": os.path.abspath(path)})
+
+    return jobs
+
+
+def read_lut(src: Union[file, str]) -> Dict[int, str]:
+    """Reads a label look-up table (e.g. ``FreeSurfer`` color table, or ``FSL``/``ITK-SNAP`` label files).
+
+    Lines that start with an integer label are read (other lines are ignored). The name is the (first) quoted
+    string of the line, if any (``ITK-SNAP``), otherwise the token that follows the label (``FreeSurfer``).
+
+    Args:
+        src: Input look-up table.
+
+    Returns:
+        Dictionary that maps each label to its name.
+    """
+    lut: Dict[int, str] = {}
+
+    with open(src) as f:
+        for line in f:
+            parts: List[str] = line.strip().split(None, 1)
+            if len(parts) < 2 or not parts[0].isdigit():
+                continue
+            if parts[1].count('"') >= 2:
+                lut[int(parts[0])] = parts[1].split('"')[1]
+            else:
+                lut[int(parts[0])] = parts[1].split()[0]
+
+    return lut
@@ -7,74 +7,729 @@
 # dtifit
 # eddy_quad
 
-from typing import Optional, Tuple,Union
+import os
+import json
+import shutil
+import numpy as np
+import nibabel as nib
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 from commandio.fileio import File, file
 from commandio.logutil import LogFile
 from commandio.command import Command
 from commandio.workdir import WorkDir
 
-from dwi_preproc.utils.niio import NiiFile, image
+from dwi_preproc.utils.enums import ApplyTopupMethod, EddyInterp, EddyOutlierType, TopupGridMode
+from dwi_preproc.utils.hashing import cache_key, is_cached
+from dwi_preproc.utils.niio import NiiFile, image, fsl_env, intermediate_ext, intermediate_path, save_image
+from dwi_preproc.utils.util import available_cores, run_command, update_json
+
+# Subsampling schedules (fastest first) for the 9 levels of FSL's b02b0 configuration
+_TOPUP_SUBSAMP: Dict[int, str] = {
+    4: "4,4,2,2,2,1,1,1,1",
+    2: "2,2,2,2,2,1,1,1,1",
+    1: "1,1,1,1,1,1,1,1,1",
+}
+
+_TOPUP_CONFIG: str = """# Written by dwi_preproc (b02b0 schedule with subsampling: {subsamp})
+--warpres=20,16,14,12,10,6,4,4,4
+--subsamp={subsamp}
+--fwhm=8,6,4,3,3,2,1,0,0
+--miter=5,5,5,5,5,10,10,20,20
+--lambda=0.005,0.001,0.0001,0.000015,0.000005,0.0000005,0.00000005,0.0000000005,0.00000000001
+--ssqlambda=1
+--regmod=bending_energy
+--estmov=1,1,1,1,1,0,0,0,0
+--minmet=0,0,0,0,0,1,1,1,1
+--splineorder=3
+--numprec=double
+--interp=spline
+--scale=1
+"""
+
+# eddy executables in order of preference
+_EDDY_GPU: Tuple[str, ...] = ("eddy_cuda", "eddy_cuda10.2", "eddy_cuda9.1", "eddy_cuda8.0")
+_EDDY_CPU: Tuple[str, ...] = ("eddy_cpu", "eddy_openmp", "eddy")
+
+
+class EddyOptionError(Exception):
+    """Exception intended to be raised for invalid (combinations of) ``eddy`` options."""
+    pass
 
-def topup(img: Union[image, str],outdir: str,acqp: Union[file, str], fout: bool = False, iout: bool = False, verbose: bool = False, config: Optional[Union[file,str]] = None, log: Optional[LogFile] = None) -> Tuple[image,Union[image,None],Union[image,None]]:
+
+class TopupGridError(Exception):
+    """Exception intended to be raised for images that can not be fit to the subsampling schedule of a ``topup`` configuration."""
+    pass
+
+
+def topup(img: Union[image, str],outdir: str,acqp: Union[file, str], fout: Union[bool, str] = False, iout: Union[bool, str] = False, verbose: bool = False, config: Optional[Union[file,str]] = None, auto_grid: bool = True, grid_mode: str = "pad", max_adjust: int = 2, out: Optional[str] = None, log: Optional[LogFile] = None) -> Tuple[str,Union[image,None],Union[image,None]]:
     """Performs image distortion correction for some input NIFTI image.
 
     Wrapper function for ``FSL``'s ``topup``.
 
+    ``topup`` requires each spatial dimension of the input image to be divisible 
+    by every subsampling level of its configuration (e.g. the ``b02b0.cnf`` 
+    configuration requires even dimensions). Should ``auto_grid`` be enabled, the 
+    header of the input image is inspected and the b0 stack is padded (or cropped) 
+    to fit the fastest valid subsampling schedule. A matching configuration file 
+    is selected (or written) should no configuration file be provided. The 
+    ``fout`` and ``iout`` outputs are restored to the original image grid afterwards.
+
+    The spline coefficients and movement parameters (``--out``) can not be restored 
+    to the original image grid, so should the grid be adjusted, a grid record 
+    (``<out>_grid.json``) and a fieldmap on the original image grid are written. 
+    The consumers of the ``topup`` outputs (``applytopup`` and ``eddy``) read the grid 
+    record, and either fit their inputs to the same grid, or use the fieldmap.
+
+    NOTE:
+        * Padding/cropping is only applied to the upper end of each axis, so the voxel indices and the affine of the input image are unchanged.
+        * ``max_adjust`` also applies to a provided configuration: the image is only fit to its subsampling schedule if at most ``max_adjust`` voxels are added (or removed) along any axis.
+
+    Usage example:
+        >>> out, fmap, b0s = topup(img="B0s.nii.gz",
+        ...                        outdir="Topup",
+        ...                        acqp="mr_params.acqp",
+        ...                        fout=True,
+        ...                        iout=True)
+        ...
+
     Args:
         img: Input image file.
         outdir: Output directory.
         acqp: Acquisition parameter files.
-        fout: Output fieldmap. Defaults to False.
-        iout: Output corrected 4D image. Defaults to False.
+        fout: Output fieldmap (in Hz), or its file name. Defaults to False.
+        iout: Output corrected 4D image, or its file name. Defaults to False.
         verbose: Enable verbose output. Defaults to False.
         config: Configuration for ``FSL``'s ``topup``. Defaults to None.
+        auto_grid: Pad/crop the input image to fit the subsampling schedule (and select a matching configuration if ``config`` is not provided). Defaults to True.
+        grid_mode: Image grid adjustment method, valid options include ``pad`` and ``crop``. Defaults to 'pad'.
+        max_adjust: Maximum number of voxels that may be added (or removed) along any axis when fitting a subsampling schedule. Defaults to 2.
+        out: Output basename (i.e. the ``--out`` argument of ``topup``). Defaults to None (``<outdir>/topup_results``).
         log: ``LogFile`` object for logging purposes. Defaults to None.
 
+    Raises:
+        TopupGridError: Exception that is raised if the image can not be fit to the subsampling schedule of the provided configuration within ``max_adjust`` voxels.
+
     Returns:
-        * Corrected image.
-        * Corrected 4D image.
+        * Output basename.
         * Fieldmap.
+        * Corrected 4D image.
     """
     with NiiFile(src=img, assert_exists=True, validate_nifti=True) as n:
         with WorkDir(src=outdir) as _:
             img: image = n.abspath()
+            outdir: str = os.path.abspath(outdir)
     
-    out_img: image = f"{outdir}/topup_results.nii.gz"
+    out: str = os.path.abspath(NiiFile(src=out).rm_ext()) if out else os.path.join(outdir, "topup_results")
+
+    if config:
+        with File(src=config, assert_exists=True) as f:
+            config: str = f.abspath()
+
+    src_dims: Tuple[int, ...] = nib.load(img).shape[:3]
+
+    if auto_grid:
+        grid_mode: str = TopupGridMode(grid_mode.lower()).name
+
+        if config:
+            subsamp: int = _max_subsamp(config=config)
+            if _grid_adjust(dims=src_dims, subsamp=subsamp, grid_mode=grid_mode) > max_adjust:
+                raise TopupGridError(
+                    f"The image dimensions {src_dims} can not be fit to the subsampling level ({subsamp}) of {config} "
+                    f"within {max_adjust} voxels ({grid_mode}). Use a configuration with a finer subsampling schedule, "
+                    f"increase the maximum adjustment, or omit the configuration."
+                )
+        else:
+            subsamp: int = _fastest_subsamp(dims=src_dims, grid_mode=grid_mode, max_adjust=max_adjust)
+            config: str = _topup_config(subsamp=subsamp, outdir=outdir)
+
+        img: image = _fit_grid(img=img, outdir=outdir, subsamp=subsamp, grid_mode=grid_mode)
 
-    cmd_str: str = f"topup --imain={img} --datain={acqp} --out={out_img}"
+    fitted: bool = tuple(nib.load(img).shape[:3]) != tuple(src_dims)
 
-    if fout:
-        fout_img: image = f"{outdir}/fieldmap.nii.gz"
+    # The fieldmap is always written (on the original image grid) for the consumers of an adjusted grid
+    if fitted and not fout:
+        fout: str = f"{out}_fieldmap"
+
+    fout_img: Union[image, None] = _topup_output(fout, default=f"{outdir}/fieldmap")
+    iout_img: Union[image, None] = _topup_output(iout, default=f"{outdir}/topup_b0s")
+
+    cmd_str: str = f"topup --imain={img} --datain={acqp} --out={out}"
+
+    if fout_img:
         cmd_str: str = f"{cmd_str} --fout={fout_img}"
-    else:
-        fout_img: file = None
 
-    if iout:
-        iout_img: image = f"{outdir}/topup_b0s.nii.gz"
+    if iout_img:
         cmd_str: str = f"{cmd_str} --iout={iout_img}"
-    else:
-        iout_img: file = None
 
     if verbose:
         cmd_str: str = f"{cmd_str} -v"
 
     if config:
-        with File(src=config, assert_exists=True) as f:
-            config: str = f.abspath()
         cmd_str: str = f"{cmd_str} --config={config}"
     
     cmd: Command = Command(cmd_str)
     cmd.check_dependency()
-    cmd.run(log=log)
+    run_command(cmd_str, env=fsl_env(), log=log)
+
+    if auto_grid:
+        for img_out in (fout_img, iout_img):
+            if img_out is not None:
+                _restore_grid(img=img_out, dims=src_dims)
+
+    grid_record: str = f"{out}_grid.json"
+
+    if fitted:
+        with open(grid_record, "w") as f:
+            json.dump({"Dims": list(src_dims), "Subsamp": subsamp, "GridMode": grid_mode, "Fieldmap": fout_img}, f, indent=4)
+    elif os.path.exists(grid_record):
+        os.remove(grid_record)
+
+    return out, fout_img, iout_img
+
+
+def applytopup(imgs: Sequence[Union[image, str]], acqp: Union[file, str], inindex: Sequence[int], topup: str, out: Union[image, str], method: str = "lsr", verbose: bool = False, log: Optional[LogFile] = None) -> image:
+    """Applies the susceptibility field estimated by ``topup`` to some input NIFTI images.
+
+    Wrapper function for ``FSL``'s ``applytopup``.
+
+    Should the image grid have been adjusted by ``topup`` (see ``topup``), the input 
+    images are fit to the same grid, and the output image is restored to the 
+    original image grid afterwards.
+
+    Usage example:
+        >>> hifi = applytopup(imgs=["B0_PA.nii.gz", "B0_AP.nii.gz"],
+        ...                   acqp="mr_params.acqp",
+        ...                   inindex=[1, 2],
+        ...                   topup="Topup/suscept_corr_B0",
+        ...                   out="Topup/hifi.nii.gz")
+        ...
+
+    Args:
+        imgs: Input image files.
+        acqp: Acquisition parameter file.
+        inindex: Row of the acquisition parameter file of each input image (1-based).
+        topup: ``topup`` output basename (i.e. the ``--out`` argument of ``topup``).
+        out: Output image.
+        method: Resampling method, valid options include ``lsr`` and ``jac``. Defaults to 'lsr'.
+        verbose: Enable verbose output. Defaults to False.
+        log: ``LogFile`` object for logging purposes. Defaults to None.
+
+    Raises:
+        IndexError: Exception that is raised if a different number of ``imgs`` and ``inindex`` are provided.
+
+    Returns:
+        Output image.
+    """
+    if len(imgs) != len(inindex):
+        raise IndexError("Inputs for 'imgs' and 'inindex' are of different lengths.")
+
+    with File(src=acqp, assert_exists=True) as f:
+        acqp: file = f.abspath()
+
+    out: image = os.path.abspath(intermediate_path(out))
+    outdir: str = os.path.dirname(out)
+    method: str = ApplyTopupMethod(method.lower()).name
+
+    with WorkDir(src=outdir) as _:
+        pass
+
+    grid: Optional[Dict[str, Any]] = _read_grid(topup)
+    inputs: List[image] = []
+
+    for n, img in enumerate(imgs):
+        with NiiFile(src=img, assert_exists=True, validate_nifti=True) as nii:
+            img: image = nii.abspath()
+        if grid:
+            img: image = _fit_grid(img=img, outdir=outdir, subsamp=grid["Subsamp"], grid_mode=grid["GridMode"], name=f"applytopup_imain{n}_grid")
+        inputs.append(img)
+
+    cmd_str: str = f"applytopup --imain={','.join(inputs)} --datain={acqp} --inindex={','.join(str(int(i)) for i in inindex)} --topup={topup} --method={method} --out={out}"
+
+    if verbose:
+        cmd_str: str = f"{cmd_str} --verbose"
+
+    cmd: Command = Command(cmd_str)
+    cmd.check_dependency()
+    run_command(cmd_str, env=fsl_env(), log=log)
+
+    if grid:
+        _restore_grid(img=out, dims=tuple(grid["Dims"]))
+
+    return out
+
+
+def _topup_output(name: Union[bool, str], default: str) -> Union[image, None]:
+    """Output image of a ``topup`` option that is either enabled (and written to a default file name), or a file name.
+
+    Args:
+        name: Option (``True``, or a file name).
+        default: Default file name.
+
+    Returns:
+        Output image (with the file extension of the intermediate images), or None if the option is not enabled.
+    """
+    if not name:
+        return None
+    return os.path.abspath(intermediate_path(default if name is True else name))
+
+
+def _read_grid(topup: str) -> Optional[Dict[str, Any]]:
+    """Reads the grid record of a ``topup`` output basename (see ``topup``).
+
+    Args:
+        topup: ``topup`` output basename.
+
+    Returns:
+        Grid record (original dimensions, subsampling level, grid adjustment method, and fieldmap), or None if the image grid was not adjusted.
+    """
+    grid_record: str = f"{topup}_grid.json"
+
+    if not os.path.exists(grid_record):
+        return None
+
+    with open(grid_record) as f:
+        return json.load(f)
+
+
+def _max_subsamp(config: Union[file, str]) -> int:
+    """Reads the coarsest subsampling level from a ``topup`` configuration file.
+
+    Args:
+        config: ``topup`` configuration file.
+
+    Returns:
+        Maximum subsampling level (``1`` if none is specified).
+    """
+    with open(config) as f:
+        for line in f:
+            line: str = line.split("#")[0].strip()
+            if line.startswith("--subsamp="):
+                return max(int(i) for i in line.split("=")[1].split(","))
+    return 1
+
+
+def _fastest_subsamp(dims: Tuple[int, ...], grid_mode: str = "pad", max_adjust: int = 2) -> int:
+    """Finds the fastest subsampling schedule that the image dimensions can be fit to.
+
+    Args:
+        dims: Spatial dimensions of the image.
+        grid_mode: Image grid adjustment method (``pad`` or ``crop``). Defaults to 'pad'.
+        max_adjust: Maximum number of voxels that may be added (or removed) along any axis. Defaults to 2.
+
+    Returns:
+        Maximum subsampling level of the schedule.
+    """
+    for subsamp in sorted(_TOPUP_SUBSAMP, reverse=True):
+        if _grid_adjust(dims=dims, subsamp=subsamp, grid_mode=grid_mode) <= max_adjust:
+            return subsamp
+    return 1
+
+
+def _grid_adjust(dims: Tuple[int, ...], subsamp: int, grid_mode: str = "pad") -> int:
+    """Maximum number of voxels that are added (or removed) along any axis to fit the image dimensions to a subsampling level.
+
+    Args:
+        dims: Spatial dimensions of the image.
+        subsamp: Maximum subsampling level of the schedule.
+        grid_mode: Image grid adjustment method (``pad`` or ``crop``). Defaults to 'pad'.
+
+    Returns:
+        Maximum number of voxels.
+    """
+    if grid_mode == "pad":
+        return max((-d) % subsamp for d in dims)
+    return max(d % subsamp for d in dims)
+
+
+def _topup_config(subsamp: int, outdir: str) -> str:
+    """Selects (or writes) the ``b02b0`` configuration file for some subsampling schedule.
+
+    The configuration files distributed with ``FSL`` (``$FSLDIR/etc/flirtsch``) 
+    are used if they exist, otherwise an equivalent configuration file is written 
+    to the output directory.
+
+    Args:
+        subsamp: Maximum subsampling level of the schedule.
+        outdir: Output directory.
+
+    Returns:
+        Absolute path to the configuration file.
+    """
+    flirtsch: str = os.path.join(os.environ.get("FSLDIR", ""), "etc", "flirtsch")
+
+    names: Tuple[str, ...] = (f"b02b0_{subsamp}.cnf",)
+    if subsamp == 2:
+        names: Tuple[str, ...] = ("b02b0.cnf",) + names
+
+    for name in names:
+        config: str = os.path.join(flirtsch, name)
+        if os.path.exists(config):
+            return os.path.abspath(config)
+
+    config: str = os.path.join(outdir, f"b02b0_{subsamp}.cnf")
+    with open(config, "w") as f:
+        f.write(_TOPUP_CONFIG.format(subsamp=_TOPUP_SUBSAMP[subsamp]))
+    return os.path.abspath(config)
+
+
+def _fit_grid(img: Union[image, str], outdir: str, subsamp: int, grid_mode: str = "pad", name: str = "topup_imain_grid") -> image:
+    """Pads (or crops) the spatial dimensions of an image to multiples of the subsampling level.
+
+    Args:
+        img: Input image file.
+        outdir: Output directory.
+        subsamp: Maximum subsampling level of the schedule.
+        grid_mode: Image grid adjustment method (``pad`` or ``crop``). Defaults to 'pad'.
+        name: Output file name (without extension). Defaults to 'topup_imain_grid'.
+
+    Returns:
+        Input image if no adjustment is needed, otherwise the adjusted image.
+    """
+    nii: nib.Nifti1Image = nib.load(img)
+    dims: Tuple[int, ...] = nii.shape[:3]
+
+    if all(d % subsamp == 0 for d in dims):
+        return img
+
+    data: np.ndarray = np.asanyarray(nii.dataobj)
+
+    if grid_mode == "pad":
+        pad: List[Tuple[int, int]] = [(0, (-d) % subsamp) for d in dims] + [(0, 0)] * (data.ndim - 3)
+        data: np.ndarray = np.pad(data, pad, mode="constant")
+    else:
+        data: np.ndarray = data[tuple(slice(0, d - d % subsamp) for d in dims)]
+
+    out: image = os.path.join(outdir, f"{name}.nii.gz")
+    return save_image(nib.Nifti1Image(data, nii.affine, nii.header), out, quantize=False)
+
+
+def _restore_grid(img: Union[image, str], dims: Tuple[int, ...]) -> image:
+    """Restores the spatial dimensions of a ``topup`` output image to the original image grid (in place).
+
+    Padded voxels are removed, and cropped voxels are filled with the nearest edge voxel values.
+
+    Args:
+        img: ``topup`` output image file.
+        dims: Original spatial dimensions.
+
+    Returns:
+        Restored image.
+    """
+    if not os.path.exists(img):
+        return img
+
+    nii: nib.Nifti1Image = nib.load(img)
+
+    if tuple(nii.shape[:3]) == tuple(dims):
+        return img
+
+    data: np.ndarray = np.asanyarray(nii.dataobj)
+    data: np.ndarray = data[tuple(slice(0, d) for d in dims)]
 
-    return out_img, fout_img, iout_img
+    pad: List[Tuple[int, int]] = [(0, d - s) for d, s in zip(dims, data.shape[:3])] + [(0, 0)] * (data.ndim - 3)
+    if any(p[1] for p in pad):
+        data: np.ndarray = np.pad(data, pad, mode="edge")
+
+    nib.save(nib.Nifti1Image(data, nii.affine, nii.header), img)
+    return img
 
 def bet():
     pass
 
-def eddy():
-    pass
+def eddy(
+    img: Union[image, str],
+    bvals: Union[file, str],
+    bvecs: Union[file, str],
+    mask: Union[image, str],
+    acqp: Union[file, str],
+    index: Union[file, str],
+    out: str,
+    topup: Optional[str] = None,
+    niter: int = 5,
+    fwhm: Union[int, Sequence[int]] = 0,
+    interp: str = "spline",
+    repol: bool = False,
+    residuals: bool = False,
+    cnr_maps: bool = False,
+    nvoxhp: int = 5000,
+    ol_type: str = "both",
+    ol_nstd: float = 3,
+    estimate_move_by_susceptibility: bool = False,
+    mbs_niter: int = 20,
+    mbs_ksp: int = 10,
+    mbs_lambda: int = 10,
+    slspec: Optional[Union[file, str]] = None,
+    mporder: int = 0,
+    s2v_niter: int = 5,
+    s2v_lambda: int = 1,
+    s2v_interp: str = "trilinear",
+    use_gpu: bool = False,
+    threads: Optional[int] = None,
+    resume: bool = True,
+    verbose: bool = False,
+    log: Optional[LogFile] = None,
+) -> Tuple[image, file]:
+    """Performs eddy current, and motion correction of some input DWI.
+
+    Wrapper function for ``FSL``'s ``eddy``.
+
+    The options are validated before ``eddy`` is run (e.g. the number of 
+    iterations and FWHM values, and the slice-to-volume options against the 
+    slice specification file). The executable is selected from the available 
+    ``eddy`` executables (``eddy_cuda*`` if ``use_gpu`` is enabled, otherwise 
+    ``eddy_cpu`` or ``eddy_openmp``), and the number of threads defaults to the 
+    number of cores allocated by the job scheduler.
+
+    Should ``resume`` be enabled, ``eddy`` is not run again if a complete set of 
+    outputs exists for the same inputs and options (e.g. when an interrupted 
+    batch is re-run).
+
+    NOTE:
+        * Slice-to-volume motion correction (``mporder`` > 0) requires ``use_gpu``.
+        * Should the image grid have been adjusted by ``topup`` (see ``topup``), its spline coefficients do not match the grid of the DWI, so the fieldmap (on the original image grid) of its grid record is used (``--field``) in place of ``--topup``.
+
+    Usage example:
+        >>> dwi, bvecs = eddy(img="dwi.nii.gz",
+        ...                   bvals="dwi.bval",
+        ...                   bvecs="dwi.bvec",
+        ...                   mask="hifi_brain_mask.nii.gz",
+        ...                   acqp="acqp.txt",
+        ...                   index="index.txt",
+        ...                   out="Eddy/sub-001_eddy_corr",
+        ...                   topup="Topup/suscept_corr_B0",
+        ...                   repol=True)
+        ...
+
+    Args:
+        img: Input DWI.
+        bvals: Corresponding b-value file.
+        bvecs: Corresponding b-vector file.
+        mask: Brain mask.
+        acqp: Acquisition parameter file.
+        index: Index file.
+        out: Output basename.
+        topup: ``topup`` output basename (i.e. the ``--out`` argument of ``topup``). Defaults to None.
+        niter: Number of iterations. Defaults to 5.
+        fwhm: FWHM (mm) for all iterations, or for each iteration. Defaults to 0.
+        interp: Interpolation model, valid options include ``spline`` and ``trilinear``. Defaults to 'spline'.
+        repol: Replace outlier slices. Defaults to False.
+        residuals: Write the residuals. Defaults to False.
+        cnr_maps: Write the shell-wise CNR maps. Defaults to False.
+        nvoxhp: Number of voxels used to estimate the hyperparameters. Defaults to 5000.
+        ol_type: Outlier grouping, valid options include ``sw``, ``gw``, and ``both``. Defaults to 'both'.
+        ol_nstd: Number of standard deviations for a slice to be considered an outlier. Defaults to 3.
+        estimate_move_by_susceptibility: Estimate how the susceptibility field changes with movement (requires ``topup``). Defaults to False.
+        mbs_niter: Number of iterations of the movement by susceptibility estimation. Defaults to 20.
+        mbs_ksp: Knot-spacing (mm) of the movement by susceptibility estimation. Defaults to 10.
+        mbs_lambda: Regularisation weight of the movement by susceptibility estimation. Defaults to 10.
+        slspec: Slice specification file (required for slice-to-volume motion correction). Defaults to None.
+        mporder: Order of the slice-to-volume movement model (0 disables slice-to-volume motion correction). Defaults to 0.
+        s2v_niter: Number of iterations of slice-to-volume motion correction. Defaults to 5.
+        s2v_lambda: Regularisation weight of slice-to-volume motion correction. Defaults to 1.
+        s2v_interp: Slice-to-volume interpolation model, valid options include ``spline`` and ``trilinear``. Defaults to 'trilinear'.
+        use_gpu: Use the GPU (CUDA) version of ``eddy``. Defaults to False.
+        threads: Number of threads (CPU versions of ``eddy``). Defaults to None (number of allocated cores).
+        resume: Use existing (complete) outputs. Defaults to True.
+        verbose: Enable verbose output. Defaults to False.
+        log: ``LogFile`` object for logging purposes. Defaults to None.
+
+    Raises:
+        EddyOptionError: Exception that is raised if the options are not valid.
+        FileNotFoundError: Exception that is raised if no ``eddy`` executable is found.
+        RuntimeError: Exception that is raised if ``eddy`` fails (its standard output and error are written to ``<out>.eddy.log`` and ``<out>.eddy.err``).
+
+    Returns:
+        * Corrected DWI.
+        * Rotated b-vector file.
+    """
+    with NiiFile(src=img, assert_exists=True, validate_nifti=True) as n:
+        img: image = n.abspath()
+
+    with NiiFile(src=mask, assert_exists=True) as m:
+        mask: image = m.abspath()
+
+    inputs: Dict[str, str] = {}
+    for name, f in (("bvals", bvals), ("bvecs", bvecs), ("acqp", acqp), ("index", index), ("slspec", slspec)):
+        if f:
+            with File(src=f, assert_exists=True) as fi:
+                inputs[name] = fi.abspath()
+
+    out: str = os.path.abspath(out)
+    outdir: str = os.path.dirname(out)
+
+    with WorkDir(src=outdir) as _:
+        pass
+
+    fwhm: List[int] = [int(i) for i in (fwhm if isinstance(fwhm, (list, tuple)) else [fwhm])]
+    interp: str = EddyInterp(interp.lower()).name
+    s2v_interp: str = EddyInterp(s2v_interp.lower()).name
+    ol_type: str = EddyOutlierType(ol_type.lower()).name
+
+    _validate_eddy(
+        img=img,
+        niter=niter,
+        fwhm=fwhm,
+        slspec=inputs.get("slspec"),
+        mporder=mporder,
+        use_gpu=use_gpu,
+        topup=topup,
+        estimate_move_by_susceptibility=estimate_move_by_susceptibility,
+    )
+
+    params: Dict[str, Any] = {
+        "topup": topup,
+        "niter": int(niter),
+        "fwhm": fwhm,
+        "interp": interp,
+        "repol": bool(repol),
+        "residuals": bool(residuals),
+        "cnr_maps": bool(cnr_maps),
+        "nvoxhp": int(nvoxhp),
+        "ol_type": ol_type,
+        "ol_nstd": float(ol_nstd),
+        "estimate_move_by_susceptibility": bool(estimate_move_by_susceptibility),
+        "mbs": [int(mbs_niter), int(mbs_ksp), int(mbs_lambda)],
+        "mporder": int(mporder),
+        "s2v": [int(s2v_niter), int(s2v_lambda), s2v_interp],
+    }
+
+    out_img: image = f"{out}{intermediate_ext()}"
+    out_bvecs: file = f"{out}.eddy_rotated_bvecs"
+    record: str = f"{out}.eddy_run.json"
+    outputs: List[str] = [out_img, out_bvecs, f"{out}.eddy_parameters"]
+
+    grid: Optional[Dict[str, Any]] = _read_grid(topup) if topup else None
+
+    files: List[str] = [img, mask] + [inputs.get(k) for k in ("bvals", "bvecs", "acqp", "index", "slspec")]
+    if grid:
+        files.append(grid["Fieldmap"])
+    elif topup:
+        files.append(f"{topup}_fieldcoef{intermediate_ext()}")
+
+    key: str = cache_key(files=[f if f and os.path.exists(f) else None for f in files], params=params)
+
+    if resume and is_cached(key=key, record=record, outputs=outputs):
+        if log:
+            log.info(f"Using existing eddy outputs:\t{out_img}")
+        return out_img, out_bvecs
+
+    exe: str = _eddy_binary(use_gpu=use_gpu)
+    threads: int = max(int(threads or available_cores()), 1)
+
+    cmd_str: str = f"{exe} --imain={img} --mask={mask} --acqp={inputs['acqp']} --index={inputs['index']} --bvecs={inputs['bvecs']} --bvals={inputs['bvals']} --out={out}"
+    cmd_str: str = f"{cmd_str} --niter={niter} --fwhm={','.join(str(i) for i in fwhm)} --interp={interp} --nvoxhp={nvoxhp} --ol_type={ol_type} --ol_nstd={ol_nstd}"
+
+    if grid:
+        cmd_str: str = f"{cmd_str} --field={NiiFile(src=grid['Fieldmap']).rm_ext()}"
+    elif topup:
+        cmd_str: str = f"{cmd_str} --topup={topup}"
+
+    if estimate_move_by_susceptibility:
+        cmd_str: str = f"{cmd_str} --estimate_move_by_susceptibility --mbs_niter={mbs_niter} --mbs_ksp={mbs_ksp} --mbs_lambda={mbs_lambda}"
+
+    if mporder > 0:
+        cmd_str: str = f"{cmd_str} --mporder={mporder} --s2v_niter={s2v_niter} --s2v_lambda={s2v_lambda} --s2v_interp={s2v_interp} --slspec={inputs['slspec']}"
+
+    if repol:
+        cmd_str: str = f"{cmd_str} --repol"
+
+    if residuals:
+        cmd_str: str = f"{cmd_str} --residuals"
+
+    if cnr_maps:
+        cmd_str: str = f"{cmd_str} --cnr_maps"
+
+    if os.path.basename(exe) == "eddy_cpu":
+        cmd_str: str = f"{cmd_str} --nthr={threads}"
+
+    if verbose:
+        cmd_str: str = f"{cmd_str} --verbose"
+
+    # Keep the standard output (e.g. the verbose output) and error of eddy, which are otherwise discarded
+    stdout: str = f"{out}.eddy.log"
+    stderr: str = f"{out}.eddy.err"
+
+    cmd: Command = Command(cmd_str)
+    cmd.check_dependency()
+    run_command(cmd_str, env={**fsl_env(), "OMP_NUM_THREADS": str(threads)}, log=log, stdout=stdout, stderr=stderr)
+
+    update_json(json_file=record, dictionary={"CacheKey": key, "Executable": exe, "Threads": threads, "Parameters": params})
+
+    return out_img, out_bvecs
+
+
+def _validate_eddy(img: Union[image, str], niter: int, fwhm: List[int], slspec: Optional[str] = None, mporder: int = 0, use_gpu: bool = False, topup: Optional[str] = None, estimate_move_by_susceptibility: bool = False) -> None:
+    """Validates (combinations of) ``eddy`` options.
+
+    Args:
+        img: Input DWI.
+        niter: Number of iterations.
+        fwhm: FWHM for all iterations, or for each iteration.
+        slspec: Slice specification file. Defaults to None.
+        mporder: Order of the slice-to-volume movement model. Defaults to 0.
+        use_gpu: Use the GPU (CUDA) version of ``eddy``. Defaults to False.
+        topup: ``topup`` output basename. Defaults to None.
+        estimate_move_by_susceptibility: Estimate how the susceptibility field changes with movement. Defaults to False.
+
+    Raises:
+        EddyOptionError: Exception that is raised if the options are not valid.
+    """
+    if niter < 1:
+        raise EddyOptionError(f"The number of iterations must be positive: {niter}")
+
+    if len(fwhm) not in (1, niter):
+        raise EddyOptionError(f"The number of FWHM values ({len(fwhm)}) must be 1, or equal to the number of iterations ({niter}).")
+
+    if estimate_move_by_susceptibility and not topup:
+        raise EddyOptionError("Movement by susceptibility estimation requires topup outputs.")
+
+    if mporder < 0:
+        raise EddyOptionError(f"The slice-to-volume movement model order must not be negative: {mporder}")
+
+    if mporder == 0:
+        return None
+
+    if not use_gpu:
+        raise EddyOptionError("Slice-to-volume motion correction (mporder > 0) requires the GPU (CUDA) version of eddy.")
+
+    if not slspec:
+        raise EddyOptionError("Slice-to-volume motion correction (mporder > 0) requires a slice specification file.")
+
+    spec: np.ndarray = np.loadtxt(slspec, ndmin=2).astype(int)
+    nz: int = nib.load(img).shape[2]
+
+    if not np.array_equal(np.sort(spec.ravel()), np.arange(nz)):
+        raise EddyOptionError(f"The slice specification file ({slspec}) does not list each of the {nz} slices of the DWI exactly once.")
+
+    if mporder > spec.shape[0] - 1:
+        raise EddyOptionError(f"The slice-to-volume movement model order ({mporder}) must not exceed the number of slice excitations - 1 ({spec.shape[0] - 1}).")
+
+    return None
+
+
+def _eddy_binary(use_gpu: bool = False) -> str:
+    """Finds the preferred ``eddy`` executable (in ``$FSLDIR/bin``, or the system path).
+
+    Args:
+        use_gpu: Use the GPU (CUDA) version of ``eddy``. Defaults to False.
+
+    Raises:
+        FileNotFoundError: Exception that is raised if no ``eddy`` executable is found.
+
+    Returns:
+        Path to the ``eddy`` executable.
+    """
+    names: Tuple[str, ...] = _EDDY_GPU if use_gpu else _EDDY_CPU
+    fsl_bin: Union[str, None] = os.path.join(os.environ["FSLDIR"], "bin") if os.environ.get("FSLDIR") else None
+
+    for name in names:
+        exe: Union[str, None] = (fsl_bin and shutil.which(name, path=fsl_bin)) or shutil.which(name)
+        if exe:
+            return exe
+
+    raise FileNotFoundError(f"None of the eddy executables were found: {', '.join(names)}")
 
 def dtifit():
     pass
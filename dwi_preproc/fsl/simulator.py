@@ -0,0 +1,1107 @@
+"""Simulator (stand-in executables) of the ``FSL`` tools (and ``ANTs``' ``N4BiasFieldCorrection``) used by the pipeline.
+
+The stand-in executables accept the same command lines as the ``FSL`` tools
+(as called by ``dwi_preproc.fsl.fslpy`` and ``dwi_preproc.sh``), and write
+correctly shaped (deterministic) outputs from their inputs, so that the
+orchestration, caching and scheduling of the pipeline can be tested and
+benchmarked without ``FSL`` (or hours of compute).
+
+The cost (latency, CPU and memory usage) of each simulated tool is set by a
+profile, and scales with the size of its (main) input image. The profile is
+read from the ``DWI_PREPROC_SIM_PROFILE`` environment variable (the name of a
+built-in profile, or a JSON file), and each run is (optionally) appended to
+the JSON lines trace file of the ``DWI_PREPROC_SIM_TRACE`` environment variable.
+
+Usage example:
+    >>> fsldir = install("/tmp/fsl_sim", profile="laptop")
+    >>> os.environ.update(sim_env(fsldir))
+    >>> out, fmap, b0s = topup(img="B0s.nii.gz", outdir="Topup", acqp="acqp.txt", fout=True)
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import multiprocessing
+import numpy as np
+import nibabel as nib
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Cost of each tool on the reference image (in seconds, MB of memory, CPU duty cycle, and whether it is multi-threaded)
+_COSTS: Dict[str, Tuple[float, float, float, bool]] = {
+    "topup": (900.0, 600.0, 1.0, False),
+    "applytopup": (15.0, 400.0, 1.0, False),
+    "eddy": (5400.0, 4000.0, 1.0, True),
+    "eddy_cuda": (900.0, 3000.0, 0.15, False),
+    "bet": (5.0, 200.0, 1.0, False),
+    "dtifit": (60.0, 800.0, 1.0, False),
+    "fslroi": (2.0, 300.0, 1.0, False),
+    "fslmerge": (2.0, 300.0, 1.0, False),
+    "fslsplit": (2.0, 300.0, 1.0, False),
+    "fslmaths": (2.0, 300.0, 1.0, False),
+    "fslval": (0.05, 20.0, 1.0, False),
+    "eddy_quad": (60.0, 500.0, 1.0, False),
+    "remove_ext": (0.01, 10.0, 1.0, False),
+    "flirt": (30.0, 300.0, 1.0, False),
+    "aff2rigid": (0.5, 50.0, 1.0, False),
+    "applywarp": (5.0, 300.0, 1.0, False),
+    "N4BiasFieldCorrection": (30.0, 300.0, 1.0, True),
+}
+
+# Size (voxels x volumes) of the reference image of the tool costs
+_REF_VOXELS: int = 96 * 96 * 60 * 100
+
+# Parallel fraction of multi-threaded tools (Amdahl's law)
+_PARALLEL: float = 0.9
+
+# Built-in profiles: scale factors of the time and memory costs, and the CPU duty cycle
+_PROFILES: Dict[str, Dict[str, Any]] = {
+    "instant": {"time": 0.0, "memory": 0.0, "cpu": 0.0},
+    "laptop": {"time": 0.005, "memory": 0.05, "cpu": 1.0},
+    "realistic": {"time": 1.0, "memory": 1.0, "cpu": 1.0},
+}
+
+# Executable names of each simulated tool
+_ALIASES: Dict[str, str] = {
+    "eddy_cpu": "eddy",
+    "eddy_openmp": "eddy",
+    "eddy_cuda10.2": "eddy_cuda",
+    "eddy_cuda9.1": "eddy_cuda",
+    "eddy_cuda8.0": "eddy_cuda",
+}
+
+# Image file extension of each FSLOUTPUTTYPE
+_OUTPUT_EXT: Dict[str, str] = {"NIFTI_GZ": ".nii.gz", "NIFTI": ".nii"}
+
+# b-values less than or equal to this value are considered to be b0s
+_B0_THRESH: float = 50
+
+
+class SimulatorError(Exception):
+    """Exception intended for invalid (simulated) ``FSL`` command lines, or missing inputs."""
+    pass
+
+
+class _Budget:
+    """Spends the (simulated) cost of a tool run, as set by the profile."""
+
+    def __init__(self, tool: str, profile: Dict[str, Any], threads: int = 1) -> None:
+        """Initializes the cost of a tool run.
+
+        Args:
+            tool: Simulated tool (not an alias).
+            profile: Profile (see ``load_profile``).
+            threads: Number of threads (of multi-threaded tools). Defaults to 1.
+        """
+        seconds, memory, cpu, threaded = _COSTS[tool]
+        override: Dict[str, float] = profile.get("tools", {}).get(tool, {})
+
+        self.seconds: float = float(override.get("seconds", seconds * profile["time"]))
+        self.memory: float = float(override.get("memory", memory * profile["memory"]))
+        self.cpu: float = float(override.get("cpu", cpu * profile["cpu"]))
+        self.threads: int = max(int(threads), 1) if threaded else 1
+        self.jitter: float = float(profile.get("jitter", 0.0))
+        self.seed: int = int(profile.get("seed", 0))
+        self.spent: Dict[str, float] = {"seconds": 0.0, "memory_mb": 0.0}
+
+    def spend(self, shape: Sequence[int], key: str = "") -> None:
+        """Spends the cost of processing an image of some shape (sleeping, or busy, and holding memory).
+
+        Args:
+            shape: Shape of the (main) input image.
+            key: Additional (deterministic) jitter seed. Defaults to ''.
+        """
+        size: float = float(np.prod(shape)) / _REF_VOXELS
+        seconds: float = self.seconds * size * ((1 - _PARALLEL) + _PARALLEL / self.threads)
+
+        if self.jitter:
+            seconds *= 1 + self.jitter * (2 * _rng(self.seed, "jitter", key, tuple(shape)).random() - 1)
+
+        memory: float = self.memory * size
+        self.spent: Dict[str, float] = {"seconds": round(seconds, 6), "memory_mb": round(memory, 3)}
+
+        if seconds <= 0:
+            return None
+
+        # Touch each page, so that the memory is resident
+        held: np.ndarray = np.ones(int(memory * 2 ** 20) // 8) if memory > 0 else None
+
+        workers: List[multiprocessing.Process] = []
+        if self.cpu > 0:
+            for _ in range(self.threads - 1):
+                p: multiprocessing.Process = multiprocessing.Process(target=_burn, args=(seconds, self.cpu), daemon=True)
+                p.start()
+                workers.append(p)
+
+        _burn(seconds, self.cpu)
+
+        for p in workers:
+            p.join()
+
+        del held
+        return None
+
+
+def load_profile(profile: Optional[str] = None) -> Dict[str, Any]:
+    """Loads a simulator profile.
+
+    A profile is the name of a built-in profile (``instant``, ``laptop``, or
+    ``realistic``), or a JSON file that (optionally) names its ``base`` profile,
+    and sets any of:
+        * ``time``, ``memory``: Scale factors of the (reference) time and memory cost of each tool.
+        * ``cpu``: CPU duty cycle (0: sleep, 1: busy) while a tool runs.
+        * ``jitter``: Relative (deterministic) variation of the run times.
+        * ``seed``: Seed of the simulated outputs and the run time variation.
+        * ``tools``: Dictionary of per-tool ``seconds``, ``memory`` (MB), and ``cpu`` costs (on the reference image).
+
+    Args:
+        profile: Built-in profile name, or JSON file. Defaults to None (``DWI_PREPROC_SIM_PROFILE``, or ``instant``).
+
+    Raises:
+        SimulatorError: Exception that is raised if the profile does not exist.
+
+    Returns:
+        Profile dictionary.
+    """
+    profile: str = profile or os.environ.get("DWI_PREPROC_SIM_PROFILE", "") or "instant"
+
+    if profile in _PROFILES:
+        return {**_PROFILES[profile], "name": profile}
+
+    if not os.path.isfile(profile):
+        raise SimulatorError(f"Unknown simulator profile (valid options include {', '.join(_PROFILES)}, or a JSON file): {profile}")
+
+    with open(profile) as f:
+        custom: Dict[str, Any] = json.load(f)
+
+    base: str = custom.get("base", "instant")
+    if base not in _PROFILES:
+        raise SimulatorError(f"Unknown base simulator profile: {base}")
+
+    return {**_PROFILES[base], **custom, "name": os.path.abspath(profile)}
+
+
+def install(fsldir: str, profile: Optional[str] = None, tools: Optional[Sequence[str]] = None) -> str:
+    """Installs the stand-in executables (and supporting files) in a simulated ``FSLDIR``.
+
+    The installed ``FSLDIR`` contains:
+        * ``bin/<tool>``: Executables of the simulated tools (and their aliases, e.g. ``eddy_openmp``, ``eddy_cuda9.1``).
+        * ``etc/fslversion``, and ``etc/flirtsch/b02b0*.cnf``: ``topup`` configuration files.
+        * ``fslpython/bin/activate``: No-op environment activation script (used by ``dwi_preproc.sh``).
+
+    Usage example:
+        >>> fsldir = install("/tmp/fsl_sim", profile="laptop")
+        >>> fsldir
+        "/tmp/fsl_sim"
+
+    Args:
+        fsldir: Simulated ``FSLDIR``.
+        profile: Default profile of the executables. Defaults to None (``DWI_PREPROC_SIM_PROFILE`` at run time).
+        tools: Tools (or aliases) to install. Defaults to None (all tools).
+
+    Raises:
+        SimulatorError: Exception that is raised if a tool is not simulated, or the profile does not exist.
+
+    Returns:
+        Absolute path to the simulated ``FSLDIR``.
+    """
+    from dwi_preproc.fsl.fslpy import _TOPUP_CONFIG, _TOPUP_SUBSAMP
+
+    fsldir: str = os.path.abspath(fsldir)
+    names: List[str] = list(tools or list(_COSTS) + list(_ALIASES))
+
+    for name in names:
+        if _ALIASES.get(name, name) not in _COSTS:
+            raise SimulatorError(f"The FSL tool is not simulated: {name}")
+
+    if profile:
+        load_profile(profile)
+        if os.path.isfile(profile):
+            profile: str = os.path.abspath(profile)
+
+    for d in ("bin", os.path.join("etc", "flirtsch"), os.path.join("fslpython", "bin")):
+        os.makedirs(os.path.join(fsldir, d), exist_ok=True)
+
+    root: str = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env: str = f"os.environ.setdefault('DWI_PREPROC_SIM_PROFILE', {profile!r})\n" if profile else ""
+
+    launcher: str = (
+        f"#!{sys.executable}\n"
+        "# FSL tool simulator (written by dwi_preproc.fsl.simulator.install)\n"
+        "import os\n"
+        "import sys\n"
+        f"sys.path.insert(0, {root!r})\n"
+        f"{env}"
+        "from dwi_preproc.fsl.simulator import main\n"
+        "sys.exit(main())\n"
+    )
+
+    for name in names:
+        exe: str = os.path.join(fsldir, "bin", name)
+        with open(exe, "w") as f:
+            f.write(launcher)
+        os.chmod(exe, 0o755)
+
+    with open(os.path.join(fsldir, "etc", "fslversion"), "w") as f:
+        f.write("6.0.3:simulated\n")
+
+    for subsamp, sched in _TOPUP_SUBSAMP.items():
+        cnf: str = _TOPUP_CONFIG.format(subsamp=sched)
+        for name in (f"b02b0_{subsamp}.cnf",) + (("b02b0.cnf",) if subsamp == 2 else ()):
+            with open(os.path.join(fsldir, "etc", "flirtsch", name), "w") as f:
+                f.write(cnf)
+
+    with open(os.path.join(fsldir, "fslpython", "bin", "activate"), "w") as f:
+        f.write("# Simulated FSL python environment (no-op)\nconda() { :; }\n")
+
+    return fsldir
+
+
+def sim_env(fsldir: str, profile: Optional[str] = None, trace: Optional[str] = None) -> Dict[str, str]:
+    """Environment variables that select a simulated ``FSLDIR`` (i.e. for subprocesses, or ``os.environ``).
+
+    Args:
+        fsldir: Simulated ``FSLDIR`` (see ``install``).
+        profile: Profile. Defaults to None (the default profile of the executables).
+        trace: JSON lines trace file of the tool runs. Defaults to None.
+
+    Returns:
+        Dictionary of environment variables.
+    """
+    fsldir: str = os.path.abspath(fsldir)
+    env: Dict[str, str] = {
+        "FSLDIR": fsldir,
+        "FSLOUTPUTTYPE": os.environ.get("FSLOUTPUTTYPE", "NIFTI_GZ"),
+        "PATH": os.pathsep.join([os.path.join(fsldir, "bin"), os.environ.get("PATH", "")]),
+    }
+
+    if profile:
+        env["DWI_PREPROC_SIM_PROFILE"] = os.path.abspath(profile) if os.path.isfile(profile) else profile
+
+    if trace:
+        env["DWI_PREPROC_SIM_TRACE"] = os.path.abspath(trace)
+
+    return env
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Runs a simulated tool, selected by the name of the executable (i.e. ``argv[0]``).
+
+    Args:
+        argv: Command line (including the executable). Defaults to None (``sys.argv``).
+
+    Returns:
+        Exit status.
+    """
+    argv: List[str] = list(sys.argv if argv is None else argv)
+    name: str = os.path.basename(argv[0])
+    tool: str = _ALIASES.get(name, name)
+
+    if tool not in _TOOLS:
+        print(f"{name}: not a simulated FSL tool (valid options include {', '.join(sorted(_TOOLS))})", file=sys.stderr)
+        return 2
+
+    start: float = time.time()
+    status: int = 0
+    budget: Optional[_Budget] = None
+
+    try:
+        profile: Dict[str, Any] = load_profile()
+        budget: _Budget = _Budget(tool=tool, profile=profile, threads=_threads(argv[1:]))
+        _TOOLS[tool](argv[1:], budget)
+    except SimulatorError as e:
+        print(f"{name}: {e}", file=sys.stderr)
+        status: int = 1
+
+    trace: str = os.environ.get("DWI_PREPROC_SIM_TRACE", "")
+    if trace:
+        record: Dict[str, Any] = {
+            "tool": name,
+            "argv": argv[1:],
+            "pid": os.getpid(),
+            "start": round(start, 6),
+            "end": round(time.time(), 6),
+            "threads": budget.threads if budget else 1,
+            **(budget.spent if budget else {}),
+            "status": status,
+        }
+        # A single (appended) write per run, so that concurrent runs do not interleave
+        with open(trace, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    return status
+
+
+def read_trace(src: str) -> List[Dict[str, Any]]:
+    """Reads a JSON lines trace file of (simulated) tool runs.
+
+    Args:
+        src: Input trace file.
+
+    Returns:
+        List of tool runs (``tool``, ``argv``, ``pid``, ``start``, ``end``, ``threads``, ``seconds``, ``memory_mb``, and ``status``).
+    """
+    with open(src) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def max_concurrency(runs: Sequence[Dict[str, Any]]) -> int:
+    """Computes the maximum number of concurrent tool runs of a trace.
+
+    Args:
+        runs: Tool runs (see ``read_trace``).
+
+    Returns:
+        Maximum number of concurrent runs.
+    """
+    events: List[Tuple[float, int]] = sorted([(r["start"], 1) for r in runs] + [(r["end"], -1) for r in runs])
+    n, peak = 0, 0
+
+    for _, step in events:
+        n += step
+        peak: int = max(peak, n)
+
+    return peak
+
+
+def _topup(args: List[str], budget: _Budget) -> None:
+    """``topup --imain --datain --out [--fout] [--iout] [--config]``"""
+    opts: Dict[str, str] = _options(args, required=("imain", "datain", "out"))
+    nii: nib.Nifti1Image = _load(opts["imain"])
+    _exists(opts["datain"])
+
+    n_vols: int = nii.shape[3] if len(nii.shape) > 3 else 1
+    if len(np.loadtxt(opts["datain"], ndmin=2)) < n_vols:
+        raise SimulatorError(f"The number of rows of the acquisition parameter file ({opts['datain']}) is less than the number of volumes ({n_vols}).")
+
+    budget.spend(nii.shape, key=opts["out"])
+
+    out: str = _strip(opts["out"])
+    dims: Tuple[int, ...] = nii.shape[:3]
+    rng: np.random.Generator = _rng(budget.seed, "topup", nii.shape)
+
+    coef: np.ndarray = rng.normal(scale=5.0, size=_coef_shape(dims)).astype(np.float32)
+    _save(coef, nii, out + "_fieldcoef")
+
+    movpar: np.ndarray = np.vstack([np.zeros(6), rng.normal(scale=[0.2, 0.2, 0.2, 0.002, 0.002, 0.002], size=(n_vols - 1, 6))])
+    np.savetxt(out + "_movpar.txt", movpar, fmt="%.6f", delimiter="  ")
+
+    if "fout" in opts:
+        _save(_field(dims), nii, opts["fout"], dtype=np.float32)
+
+    if "iout" in opts:
+        _save(np.asarray(nii.dataobj, dtype=np.float32), nii, opts["iout"], dtype=np.float32)
+
+    return None
+
+
+def _applytopup(args: List[str], budget: _Budget) -> None:
+    """``applytopup --imain=<img>[,<img>] --inindex --topup --out [--datain] [--method]``"""
+    opts: Dict[str, str] = _options(args, required=("imain", "inindex", "topup", "out"))
+    niis: List[nib.Nifti1Image] = [_load(i) for i in opts["imain"].split(",")]
+
+    if len(opts["inindex"].split(",")) != len(niis):
+        raise SimulatorError("The number of input indices must equal the number of input images.")
+
+    if len({n.shape for n in niis}) > 1:
+        raise SimulatorError("The input images must have the same shape.")
+
+    _fieldcoef(opts["topup"], niis[0].shape[:3])
+
+    budget.spend((len(niis),) + niis[0].shape, key=opts["out"])
+
+    if opts.get("method", "lsr") == "lsr":
+        data: np.ndarray = np.mean([np.asarray(n.dataobj, dtype=np.float32) for n in niis], axis=0)
+    else:
+        data: np.ndarray = np.asarray(niis[0].dataobj, dtype=np.float32)
+
+    _save(data, niis[0], opts["out"], dtype=np.float32)
+    return None
+
+
+def _eddy(args: List[str], budget: _Budget) -> None:
+    """``eddy --imain --mask --acqp --index --bvecs --bvals --out [options]``"""
+    opts: Dict[str, str] = _options(args, required=("imain", "mask", "acqp", "index", "bvecs", "bvals", "out"))
+    nii: nib.Nifti1Image = _load(opts["imain"])
+    _load(opts["mask"])
+
+    for k in ("acqp", "index", "bvecs", "bvals"):
+        _exists(opts[k])
+
+    if "topup" in opts:
+        _fieldcoef(opts["topup"], nii.shape[:3])
+
+    if "field" in opts and _load(opts["field"]).shape[:3] != nii.shape[:3]:
+        raise SimulatorError(f"The field ({opts['field']}) and the input image ({opts['imain']}) do not have the same dimensions.")
+
+    bvals: np.ndarray = np.loadtxt(opts["bvals"]).ravel()
+    bvecs: np.ndarray = np.loadtxt(opts["bvecs"], ndmin=2)
+    n_vols: int = nii.shape[3] if len(nii.shape) > 3 else 1
+    nz: int = nii.shape[2]
+
+    if len(bvals) != n_vols or bvecs.shape[-1] != n_vols:
+        raise SimulatorError(f"The number of b-values ({len(bvals)}) and b-vectors ({bvecs.shape[-1]}) must equal the number of volumes ({n_vols}).")
+
+    mporder: int = int(opts.get("mporder", 0))
+    excitations: int = nz
+    if mporder > 0:
+        excitations: int = len(np.loadtxt(_exists(opts.get("slspec", "")), ndmin=2))
+
+    budget.spend(nii.shape, key=opts["out"])
+
+    out: str = _strip(opts["out"])
+    rng: np.random.Generator = _rng(budget.seed, "eddy", nii.shape)
+    data: np.ndarray = np.asarray(nii.dataobj, dtype=np.float32)
+    _save(data, nii, out, dtype=np.float32)
+
+    # Motion (slow drift, and jitter) and linear/quadratic eddy current parameters
+    params: np.ndarray = np.zeros((n_vols, 16))
+    params[:, :3] = np.cumsum(rng.normal(scale=0.05, size=(n_vols, 3)), axis=0)
+    params[:, 3:6] = np.cumsum(rng.normal(scale=5e-4, size=(n_vols, 3)), axis=0)
+    params[:, 6:16] = rng.normal(scale=[0.5, 0.5, 0.5] + [1e-3] * 6 + [10.0], size=(n_vols, 10)) * (bvals > _B0_THRESH)[:, None]
+    np.savetxt(out + ".eddy_parameters", params, fmt="%.6e", delimiter="  ")
+
+    trans: np.ndarray = params[:, :3]
+    rms: np.ndarray = np.stack([np.linalg.norm(trans - trans[0], axis=1), np.r_[0, np.linalg.norm(np.diff(trans, axis=0), axis=1)]], axis=1)
+    np.savetxt(out + ".eddy_movement_rms", rms, fmt="%.6f", delimiter="  ")
+    np.savetxt(out + ".eddy_restricted_movement_rms", rms * 0.8, fmt="%.6f", delimiter="  ")
+
+    np.savetxt(out + ".eddy_rotated_bvecs", bvecs, fmt="%.6f", delimiter="  ")
+
+    shells: np.ndarray = np.unique(np.round(bvals[bvals > _B0_THRESH], -2))
+    np.savetxt(out + ".eddy_post_eddy_shell_alignment_parameters", np.zeros((len(shells), 6)), fmt="%.6f", delimiter="  ")
+    np.savetxt(out + ".eddy_post_eddy_shell_PE_translation_parameters", np.zeros((len(shells), 1)), fmt="%.6f", delimiter="  ")
+
+    # Outlier slices of the diffusion weighted volumes
+    nstd: np.ndarray = np.abs(rng.normal(size=(n_vols, nz))) * (bvals > _B0_THRESH)[:, None]
+    ol: np.ndarray = nstd > float(opts.get("ol_nstd", 3))
+    header: str = "One row per scan, one column per slice."
+    np.savetxt(out + ".eddy_outlier_map", ol.astype(int), fmt="%d", header=f"{header} Outlier: 1, Non-outlier: 0", comments="")
+    np.savetxt(out + ".eddy_outlier_n_stdev_map", nstd, fmt="%.4f", header=f"{header} Number of standard deviations", comments="")
+    np.savetxt(out + ".eddy_outlier_n_sqr_stdev_map", nstd ** 2, fmt="%.4f", header=f"{header} Number of standard deviations (squared)", comments="")
+
+    with open(out + ".eddy_outlier_report", "w") as f:
+        for v, s in zip(*np.nonzero(ol)):
+            f.write(f"Slice {s} in scan {v} is an outlier with mean {-nstd[v, s]:.4f} standard deviations off, and mean squared {nstd[v, s] ** 2:.4f} standard deviations off.\n")
+
+    if mporder > 0:
+        mot: np.ndarray = np.repeat(params[:, :6], excitations, axis=0) + rng.normal(scale=0.01, size=(n_vols * excitations, 6))
+        np.savetxt(out + ".eddy_movement_over_time", mot, fmt="%.6f", delimiter="  ")
+
+    if "repol" in opts:
+        _save(data, nii, out + ".eddy_outlier_free_data", dtype=np.float32)
+
+    if "residuals" in opts:
+        _save(rng.normal(scale=5.0, size=data.shape).astype(np.float32), nii, out + ".eddy_residuals", dtype=np.float32)
+
+    if "cnr_maps" in opts:
+        b0: np.ndarray = data[..., bvals <= _B0_THRESH] if data.ndim > 3 else data[..., np.newaxis]
+        tsnr: np.ndarray = np.mean(b0, axis=-1) / (np.std(b0, axis=-1) + 1e-6) if b0.shape[-1] > 1 else np.zeros(data.shape[:3])
+        cnr: np.ndarray = np.stack([tsnr] + [np.where(data[..., 0] > 0, 2.0 + 0.001 * b, 0) for b in shells], axis=-1)
+        _save(cnr.astype(np.float32), nii, out + ".eddy_cnr_maps", dtype=np.float32)
+
+    with open(out + ".eddy_command_txt", "w") as f:
+        f.write(" ".join(["eddy"] + args) + "\n")
+
+    with open(out + ".eddy_values_of_all_input_parameters", "w") as f:
+        f.write("\n".join(f"--{k}={v}" for k, v in sorted(opts.items())) + "\n")
+
+    return None
+
+
+def _bet(args: List[str], budget: _Budget) -> None:
+    """``bet <input> <output> [-m] [-n] [-f <f>] [options]``"""
+    if len(args) < 2:
+        raise SimulatorError("Usage: bet <input> <output> [options]")
+
+    nii: nib.Nifti1Image = _load(args[0])
+    out: str = _strip(args[1])
+    flags: List[str] = args[2:]
+    frac: float = float(flags[flags.index("-f") + 1]) if "-f" in flags[:-1] else 0.5
+
+    budget.spend(nii.shape[:3], key=out)
+
+    data: np.ndarray = np.asarray(nii.dataobj)
+    vol: np.ndarray = data[..., 0] if data.ndim > 3 else data
+    lo, hi = np.percentile(vol, (2, 98))
+    mask: np.ndarray = vol > lo + 0.2 * frac * (hi - lo)
+
+    if "-n" not in flags:
+        _save(np.where(mask, vol, 0).astype(vol.dtype), nii, out, shape=vol.shape)
+
+    if "-m" in flags:
+        _save(mask.astype(np.uint8), nii, out + "_mask", dtype=np.uint8, shape=vol.shape)
+
+    return None
+
+
+def _dtifit(args: List[str], budget: _Budget) -> None:
+    """``dtifit --data --out --mask --bvecs --bvals [--save_tensor]`` (or ``-k -o -m -r -b``)"""
+    short: Dict[str, str] = {"-k": "data", "-o": "out", "-m": "mask", "-r": "bvecs", "-b": "bvals"}
+    args: List[str] = [f"--{short[a]}={b}" for a, b in zip(args, args[1:]) if a in short] + [a for a in args if a.startswith("--")]
+    opts: Dict[str, str] = _options(args, required=("data", "out", "mask", "bvecs", "bvals"))
+
+    nii: nib.Nifti1Image = _load(opts["data"])
+    mask: np.ndarray = np.asarray(_load(opts["mask"]).dataobj) > 0
+    bvals: np.ndarray = np.loadtxt(_exists(opts["bvals"])).ravel()
+    bvecs: np.ndarray = np.loadtxt(_exists(opts["bvecs"]), ndmin=2)
+
+    if bvecs.shape[0] != 3:
+        bvecs: np.ndarray = bvecs.T
+
+    if len(nii.shape) != 4 or nii.shape[3] != len(bvals) or bvecs.shape[1] != len(bvals):
+        raise SimulatorError(f"The number of b-values ({len(bvals)}), b-vectors, and volumes {nii.shape} must be equal.")
+
+    budget.spend(nii.shape, key=opts["out"])
+
+    # Log-linear least squares tensor fit (within the mask)
+    x, y, z = bvecs
+    design: np.ndarray = np.stack([np.ones_like(bvals), -bvals * x * x, -2 * bvals * x * y, -2 * bvals * x * z, -bvals * y * y, -2 * bvals * y * z, -bvals * z * z], axis=1)
+    sig: np.ndarray = np.asarray(nii.dataobj, dtype=np.float64)[mask]
+    coef: np.ndarray = np.log(np.maximum(sig, 1.0)) @ np.linalg.pinv(design).T
+
+    xx, xy, xz, yy, yz, zz = (coef[:, i] for i in range(1, 7))
+    tensor: np.ndarray = np.stack([np.stack([xx, xy, xz], -1), np.stack([xy, yy, yz], -1), np.stack([xz, yz, zz], -1)], -2)
+    evals, evecs = np.linalg.eigh(tensor)
+    evals, evecs = evals[:, ::-1], evecs[:, :, ::-1]
+
+    md: np.ndarray = evals.mean(axis=1)
+    fa: np.ndarray = np.sqrt(1.5 * np.sum((evals - md[:, None]) ** 2, axis=1) / np.maximum(np.sum(evals ** 2, axis=1), 1e-20))
+    dev: np.ndarray = tensor - md[:, None, None] * np.eye(3)
+    norm: np.ndarray = np.linalg.norm(dev, axis=(1, 2))
+    mo: np.ndarray = np.clip(3 * np.sqrt(6) * np.linalg.det(dev / np.maximum(norm, 1e-20)[:, None, None]), -1, 1)
+
+    out: str = _strip(opts["out"])
+    maps: Dict[str, np.ndarray] = {"FA": fa, "MD": md, "MO": mo, "S0": np.exp(coef[:, 0])}
+    for i in range(3):
+        maps[f"L{i + 1}"] = evals[:, i]
+        maps[f"V{i + 1}"] = evecs[:, :, i]
+
+    if "save_tensor" in opts:
+        maps["tensor"] = coef[:, 1:]
+
+    for name, vox in maps.items():
+        vol: np.ndarray = np.zeros(nii.shape[:3] + vox.shape[1:], dtype=np.float32)
+        vol[mask] = vox
+        _save(vol, nii, f"{out}_{name}", dtype=np.float32)
+
+    return None
+
+
+def _fslroi(args: List[str], budget: _Budget) -> None:
+    """``fslroi <input> <output> <tmin> <tsize>`` (or ``<xmin> <xsize> <ymin> <ysize> <zmin> <zsize> [<tmin> <tsize>]``)"""
+    if len(args) not in (4, 8, 10):
+        raise SimulatorError("Usage: fslroi <input> <output> <tmin> <tsize> (or <xmin> <xsize> <ymin> <ysize> <zmin> <zsize> [<tmin> <tsize>])")
+
+    nii: nib.Nifti1Image = _load(args[0])
+    # Non-numeric arguments are read as 0 (as with atof)
+    nums: List[int] = [int(_atof(a)) for a in args[2:]]
+    data: np.ndarray = np.asarray(nii.dataobj)
+    data: np.ndarray = data[..., np.newaxis] if data.ndim == 3 else data
+
+    if len(nums) == 2:
+        nums: List[int] = [0, -1, 0, -1, 0, -1] + nums
+
+    roi: List[slice] = [slice(lo, None if n < 0 else lo + n) for lo, n in zip(nums[::2], nums[1::2])]
+    roi += [slice(None)] * (4 - len(roi))
+    data: np.ndarray = data[tuple(roi)]
+
+    if 0 in data.shape:
+        raise SimulatorError(f"The region of interest is empty: {' '.join(args[2:])}")
+
+    budget.spend(data.shape, key=args[1])
+    _save(data, nii, args[1], shape=data.shape if data.shape[3] > 1 else data.shape[:3])
+    return None
+
+
+def _fslmerge(args: List[str], budget: _Budget) -> None:
+    """``fslmerge -t|-x|-y|-z|-a <output> <file1> <file2> ...`` (or ``-tr <output> <files> <tr>``)"""
+    axes: Dict[str, int] = {"-x": 0, "-y": 1, "-z": 2, "-t": 3, "-a": 3, "-tr": 3}
+
+    if len(args) < 3 or args[0] not in axes:
+        raise SimulatorError("Usage: fslmerge <-x/y/z/t/a/tr> <output> <file1 file2 ...> [tr]")
+
+    inputs: List[str] = args[2:-1] if args[0] == "-tr" else args[2:]
+    niis: List[nib.Nifti1Image] = [_load(i) for i in inputs]
+    data: List[np.ndarray] = [np.asarray(n.dataobj) for n in niis]
+    data: List[np.ndarray] = [d[..., np.newaxis] if d.ndim == 3 else d for d in data]
+    axis: int = axes[args[0]]
+
+    if len({d.shape[:axis] + d.shape[axis + 1:] for d in data}) > 1:
+        raise SimulatorError("The input images must have the same dimensions (other than the merged dimension).")
+
+    merged: np.ndarray = np.concatenate(data, axis=axis)
+    budget.spend(merged.shape, key=args[1])
+    _save(merged, niis[0], args[1], shape=merged.shape if merged.shape[3] > 1 else merged.shape[:3])
+    return None
+
+
+def _fslsplit(args: List[str], budget: _Budget) -> None:
+    """``fslsplit <input> [output_basename] [-t|-x|-y|-z]``"""
+    if not args:
+        raise SimulatorError("Usage: fslsplit <input> [output_basename] [-t/x/y/z]")
+
+    axes: Dict[str, int] = {"-x": 0, "-y": 1, "-z": 2, "-t": 3}
+    flags: List[str] = [a for a in args[1:] if a in axes]
+    names: List[str] = [a for a in args[1:] if a not in axes]
+
+    nii: nib.Nifti1Image = _load(args[0])
+    data: np.ndarray = np.asarray(nii.dataobj)
+    data: np.ndarray = data[..., np.newaxis] if data.ndim == 3 else data
+    axis: int = axes[flags[0]] if flags else 3
+    basename: str = names[0] if names else "vol"
+
+    budget.spend(data.shape, key=basename)
+
+    for n in range(data.shape[axis]):
+        part: np.ndarray = np.take(data, [n], axis=axis)
+        _save(part, nii, f"{basename}{n:04d}", shape=part.shape if axis != 3 else part.shape[:3])
+
+    return None
+
+
+def _fslmaths(args: List[str], budget: _Budget) -> None:
+    """``fslmaths <input> [operations] <output> [-odt <type>]``"""
+    dtypes: Dict[str, type] = {"char": np.uint8, "short": np.int16, "int": np.int32, "float": np.float32, "double": np.float64}
+    odt: Optional[type] = None
+
+    if len(args) > 3 and args[-2] == "-odt":
+        odt: type = dtypes.get(args[-1], np.float32)
+        args: List[str] = args[:-2]
+
+    if len(args) < 2:
+        raise SimulatorError("Usage: fslmaths <input> [operations] <output>")
+
+    nii: nib.Nifti1Image = _load(args[0])
+    data: np.ndarray = np.asarray(nii.dataobj, dtype=np.float32)
+    ops: List[str] = args[1:-1]
+
+    budget.spend(data.shape, key=args[-1])
+
+    binary: Dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+        "-add": np.add,
+        "-sub": np.subtract,
+        "-mul": np.multiply,
+        "-div": lambda a, b: np.divide(a, b, out=np.zeros_like(a), where=b != 0),
+        "-max": np.maximum,
+        "-min": np.minimum,
+        "-mas": lambda a, b: np.where(b > 0, a, 0),
+        "-thr": lambda a, b: np.where(a >= b, a, 0),
+        "-uthr": lambda a, b: np.where(a <= b, a, 0),
+    }
+    unary: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+        "-Tmean": lambda a: a.mean(axis=3) if a.ndim > 3 else a,
+        "-Tmax": lambda a: a.max(axis=3) if a.ndim > 3 else a,
+        "-Tmin": lambda a: a.min(axis=3) if a.ndim > 3 else a,
+        "-Tstd": lambda a: a.std(axis=3) if a.ndim > 3 else np.zeros_like(a),
+        "-Tmedian": lambda a: np.median(a, axis=3) if a.ndim > 3 else a,
+        "-bin": lambda a: (a > 0).astype(np.float32),
+        "-abs": np.abs,
+        "-sqrt": lambda a: np.sqrt(np.maximum(a, 0)),
+        "-exp": np.exp,
+        "-log": lambda a: np.log(np.where(a > 0, a, 1)),
+        "-nan": lambda a: np.nan_to_num(a, nan=0.0),
+    }
+
+    i: int = 0
+    while i < len(ops):
+        op: str = ops[i]
+        if op in unary:
+            data: np.ndarray = unary[op](data).astype(np.float32)
+            i += 1
+        elif op in binary and i + 1 < len(ops):
+            operand: Any = _operand(ops[i + 1])
+            data: np.ndarray = binary[op](data, operand).astype(np.float32)
+            i += 2
+        else:
+            raise SimulatorError(f"Unsupported (simulated) operation: {op}")
+
+    dtype: type = odt or (np.float32 if ops else nii.get_data_dtype())
+    _save(data, nii, args[-1], dtype=dtype, shape=data.shape)
+    return None
+
+
+def _fslval(args: List[str], budget: _Budget) -> None:
+    """``fslval <input> <keyword>`` (``dim<n>``, ``pixdim<n>``, or ``datatype``)"""
+    if len(args) != 2:
+        raise SimulatorError("Usage: fslval <input> <keyword>")
+
+    nii: nib.Nifti1Image = _load(args[0])
+    hdr: nib.Nifti1Header = nii.header
+    key: str = args[1]
+
+    budget.spend((1,), key=key)
+
+    if key.startswith("pixdim") and key[6:].isdigit():
+        print(f"{float(hdr['pixdim'][int(key[6:])]):.6f}")
+    elif key.startswith("dim") and key[3:].isdigit():
+        print(int(hdr["dim"][int(key[3:])]))
+    elif key == "datatype":
+        print(int(hdr["datatype"]))
+    else:
+        raise SimulatorError(f"Unsupported (simulated) keyword: {key}")
+
+    return None
+
+
+def _eddy_quad(args: List[str], budget: _Budget) -> None:
+    """``eddy_quad <eddy_basename> --eddyIdx --eddyParams --mask --bvals [--output-dir] [options]``"""
+    from dwi_preproc.qc.eddy import eddy_metrics
+
+    if not args:
+        raise SimulatorError("Usage: eddy_quad <eddy_basename> -idx <index> -par <acqp> -m <mask> -b <bvals> [options]")
+
+    basename: str = _strip(args[0])
+    opts: Dict[str, str] = {a.lstrip("-"): b for a, b in zip(args[1:], args[2:]) if a.startswith("-")}
+    bvals: str = _exists(opts.get("bvals", opts.get("b", "")))
+    mask: str = _find(opts.get("mask", opts.get("m", "")))
+    outdir: str = opts.get("output-dir", opts.get("o", basename + ".qc"))
+
+    if os.path.exists(outdir):
+        raise SimulatorError(f"Output directory already exists: {outdir}")
+
+    nii: nib.Nifti1Image = _load(basename)
+    budget.spend(nii.shape, key=outdir)
+
+    os.makedirs(outdir)
+    metrics: Dict[str, float] = eddy_metrics(basename=basename, bvals=bvals, mask=mask)
+
+    with open(os.path.join(outdir, "qc.json"), "w") as f:
+        json.dump(metrics, f, indent=4)
+
+    return None
+
+
+def _remove_ext(args: List[str], budget: _Budget) -> None:
+    """``remove_ext <list of image names>``"""
+    budget.spend((1,), key=" ".join(args))
+    print(" ".join(_strip(a) for a in args))
+    return None
+
+
+def _flirt(args: List[str], budget: _Budget) -> None:
+    """``flirt -in <input> -ref <reference> [-omat <matrix>] [-out <output>] [-dof <dof>] [options]``
+
+    The estimated transform is the translation that aligns the centres of the fields of view of the images (in scaled voxel coordinates).
+    """
+    opts: Dict[str, str] = {a: b for a, b in zip(args, args[1:]) if a.startswith("-")}
+
+    for k in ("-in", "-ref"):
+        if k not in opts:
+            raise SimulatorError(f"Missing required option: {k}")
+
+    if "-omat" not in opts and "-out" not in opts:
+        raise SimulatorError("At least one of -omat, or -out is required.")
+
+    nii: nib.Nifti1Image = _load(opts["-in"])
+    ref: nib.Nifti1Image = _load(opts["-ref"])
+
+    budget.spend(nii.shape[:3], key=opts.get("-omat", opts.get("-out", "")))
+
+    mat: np.ndarray = np.eye(4)
+    mat[:3, 3] = _fov_centre(ref) - _fov_centre(nii)
+
+    if "-omat" in opts:
+        np.savetxt(opts["-omat"], mat, fmt="%.6f", delimiter="  ")
+
+    if "-out" in opts:
+        _save(_resample(nii, ref, mat), ref, opts["-out"], dtype=np.float32)
+
+    return None
+
+
+def _aff2rigid(args: List[str], budget: _Budget) -> None:
+    """``aff2rigid <input_affine> <output_rigid>``"""
+    if len(args) != 2:
+        raise SimulatorError("Usage: aff2rigid <input_affine> <output_rigid>")
+
+    mat: np.ndarray = np.loadtxt(_exists(args[0]), ndmin=2)
+    if mat.shape != (4, 4):
+        raise SimulatorError(f"Invalid (4 x 4) affine matrix: {args[0]}")
+
+    budget.spend((1,), key=args[1])
+
+    # Rotation closest to the linear part of the affine (polar decomposition)
+    u, _, vt = np.linalg.svd(mat[:3, :3])
+    rigid: np.ndarray = np.eye(4)
+    rigid[:3, :3] = u @ vt
+    rigid[:3, 3] = mat[:3, 3]
+    np.savetxt(args[1], rigid, fmt="%.6f", delimiter="  ")
+
+    return None
+
+
+def _applywarp(args: List[str], budget: _Budget) -> None:
+    """``applywarp --in --out --ref [--premat] [--interp]`` (warp fields are not simulated)"""
+    opts: Dict[str, str] = _options(args, required=("in", "out", "ref"))
+
+    if "warp" in opts:
+        raise SimulatorError("Unsupported (simulated) option: --warp")
+
+    nii: nib.Nifti1Image = _load(opts["in"])
+    ref: nib.Nifti1Image = _load(opts["ref"])
+    mat: np.ndarray = np.loadtxt(_exists(opts["premat"]), ndmin=2) if "premat" in opts else np.eye(4)
+
+    budget.spend(ref.shape[:3] + nii.shape[3:], key=opts["out"])
+    _save(_resample(nii, ref, mat), ref, opts["out"], dtype=np.float32)
+
+    return None
+
+
+def _n4(args: List[str], budget: _Budget) -> None:
+    """``N4BiasFieldCorrection -d 3 -i <input> -o [<output>,<bias>] [-x <mask>] [-s <shrink>] [-c [<iters>,<thresh>]] [-b [<distance>]] [-v 1]``
+
+    The (smooth) bias field is a linear gradient along the first axis. The outputs are written to the file names as given (as ``ANTs`` does).
+    """
+    opts: Dict[str, str] = {a: b for a, b in zip(args, args[1:]) if a.startswith("-")}
+
+    for k in ("-i", "-o"):
+        if k not in opts:
+            raise SimulatorError(f"Missing required option: {k}")
+
+    if opts.get("-d", "3") != "3":
+        raise SimulatorError(f"Unsupported image dimension: {opts['-d']}")
+
+    outputs: List[str] = opts["-o"].strip("[]").split(",")
+    nii: nib.Nifti1Image = _load(opts["-i"])
+
+    if "-x" in opts:
+        mask: nib.Nifti1Image = _load(opts["-x"])
+        if mask.shape[:3] != nii.shape[:3]:
+            raise SimulatorError("The mask and input image must have the same dimensions.")
+
+    budget.spend(nii.shape[:3], key=outputs[0])
+
+    data: np.ndarray = np.asarray(nii.dataobj, dtype=np.float32)
+    bias: np.ndarray = np.broadcast_to(np.linspace(0.9, 1.1, nii.shape[0], dtype=np.float32).reshape(-1, 1, 1), nii.shape[:3])
+
+    for name, vol in zip(outputs, (data / bias, bias)):
+        out: nib.Nifti1Image = nib.Nifti1Image(np.ascontiguousarray(vol), nii.affine, nii.header.copy())
+        out.set_data_dtype(np.float32)
+        nib.save(out, name)
+
+    return None
+
+
+# Simulated tools
+_TOOLS: Dict[str, Callable[[List[str], _Budget], None]] = {
+    "topup": _topup,
+    "applytopup": _applytopup,
+    "eddy": _eddy,
+    "eddy_cuda": _eddy,
+    "bet": _bet,
+    "dtifit": _dtifit,
+    "fslroi": _fslroi,
+    "fslmerge": _fslmerge,
+    "fslsplit": _fslsplit,
+    "fslmaths": _fslmaths,
+    "fslval": _fslval,
+    "eddy_quad": _eddy_quad,
+    "remove_ext": _remove_ext,
+    "flirt": _flirt,
+    "aff2rigid": _aff2rigid,
+    "applywarp": _applywarp,
+    "N4BiasFieldCorrection": _n4,
+}
+
+
+def _burn(seconds: float, duty: float) -> None:
+    """Keeps a CPU busy for a fraction (duty cycle) of some time (in 10 ms periods), and sleeps otherwise.
+
+    Args:
+        seconds: Time (in seconds).
+        duty: Duty cycle (0: sleep, 1: busy).
+    """
+    end: float = time.perf_counter() + seconds
+    duty: float = min(max(duty, 0.0), 1.0)
+
+    while True:
+        now: float = time.perf_counter()
+        if now >= end:
+            break
+        busy: float = min(now + 0.01 * duty, end)
+        while time.perf_counter() < busy:
+            pass
+        time.sleep(max(min(0.01 * (1 - duty), end - time.perf_counter()), 0))
+
+    return None
+
+
+def _options(args: Sequence[str], required: Sequence[str] = ()) -> Dict[str, str]:
+    """Parses the (``--<option>=<value>``, or ``--<flag>``) long options of a command line.
+
+    Args:
+        args: Command line arguments.
+        required: Required options. Defaults to ().
+
+    Raises:
+        SimulatorError: Exception that is raised if a required option is missing.
+
+    Returns:
+        Dictionary of options (flags have a value of 'true').
+    """
+    opts: Dict[str, str] = {}
+
+    for arg in args:
+        if arg.startswith("--"):
+            key, _, value = arg[2:].partition("=")
+            opts[key] = value if value else "true"
+
+    missing: List[str] = [k for k in required if k not in opts]
+    if missing:
+        raise SimulatorError(f"Missing required option(s): {', '.join('--' + k for k in missing)}")
+
+    return opts
+
+
+def _threads(args: Sequence[str]) -> int:
+    """Number of threads of a tool run (the ``--nthr`` option, ``OMP_NUM_THREADS``, or ``ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS``)."""
+    for arg in args:
+        if arg.startswith("--nthr="):
+            return max(int(arg.split("=", 1)[1]), 1)
+    for var in ("OMP_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"):
+        if os.environ.get(var):
+            return max(int(os.environ[var]), 1)
+    return 1
+
+
+def _ext() -> str:
+    """Image file extension of ``FSLOUTPUTTYPE``."""
+    return _OUTPUT_EXT.get(os.environ.get("FSLOUTPUTTYPE", "NIFTI_GZ"), ".nii.gz")
+
+
+def _strip(name: str) -> str:
+    """Removes the image file extension (if any) of a file name."""
+    for ext in (".nii.gz", ".nii"):
+        if name.endswith(ext):
+            return name[: -len(ext)]
+    return name
+
+
+def _find(name: str) -> str:
+    """Finds an image (with, or without its file extension), as ``FSL`` does.
+
+    Raises:
+        SimulatorError: Exception that is raised if the image does not exist.
+    """
+    for path in (name, name + ".nii.gz", name + ".nii"):
+        if name and os.path.isfile(path):
+            return path
+    raise SimulatorError(f"Image Exception : Failed to read volume {name}")
+
+
+def _exists(name: str) -> str:
+    """Asserts that a (non-image) input file exists.
+
+    Raises:
+        SimulatorError: Exception that is raised if the file does not exist.
+    """
+    if not name or not os.path.isfile(name):
+        raise SimulatorError(f"Could not open file: {name}")
+    return name
+
+
+def _load(name: str) -> nib.Nifti1Image:
+    """Loads an image (with, or without its file extension)."""
+    return nib.load(_find(name))
+
+
+def _save(data: np.ndarray, ref: nib.Nifti1Image, name: str, dtype: Optional[type] = None, shape: Optional[Sequence[int]] = None) -> str:
+    """Saves an image (with the file extension of ``FSLOUTPUTTYPE``) on the grid of a reference image.
+
+    Args:
+        data: Image data.
+        ref: Reference image (affine, and header).
+        name: Output file name (with, or without its file extension).
+        dtype: Output data type. Defaults to None (data type of the reference image).
+        shape: Output shape. Defaults to None (shape of the data).
+
+    Returns:
+        Output file name.
+    """
+    out: str = _strip(name) + _ext()
+    data: np.ndarray = data.reshape(shape) if shape is not None else data
+
+    nii: nib.Nifti1Image = nib.Nifti1Image(data, ref.affine, ref.header.copy())
+    nii.set_data_dtype(dtype or ref.get_data_dtype())
+    nii.header.set_slope_inter(1.0, 0.0)
+    nib.save(nii, out)
+
+    return out
+
+
+def _fov_centre(nii: nib.Nifti1Image) -> np.ndarray:
+    """Centre of the field of view of an image (in scaled voxel coordinates, i.e. mm)."""
+    return (np.asarray(nii.shape[:3], dtype=np.float64) - 1) * np.asarray(nii.header.get_zooms()[:3]) / 2
+
+
+def _resample(nii: nib.Nifti1Image, ref: nib.Nifti1Image, mat: np.ndarray) -> np.ndarray:
+    """Resamples an image (nearest neighbour) on the grid of a reference image.
+
+    Args:
+        nii: Input image.
+        ref: Reference image.
+        mat: ``FLIRT`` matrix (scaled voxel coordinates of the input to those of the reference).
+
+    Returns:
+        Resampled image data (zero outside of the field of view of the input).
+    """
+    data: np.ndarray = np.asarray(nii.dataobj, dtype=np.float32)
+    grid: np.ndarray = np.indices(ref.shape[:3]).reshape(3, -1).T * np.asarray(ref.header.get_zooms()[:3])
+
+    # Reference (mm) to input (voxel) coordinates
+    inv: np.ndarray = np.linalg.inv(mat)
+    vox: np.ndarray = (grid @ inv[:3, :3].T + inv[:3, 3]) / np.asarray(nii.header.get_zooms()[:3])
+    vox: np.ndarray = np.rint(vox).astype(np.int64)
+    inside: np.ndarray = np.all((vox >= 0) & (vox < np.asarray(data.shape[:3])), axis=1)
+
+    out: np.ndarray = np.zeros((len(grid),) + data.shape[3:], dtype=np.float32)
+    out[inside] = data[vox[inside, 0], vox[inside, 1], vox[inside, 2]]
+
+    return out.reshape(ref.shape[:3] + data.shape[3:])
+
+
+def _operand(arg: str) -> Any:
+    """Reads the operand of a (``fslmaths``) binary operation: a number, or an image."""
+    try:
+        return float(arg)
+    except ValueError:
+        data: np.ndarray = np.asarray(_load(arg).dataobj, dtype=np.float32)
+        return data
+
+
+def _atof(arg: str) -> float:
+    """Converts a string to a number, as C's ``atof`` does (0 if the string is not a number)."""
+    try:
+        return float(arg)
+    except ValueError:
+        return 0.0
+
+
+def _coef_shape(dims: Sequence[int]) -> Tuple[int, ...]:
+    """Shape of the (simulated) spline coefficients of a ``topup`` field of an image grid (a knot every 2 voxels)."""
+    return tuple(d // 2 + 3 for d in dims)
+
+
+def _fieldcoef(topup: str, dims: Sequence[int]) -> str:
+    """Finds the spline coefficients of a ``topup`` output basename, and asserts that they match an image grid, as ``FSL`` does.
+
+    Raises:
+        SimulatorError: Exception that is raised if the spline coefficients do not match the image grid.
+    """
+    coef: str = _find(f"{topup}_fieldcoef")
+    if nib.load(coef).shape[:3] != _coef_shape(dims):
+        raise SimulatorError(f"The field coefficients ({coef}) do not match the image dimensions {tuple(dims)}.")
+    return coef
+
+
+def _field(dims: Sequence[int]) -> np.ndarray:
+    """Simulates a (smooth, deterministic) susceptibility field (Hz)."""
+    grid: np.ndarray = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in dims], indexing="ij"))
+    return (60 * np.exp(-((grid[0] ** 2 + (grid[1] + 0.6) ** 2 + (grid[2] + 0.4) ** 2) / 0.1))).astype(np.float32)
+
+
+def _rng(seed: int, *key: Any) -> np.random.Generator:
+    """Random number generator that is determined by a seed, and a key (e.g. the tool, and input shape)."""
+    return np.random.default_rng([int(seed) & 0xFFFFFFFF, zlib.crc32(repr(key).encode())])
@@ -0,0 +1,268 @@
+"""Native parsing of ``FSL``'s ``eddy`` outputs, and (cohort-level) QC metrics.
+
+The metrics are equivalent to the volume-level summaries of ``FSL``'s
+``eddy_quad``, and are computed without running ``eddy_quad`` for each subject.
+"""
+import os
+import hashlib
+import numpy as np
+import nibabel as nib
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.diffusion.dwi.btable import read_bvals, shells
+from dwi_preproc.utils.niio import image
+
+# eddy output suffixes, and how they are parsed: (dtype, number of header rows)
+_EDDY_OUTPUTS: Dict[str, Tuple[type, int]] = {
+    "eddy_parameters": (np.float64, 0),
+    "eddy_movement_rms": (np.float64, 0),
+    "eddy_restricted_movement_rms": (np.float64, 0),
+    "eddy_outlier_map": (np.bool_, 1),
+    "eddy_outlier_n_stdev_map": (np.float32, 1),
+    "eddy_outlier_n_sqr_stdev_map": (np.float32, 1),
+    "eddy_movement_over_time": (np.float64, 0),
+}
+
+# In-memory cache of parsed files: (path, size, mtime) -> array
+_CACHE: Dict[Tuple[str, int, int], np.ndarray] = {}
+
+
+def read_eddy_file(src: Union[file, str], dtype: type = np.float64, skiprows: int = 0, cache_dir: Optional[str] = None) -> np.ndarray:
+    """Reads an (ASCII) ``eddy`` output file into a typed numpy array.
+
+    Parsed files are cached (keyed on their path, size and modification time),
+    in memory and, should a cache directory be provided, on disk (as ``.npy``
+    files), so that repeated (e.g. cohort-level) reads do not parse the text again.
+
+    Args:
+        src: Input ``eddy`` output file.
+        dtype: Output data type. Defaults to np.float64.
+        skiprows: Number of header rows. Defaults to 0.
+        cache_dir: Directory of the on-disk cache. Defaults to None.
+
+    Returns:
+        2D numpy array (one row per volume, or per excitation for slice-to-volume parameters).
+    """
+    src: str = os.path.abspath(src)
+    st: os.stat_result = os.stat(src)
+    key: Tuple[str, int, int] = (src, st.st_size, st.st_mtime_ns)
+
+    if key in _CACHE:
+        return _CACHE[key]
+
+    cached: Union[str, None] = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        digest: str = hashlib.sha1(repr(key).encode()).hexdigest()
+        cached: str = os.path.join(cache_dir, f"{os.path.basename(src)}.{digest}.npy")
+
+    if cached and os.path.exists(cached):
+        arr: np.ndarray = np.load(cached)
+    else:
+        arr: np.ndarray = np.loadtxt(src, skiprows=skiprows, ndmin=2).astype(dtype)
+        if cached:
+            # Write atomically, as several worker processes may parse the same file
+            tmp: str = f"{cached[:-4]}.{os.getpid()}.npy"
+            np.save(tmp, arr)
+            os.replace(tmp, cached)
+
+    _CACHE[key] = arr
+
+    return arr
+
+
+def read_eddy(basename: str, cache_dir: Optional[str] = None) -> Dict[str, np.ndarray]:
+    """Reads the (existing) outputs of ``eddy`` for some output basename.
+
+    Usage example:
+        >>> outputs = read_eddy("Eddy/sub-001_eddy_corr")
+        >>> outputs["eddy_movement_rms"].shape
+        (65, 2)
+
+    Args:
+        basename: ``eddy`` output basename (i.e. the ``--out`` argument).
+        cache_dir: Directory of the on-disk cache. Defaults to None.
+
+    Returns:
+        Dictionary that maps each output suffix (e.g. ``eddy_parameters``, and ``eddy_cnr_maps`` as a lazily loaded ``nibabel`` image) to its contents.
+    """
+    outputs: Dict[str, Any] = {}
+
+    for suffix, (dtype, skiprows) in _EDDY_OUTPUTS.items():
+        src: str = f"{basename}.{suffix}"
+        if os.path.exists(src):
+            outputs[suffix] = read_eddy_file(src, dtype=dtype, skiprows=skiprows, cache_dir=cache_dir)
+
+    for ext in (".nii.gz", ".nii"):
+        if os.path.exists(f"{basename}.eddy_cnr_maps{ext}"):
+            outputs["eddy_cnr_maps"] = nib.load(f"{basename}.eddy_cnr_maps{ext}")
+            break
+
+    return outputs
+
+
+def eddy_metrics(
+    basename: str,
+    bvals: Union[file, str],
+    mask: Optional[Union[image, str]] = None,
+    cache_dir: Optional[str] = None,
+    b0_thresh: float = 50,
+) -> Dict[str, float]:
+    """Computes the ``eddy_quad`` equivalent QC metrics of a single subject.
+
+    The metrics include:
+        * ``qc_mot_abs``, ``qc_mot_rel``: Mean absolute and relative motion (mm).
+        * ``qc_mot_abs_restricted``, ``qc_mot_rel_restricted``: Mean restricted (i.e. without the PE translation) absolute and relative motion (mm).
+        * ``qc_params_avg_{trans,rot,ec}_{x,y,z}``: Mean absolute translations (mm), rotations (degrees), and linear eddy current terms (Hz/mm).
+        * ``qc_outliers_tot``, ``qc_outliers_b<b>``: Percentage of outlier slices (in total, and for each shell).
+        * ``qc_cnr_avg_b0``, ``qc_cnr_std_b0``: Mean (and standard deviation) b0 temporal SNR within the mask.
+        * ``qc_cnr_avg_b<b>``, ``qc_cnr_std_b<b>``: Mean (and standard deviation) CNR of each shell within the mask.
+        * ``qc_s2v_params_avg_std``: Mean (across volumes and parameters) within-volume standard deviation of the slice-to-volume motion parameters.
+
+    Args:
+        basename: ``eddy`` output basename (i.e. the ``--out`` argument).
+        bvals: Corresponding b-value file.
+        mask: Brain mask. Defaults to None (the non-zero voxels of the CNR maps).
+        cache_dir: Directory of the on-disk cache. Defaults to None.
+        b0_thresh: b-values less than or equal to this value are considered to be b0s. Defaults to 50.
+
+    Returns:
+        Dictionary of QC metrics (metrics of missing outputs are omitted).
+    """
+    outputs: Dict[str, Any] = read_eddy(basename, cache_dir=cache_dir)
+    bval: np.ndarray = read_bvals(bvals)
+    groups: Dict[int, np.ndarray] = shells(bval, b0_thresh=b0_thresh)
+    metrics: Dict[str, float] = {}
+
+    if "eddy_movement_rms" in outputs:
+        rms: np.ndarray = outputs["eddy_movement_rms"]
+        metrics["qc_mot_abs"] = float(rms[:, 0].mean())
+        metrics["qc_mot_rel"] = float(rms[:, 1].mean())
+
+    if "eddy_restricted_movement_rms" in outputs:
+        rms: np.ndarray = outputs["eddy_restricted_movement_rms"]
+        metrics["qc_mot_abs_restricted"] = float(rms[:, 0].mean())
+        metrics["qc_mot_rel_restricted"] = float(rms[:, 1].mean())
+
+    if "eddy_parameters" in outputs:
+        params: np.ndarray = np.abs(outputs["eddy_parameters"][:, :9])
+        params[:, 3:6] = np.degrees(params[:, 3:6])
+        avg: np.ndarray = params.mean(axis=0)
+        for n, name in enumerate(f"{p}_{ax}" for p in ("trans", "rot", "ec") for ax in "xyz"):
+            metrics[f"qc_params_avg_{name}"] = float(avg[n])
+
+    if "eddy_outlier_map" in outputs:
+        ol: np.ndarray = outputs["eddy_outlier_map"]
+        metrics["qc_outliers_tot"] = float(100 * ol.mean())
+        for b, idx in groups.items():
+            if b > 0 and idx.max() < ol.shape[0]:
+                metrics[f"qc_outliers_b{b}"] = float(100 * ol[idx].mean())
+
+    if "eddy_cnr_maps" in outputs:
+        cnr: np.ndarray = np.asarray(outputs["eddy_cnr_maps"].dataobj, dtype=np.float32)
+        if cnr.ndim == 3:
+            cnr: np.ndarray = cnr[..., np.newaxis]
+
+        if mask:
+            msk: np.ndarray = np.asarray(nib.load(mask).dataobj) > 0
+        else:
+            msk: np.ndarray = cnr[..., 0] != 0
+
+        # First volume: b0 tSNR, then the CNR of each (non-zero) shell in ascending order
+        vals: np.ndarray = cnr[msk]
+        labels: List[str] = ["b0"] + [f"b{b}" for b in sorted(groups) if b > 0]
+        for n, label in enumerate(labels[: vals.shape[1]]):
+            metrics[f"qc_cnr_avg_{label}"] = float(np.nanmean(vals[:, n]))
+            metrics[f"qc_cnr_std_{label}"] = float(np.nanstd(vals[:, n]))
+
+    if "eddy_movement_over_time" in outputs:
+        mot: np.ndarray = outputs["eddy_movement_over_time"]
+        if mot.shape[0] % len(bval) == 0:
+            mot: np.ndarray = mot[:, :6].reshape(len(bval), -1, 6)
+            metrics["qc_s2v_params_avg_std"] = float(mot.std(axis=1).mean())
+
+    return metrics
+
+
+def cohort_metrics(
+    jobs: Sequence[Dict[str, str]],
+    n_procs: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+) -> Dict[str, np.ndarray]:
+    """Computes the QC metrics of a cohort, and aggregates them into a single columnar table.
+
+    Usage example:
+        >>> table = cohort_metrics(jobs=[{"name": "sub-001", "basename": "sub-001/Eddy/sub-001_eddy_corr", "bvals": "sub-001/dwi.bval"},
+        ...                              {"name": "sub-002", "basename": "sub-002/Eddy/sub-002_eddy_corr", "bvals": "sub-002/dwi.bval"}],
+        ...                        cache_dir="eddy_cache")
+        >>> table["qc_mot_abs"]
+        array([0.41, 0.57])
+
+    Args:
+        jobs: Dictionary for each subject with its ``name``, ``basename``, ``bvals`` (and optionally its ``mask``).
+        n_procs: Number of worker processes. Defaults to None (number of CPUs).
+        cache_dir: Directory of the on-disk cache. Defaults to None.
+
+    Returns:
+        Dictionary of columns (``name``, then the union of the metrics of all subjects, with missing metrics as ``NaN``).
+    """
+    with ProcessPoolExecutor(max_workers=n_procs) as pool:
+        futures: List[Any] = [
+            pool.submit(
+                eddy_metrics,
+                basename=job["basename"],
+                bvals=job["bvals"],
+                mask=job.get("mask"),
+                cache_dir=cache_dir,
+            )
+            for job in jobs
+        ]
+        rows: List[Dict[str, float]] = [f.result() for f in futures]
+
+    columns: List[str] = sorted({k for row in rows for k in row})
+    table: Dict[str, np.ndarray] = {"name": np.array([job["name"] for job in jobs])}
+
+    for col in columns:
+        table[col] = np.array([row.get(col, np.nan) for row in rows], dtype=np.float64)
+
+    return table
+
+
+def write_table(table: Dict[str, np.ndarray], out: Union[file, str], sep: str = "\t") -> file:
+    """Writes a columnar table to a delimited text file.
+
+    Args:
+        table: Dictionary of (equal length) columns.
+        out: Output file.
+        sep: Column delimiter. Defaults to '\\t'.
+
+    Returns:
+        Output file.
+    """
+    columns: List[str] = list(table)
+    nrows: int = len(table[columns[0]]) if columns else 0
+
+    with open(out, "w") as f:
+        f.write(sep.join(columns) + "\n")
+        for i in range(nrows):
+            f.write(sep.join(_fmt(table[c][i]) for c in columns) + "\n")
+
+    return os.path.abspath(out)
+
+
+def _fmt(value: Any) -> str:
+    """Formats a table value (floats with 6 significant digits, ``NaN`` as 'n/a').
+
+    Args:
+        value: Table value.
+
+    Returns:
+        Formatted value.
+    """
+    if isinstance(value, (float, np.floating)):
+        return "n/a" if np.isnan(value) else f"{value:.6g}"
+    return str(value)
@@ -0,0 +1,352 @@
+"""Native (``numpy``) rendering of quality control (QC) images.
+
+Ortho and lightbox views (and FA-weighted V1 RGB overlays) are written
+directly to PNG files, without the need for a display (e.g. ``FSLeyes``).
+"""
+import os
+import zlib
+import struct
+import numpy as np
+import nibabel as nib
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from dwi_preproc.utils.niio import NiiFile, image
+
+
+def write_png(arr: np.ndarray, out: str) -> str:
+    """Writes an 8-bit grayscale (H x W) or RGB (H x W x 3) image to a PNG file.
+
+    Args:
+        arr: Input ``uint8`` numpy array.
+        out: Output PNG file.
+
+    Returns:
+        Output PNG file.
+    """
+    arr: np.ndarray = np.ascontiguousarray(arr, dtype=np.uint8)
+    height, width = arr.shape[:2]
+    color_type: int = 2 if arr.ndim == 3 else 0
+
+    # Each scanline is prefixed with its filter type (0 - None)
+    raw: np.ndarray = np.hstack(
+        (np.zeros((height, 1), dtype=np.uint8), arr.reshape(height, -1))
+    )
+
+    def _chunk(tag: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + tag
+            + data
+            + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+        )
+
+    with open(out, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)))
+        f.write(_chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(_chunk(b"IEND", b""))
+
+    return os.path.abspath(out)
+
+
+class Volume:
+    """A single (3D) volume of a NIFTI image, read one (displayed) slice at a time."""
+
+    def __init__(self, nii: nib.Nifti1Image, vol: Optional[int] = None) -> None:
+        """Initializes the volume (no data is read).
+
+        Args:
+            nii: Input NIFTI image.
+            vol: Volume index (of 4D images). Defaults to None (3D images, or all the components of vector images, e.g. V1).
+        """
+        self.nii: nib.Nifti1Image = nii
+        self.vol: Optional[int] = vol
+        self.shape: Tuple[int, ...] = nii.shape[:3] if vol is not None or len(nii.shape) < 4 else nii.shape[:4]
+
+    def take(self, index: int, axis: int) -> np.ndarray:
+        """Reads a single slice (of each component of vector images) from the image data proxy.
+
+        Args:
+            index: Slice index.
+            axis: Data axis that is normal to the slice.
+
+        Returns:
+            Slice data (2D, or 2D with the components along the last axis).
+        """
+        slicer: List[Union[int, slice]] = [slice(None)] * 3
+        slicer[axis] = int(index)
+
+        if len(self.nii.shape) < 4:
+            return np.asarray(self.nii.dataobj[tuple(slicer)], dtype=np.float32)
+        if self.vol is not None:
+            return np.asarray(self.nii.dataobj[tuple(slicer) + (self.vol,)], dtype=np.float32)
+
+        return np.stack(
+            [np.asarray(self.nii.dataobj[tuple(slicer) + (c,)], dtype=np.float32) for c in range(self.shape[3])],
+            axis=-1,
+        )
+
+
+def load_volume(img: Union[image, str], vol: int = 0) -> Tuple[Volume, np.ndarray, Tuple[float, ...]]:
+    """Opens a single (3D) volume of a NIFTI image, and reads its orientation.
+
+    No image data is read: only the displayed slices are later read from the image data
+    proxy (see ``Volume``). Vector images (e.g. V1) with 3 components are read component by component.
+
+    Args:
+        img: Input NIFTI image.
+        vol: Volume index. Defaults to 0.
+
+    Returns:
+        * Volume (see ``Volume``).
+        * Orientation of the data axes relative to RAS+ (see ``nibabel.io_orientation``).
+        * Voxel sizes.
+    """
+    nii: nib.Nifti1Image = nib.load(img, keep_file_open=True)
+    shape: Tuple[int, ...] = nii.shape
+
+    data: Volume = Volume(nii, vol=int(vol) if len(shape) > 3 and shape[3] > 3 else None)
+
+    return data, nib.io_orientation(nii.affine), nii.header.get_zooms()[:3]
+
+
+def ortho(data: Union[np.ndarray, Volume], ornt: np.ndarray, zooms: Sequence[float] = (1, 1, 1)) -> np.ndarray:
+    """Creates an ortho view (sagittal, coronal, and axial slices through the centre of the image).
+
+    Args:
+        data: Volume data (3D, or 4D with RGB components along the last axis), or volume (see ``Volume``).
+        ornt: Orientation of the data axes relative to RAS+.
+        zooms: Voxel sizes. Defaults to (1, 1, 1).
+
+    Returns:
+        Ortho view (image rows x columns [x 3]).
+    """
+    panels: List[np.ndarray] = []
+    for axis in (0, 1, 2):
+        n: int = _ras_shape(data, ornt)[axis]
+        panels.append(_display_slice(data, ornt, axis=axis, index=n // 2, zooms=zooms))
+
+    return _tile(panels, ncols=3)
+
+
+def lightbox(data: Union[np.ndarray, Volume], ornt: np.ndarray, zooms: Sequence[float] = (1, 1, 1), nslices: int = 18, ncols: int = 6, frac: Tuple[float, float] = (0.15, 0.85)) -> np.ndarray:
+    """Creates a lightbox view (evenly spaced axial slices).
+
+    Args:
+        data: Volume data (3D, or 4D with RGB components along the last axis), or volume (see ``Volume``).
+        ornt: Orientation of the data axes relative to RAS+.
+        zooms: Voxel sizes. Defaults to (1, 1, 1).
+        nslices: Number of slices. Defaults to 18.
+        ncols: Number of columns. Defaults to 6.
+        frac: Range of the slices (as fractions of the number of axial slices). Defaults to (0.15, 0.85).
+
+    Returns:
+        Lightbox view (image rows x columns [x 3]).
+    """
+    n: int = _ras_shape(data, ornt)[2]
+    idx: np.ndarray = np.unique(np.linspace(frac[0] * (n - 1), frac[1] * (n - 1), nslices).round().astype(int))
+
+    panels: List[np.ndarray] = [
+        _display_slice(data, ornt, axis=2, index=int(i), zooms=zooms) for i in idx
+    ]
+
+    return _tile(panels, ncols=ncols)
+
+
+def to_uint8(data: np.ndarray, pct: Tuple[float, float] = (2, 98)) -> np.ndarray:
+    """Scales an image to 8-bit using a (robust) percentile intensity window.
+
+    Args:
+        data: Input image.
+        pct: Lower and upper percentiles of the intensity window (computed over the non-zero voxels). Defaults to (2, 98).
+
+    Returns:
+        ``uint8`` image.
+    """
+    nz: np.ndarray = data[data != 0]
+
+    if nz.size == 0:
+        return np.zeros(data.shape, dtype=np.uint8)
+
+    lo, hi = np.percentile(nz, pct)
+    scaled: np.ndarray = (data - lo) / max(hi - lo, np.finfo(np.float32).eps)
+
+    return (np.clip(scaled, 0, 1) * 255).astype(np.uint8)
+
+
+def fa_rgb(fa: np.ndarray, v1: np.ndarray) -> np.ndarray:
+    """Creates a FA-weighted principal eigenvector (V1) RGB image.
+
+    Args:
+        fa: FA image (3D), or view.
+        v1: V1 image (x, y, z, 3), or view (with the components along the last axis).
+
+    Returns:
+        ``uint8`` RGB image (or view).
+    """
+    rgb: np.ndarray = np.abs(v1) * np.clip(fa, 0, 1)[..., np.newaxis]
+    return (np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+
+
+def render_qc(out_name: str, dwi: Optional[Union[image, str]] = None, fa: Optional[Union[image, str]] = None, v1: Optional[Union[image, str]] = None, vol: int = 0) -> List[str]:
+    """Renders the QC images of a single subject/acquisition.
+
+    The outputs (should the corresponding inputs be provided) are:
+        * ``<out_name>_dwi_ortho.png``
+        * ``<out_name>_dwi_lightbox.png``
+        * ``<out_name>_FA_ortho.png`` (V1 RGB overlay, if V1 is provided)
+        * ``<out_name>_FA_lightbox.png`` (V1 RGB overlay, if V1 is provided)
+
+    Usage example:
+        >>> render_qc(out_name="imgs/sub-001_run-01",
+        ...           dwi="sub-001_dwi.nii.gz",
+        ...           fa="Tensor/sub-001_FA.nii.gz",
+        ...           v1="Tensor/sub-001_V1.nii.gz")
+        ...
+
+    Args:
+        out_name: Output path and file name prefix.
+        dwi: Preprocessed DWI. Defaults to None.
+        fa: FA image. Defaults to None.
+        v1: V1 image. Defaults to None.
+        vol: Volume of the DWI to render. Defaults to 0.
+
+    Returns:
+        List of output PNG files.
+    """
+    outdir: str = os.path.dirname(os.path.abspath(out_name))
+    if not os.path.exists(outdir):
+        os.makedirs(outdir, exist_ok=True)
+
+    outputs: List[str] = []
+
+    # Only the displayed slices are read, so intensities are scaled (and FA/V1 combined) once the views are tiled
+    if dwi:
+        with NiiFile(src=dwi, assert_exists=True) as n:
+            data, ornt, zooms = load_volume(n.abspath(), vol=vol)
+        outputs.append(write_png(to_uint8(ortho(data, ornt, zooms)), f"{out_name}_dwi_ortho.png"))
+        outputs.append(write_png(to_uint8(lightbox(data, ornt, zooms)), f"{out_name}_dwi_lightbox.png"))
+
+    if fa:
+        with NiiFile(src=fa, assert_exists=True) as n:
+            data, ornt, zooms = load_volume(n.abspath())
+
+        vec: Optional[Volume] = None
+        if v1:
+            with NiiFile(src=v1, assert_exists=True) as n:
+                vec, _, _ = load_volume(n.abspath())
+
+        for view, name in ((ortho, "ortho"), (lightbox, "lightbox")):
+            panel: np.ndarray = view(data, ornt, zooms)
+            panel: np.ndarray = fa_rgb(panel, view(vec, ornt, zooms)) if vec is not None else to_uint8(panel)
+            outputs.append(write_png(panel, f"{out_name}_FA_{name}.png"))
+
+    return outputs
+
+
+def render_cohort(jobs: Sequence[Dict[str, str]], n_procs: Optional[int] = None) -> Dict[str, List[str]]:
+    """Renders the QC images of a cohort, with subjects spread across a process pool.
+
+    Usage example:
+        >>> render_cohort(jobs=[{"out_name": "imgs/sub-001", "dwi": "sub-001_dwi.nii.gz"},
+        ...                     {"out_name": "imgs/sub-002", "dwi": "sub-002_dwi.nii.gz"}],
+        ...               n_procs=4)
+        ...
+
+    Args:
+        jobs: Keyword arguments of ``render_qc`` for each subject/acquisition.
+        n_procs: Number of worker processes. Defaults to None (number of CPUs).
+
+    Returns:
+        Dictionary that maps each ``out_name`` to its output PNG files.
+    """
+    with ProcessPoolExecutor(max_workers=n_procs) as pool:
+        futures: Dict[str, object] = {
+            job["out_name"]: pool.submit(render_qc, **job) for job in jobs
+        }
+        return {name: fut.result() for name, fut in futures.items()}
+
+
+def _ras_shape(data: Union[np.ndarray, Volume], ornt: np.ndarray) -> Tuple[int, int, int]:
+    """Spatial shape of a volume in RAS+ axis order.
+
+    Args:
+        data: Volume data, or volume (see ``Volume``).
+        ornt: Orientation of the data axes relative to RAS+.
+
+    Returns:
+        Number of voxels along the R, A, and S axes.
+    """
+    shape: List[int] = [0, 0, 0]
+    for ax, (ras, _) in enumerate(ornt):
+        shape[int(ras)] = data.shape[ax]
+    return tuple(shape)
+
+
+def _display_slice(data: Union[np.ndarray, Volume], ornt: np.ndarray, axis: int, index: int, zooms: Sequence[float] = (1, 1, 1)) -> np.ndarray:
+    """Extracts a slice in RAS+ orientation, oriented for display (superior/anterior up).
+
+    Args:
+        data: Volume data (3D, or 4D with RGB components along the last axis), or volume (see ``Volume``).
+        ornt: Orientation of the data axes relative to RAS+.
+        axis: RAS+ axis that is normal to the slice (0 - sagittal, 1 - coronal, 2 - axial).
+        index: Slice index along the RAS+ axis.
+        zooms: Voxel sizes. Defaults to (1, 1, 1).
+
+    Returns:
+        Display slice (rows x columns [x 3]).
+    """
+    # Data axis (and flip) of each RAS+ axis
+    data_ax: Dict[int, Tuple[int, int]] = {int(ras): (ax, int(flip)) for ax, (ras, flip) in enumerate(ornt)}
+
+    ax, flip = data_ax[axis]
+    if flip < 0:
+        index: int = data.shape[ax] - 1 - index
+
+    slc: np.ndarray = data.take(index, axis=ax)
+    remaining: List[int] = [data_ax[r] for r in range(3) if r != axis]
+    sizes: List[float] = [zooms[a] for a, _ in remaining]
+
+    # Order the remaining (in-plane) data axes as RAS+
+    order: List[int] = [sorted([a for a, _ in remaining]).index(a) for a, _ in remaining]
+    slc: np.ndarray = np.moveaxis(slc, order, [0, 1])
+
+    for n, (_, f) in enumerate(remaining):
+        if f < 0:
+            slc: np.ndarray = np.flip(slc, axis=n)
+
+    # Rows: second in-plane axis (flipped so that it increases upwards), columns: first in-plane axis
+    slc: np.ndarray = np.swapaxes(slc, 0, 1)[::-1]
+
+    # Approximate anisotropic voxels by pixel repetition
+    reps: np.ndarray = np.maximum(np.round(np.array(sizes[::-1]) / min(sizes)), 1).astype(int)
+    slc: np.ndarray = np.repeat(np.repeat(slc, reps[0], axis=0), reps[1], axis=1)
+
+    return slc
+
+
+def _tile(panels: List[np.ndarray], ncols: int) -> np.ndarray:
+    """Tiles 2D (or RGB) panels into a grid (padded with zeros to a common panel size).
+
+    Args:
+        panels: Panels to tile.
+        ncols: Number of columns.
+
+    Returns:
+        Tiled image.
+    """
+    h: int = max(p.shape[0] for p in panels)
+    w: int = max(p.shape[1] for p in panels)
+    ncols: int = min(ncols, len(panels))
+    nrows: int = int(np.ceil(len(panels) / ncols))
+
+    out: np.ndarray = np.zeros((nrows * h, ncols * w) + panels[0].shape[2:], dtype=panels[0].dtype)
+    for n, p in enumerate(panels):
+        r, c = divmod(n, ncols)
+        y0: int = r * h + (h - p.shape[0]) // 2
+        x0: int = c * w + (w - p.shape[1]) // 2
+        out[y0 : y0 + p.shape[0], x0 : x0 + p.shape[1]] = p
+
+    return out
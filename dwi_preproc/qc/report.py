@@ -0,0 +1,278 @@
+"""Incremental cohort quality control (QC) report builder.
+
+A JSON manifest records the QC images (artifacts) of each subject/acquisition,
+and the hashes of the inputs they were rendered from. Only new or changed
+subjects are rendered, and the HTML index is regenerated from the manifest.
+"""
+import os
+import glob
+import html
+import json
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from commandio.fileio import file
+from commandio.workdir import WorkDir
+
+from dwi_preproc.qc.render import render_cohort
+from dwi_preproc.utils.hashing import hash_file
+
+# Manifest format version
+_MANIFEST_VERSION: int = 1
+
+# Inputs of each subject/acquisition (in rendering order)
+_INPUTS: Tuple[str, ...] = ("dwi", "fa", "v1")
+
+
+def find_subjects(derivative_dir: str, bval: Optional[str] = None) -> Tuple[Dict[str, Dict[str, str]], List[str], List[str]]:
+    """Finds the preprocessed subjects/acquisitions of a pipeline derivatives directory.
+
+    The expected layout is ``<derivative_dir>/derivatives/sub-<sub>/ses-<ses>/<acq>``,
+    where each acquisition directory contains the preprocessed DWI (``*_dwi.nii*``), a
+    ``Tensor`` directory with the FA and V1 images, and the ``Eddy.qc`` directory.
+
+    Args:
+        derivative_dir: Parent derivatives directory.
+        bval: b-value label (e.g. 'b800') that is removed from the acquisition name. Defaults to None.
+
+    Returns:
+        * Dictionary that maps each subject/acquisition name (e.g. ``sub-001_run-01``) to its inputs.
+        * Subject/acquisition names with an incomplete set of preprocessed images.
+        * Subject/acquisition names without QC information (``Eddy.qc``).
+    """
+    subjects: Dict[str, Dict[str, str]] = {}
+    incomplete: List[str] = []
+    missing_qc: List[str] = []
+
+    for acq in sorted(glob.glob(os.path.join(derivative_dir, "derivatives", "sub-*", "*", "*"))):
+        if not os.path.isdir(acq):
+            continue
+
+        sub: str = os.path.basename(os.path.dirname(os.path.dirname(acq)))
+        run: str = os.path.basename(acq)
+
+        if bval:
+            run: str = run.replace(f"bval-{bval}_", "")
+
+        name: str = f"{sub}_{run}"
+
+        if not os.path.isdir(os.path.join(acq, "Eddy.qc")):
+            missing_qc.append(name)
+
+        inputs: Dict[str, List[str]] = {
+            "dwi": glob.glob(os.path.join(acq, "*_dwi.nii*")),
+            "fa": glob.glob(os.path.join(acq, "Tensor", "*FA*.nii*")),
+            "v1": glob.glob(os.path.join(acq, "Tensor", "*V1*.nii*")),
+        }
+
+        if not all(inputs.values()):
+            incomplete.append(name)
+            continue
+
+        subjects[name] = {k: os.path.abspath(sorted(v)[0]) for k, v in inputs.items()}
+
+    return subjects, incomplete, missing_qc
+
+
+def build_report(
+    subjects: Dict[str, Dict[str, str]],
+    outdir: str,
+    title: str = "DWI QC",
+    n_procs: Optional[int] = None,
+    force: bool = False,
+    incomplete: Optional[List[str]] = None,
+    missing_qc: Optional[List[str]] = None,
+) -> Tuple[file, List[str]]:
+    """Builds (or updates) a cohort QC report.
+
+    The QC images of a subject are rendered if the subject is new, if any of its
+    input hashes changed, or if any of its images are missing. Input files are only
+    re-hashed if their size or modification time changed since they were last
+    recorded. Subjects that are no longer present are removed from the manifest
+    (and the index).
+
+    Usage example:
+        >>> subjects, incomplete, missing_qc = find_subjects("dwi_preproc.s2v/b800.preproc", bval="b800")
+        >>> index, rendered = build_report(subjects=subjects,
+        ...                                outdir="dwi.preproc.qc/b800",
+        ...                                title="b800 QC",
+        ...                                incomplete=incomplete,
+        ...                                missing_qc=missing_qc)
+        ...
+
+    Args:
+        subjects: Dictionary that maps each subject/acquisition name to its inputs (``dwi``, and optionally ``fa`` and ``v1``).
+        outdir: Output directory (the images are written to ``<outdir>/imgs``).
+        title: Title of the HTML index. Defaults to 'DWI QC'.
+        n_procs: Number of worker processes used for rendering. Defaults to None (number of CPUs).
+        force: Re-render all subjects. Defaults to False.
+        incomplete: Subject/acquisition names to list as incomplete in the index. Defaults to None.
+        missing_qc: Subject/acquisition names to list as without QC information in the index. Defaults to None.
+
+    Returns:
+        * HTML index file.
+        * Names of the subjects/acquisitions that were rendered.
+    """
+    with WorkDir(src=os.path.join(outdir, "imgs")) as _:
+        outdir: str = os.path.abspath(outdir)
+
+    manifest_file: str = os.path.join(outdir, "qc_manifest.json")
+    manifest: Dict[str, Any] = load_manifest(manifest_file)
+    previous: Dict[str, Any] = manifest["Subjects"]
+
+    entries: Dict[str, Any] = {}
+    jobs: List[Dict[str, str]] = []
+
+    for name, inputs in sorted(subjects.items()):
+        old: Dict[str, Any] = previous.get(name, {})
+        record: Dict[str, Dict[str, Any]] = {
+            k: _fingerprint(v, old.get("Inputs", {}).get(k))
+            for k, v in inputs.items()
+            if k in _INPUTS and v
+        }
+
+        changed: bool = (
+            force
+            or _hashes(record) != _hashes(old.get("Inputs", {}))
+            or not old.get("Artifacts")
+            or not all(os.path.exists(os.path.join(outdir, a)) for a in old["Artifacts"])
+        )
+
+        entries[name] = {"Inputs": record, "Artifacts": old.get("Artifacts", [])}
+
+        if changed:
+            jobs.append({"out_name": os.path.join(outdir, "imgs", name), **{k: v["Path"] for k, v in record.items()}})
+
+    if jobs:
+        rendered: Dict[str, List[str]] = render_cohort(jobs=jobs, n_procs=n_procs)
+        for job in jobs:
+            name: str = os.path.basename(job["out_name"])
+            entries[name]["Artifacts"] = [os.path.relpath(a, outdir) for a in rendered[job["out_name"]]]
+
+    manifest["Subjects"] = entries
+    manifest["Incomplete"] = sorted(incomplete or [])
+    manifest["MissingQC"] = sorted(missing_qc or [])
+    write_manifest(manifest, manifest_file)
+
+    index: str = write_index(manifest, os.path.join(outdir, "index.html"), title=title)
+
+    return index, [os.path.basename(j["out_name"]) for j in jobs]
+
+
+def load_manifest(manifest_file: Union[file, str]) -> Dict[str, Any]:
+    """Loads a QC manifest (an empty manifest is returned if it does not exist, or is not valid).
+
+    Args:
+        manifest_file: Manifest JSON file.
+
+    Returns:
+        Manifest dictionary.
+    """
+    empty: Dict[str, Any] = {"Version": _MANIFEST_VERSION, "Subjects": {}, "Incomplete": [], "MissingQC": []}
+
+    if not os.path.exists(manifest_file):
+        return empty
+
+    try:
+        with open(manifest_file) as f:
+            manifest: Dict[str, Any] = json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return empty
+
+    if manifest.get("Version") != _MANIFEST_VERSION:
+        return empty
+
+    return manifest
+
+
+def write_manifest(manifest: Dict[str, Any], manifest_file: Union[file, str]) -> file:
+    """Writes a QC manifest (atomically, so that an interrupted update leaves the previous manifest intact).
+
+    Args:
+        manifest: Manifest dictionary.
+        manifest_file: Manifest JSON file.
+
+    Returns:
+        Manifest JSON file.
+    """
+    tmp: str = f"{manifest_file}.tmp"
+
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    os.replace(tmp, manifest_file)
+
+    return os.path.abspath(manifest_file)
+
+
+def write_index(manifest: Dict[str, Any], out: Union[file, str], title: str = "DWI QC") -> file:
+    """Writes the HTML index of a QC manifest.
+
+    Args:
+        manifest: Manifest dictionary.
+        out: Output HTML file.
+        title: Title of the HTML index. Defaults to 'DWI QC'.
+
+    Returns:
+        Output HTML file.
+    """
+    title: str = html.escape(title)
+    body: List[str] = [f"<h1>{title}</h1>", f"<p>{len(manifest['Subjects'])} subjects/acquisitions</p>"]
+
+    if manifest.get("Incomplete"):
+        body.append("<h2>Incomplete</h2>")
+        body.append("<ul>" + "".join(f"<li>{html.escape(n)}</li>" for n in manifest["Incomplete"]) + "</ul>")
+
+    if manifest.get("MissingQC"):
+        body.append("<h2>No QC information</h2>")
+        body.append("<ul>" + "".join(f"<li>{html.escape(n)}</li>" for n in manifest["MissingQC"]) + "</ul>")
+
+    for name, entry in sorted(manifest["Subjects"].items()):
+        body.append(f'<h2 id="{html.escape(name)}">{html.escape(name)}</h2>')
+        for a in entry["Artifacts"]:
+            body.append(f'<img src="{html.escape(a)}" loading="lazy" alt="{html.escape(os.path.basename(a))}"><br>')
+
+    with open(out, "w") as f:
+        f.write(
+            "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+            f"<title>{title}</title>\n"
+            "<style>body{background:#111;color:#eee;font-family:sans-serif} img{max-width:100%}</style>\n"
+            "</head>\n<body>\n" + "\n".join(body) + "\n</body>\n</html>\n"
+        )
+
+    return os.path.abspath(out)
+
+
+def _fingerprint(src: str, old: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Records the path, size, modification time and hash of an input file.
+
+    The hash of the previous record is reused if the path, size and modification time are unchanged.
+
+    Args:
+        src: Input file.
+        old: Previous record of the input file. Defaults to None.
+
+    Returns:
+        Input file record.
+    """
+    st: os.stat_result = os.stat(src)
+    record: Dict[str, Any] = {"Path": os.path.abspath(src), "Size": st.st_size, "MTime": st.st_mtime_ns}
+
+    if old and all(old.get(k) == v for k, v in record.items()) and old.get("Hash"):
+        record["Hash"] = old["Hash"]
+    else:
+        record["Hash"] = hash_file(src)
+
+    return record
+
+
+def _hashes(record: Dict[str, Dict[str, Any]]) -> Dict[str, Optional[str]]:
+    """Input hashes of a subject record.
+
+    Args:
+        record: Subject input records.
+
+    Returns:
+        Dictionary that maps each input to its hash.
+    """
+    return {k: v.get("Hash") for k, v in record.items()}
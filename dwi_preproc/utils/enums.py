@@ -18,3 +18,52 @@ class NiiHeaderField(Enum):
 
     descrip: str = "descrip"
     intent_name: str = "intent_name"
+
+
+@unique
+class TopupGridMode(Enum):
+    """Image grid adjustment options for ``FSL``'s ``topup``."""
+
+    pad: str = "pad"
+    crop: str = "crop"
+
+
+@unique
+class ApplyTopupMethod(Enum):
+    """Resampling method options for ``FSL``'s ``applytopup``."""
+
+    lsr: str = "lsr"
+    jac: str = "jac"
+
+
+@unique
+class EddyInterp(Enum):
+    """Interpolation options for ``FSL``'s ``eddy`` (and its slice-to-volume correction)."""
+
+    spline: str = "spline"
+    trilinear: str = "trilinear"
+
+
+@unique
+class EddyOutlierType(Enum):
+    """Outlier replacement grouping options for ``FSL``'s ``eddy``."""
+
+    sw: str = "sw"
+    gw: str = "gw"
+    both: str = "both"
+
+
+@unique
+class IntermediateFormat(Enum):
+    """Image file formats of the intermediate (work directory) images."""
+
+    nii_gz: str = "nii.gz"
+    nii: str = "nii"
+
+
+@unique
+class ArrayStoreFormat(Enum):
+    """Chunked array store formats (of exported images)."""
+
+    hdf5: str = "h5"
+    zarr: str = "zarr"
@@ -0,0 +1,530 @@
+"""Structured (JSON lines) event logging, and Prometheus (textfile) metrics of pipeline runs.
+
+Events are written by a background writer thread, in buffered batches, so
+that logging does not block processing on (slow) network storage. Counters
+and histograms (e.g. stage and command durations, cache hits and failures)
+are accumulated from the events, and exported in the Prometheus text format
+(e.g. for the textfile collector of the node exporter).
+
+Pipeline (shell) runs send their events to a collector process through a
+named pipe (FIFO): each event is a single line, either a JSON object, or the
+tab separated record of ``dwi_preproc.sh`` (see ``parse_record``). Native
+stages (subprocesses) send their events with ``emit`` to the pipe that is
+set by the ``DWI_PREPROC_EVENTS`` environment variable.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import threading
+
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from commandio.fileio import file
+
+# Default (upper) bucket bounds of the duration histograms (in seconds)
+_BUCKETS: Tuple[float, ...] = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400)
+
+# Fields of the tab separated event records of dwi_preproc.sh (in order)
+_RECORD_FIELDS: Tuple[str, ...] = ("time", "event", "stage", "status", "start", "command")
+
+# Metric name prefix, and descriptions of the metrics
+_PREFIX: str = "dwi_preproc"
+_HELP: Dict[str, str] = {
+    "events_total": "Number of logged events.",
+    "commands_total": "Number of commands run.",
+    "failures_total": "Number of failed commands (and errors).",
+    "cache_total": "Number of cache look-ups (result: hit, or miss).",
+    "stage_duration_seconds": "Stage durations.",
+    "command_duration_seconds": "Command durations.",
+    "last_event_timestamp_seconds": "Time of the last logged event.",
+    "work_disk_bytes": "Disk usage of the working directory (at the last stage boundary).",
+    "work_disk_peak_bytes": "Peak disk usage of the working directory (at stage boundaries).",
+    "work_freed_bytes_total": "Disk space freed by the (early) clean-up of intermediates.",
+}
+
+# Largest event line that is written atomically to a pipe (POSIX PIPE_BUF)
+_PIPE_BUF: int = 4096
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms, exported in the Prometheus text format.
+
+    Usage example:
+        >>> m = Metrics()
+        >>> m.inc("commands_total", stage="topup", status="ok")
+        >>> m.observe("stage_duration_seconds", 812.4, stage="topup")
+        >>> m.write_textfile("/var/lib/node_exporter/textfile/dwi_preproc_sub-001.prom")
+        "/var/lib/node_exporter/textfile/dwi_preproc_sub-001.prom"
+    """
+
+    def __init__(self, buckets: Sequence[float] = _BUCKETS, labels: Optional[Dict[str, str]] = None) -> None:
+        """Initializes the metrics.
+
+        Args:
+            buckets: Upper bounds of the histogram buckets. Defaults to (1, 5, 15, ..., 14400) seconds.
+            labels: Labels (e.g. ``subject``) that are added to each metric. Defaults to None.
+        """
+        self.buckets: Tuple[float, ...] = tuple(sorted(float(b) for b in buckets))
+        self.labels: Dict[str, str] = dict(labels or {})
+        self._counters: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+        self._gauges: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+        self._hists: Dict[str, Dict[Tuple[Tuple[str, str], ...], List[float]]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        """Increments a counter.
+
+        Args:
+            name: Metric name (without the ``dwi_preproc_`` prefix).
+            value: Increment. Defaults to 1.
+            **labels: Metric labels.
+        """
+        key: Tuple[Tuple[str, str], ...] = self._key(labels)
+        with self._lock:
+            series: Dict[Tuple[Tuple[str, str], ...], float] = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+        return None
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        """Sets a gauge.
+
+        Args:
+            name: Metric name (without the ``dwi_preproc_`` prefix).
+            value: Value.
+            **labels: Metric labels.
+        """
+        with self._lock:
+            self._gauges.setdefault(name, {})[self._key(labels)] = float(value)
+        return None
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        """Adds an observation to a histogram.
+
+        Args:
+            name: Metric name (without the ``dwi_preproc_`` prefix).
+            value: Observed value.
+            **labels: Metric labels.
+        """
+        key: Tuple[Tuple[str, str], ...] = self._key(labels)
+        with self._lock:
+            # Per-bucket counts (the last bucket is +Inf), followed by the sum
+            hist: List[float] = self._hists.setdefault(name, {}).setdefault(key, [0.0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            else:
+                hist[len(self.buckets)] += 1
+            hist[-1] += value
+        return None
+
+    def render(self) -> str:
+        """Renders the metrics in the Prometheus text format.
+
+        Returns:
+            Metrics (text).
+        """
+        lines: List[str] = []
+
+        with self._lock:
+            for kind, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted(metrics):
+                    lines.extend(self._header(name, kind))
+                    for key, value in sorted(metrics[name].items()):
+                        lines.append(f"{_PREFIX}_{name}{_labels(key)} {_num(value)}")
+
+            for name in sorted(self._hists):
+                lines.extend(self._header(name, "histogram"))
+                for key, hist in sorted(self._hists[name].items()):
+                    total: float = 0
+                    for bound, count in zip(self.buckets + (float("inf"),), hist[:-1]):
+                        total += count
+                        le: str = "+Inf" if bound == float("inf") else _num(bound)
+                        lines.append(f"{_PREFIX}_{name}_bucket{_labels(key + (('le', le),))} {_num(total)}")
+                    lines.append(f"{_PREFIX}_{name}_sum{_labels(key)} {_num(hist[-1])}")
+                    lines.append(f"{_PREFIX}_{name}_count{_labels(key)} {_num(total)}")
+
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def write_textfile(self, out: Union[file, str]) -> file:
+        """Writes the metrics to a (``.prom``) textfile, atomically (the textfile collector never reads a partial file).
+
+        Args:
+            out: Output textfile.
+
+        Returns:
+            Absolute path to the textfile.
+        """
+        out: str = os.path.abspath(out)
+        tmp: str = f"{out}.{os.getpid()}.tmp"
+
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, out)
+
+        return out
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+        """Sorted (label, value) pairs, including the common labels."""
+        return tuple(sorted((k, str(v)) for k, v in {**self.labels, **labels}.items() if v is not None))
+
+    def _header(self, name: str, kind: str) -> List[str]:
+        """HELP and TYPE lines of a metric."""
+        return [f"# HELP {_PREFIX}_{name} {_HELP.get(name, name)}", f"# TYPE {_PREFIX}_{name} {kind}"]
+
+
+class EventLog:
+    """Structured (JSON lines) event log, written by a background writer thread.
+
+    Each event is a JSON object with (at least) the ``time`` (UNIX time),
+    ``event``, ``subject``, ``host`` and ``pid`` fields, and (depending on the
+    event) the ``stage``, ``command``, ``status`` and ``duration`` (seconds).
+
+    Events are queued (``emit`` does not block), and the writer thread
+    appends them to the log file in batches: when ``max_buffer`` events are
+    buffered, or every ``flush_interval`` seconds. The metrics (and their
+    textfile, if any) are updated from the events.
+
+    The following events update the metrics:
+        * ``stage_start``: Starts a stage (and ends the current stage, if any).
+        * ``stage_end``: Ends a stage (``duration`` is computed, if not provided).
+        * ``command``: A command (with its ``status``, and ``duration``) was run.
+        * ``cache``: A cache look-up (``status``: ``hit``, or ``miss``).
+        * ``error``: An error occurred.
+
+    Usage example:
+        >>> with EventLog("logs/sub-001.events.jsonl", subject="sub-001", textfile="logs/dwi_preproc_sub-001.prom") as events:
+        ...     with events.stage("topup"):
+        ...         events.emit("command", command="topup --imain=B0s ...", status=0, duration=812.4)
+        ...
+    """
+
+    def __init__(
+        self,
+        log: Union[file, str],
+        subject: Optional[str] = None,
+        metrics: Optional[Metrics] = None,
+        textfile: Optional[Union[file, str]] = None,
+        flush_interval: float = 2.0,
+        max_buffer: int = 256,
+    ) -> None:
+        """Initializes the event log, and starts the writer thread.
+
+        Args:
+            log: Output (JSON lines) log file (appended to).
+            subject: Subject (or run) identifier that is added to each event. Defaults to None.
+            metrics: Metrics that are updated from the events. Defaults to None (new metrics, labelled with the subject).
+            textfile: Output Prometheus textfile, rewritten on each flush. Defaults to None.
+            flush_interval: Maximum time (seconds) that events are buffered. Defaults to 2.
+            max_buffer: Maximum number of buffered events. Defaults to 256.
+        """
+        self.log: str = os.path.abspath(log)
+        self.subject: Optional[str] = subject
+        self.metrics: Metrics = metrics or Metrics(labels={"subject": subject} if subject else None)
+        self.textfile: Optional[str] = os.path.abspath(textfile) if textfile else None
+        self.flush_interval: float = float(flush_interval)
+        self.max_buffer: int = max(int(max_buffer), 1)
+
+        self._host: str = socket.gethostname()
+        self._stage: Optional[Tuple[str, float]] = None
+        self._queue: queue.Queue = queue.Queue()
+        self._closed: bool = False
+
+        os.makedirs(os.path.dirname(self.log), exist_ok=True)
+        self._writer: threading.Thread = threading.Thread(target=self._write, name="EventLogWriter", daemon=True)
+        self._writer.start()
+
+    def __enter__(self) -> "EventLog":
+        """Context manager entrance."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback) -> None:
+        """Context manager exit: ends the current stage, and flushes (and closes) the log."""
+        if exc_type is not None:
+            self.emit("error", message=f"{exc_type.__name__}: {exc_val}")
+        self.close()
+
+    def emit(self, event: str, **fields: Any) -> Dict[str, Any]:
+        """Logs an event (queued for the writer thread), and updates the metrics.
+
+        Args:
+            event: Event type (e.g. ``stage_start``, ``command``, ``cache``, ``error``).
+            **fields: Event fields (e.g. ``stage``, ``command``, ``status``, ``duration``). A ``time`` field overrides the event time.
+
+        Returns:
+            Event dictionary.
+        """
+        record: Dict[str, Any] = {
+            "time": round(time.time(), 6),
+            "event": event,
+            "subject": self.subject,
+            "host": self._host,
+            "pid": os.getpid(),
+        }
+        record.update({k: v for k, v in fields.items() if v is not None})
+
+        if event == "stage_start":
+            self._end_stage(end=record["time"])
+            self._stage = (record.get("stage", ""), record["time"])
+
+        if event == "stage_end" and "duration" not in record and self._stage:
+            record["duration"] = round(record["time"] - self._stage[1], 6)
+            record.setdefault("stage", self._stage[0])
+            self._stage = None
+
+        self._account(record)
+        self._queue.put(json.dumps(record, default=str) + "\n")
+
+        return record
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator["EventLog"]:
+        """Context manager that logs the start and end (and duration) of a stage.
+
+        Args:
+            name: Stage name.
+        """
+        self.emit("stage_start", stage=name)
+        try:
+            yield self
+        except BaseException as e:
+            self.emit("error", stage=name, message=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            self._end_stage()
+
+    def close(self) -> None:
+        """Ends the current stage, writes the remaining (buffered) events, and stops the writer thread."""
+        if self._closed:
+            return None
+
+        self._end_stage()
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+
+        return None
+
+    def _end_stage(self, end: Optional[float] = None) -> None:
+        """Ends the current stage (if any)."""
+        if self._stage is None:
+            return None
+
+        name, start = self._stage
+        self._stage = None
+        self.emit("stage_end", stage=name, duration=round((end or time.time()) - start, 6))
+        return None
+
+    def _account(self, record: Dict[str, Any]) -> None:
+        """Updates the metrics from an event."""
+        event: str = record["event"]
+        stage: Optional[str] = record.get("stage") or None
+
+        self.metrics.inc("events_total", event=event)
+        self.metrics.set("last_event_timestamp_seconds", record["time"])
+
+        if event == "stage_end" and "duration" in record:
+            self.metrics.observe("stage_duration_seconds", float(record["duration"]), stage=stage)
+        elif event == "command":
+            failed: bool = str(record.get("status", 0)) not in ("0", "ok")
+            self.metrics.inc("commands_total", stage=stage, status="failed" if failed else "ok")
+            if "duration" in record:
+                self.metrics.observe("command_duration_seconds", float(record["duration"]), stage=stage)
+            if failed:
+                self.metrics.inc("failures_total", stage=stage)
+        elif event == "cache":
+            self.metrics.inc("cache_total", stage=stage, result=record.get("status", "hit"))
+        elif event == "error":
+            self.metrics.inc("failures_total", stage=stage)
+        elif event == "disk":
+            self.metrics.set("work_disk_bytes", float(record.get("used", 0)))
+            self.metrics.set("work_disk_peak_bytes", float(record.get("peak", 0)))
+            self.metrics.inc("work_freed_bytes_total", float(record.get("freed", 0)), stage=stage)
+
+        return None
+
+    def _write(self) -> None:
+        """Writer thread: appends the queued events to the log file, in batches."""
+        buffer: List[str] = []
+        last: float = time.monotonic()
+        done: bool = False
+
+        while not done:
+            try:
+                line: Optional[str] = self._queue.get(timeout=max(self.flush_interval - (time.monotonic() - last), 0.01))
+                if line is None:
+                    done = True
+                else:
+                    buffer.append(line)
+            except queue.Empty:
+                pass
+
+            if buffer and (done or len(buffer) >= self.max_buffer or time.monotonic() - last >= self.flush_interval):
+                self._flush(buffer)
+                buffer: List[str] = []
+                last: float = time.monotonic()
+            elif done or time.monotonic() - last >= self.flush_interval:
+                if self.textfile:
+                    self.metrics.write_textfile(self.textfile)
+                last: float = time.monotonic()
+
+        return None
+
+    def _flush(self, lines: List[str]) -> None:
+        """Appends a batch of event lines to the log file (in a single write), and rewrites the textfile."""
+        try:
+            with open(self.log, "a") as f:
+                f.write("".join(lines))
+            if self.textfile:
+                self.metrics.write_textfile(self.textfile)
+        except OSError as e:
+            print(f"Unable to write the event log ({self.log}): {e}", file=sys.stderr)
+        return None
+
+
+def parse_record(line: str) -> Optional[Dict[str, Any]]:
+    """Parses an event line: a JSON object, or a tab separated record of ``dwi_preproc.sh``.
+
+    The tab separated records have the fields: ``time``, ``event``, ``stage``,
+    ``status``, ``start`` (UNIX time, for the ``duration``), and ``command``
+    (the rest of the line). Empty fields are omitted.
+
+    Args:
+        line: Event line.
+
+    Returns:
+        Event fields, or None if the line is not a valid event.
+    """
+    line: str = line.rstrip("\n")
+
+    if not line.strip():
+        return None
+
+    if line.lstrip().startswith("{"):
+        try:
+            record: Dict[str, Any] = json.loads(line)
+        except json.JSONDecodeError:
+            return None
+        return record if isinstance(record, dict) and "event" in record else None
+
+    values: List[str] = line.split("\t", len(_RECORD_FIELDS) - 1)
+    if len(values) < 2 or not values[1]:
+        return None
+
+    record: Dict[str, Any] = {k: v for k, v in zip(_RECORD_FIELDS, values) if v != ""}
+
+    try:
+        for k in ("time", "start"):
+            if k in record:
+                record[k] = float(record[k])
+    except ValueError:
+        return None
+
+    if "start" in record and "time" in record:
+        record["duration"] = round(record["time"] - record.pop("start"), 6)
+
+    if "status" in record and record["status"].lstrip("-").isdigit():
+        record["status"] = int(record["status"])
+
+    return record
+
+
+def collect(
+    src: Union[file, str],
+    log: Union[file, str],
+    subject: Optional[str] = None,
+    textfile: Optional[Union[file, str]] = None,
+    flush_interval: float = 2.0,
+) -> int:
+    """Collects events from a (named) pipe, or file, into an event log, until the end of the input.
+
+    The end of a named pipe is reached once all of its writers have closed it.
+
+    Usage example:
+        >>> n = collect("/tmp/sub-001.events", "logs/sub-001.events.jsonl", subject="sub-001", textfile="logs/dwi_preproc_sub-001.prom")
+
+    Args:
+        src: Input (named) pipe, or file, of event lines (see ``parse_record``).
+        log: Output (JSON lines) log file (appended to).
+        subject: Subject (or run) identifier. Defaults to None.
+        textfile: Output Prometheus textfile. Defaults to None.
+        flush_interval: Maximum time (seconds) that events are buffered. Defaults to 2.
+
+    Returns:
+        Number of collected events.
+    """
+    n: int = 0
+
+    with EventLog(log=log, subject=subject, textfile=textfile, flush_interval=flush_interval) as events:
+        with open(src) as f:
+            for line in f:
+                record: Optional[Dict[str, Any]] = parse_record(line)
+                if record is None:
+                    continue
+                # The subject of the collector takes precedence
+                record.pop("subject", None)
+                events.emit(record.pop("event"), **record)
+                n += 1
+
+    return n
+
+
+def emit(event: str, **fields: Any) -> bool:
+    """Sends an event to the collector of the current pipeline run (``DWI_PREPROC_EVENTS``), if any.
+
+    The event is written (as a single JSON line) without blocking, and is
+    dropped if there is no collector. The current stage (``DWI_PREPROC_STAGE``)
+    is added to the event, unless it is provided.
+
+    Usage example:
+        >>> emit("cache", status="hit", record="Eddy/sub-001_eddy_corr.eddy_run.json")
+        True
+
+    Args:
+        event: Event type.
+        **fields: Event fields.
+
+    Returns:
+        True if the event was sent, False otherwise.
+    """
+    dst: str = os.environ.get("DWI_PREPROC_EVENTS", "")
+
+    if not dst:
+        return False
+
+    record: Dict[str, Any] = {"time": round(time.time(), 6), "event": event, "stage": os.environ.get("DWI_PREPROC_STAGE") or None, "pid": os.getpid()}
+    record.update(fields)
+    line: bytes = (json.dumps({k: v for k, v in record.items() if v is not None}, default=str) + "\n").encode()
+
+    if len(line) > _PIPE_BUF:
+        return False
+
+    try:
+        fd: int = os.open(dst, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+    except OSError:
+        return False
+
+    try:
+        os.write(fd, line)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def _labels(key: Sequence[Tuple[str, str]]) -> str:
+    """Renders (label, value) pairs in the Prometheus text format."""
+    if not key:
+        return ""
+    esc: Dict[int, str] = {ord("\\"): "\\\\", ord('"'): '\\"', ord("\n"): "\\n"}
+    return "{" + ",".join(f'{k}="{str(v).translate(esc)}"' for k, v in key) + "}"
+
+
+def _num(value: float) -> str:
+    """Renders a number in the Prometheus text format."""
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
@@ -0,0 +1,254 @@
+"""Content hashing utilities used to cache the outputs of pipeline stages.
+
+NIFTI images are hashed by their decoded content (header and voxel data), so
+that their hashes do not depend on the compression (e.g. the gzip level, or
+``.nii`` vs. ``.nii.gz``). Hashes are cached in memory and on disk (see
+``dwi_preproc.utils.statcache``), keyed on the (device, inode, size,
+modification time) of each file, so that unchanged files are not hashed again.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import nibabel as nib
+
+from concurrent.futures import ThreadPoolExecutor
+from nibabel.openers import Opener
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.utils.eventlog import emit
+from dwi_preproc.utils.statcache import read_stat_cache, stat_cache_dir, stat_key, write_stat_cache
+from dwi_preproc.utils.util import available_cores
+
+# Read files in 1 MB chunks
+_CHUNK_SIZE: int = 1024 ** 2
+
+# Prefix of the (decoded) image content hashes, so that they differ from file hashes
+_IMAGE_TAG: bytes = b"dwi_preproc:nifti:v2\0"
+
+# Version of the hashes (part of the cache keys, so that cached hashes of older versions are not used)
+_HASH_VERSION: str = "dwi_preproc:hash:v2"
+
+# NIFTI file extensions (hashed by their decoded content)
+_NIFTI_EXT: Tuple[str, ...] = (".nii", ".nii.gz")
+
+# In-memory cache of content hashes: stat key (device, inode, size, mtime, and algorithm) -> hash
+_HASHES: Dict[str, str] = {}
+
+
+class ImageHashError(Exception):
+    """Exception intended for NIFTI images that can not be hashed (e.g. truncated image data)."""
+    pass
+
+
+def hash_file(src: Union[file, str], algorithm: str = "sha256") -> str:
+    """Hashes the contents of a file in a streamed manner (bounded memory).
+
+    Args:
+        src: Input file.
+        algorithm: Hashing algorithm (any algorithm supported by ``hashlib``). Defaults to 'sha256'.
+
+    Returns:
+        Hexadecimal digest of the file contents.
+    """
+    h = hashlib.new(algorithm)
+
+    with open(src, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def hash_image(src: Union[file, str], algorithm: str = "sha256") -> str:
+    """Hashes the decoded content (header and voxel data) of a NIFTI image in a streamed manner (bounded memory).
+
+    The (raw, on-disk) header and voxel data bytes are hashed, after
+    decompression, so the hash of an image does not depend on its compression
+    (e.g. the gzip level, or ``.nii`` vs. ``.nii.gz``). Header extensions are
+    not hashed.
+
+    NOTE:
+        The header is read from the file, rather than from the loaded header
+        (in which ``nibabel`` resets ``scl_slope`` and ``scl_inter``), so that
+        images that only differ in their scaling have different hashes.
+
+    Args:
+        src: Input NIFTI image.
+        algorithm: Hashing algorithm (any algorithm supported by ``hashlib``). Defaults to 'sha256'.
+
+    Raises:
+        ImageHashError: Exception that is raised if the image data is truncated.
+
+    Returns:
+        Hexadecimal digest of the image content.
+    """
+    nii: nib.Nifti1Image = nib.load(src)
+    hdr: nib.Nifti1Header = nii.header
+
+    h = hashlib.new(algorithm)
+    h.update(_IMAGE_TAG)
+
+    size: int = len(hdr.binaryblock)
+    remaining: int = int(np.prod(nii.shape)) * hdr.get_data_dtype().itemsize
+
+    try:
+        with Opener(nii.get_filename(), "rb") as f:
+            raw: bytes = f.read(size)
+            if len(raw) < size:
+                raise ImageHashError(f"Truncated image header: {src}")
+            h.update(raw)
+            f.seek(nii.dataobj.offset)
+            while remaining > 0:
+                chunk: bytes = f.read(min(_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                h.update(chunk)
+                remaining -= len(chunk)
+    except EOFError:
+        pass
+
+    if remaining > 0:
+        raise ImageHashError(f"Truncated image data ({remaining} bytes missing): {src}")
+
+    return h.hexdigest()
+
+
+def content_hash(src: Union[file, str], algorithm: str = "sha256", cache_dir: Optional[str] = None) -> str:
+    """Hashes the content of a file (the decoded content of NIFTI images), using cached hashes of unchanged files.
+
+    Hashes are cached in memory and (should a cache directory be available) on
+    disk, keyed on the (device, inode, size, modification time) of the file.
+
+    Usage example:
+        >>> content_hash("sub-001_dwi.nii.gz") == content_hash("sub-001_dwi.nii")
+        True
+
+    Args:
+        src: Input file.
+        algorithm: Hashing algorithm (any algorithm supported by ``hashlib``). Defaults to 'sha256'.
+        cache_dir: Directory of the on-disk cache. Defaults to None (``$DWI_PREPROC_CACHE/hashes``, or ``~/.cache/dwi_preproc/hashes``). An empty string disables the on-disk cache.
+
+    Raises:
+        ImageHashError: Exception that is raised if the image data of a NIFTI image is truncated.
+
+    Returns:
+        Hexadecimal digest of the file content.
+    """
+    key: str = stat_key({"src": src}, tag=f"{_HASH_VERSION}:{algorithm}")
+
+    if key in _HASHES:
+        return _HASHES[key]
+
+    cache_dir: str = stat_cache_dir("hashes", cache_dir)
+    digest: Union[str, None] = read_stat_cache(key, cache_dir)
+
+    if isinstance(digest, str) and digest:
+        _HASHES[key] = digest
+        return digest
+
+    if str(src).endswith(_NIFTI_EXT):
+        try:
+            digest: str = hash_image(src, algorithm=algorithm)
+        except (nib.filebasedimages.ImageFileError, ValueError):
+            # Not a (valid) NIFTI image
+            digest: str = hash_file(src, algorithm=algorithm)
+    else:
+        digest: str = hash_file(src, algorithm=algorithm)
+
+    write_stat_cache(key, digest, cache_dir)
+    _HASHES[key] = digest
+
+    return digest
+
+
+def hash_files(
+    files: Sequence[Union[file, str]],
+    algorithm: str = "sha256",
+    cache_dir: Optional[str] = None,
+    max_workers: Optional[int] = None,
+) -> Dict[str, str]:
+    """Hashes the content of several files concurrently (see ``content_hash``).
+
+    Files are hashed by a pool of threads: decompression and hashing release
+    the GIL, and each thread streams a single file at a time (bounded memory).
+
+    Usage example:
+        >>> hashes = hash_files(glob.glob("sub-*/dwi/*.nii.gz"))
+        >>> hashes["sub-001/dwi/sub-001_dwi.nii.gz"]
+        "5f1e..."
+
+    Args:
+        files: Input files.
+        algorithm: Hashing algorithm (any algorithm supported by ``hashlib``). Defaults to 'sha256'.
+        cache_dir: Directory of the on-disk cache (see ``content_hash``). Defaults to None.
+        max_workers: Number of threads. Defaults to None (number of allocated cores, up to 8).
+
+    Returns:
+        Dictionary that maps each input file (as provided) to its hash.
+    """
+    files: List[str] = list(dict.fromkeys(str(f) for f in files))
+    max_workers: int = max(int(max_workers or min(available_cores(), 8)), 1)
+
+    if len(files) <= 1 or max_workers == 1:
+        return {f: content_hash(f, algorithm=algorithm, cache_dir=cache_dir) for f in files}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as pool:
+        digests: List[str] = list(pool.map(lambda f: content_hash(f, algorithm=algorithm, cache_dir=cache_dir), files))
+
+    return dict(zip(files, digests))
+
+
+def cache_key(files: Sequence[Optional[Union[file, str]]], params: Optional[Dict[str, Any]] = None, algorithm: str = "sha256") -> str:
+    """Computes a cache key from the contents of some input files and a set of (JSON serializable) parameters.
+
+    Usage example:
+        >>> cache_key(files=["b0.nii.gz", None], params={"shrink_factor": 4})
+        "5f1e..."
+
+    Args:
+        files: Input files (``None`` entries are allowed, and are hashed as such).
+        params: Dictionary of parameters. Defaults to None.
+        algorithm: Hashing algorithm (any algorithm supported by ``hashlib``). Defaults to 'sha256'.
+
+    Returns:
+        Hexadecimal digest of the cache key.
+    """
+    h = hashlib.new(algorithm)
+    digests: Dict[str, str] = hash_files([f for f in files if f], algorithm=algorithm)
+
+    for f in files:
+        h.update((digests[str(f)] if f else "None").encode())
+
+    h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+
+    return h.hexdigest()
+
+
+def is_cached(key: str, record: Union[file, str], outputs: Sequence[Union[file, str]]) -> bool:
+    """Checks if the outputs of some stage are cached for some cache key.
+
+    The result is sent (as a ``cache`` event) to the event collector of the pipeline run, if any.
+
+    Args:
+        key: Cache key.
+        record: JSON file that records the cache key of the existing outputs.
+        outputs: Output files of the stage.
+
+    Returns:
+        True if all outputs exist and the recorded cache key matches, False otherwise.
+    """
+    hit: bool = False
+
+    if os.path.exists(record) and all(os.path.exists(o) for o in outputs):
+        try:
+            with open(record) as f:
+                hit: bool = json.load(f).get("CacheKey") == key
+        except (json.JSONDecodeError, OSError):
+            hit: bool = False
+
+    emit("cache", status="hit" if hit else "miss", record=os.path.abspath(record))
+
+    return hit
@@ -1,23 +1,50 @@
 """NIFTI file read/write module."""
+import io
 import os
+import shutil
+import numpy as np
 import nibabel as nib
 
-from typing import NewType, Union
+from typing import Any, Dict, Iterator, List, NewType, Optional, Sequence, Tuple, Union
 from warnings import warn
 
+from nibabel.openers import Opener
+
 from commandio.fileio import File
 
-from dwi_preproc.utils.enums import NiiHeaderField
+from dwi_preproc.utils.enums import ArrayStoreFormat, IntermediateFormat, NiiHeaderField
 
 # Globally define type(s)
 image = NewType('image',str)
 
+# Environmental variables that define the intermediate image policy
+_FORMAT_ENV: str = "DWI_PREPROC_INTERMEDIATE"
+_QUANTIZE_ENV: str = "DWI_PREPROC_QUANTIZE"
+
+# FSLOUTPUTTYPE (and file extension) of each intermediate image format
+_FSLOUTPUTTYPE: Dict[str, str] = {"nii_gz": "NIFTI_GZ", "nii": "NIFTI"}
+_EXT: Dict[str, str] = {"nii_gz": ".nii.gz", "nii": ".nii"}
+
+# gzip compression level of published (final) images
+_PUBLISH_COMPRESSLEVEL: int = 6
+
+# File extensions of chunked array stores
+_STORE_EXT: Dict[str, str] = {".h5": "hdf5", ".hdf5": "hdf5", ".zarr": "zarr"}
+
+# Default chunk shape (x, y, z, volumes) of exported 4D images
+_STORE_CHUNKS: Tuple[int, int, int, int] = (16, 16, 16, 16)
+
 
 class InvalidNiftiFileError(Exception):
     """Exception intended for invalid NIFTI files."""
     pass
 
 
+class ArrayStoreError(Exception):
+    """Exception intended for invalid (or unsupported) chunked array stores."""
+    pass
+
+
 class NiiFile(File):
     """NIFTI file class specific for NIFTI files which inherits class methods from the ``File`` base class.
 
@@ -161,3 +188,666 @@ class NiiFile(File):
                 )
             img.header["intent_name"] = txt
         return None
+
+
+def _check_indices(idx: Sequence[int]) -> List[int]:
+    """Checks that volume indices are unique, and in ascending order.
+
+    Args:
+        idx: Volume indices.
+
+    Raises:
+        ValueError: Exception that is raised if the indices are unsorted, or include duplicates.
+
+    Returns:
+        List of volume indices.
+    """
+    idx: List[int] = [int(i) for i in idx]
+    if any(b <= a for a, b in zip(idx, idx[1:])):
+        raise ValueError(f"The volume indices must be unique, and in ascending order: {idx}")
+    return idx
+
+
+def iter_volumes(img: Union[image, str], idx: Optional[Sequence[int]] = None) -> Iterator[np.ndarray]:
+    """Streams the volumes of a 4D NIFTI image, one volume at a time.
+
+    Volumes are read in ascending order so that compressed (``.nii.gz``) images
+    are only decompressed once, and only a single volume is held in memory.
+    The indices must therefore be unique, and in ascending order: volumes are
+    yielded in the order of ``idx``.
+
+    Usage example:
+        >>> for vol in iter_volumes("dwi.nii.gz", idx=[0, 5, 10]):
+        ...     print(vol.mean())
+        ...
+
+    Args:
+        img: Input NIFTI image.
+        idx: Volume indices to read (unique, in ascending order). Defaults to None (all volumes).
+
+    Raises:
+        ValueError: Exception that is raised if the indices are unsorted, or include duplicates.
+
+    Yields:
+        Scaled (``float32``) volume data.
+    """
+    if idx is not None:
+        idx: List[int] = _check_indices(idx)
+
+    nii: nib.Nifti1Image = nib.load(img, keep_file_open=True)
+
+    if len(nii.shape) < 4:
+        yield np.asarray(nii.dataobj, dtype=np.float32)
+        return
+
+    if idx is None:
+        idx: Sequence[int] = range(nii.shape[3])
+
+    for i in idx:
+        yield np.asarray(nii.dataobj[..., i], dtype=np.float32)
+
+
+def extract_volumes(img: Union[image, str], out: Union[image, str], idx: Sequence[int]) -> image:
+    """Writes a subset of the volumes of a 4D NIFTI image to a new NIFTI image.
+
+    The (raw) bytes of each selected volume are copied in a single streamed pass,
+    so the data type and scaling of the input image are preserved and memory use
+    is bounded by the size of a single volume. The indices must therefore be
+    unique, and in ascending order.
+
+    Usage example:
+        >>> extract_volumes("dwi.nii.gz", "dwi_subset.nii.gz", idx=[0, 1, 2])
+        "abspath/to/dwi_subset.nii.gz"
+
+    Args:
+        img: Input 4D NIFTI image.
+        out: Output NIFTI image.
+        idx: Volume indices to keep (unique, in ascending order).
+
+    Raises:
+        ValueError: Exception that is raised if the indices are unsorted, or include duplicates.
+
+    Returns:
+        Output NIFTI image.
+    """
+    keep: set = set(_check_indices(idx))
+    nii: nib.Nifti1Image = nib.load(img)
+    out: str = NiiFile(src=out).src
+
+    hdr: nib.Nifti1Header = nii.header.copy()
+    nvols: int = nii.shape[3] if len(nii.shape) > 3 else 1
+    hdr.set_data_shape(nii.shape[:3] + (len(keep),))
+
+    # Scaling is moved from the header to the data proxy when the image is loaded
+    hdr.set_slope_inter(nii.dataobj.slope, nii.dataobj.inter)
+
+    vol_bytes: int = int(np.prod(nii.shape[:3])) * hdr.get_data_dtype().itemsize
+
+    with Opener(nii.get_filename(), "rb") as src, Opener(out, "wb") as dst:
+        _write_header(hdr=hdr, fileobj=dst)
+        src.seek(nii.dataobj.offset)
+        for i in range(nvols):
+            buf: bytes = src.read(vol_bytes)
+            if i in keep:
+                dst.write(buf)
+
+    return os.path.abspath(out)
+
+
+def scale_volumes(img: Union[image, str], out: Union[image, str], scale: Sequence[float]) -> image:
+    """Multiplies each volume of a 4D NIFTI image by a (per-volume) scale factor, in a single streamed pass.
+
+    The (raw) bytes of each volume are read, scaled (after the scaling of the
+    input image is applied), and written one volume at a time, so memory use
+    is bounded by the size of a single volume.
+
+    NOTE:
+        Integer images keep their data type (which halves the output of ``int16`` images, compared to ``float32``): the
+        slope (``scl_slope``) is multiplied by the largest scale factor, so that the scaled values fit the data type.
+        Floating point images are written as ``float32``.
+
+    Usage example:
+        >>> scale_volumes("dwi.nii.gz", "dwi_scaled.nii.gz", scale=[1.0, 1.01, 1.02])
+        "abspath/to/dwi_scaled.nii.gz"
+
+    Args:
+        img: Input 4D NIFTI image.
+        out: Output NIFTI image.
+        scale: Scale factor of each volume.
+
+    Raises:
+        ValueError: Exception that is raised if the number of scale factors does not match the number of volumes.
+
+    Returns:
+        Output NIFTI image.
+    """
+    nii: nib.Nifti1Image = nib.load(img)
+    out: str = NiiFile(src=out).src
+    nvols: int = nii.shape[3] if len(nii.shape) > 3 else 1
+
+    if len(scale) != nvols:
+        raise ValueError(f"The number of scale factors ({len(scale)}) does not match the number of volumes ({nvols}) of: {img}")
+
+    src_dtype: np.dtype = nii.header.get_data_dtype()
+    slope, inter = nii.dataobj.slope, nii.dataobj.inter
+    nvox: int = int(np.prod(nii.shape[:3]))
+
+    hdr: nib.Nifti1Header = nii.header.copy()
+
+    if np.issubdtype(src_dtype, np.integer):
+        info: np.iinfo = np.iinfo(src_dtype)
+        out_slope: float = float(np.max(np.abs(scale))) * max(abs(info.min * slope + inter), abs(info.max * slope + inter)) / info.max
+        hdr.set_slope_inter(out_slope, 0)
+    else:
+        info: Union[np.iinfo, None] = None
+        out_slope: float = 1.0
+        hdr.set_data_dtype(np.float32)
+        hdr.set_slope_inter(1, 0)
+
+    out_dtype: np.dtype = hdr.get_data_dtype()
+
+    with Opener(nii.get_filename(), "rb") as src, Opener(out, "wb") as dst:
+        _write_header(hdr=hdr, fileobj=dst)
+        src.seek(nii.dataobj.offset)
+        for s in scale:
+            # Voxel order is irrelevant to the (element-wise) scaling, so the volume is not reshaped
+            vol: np.ndarray = np.frombuffer(src.read(nvox * src_dtype.itemsize), dtype=src_dtype)
+            vol: np.ndarray = (vol * slope + inter) * (float(s) / out_slope)
+            if info is not None:
+                vol: np.ndarray = np.clip(np.rint(vol), info.min, info.max)
+            dst.write(vol.astype(out_dtype).tobytes())
+
+    return os.path.abspath(out)
+
+
+def _write_header(hdr: nib.Nifti1Header, fileobj: io.IOBase) -> None:
+    """Writes a (single file) NIFTI header, extensions and padding up to the data offset.
+
+    Args:
+        hdr: NIFTI header.
+        fileobj: File object opened for writing.
+    """
+    buf: io.BytesIO = io.BytesIO()
+    hdr.write_to(buf)
+    hdr.set_data_offset(max(hdr.get_data_offset(), len(buf.getvalue())))
+
+    hdr.write_to(fileobj)
+    fileobj.write(b"\x00" * (hdr.get_data_offset() - len(buf.getvalue())))
+    return None
+
+
+def set_intermediate_format(fmt: str = "nii.gz", quantize: bool = False) -> str:
+    """Sets the (pipeline-wide) intermediate image policy.
+
+    The policy is stored in the environment so that it is inherited by every
+    stage (and subprocess), and ``FSLOUTPUTTYPE`` is set accordingly for all
+    wrapped ``FSL`` commands.
+
+    NOTE:
+        Compressed intermediates written by ``nibabel`` use its (fastest) default gzip compression level.
+
+    Usage example:
+        >>> set_intermediate_format("nii", quantize=True)
+        "nii"
+
+    Args:
+        fmt: Intermediate image format, valid options include ``nii.gz`` and ``nii``. Defaults to 'nii.gz'.
+        quantize: Store raw-like (e.g. DWI) intermediates as ``int16`` with scaling (``scl_slope``). Defaults to False.
+
+    Returns:
+        Intermediate image format.
+    """
+    fmt: str = IntermediateFormat(fmt.lower().lstrip(".")).name
+
+    os.environ[_FORMAT_ENV] = IntermediateFormat[fmt].value
+    os.environ[_QUANTIZE_ENV] = "1" if quantize else "0"
+    os.environ["FSLOUTPUTTYPE"] = _FSLOUTPUTTYPE[fmt]
+
+    return IntermediateFormat[fmt].value
+
+
+def intermediate_format() -> str:
+    """Intermediate image format of the current policy (``nii.gz`` if not set).
+
+    Returns:
+        Intermediate image format name (``nii_gz``, or ``nii``).
+    """
+    return IntermediateFormat(os.environ.get(_FORMAT_ENV, "nii.gz").lower().lstrip(".")).name
+
+
+def intermediate_ext() -> str:
+    """File extension of intermediate images (this is also the extension of the outputs of ``FSL`` commands).
+
+    Returns:
+        File extension (``.nii.gz``, or ``.nii``).
+    """
+    return _EXT[intermediate_format()]
+
+
+def fsl_env() -> Dict[str, str]:
+    """Environment of wrapped ``FSL`` commands, consistent with the intermediate image policy.
+
+    Returns:
+        Dictionary of environmental variables.
+    """
+    return {"FSLOUTPUTTYPE": _FSLOUTPUTTYPE[intermediate_format()]}
+
+
+def intermediate_path(out: Union[image, str]) -> image:
+    """Replaces the (NIFTI) file extension of some output path with that of the intermediate image policy.
+
+    Args:
+        out: Output NIFTI file path.
+
+    Returns:
+        Output NIFTI file path.
+    """
+    return NiiFile(src=out).rm_ext() + intermediate_ext()
+
+
+def save_image(nii: nib.Nifti1Image, out: Union[image, str], quantize: Optional[bool] = None) -> image:
+    """Saves an intermediate NIFTI image using the intermediate image policy.
+
+    Args:
+        nii: Input NIFTI image.
+        out: Output NIFTI file path (the file extension is replaced by that of the policy).
+        quantize: Store the image as ``int16`` with scaling (should only be used for raw-like data). Defaults to None (the policy is used).
+
+    Returns:
+        Output NIFTI image.
+    """
+    out: str = intermediate_path(out)
+
+    if quantize is None:
+        quantize: bool = os.environ.get(_QUANTIZE_ENV, "0") == "1"
+
+    if quantize and np.issubdtype(nii.get_data_dtype(), np.floating):
+        # The scaling (slope/intercept) is computed by nibabel when the image is written
+        nii.set_data_dtype(np.int16)
+
+    nib.save(nii, out)
+
+    return os.path.abspath(out)
+
+
+def to_nifti_gz(src: Union[image, str], out: Optional[Union[image, str]] = None, remove: bool = False) -> image:
+    """Converts an (intermediate) NIFTI image to a compressed (``.nii.gz``) NIFTI image.
+
+    Uncompressed images are compressed in a single streamed pass (the header,
+    data type and scaling are preserved). Compressed images are copied as is.
+
+    Usage example:
+        >>> to_nifti_gz("Eddy/dwi_eddy_corr.nii", "out/sub-001_dwi.nii.gz")
+        "abspath/to/out/sub-001_dwi.nii.gz"
+
+    Args:
+        src: Input NIFTI image.
+        out: Output NIFTI image. Defaults to None (the input path, with the ``.nii.gz`` extension).
+        remove: Remove the input image once converted. Defaults to False.
+
+    Returns:
+        Output NIFTI image.
+    """
+    with NiiFile(src=src, assert_exists=True) as n:
+        src: str = n.abspath()
+        ext: str = n.ext
+
+    out: str = NiiFile(src=out or src).rm_ext() + ".nii.gz"
+
+    if os.path.abspath(out) == src:
+        return src
+
+    if ext == ".nii.gz":
+        shutil.copyfile(src, out)
+    else:
+        with open(src, "rb") as fi, Opener(out, "wb", compresslevel=_PUBLISH_COMPRESSLEVEL) as fo:
+            shutil.copyfileobj(fi, fo, length=1024 ** 2)
+
+    if remove:
+        os.remove(src)
+
+    return os.path.abspath(out)
+
+
+def export_store(
+    out: str,
+    dwi: Union[image, str],
+    bvals: Optional[str] = None,
+    bvecs: Optional[str] = None,
+    mask: Optional[Union[image, str]] = None,
+    maps: Optional[Dict[str, Union[image, str]]] = None,
+    chunks: Sequence[int] = _STORE_CHUNKS,
+    compresslevel: int = 4,
+) -> str:
+    """Exports a (preprocessed) DWI, and its associated files, to a chunked and compressed array store.
+
+    The store format is determined by the file extension of the output: HDF5
+    (``.h5``/``.hdf5``, requires ``h5py``) or Zarr (``.zarr``, requires ``zarr``).
+    The store contains the following arrays:
+        * ``dwi``: DWI (x, y, z, volumes) as ``float32``.
+        * ``mask``: Brain mask (x, y, z) as ``uint8`` [if provided].
+        * ``bvals``, ``bvecs``: b-values (volumes), and b-vectors (3 x volumes) [if provided].
+        * ``maps/<name>``: Additional (e.g. tensor) maps as ``float32`` [if provided].
+
+    The affine and voxel sizes are stored as attributes of the store. Chunks span
+    a small block of voxels and volumes, so that voxel time-series and per-volume
+    reads (see ``DWIStore``) only decompress the chunks they touch. The DWI is
+    streamed into the store, one chunk of volumes at a time.
+
+    Usage example:
+        >>> export_store("sub-001_dwi.h5",
+        ...              dwi="sub-001_dwi.nii.gz",
+        ...              bvals="sub-001_dwi.bval",
+        ...              bvecs="sub-001_dwi.bvec",
+        ...              mask="sub-001_mask.nii.gz",
+        ...              maps={"FA": "Tensor/dti_FA.nii.gz"},
+        ...              chunks=(8, 8, 8, 32))
+        "abspath/to/sub-001_dwi.h5"
+
+    Args:
+        out: Output array store.
+        dwi: Input DWI.
+        bvals: Corresponding b-value file. Defaults to None.
+        bvecs: Corresponding b-vector file. Defaults to None.
+        mask: Brain mask. Defaults to None.
+        maps: Dictionary that maps the name of each additional map to its image. Defaults to None.
+        chunks: Chunk shape (x, y, z, volumes) of 4D images (the first three dimensions are used for 3D images), where -1 spans the full dimension. Defaults to (16, 16, 16, 16).
+        compresslevel: Compression level (gzip, HDF5 only; Zarr stores use the default compressor of ``zarr``). Defaults to 4.
+
+    Raises:
+        ArrayStoreError: Exception that is raised if the store format is not supported.
+        ImportError: Exception that is raised if the (optional) dependency of the store format is not installed.
+
+    Returns:
+        Output array store.
+    """
+    from dwi_preproc.diffusion.dwi.btable import read_bvals, read_bvecs
+
+    with NiiFile(src=dwi, assert_exists=True, validate_nifti=True) as n:
+        dwi: str = n.abspath()
+
+    fmt: str = _store_format(out)
+    nii: nib.Nifti1Image = nib.load(dwi)
+    shape: Tuple[int, ...] = nii.shape[:3] + ((nii.shape[3],) if len(nii.shape) > 3 else (1,))
+    dwi_chunks: Tuple[int, ...] = _resolve_chunks(chunks, shape)
+
+    root = _open_store(out, "w")
+
+    try:
+        root.attrs["affine"] = nii.affine.tolist()
+        root.attrs["zooms"] = [float(i) for i in nii.header.get_zooms()[:3]]
+
+        ds = _create_array(root, fmt, "dwi", shape, np.float32, dwi_chunks, compresslevel)
+        step: int = dwi_chunks[3]
+        buf: List[np.ndarray] = []
+        start: int = 0
+
+        for vol in iter_volumes(dwi):
+            buf.append(vol)
+            if len(buf) == step:
+                ds[..., start : start + step] = np.stack(buf, axis=-1)
+                start += step
+                buf: List[np.ndarray] = []
+
+        if buf:
+            ds[..., start : start + len(buf)] = np.stack(buf, axis=-1)
+
+        if mask:
+            msk: np.ndarray = (np.asarray(nib.load(mask).dataobj) > 0).astype(np.uint8)
+            _create_array(root, fmt, "mask", msk.shape, np.uint8, dwi_chunks[:3], compresslevel)[...] = msk
+
+        if bvals:
+            bval: np.ndarray = read_bvals(bvals)
+            _create_array(root, fmt, "bvals", bval.shape, np.float64, bval.shape, compresslevel)[...] = bval
+
+        if bvecs:
+            bvec: np.ndarray = read_bvecs(bvecs)
+            _create_array(root, fmt, "bvecs", bvec.shape, np.float64, bvec.shape, compresslevel)[...] = bvec
+
+        if maps:
+            group = root.require_group("maps")
+            for name, img in maps.items():
+                data: np.ndarray = np.asarray(nib.load(img).dataobj, dtype=np.float32)
+                map_chunks: Tuple[int, ...] = _resolve_chunks(chunks[: data.ndim], data.shape)
+                _create_array(group, fmt, name, data.shape, np.float32, map_chunks, compresslevel)[...] = data
+    finally:
+        if fmt == "hdf5":
+            root.close()
+
+    return os.path.abspath(out)
+
+
+class DWIStore:
+    """Reader of the chunked array stores written by ``export_store``.
+
+    Arrays are read lazily (only the chunks that intersect a selection are read and decompressed).
+
+    Usage example:
+        >>> with DWIStore("sub-001_dwi.h5") as store:
+        ...     signal = store.timeseries(45, 50, 30)
+        ...     b1000 = store.shell(1000)
+        ...     fa = store["maps/FA"][:, :, 30]
+        ...
+
+    Attributes:
+        src: Input array store.
+        format: Store format (``hdf5``, or ``zarr``).
+        affine: Affine (4 x 4) of the exported images.
+        zooms: Voxel sizes (mm) of the exported images.
+    """
+
+    def __init__(self, src: str) -> None:
+        """Initialization method for the DWIStore class.
+
+        Args:
+            src: Input array store.
+
+        Raises:
+            ArrayStoreError: Exception that is raised if the store does not exist, or its format is not supported.
+            ImportError: Exception that is raised if the (optional) dependency of the store format is not installed.
+        """
+        if not os.path.exists(src):
+            raise ArrayStoreError(f"The array store does not exist: {src}")
+
+        self.src: str = os.path.abspath(src)
+        self.format: str = _store_format(src)
+        self._root = _open_store(self.src, "r")
+        self.affine: np.ndarray = np.asarray(self._root.attrs["affine"], dtype=np.float64)
+        self.zooms: Tuple[float, ...] = tuple(float(i) for i in self._root.attrs["zooms"])
+
+    def __enter__(self) -> "DWIStore":
+        """Context manager entrance method for the DWIStore class."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback) -> None:
+        """Context manager exit method for the DWIStore class."""
+        self.close()
+
+    def __getitem__(self, name: str) -> Any:
+        """Returns the (lazily read) array of some name (e.g. ``dwi``, or ``maps/FA``)."""
+        return self._root[name]
+
+    def __contains__(self, name: str) -> bool:
+        """Checks if the store contains an array of some name."""
+        return name in self.keys()
+
+    def keys(self) -> List[str]:
+        """Names of the arrays of the store.
+
+        Returns:
+            List of array names (maps are listed as ``maps/<name>``).
+        """
+        names: List[str] = [k for k in self._root.keys() if k != "maps"]
+
+        if "maps" in self._root:
+            names.extend(f"maps/{k}" for k in self._root["maps"].keys())
+
+        return sorted(names)
+
+    def timeseries(self, i: int, j: int, k: int, name: str = "dwi") -> np.ndarray:
+        """Reads the signal of a single voxel across all volumes.
+
+        Args:
+            i: Voxel index (x).
+            j: Voxel index (y).
+            k: Voxel index (z).
+            name: Array name. Defaults to 'dwi'.
+
+        Returns:
+            1-dimensional numpy array (volumes).
+        """
+        return np.asarray(self[name][i, j, k, :])
+
+    def volumes(self, idx: Sequence[int], name: str = "dwi") -> np.ndarray:
+        """Reads a subset of the volumes of a 4D array.
+
+        Args:
+            idx: Volume indices (in ascending order).
+            name: Array name. Defaults to 'dwi'.
+
+        Returns:
+            4D numpy array (x, y, z, volumes).
+        """
+        arr = self[name]
+        return np.stack([np.asarray(arr[..., int(i)]) for i in sorted(idx)], axis=-1)
+
+    def shell(self, b: int, b0_thresh: float = 50, tol: float = 100) -> np.ndarray:
+        """Reads the volumes of a single b-value shell.
+
+        Args:
+            b: (Rounded) b-value of the shell (0 for the b0s).
+            b0_thresh: b-values less than or equal to this value are considered to be b0s. Defaults to 50.
+            tol: b-values are rounded to the nearest multiple of this value. Defaults to 100.
+
+        Raises:
+            ArrayStoreError: Exception that is raised if the store does not contain b-values, or the shell.
+
+        Returns:
+            4D numpy array (x, y, z, volumes).
+        """
+        from dwi_preproc.diffusion.dwi.btable import shells
+
+        if "bvals" not in self:
+            raise ArrayStoreError(f"The array store does not contain b-values: {self.src}")
+
+        groups: Dict[int, np.ndarray] = shells(np.asarray(self["bvals"][...]), b0_thresh=b0_thresh, tol=tol)
+
+        if b not in groups:
+            raise ArrayStoreError(f"The b-value shell {b} does not exist. Available shells: {sorted(groups)}")
+
+        return self.volumes(groups[b])
+
+    def to_nifti(self, name: str, out: Union[image, str]) -> image:
+        """Writes an array of the store to a NIFTI image.
+
+        Args:
+            name: Array name.
+            out: Output NIFTI image.
+
+        Returns:
+            Output NIFTI image.
+        """
+        nib.save(nib.Nifti1Image(np.asarray(self[name][...]), self.affine), out)
+        return os.path.abspath(out)
+
+    def close(self) -> None:
+        """Closes the array store."""
+        if self.format == "hdf5" and self._root:
+            self._root.close()
+        return None
+
+
+def _store_format(src: str) -> str:
+    """Format of an array store (determined by its file extension).
+
+    Args:
+        src: Array store.
+
+    Raises:
+        ArrayStoreError: Exception that is raised if the file extension is not supported.
+
+    Returns:
+        Store format (``hdf5``, or ``zarr``).
+    """
+    ext: str = os.path.splitext(src.rstrip(os.sep))[1].lower()
+
+    if ext not in _STORE_EXT:
+        raise ArrayStoreError(f"Unsupported array store extension '{ext}'. Valid extensions include: {', '.join(_STORE_EXT)}")
+
+    return ArrayStoreFormat[_STORE_EXT[ext]].name
+
+
+def _open_store(src: str, mode: str) -> Any:
+    """Opens (the root group of) an array store.
+
+    Args:
+        src: Array store.
+        mode: Access mode ('r', or 'w').
+
+    Raises:
+        ImportError: Exception that is raised if the (optional) dependency of the store format is not installed.
+
+    Returns:
+        Root group (``h5py.File``, or ``zarr.Group``).
+    """
+    fmt: str = _store_format(src)
+
+    if fmt == "hdf5":
+        try:
+            import h5py
+        except ImportError as error:
+            raise ImportError("HDF5 array stores require the h5py package (pip install h5py).") from error
+        return h5py.File(src, mode)
+
+    try:
+        import zarr
+    except ImportError as error:
+        raise ImportError("Zarr array stores require the zarr package (pip install zarr).") from error
+
+    return zarr.open_group(src, mode=mode)
+
+
+def _create_array(group: Any, fmt: str, name: str, shape: Sequence[int], dtype: type, chunks: Sequence[int], compresslevel: int) -> Any:
+    """Creates a chunked (and compressed) array in an array store group.
+
+    Args:
+        group: Array store group.
+        fmt: Store format (``hdf5``, or ``zarr``).
+        name: Array name.
+        shape: Array shape.
+        dtype: Array data type.
+        chunks: Chunk shape.
+        compresslevel: Compression level (HDF5 only).
+
+    Returns:
+        Array of the store.
+    """
+    shape: Tuple[int, ...] = tuple(int(i) for i in shape)
+    chunks: Tuple[int, ...] = tuple(int(i) for i in chunks)
+
+    if fmt == "hdf5":
+        return group.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks, compression="gzip", compression_opts=compresslevel, shuffle=True)
+
+    if hasattr(group, "create_array"):
+        # zarr >= 3
+        return group.create_array(name, shape=shape, dtype=dtype, chunks=chunks)
+
+    return group.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks)
+
+
+def _resolve_chunks(chunks: Sequence[int], shape: Sequence[int]) -> Tuple[int, ...]:
+    """Resolves a chunk shape (-1, or None, spans the full dimension; chunks are limited to the array shape).
+
+    Args:
+        chunks: Chunk shape.
+        shape: Array shape.
+
+    Returns:
+        Chunk shape.
+    """
+    chunks: List[Optional[int]] = list(chunks) + [-1] * (len(shape) - len(chunks))
+
+    return tuple(
+        int(n) if c is None or c < 1 else int(min(c, n))
+        for c, n in zip(chunks, shape)
+    )
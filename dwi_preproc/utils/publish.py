@@ -0,0 +1,299 @@
+"""Publishing of (preprocessed) outputs from the working directory to the output directory.
+
+Files are published without copying their data whenever possible (rename,
+hardlink, or reflink), and a manifest of the published files is written to the
+output directory.
+"""
+import os
+import json
+import errno
+import hashlib
+import shutil
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.utils.hashing import _CHUNK_SIZE
+from dwi_preproc.utils.niio import to_nifti_gz
+
+# Manifest file name (written to the output directory)
+MANIFEST: str = "publish_manifest.json"
+
+# Linux ioctl request code to clone (reflink) a file
+_FICLONE: int = 0x40049409
+
+
+def publish_file(src: Union[file, str], dst: Union[file, str], move: bool = False) -> Dict[str, Any]:
+    """Publishes a single file.
+
+    The following methods are tried in order:
+        * ``rename``: Atomic rename (only if ``move`` is enabled, and the source and destination share a filesystem).
+        * ``hardlink``: Hardlink (source and destination share a filesystem).
+        * ``reflink``: Copy-on-write clone (supporting filesystems, e.g. btrfs, XFS).
+        * ``copy``: Streamed copy (checksummed) to a temporary file, which is then renamed to the destination.
+
+    NOTE:
+        Uncompressed NIFTI images (``.nii``) are compressed should the destination be a compressed NIFTI image (``.nii.gz``).
+
+    Args:
+        src: Source file.
+        dst: Destination file (existing files are replaced).
+        move: Allow the source file to be moved (renamed). Defaults to False.
+
+    Returns:
+        Manifest record of the published file.
+    """
+    src: str = os.path.abspath(src)
+    dst: str = os.path.abspath(dst)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return _record(dst, method="existing")
+
+    if src.endswith(".nii") and dst.endswith(".nii.gz"):
+        to_nifti_gz(src=src, out=dst, remove=move)
+        return _record(dst, method="compress")
+
+    same_fs: bool = os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev
+    digest: Union[str, None] = None
+
+    if move and same_fs:
+        os.replace(src, dst)
+        method: str = "rename"
+    elif same_fs and _link(src, dst):
+        method: str = "hardlink"
+    elif _reflink(src, dst):
+        method: str = "reflink"
+    else:
+        digest: str = _copy(src, dst)
+        method: str = "copy"
+
+    return _record(dst, method=method, digest=digest)
+
+
+def publish(
+    files: Sequence[Tuple[Union[file, str], str]],
+    outdir: str,
+    trees: Optional[Sequence[Tuple[str, str]]] = None,
+    move: bool = False,
+    compress: bool = True,
+    manifest: str = MANIFEST,
+) -> file:
+    """Publishes files (and directory trees) to an output directory, and updates its manifest.
+
+    The manifest (``<outdir>/publish_manifest.json``) is updated (atomically)
+    once all files are published, so a manifest entry implies the file is
+    complete. Downstream tools can use the manifest to check for a complete set
+    of outputs without walking the output directory.
+
+    Usage example:
+        >>> publish(files=[("work/Eddy/dwi_eddy_corr.nii", "sub-001_dwi.nii.gz"),
+        ...                ("work/dwi.bval", "sub-001_dwi.bval")],
+        ...         outdir="derivatives/sub-001",
+        ...         trees=[("work/Tensor", "Tensor")])
+        ...
+
+    Args:
+        files: Source files, and their destination (relative to the output directory).
+        outdir: Output directory.
+        trees: Source directories, and their destination (relative to the output directory). Defaults to None.
+        move: Allow the source files to be moved (renamed). Defaults to False.
+        compress: Compress uncompressed NIFTI images (``.nii``) of the directory trees. Defaults to True.
+        manifest: Manifest file name. Defaults to 'publish_manifest.json'.
+
+    Returns:
+        Manifest file.
+    """
+    outdir: str = os.path.abspath(outdir)
+    os.makedirs(outdir, exist_ok=True)
+
+    items: List[Tuple[str, str]] = [(src, os.path.join(outdir, dst)) for src, dst in files]
+
+    for src_dir, dst_dir in trees or []:
+        for root, _, names in os.walk(src_dir):
+            for name in sorted(names):
+                src: str = os.path.join(root, name)
+                dst: str = os.path.join(outdir, dst_dir, os.path.relpath(src, src_dir))
+                if compress and dst.endswith(".nii"):
+                    dst: str = f"{dst}.gz"
+                items.append((src, dst))
+
+    records: Dict[str, Dict[str, Any]] = {}
+    for src, dst in items:
+        records[os.path.relpath(dst, outdir)] = publish_file(src, dst, move=move)
+
+    return update_manifest(os.path.join(outdir, manifest), records)
+
+
+def update_manifest(manifest: Union[file, str], records: Dict[str, Dict[str, Any]]) -> file:
+    """Adds (or replaces) records of published files in a manifest.
+
+    Args:
+        manifest: Manifest file.
+        records: Dictionary that maps each published file (relative to the output directory) to its record.
+
+    Returns:
+        Manifest file.
+    """
+    data: Dict[str, Any] = read_manifest(manifest)
+    data["Files"].update(records)
+
+    tmp: str = f"{manifest}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp, manifest)
+
+    return os.path.abspath(manifest)
+
+
+def read_manifest(manifest: Union[file, str]) -> Dict[str, Any]:
+    """Reads a manifest of published files (an empty manifest is returned if it does not exist).
+
+    Args:
+        manifest: Manifest file.
+
+    Returns:
+        Manifest dictionary.
+    """
+    try:
+        with open(manifest) as f:
+            data: Dict[str, Any] = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        data: Dict[str, Any] = {}
+
+    data.setdefault("Files", {})
+    return data
+
+
+def is_published(outdir: str, expected: Sequence[str], manifest: str = MANIFEST) -> bool:
+    """Checks if a set of outputs are published (i.e. recorded in the manifest, and exist with the recorded size).
+
+    Args:
+        outdir: Output directory.
+        expected: Expected files (relative to the output directory).
+        manifest: Manifest file name. Defaults to 'publish_manifest.json'.
+
+    Returns:
+        True if all of the expected files are published, False otherwise.
+    """
+    files: Dict[str, Any] = read_manifest(os.path.join(outdir, manifest))["Files"]
+
+    for name in expected:
+        path: str = os.path.join(outdir, name)
+        if name not in files or not os.path.exists(path) or os.path.getsize(path) != files[name]["Size"]:
+            return False
+
+    return True
+
+
+def _link(src: str, dst: str) -> bool:
+    """Hardlinks a file (replacing the destination atomically).
+
+    Args:
+        src: Source file.
+        dst: Destination file.
+
+    Returns:
+        True if the file was linked, False otherwise.
+    """
+    tmp: str = f"{dst}.{os.getpid()}.tmp"
+
+    try:
+        os.link(src, tmp)
+    except OSError:
+        return False
+
+    os.replace(tmp, dst)
+    return True
+
+
+def _reflink(src: str, dst: str) -> bool:
+    """Clones (reflinks) a file, should the platform and filesystem support it.
+
+    Args:
+        src: Source file.
+        dst: Destination file.
+
+    Returns:
+        True if the file was cloned, False otherwise.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    tmp: str = f"{dst}.{os.getpid()}.tmp"
+
+    try:
+        with open(src, "rb") as fi, open(tmp, "wb") as fo:
+            fcntl.ioctl(fo.fileno(), _FICLONE, fi.fileno())
+    except OSError as error:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if error.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EBADF, errno.ENOSYS):
+            return False
+        raise
+
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+    return True
+
+
+def _copy(src: str, dst: str, algorithm: str = "sha256") -> str:
+    """Copies a file in a streamed manner, and verifies the copy using checksums.
+
+    Args:
+        src: Source file.
+        dst: Destination file.
+        algorithm: Hashing algorithm. Defaults to 'sha256'.
+
+    Raises:
+        IOError: Exception that is raised if the checksums of the source and the copy do not match.
+
+    Returns:
+        Hexadecimal digest of the file.
+    """
+    tmp: str = f"{dst}.{os.getpid()}.tmp"
+    h_src = hashlib.new(algorithm)
+    h_dst = hashlib.new(algorithm)
+
+    with open(src, "rb") as fi, open(tmp, "wb") as fo:
+        for chunk in iter(lambda: fi.read(_CHUNK_SIZE), b""):
+            h_src.update(chunk)
+            fo.write(chunk)
+        fo.flush()
+        os.fsync(fo.fileno())
+
+    with open(tmp, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            h_dst.update(chunk)
+
+    if h_src.hexdigest() != h_dst.hexdigest():
+        os.remove(tmp)
+        raise IOError(f"Checksum mismatch while copying {src} to {dst}.")
+
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+
+    return h_src.hexdigest()
+
+
+def _record(dst: str, method: str, digest: Optional[str] = None) -> Dict[str, Any]:
+    """Manifest record of a published file.
+
+    Args:
+        dst: Published file.
+        method: Publishing method.
+        digest: Hexadecimal (sha256) digest of the file. Defaults to None.
+
+    Returns:
+        Manifest record.
+    """
+    st: os.stat_result = os.stat(dst)
+    record: Dict[str, Any] = {"Size": st.st_size, "MTime": st.st_mtime, "Method": method}
+
+    if digest:
+        record["SHA256"] = digest
+
+    return record
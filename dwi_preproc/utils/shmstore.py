@@ -0,0 +1,237 @@
+"""Shared memory backed store of (NIFTI) image data for process pool workers.
+
+Arrays are published once by the parent process, and worker processes attach
+to them by name (without copying, or pickling the data).
+"""
+import weakref
+import numpy as np
+import nibabel as nib
+
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+from dwi_preproc.utils.niio import NiiFile, image, iter_volumes
+
+# Shared memory blocks attached to by the current (worker) process
+_ATTACHED: Dict[str, SharedMemory] = {}
+
+
+class SharedRef(NamedTuple):
+    """(Picklable) reference to a shared array."""
+
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+class SharedVolumeStore:
+    """Store of shared memory backed numpy arrays.
+
+    The shared memory blocks are owned by the store: they are released when the
+    store is closed (or exits its context), or should the store be garbage
+    collected (or the interpreter exit) before then.
+
+    Usage example:
+        >>> with SharedVolumeStore() as store:
+        ...     refs = store.publish_nifti("dwi.nii.gz", mask="mask.nii.gz")
+        ...     with ProcessPoolExecutor() as pool:
+        ...         results = list(pool.map(worker, [refs["data"]] * 4, range(4)))
+        ...
+        >>> # In the worker function
+        >>> data = attach(ref)
+
+    Attributes:
+        refs: Dictionary that maps each key to the reference of its shared array.
+    """
+
+    def __init__(self) -> None:
+        """Initialization method for the SharedVolumeStore class."""
+        self.refs: Dict[str, SharedRef] = {}
+        self._blocks: Dict[str, SharedMemory] = {}
+        self._finalizer: weakref.finalize = weakref.finalize(self, _release, self._blocks)
+
+    def __enter__(self) -> "SharedVolumeStore":
+        """Context manager entrance method for the SharedVolumeStore class."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback) -> None:
+        """Context manager exit method for the SharedVolumeStore class."""
+        self.close()
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        """Returns the (shared) array of some key."""
+        ref: SharedRef = self.refs[key]
+        return np.ndarray(ref.shape, dtype=ref.dtype, buffer=self._blocks[key].buf)
+
+    def create(self, key: str, shape: Tuple[int, ...], dtype: Union[str, type] = np.float32) -> Tuple[SharedRef, np.ndarray]:
+        """Creates an (uninitialized) shared array.
+
+        Args:
+            key: Key of the array (must be unique within the store).
+            shape: Shape of the array.
+            dtype: Data type of the array. Defaults to np.float32.
+
+        Raises:
+            KeyError: Exception that is raised if the key already exists.
+
+        Returns:
+            * Reference to the shared array.
+            * Shared array.
+        """
+        if key in self._blocks:
+            raise KeyError(f"The key already exists in the store: {key}")
+
+        dtype: np.dtype = np.dtype(dtype)
+        shape: Tuple[int, ...] = tuple(int(i) for i in shape)
+        size: int = max(int(np.prod(shape)) * dtype.itemsize, 1)
+
+        shm: SharedMemory = SharedMemory(create=True, size=size)
+        self._blocks[key] = shm
+        self.refs[key] = SharedRef(name=shm.name, shape=shape, dtype=dtype.str)
+
+        return self.refs[key], self[key]
+
+    def publish(self, key: str, arr: np.ndarray) -> SharedRef:
+        """Publishes (copies) a numpy array to the store.
+
+        Args:
+            key: Key of the array (must be unique within the store).
+            arr: Input numpy array.
+
+        Returns:
+            Reference to the shared array.
+        """
+        ref, shared = self.create(key, arr.shape, arr.dtype)
+        shared[...] = arr
+        return ref
+
+    def publish_nifti(self, img: Union[image, str], key: str = "data", mask: Optional[Union[image, str]] = None, dtype: Union[str, type] = np.float32) -> Dict[str, SharedRef]:
+        """Publishes the data of a NIFTI image to the store.
+
+        The image is streamed (one volume at a time) into the shared array, so it
+        is never held in memory twice. Should a mask be provided, a (masked) voxel
+        matrix is published instead of the image array.
+
+        Args:
+            img: Input NIFTI image.
+            key: Key of the (image, or voxel matrix) array. Defaults to 'data'.
+            mask: Mask image. Defaults to None.
+            dtype: Data type of the array. Defaults to np.float32.
+
+        Returns:
+            Dictionary of references that includes:
+                * ``<key>``: Image array (x, y, z[, volumes]), or voxel matrix (voxels x volumes).
+                * ``<key>_index``: Voxel indices (voxels x 3) of the voxel matrix (if a mask is provided).
+        """
+        with NiiFile(src=img, assert_exists=True, validate_nifti=True) as n:
+            img: image = n.abspath()
+
+        shape: Tuple[int, ...] = nib.load(img).shape
+        nvols: int = shape[3] if len(shape) > 3 else 1
+
+        refs: Dict[str, SharedRef] = {}
+
+        if mask is None:
+            refs[key], shared = self.create(key, shape, dtype)
+            out: np.ndarray = shared.reshape(shape[:3] + (nvols,))
+            for n, vol in enumerate(iter_volumes(img)):
+                out[..., n] = vol
+            return refs
+
+        msk: np.ndarray = np.asarray(nib.load(mask).dataobj) > 0
+        idx: np.ndarray = np.argwhere(msk)
+
+        refs[f"{key}_index"] = self.publish(f"{key}_index", idx)
+        refs[key], shared = self.create(key, (len(idx), nvols), dtype)
+
+        for n, vol in enumerate(iter_volumes(img)):
+            shared[:, n] = vol[msk]
+
+        return refs
+
+    def close(self) -> None:
+        """Releases (unlinks) all shared memory blocks of the store."""
+        self._finalizer()
+        self.refs.clear()
+        return None
+
+
+def attach(ref: SharedRef) -> np.ndarray:
+    """Attaches to a shared array (e.g. in a worker process) without copying it.
+
+    The shared memory block remains mapped for the lifetime of the process (or until ``detach`` is called), and is not released by the attaching process.
+
+    Args:
+        ref: Reference to the shared array.
+
+    Returns:
+        Shared array.
+    """
+    if ref.name not in _ATTACHED:
+        _ATTACHED[ref.name] = _open_untracked(ref.name)
+
+    return np.ndarray(ref.shape, dtype=ref.dtype, buffer=_ATTACHED[ref.name].buf)
+
+
+def detach(ref: SharedRef) -> None:
+    """Detaches from a shared array (views of the array must no longer be used).
+
+    Args:
+        ref: Reference to the shared array.
+    """
+    shm: Union[SharedMemory, None] = _ATTACHED.pop(ref.name, None)
+
+    if shm is not None:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+
+    return None
+
+
+def _open_untracked(name: str) -> SharedMemory:
+    """Opens an existing shared memory block without registering it with the resource tracker.
+
+    Otherwise, the resource tracker of a (spawned) worker process would release the block once the worker exits.
+
+    Args:
+        name: Name of the shared memory block.
+
+    Returns:
+        Shared memory block.
+    """
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _release(blocks: Dict[str, SharedMemory]) -> None:
+    """Closes and unlinks shared memory blocks.
+
+    Args:
+        blocks: Dictionary of shared memory blocks.
+    """
+    for shm in blocks.values():
+        try:
+            shm.close()
+        except BufferError:
+            # Views of the block still exist, the mapping is released with them
+            pass
+
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    blocks.clear()
+
+    return None
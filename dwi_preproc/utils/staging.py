@@ -0,0 +1,280 @@
+"""Staging of a queue of pipeline runs on node-local scratch storage.
+
+Subjects of a queue are processed (one at a time) on a single node, with:
+    * Prefetch: the inputs of the next subjects are staged (copied) to local
+      scratch by background threads while the current subject is processed.
+    * Local processing: the data directory (working directory, logs and
+      derivatives) of each run is on local scratch (local disk, or tmpfs).
+    * Asynchronous write-back: the data directory of each completed run is
+      published to the (shared) data directory by background threads, while
+      the next subject is processed.
+    * Resume: subjects completed by a previous run of the queue (whose
+      written back outputs still exist) are skipped, and the logs of a
+      resubmitted subject are appended to those of its previous runs.
+
+Thus, reads from (and writes to) shared network storage are not on the
+critical path of each subject.
+"""
+import os
+import glob
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.utils.niio import NiiFile
+from dwi_preproc.utils.publish import _record, is_published, publish, publish_file, read_manifest, update_manifest
+from dwi_preproc.utils.util import update_json
+
+# Append-only logs of a run (appended to the existing logs of the shared data directory, rather than replacing them)
+_APPEND_LOGS: Tuple[str, ...] = (".log", ".err", ".events.jsonl")
+
+
+class StagingError(Exception):
+    """Exception intended for inputs that can not be staged (e.g. missing inputs)."""
+    pass
+
+
+def series_files(img: str) -> List[str]:
+    """Files of a series (image, and its sidecars, e.g. ``.bval``, ``.bvec`` and ``.json``), as copied by the pipeline.
+
+    Args:
+        img: Input image.
+
+    Raises:
+        StagingError: Exception that is raised if the input image does not exist.
+
+    Returns:
+        List of the files of the series.
+    """
+    if not os.path.isfile(img):
+        raise StagingError(f"Input image does not exist: {img}")
+
+    name: str = NiiFile(src=img).rm_ext()
+    return sorted(f for f in glob.glob(glob.escape(name) + ".*") if os.path.isfile(f))
+
+
+def stage_inputs(imgs: Sequence[str], dest: str) -> Dict[str, str]:
+    """Stages (copies) the series of input images to a (local) directory.
+
+    Files are staged to their absolute path under the destination directory,
+    so that the (BIDS) directory structure of the inputs is preserved.
+
+    Args:
+        imgs: Input images.
+        dest: Destination directory.
+
+    Raises:
+        StagingError: Exception that is raised if an input image does not exist.
+
+    Returns:
+        Dictionary that maps each input image to its staged copy.
+    """
+    staged: Dict[str, str] = {}
+
+    for img in imgs:
+        img: str = os.path.abspath(img)
+        for f in series_files(img):
+            publish_file(f, os.path.join(dest, f.lstrip(os.sep)))
+        staged[img] = os.path.join(dest, img.lstrip(os.sep))
+
+    return staged
+
+
+def read_jobs(src: Union[file, str]) -> List[Dict[str, Any]]:
+    """Reads a queue of pipeline runs.
+
+    Each (non-empty) line of the queue file is a DWI, optionally followed by its
+    rPE b0s (whitespace separated). Lines that start with ``#`` are ignored.
+
+    Args:
+        src: Input queue file.
+
+    Returns:
+        List of jobs (``Name``, ``DWI``, and ``B0``).
+    """
+    jobs: List[Dict[str, Any]] = []
+
+    with open(src) as f:
+        for line in f:
+            fields: List[str] = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            dwi: str = os.path.abspath(fields[0])
+            jobs.append({
+                "Name": os.path.basename(NiiFile(src=dwi).rm_ext()),
+                "DWI": dwi,
+                "B0": os.path.abspath(fields[1]) if len(fields) > 1 else None,
+            })
+
+    return jobs
+
+
+def run_queue(
+    jobs: Sequence[Dict[str, Any]],
+    data_dir: str,
+    script: str,
+    args: Optional[Sequence[str]] = None,
+    scratch: Optional[str] = None,
+    prefetch: int = 2,
+    writeback_workers: int = 1,
+    report: Optional[Union[file, str]] = None,
+    resume: bool = True,
+) -> List[Dict[str, Any]]:
+    """Runs a queue of pipeline runs on local scratch, with input prefetch and asynchronous write-back.
+
+    The inputs of (up to) ``prefetch`` subjects after the current one are
+    staged in the background. The local data directory of each run is
+    published (moved) to the shared data directory once the run completes (or
+    fails, so that its logs are kept), and its manifest (and exit status) is
+    written to ``<data_dir>/logs/<name>.writeback.json``. Jobs that completed
+    in a previous run of the queue (exit status 0, and their written back
+    outputs still exist) are skipped, so that a resubmitted queue does not
+    replace their outputs.
+
+    Usage example:
+        >>> records = run_queue(read_jobs("queue.txt"), data_dir="derivatives/dwi_preproc", script="dwi_preproc.sh",
+        ...                     args=["--BIDS", "--tensor", "--qc"], scratch="/tmp", prefetch=2)
+        >>> records[0]["StageWait"]
+        0.0
+
+    Args:
+        jobs: Queue of jobs (``Name``, ``DWI``, and ``B0``).
+        data_dir: Shared data directory (``--data-dir`` of the pipeline).
+        script: Pipeline script (``dwi_preproc.sh``).
+        args: Additional arguments of the pipeline. Defaults to None.
+        scratch: Local scratch directory (e.g. ``/tmp``, or ``/dev/shm``). Defaults to None (``TMPDIR``, or ``/tmp``).
+        prefetch: Number of subjects (after the current one) whose inputs are staged in the background. Defaults to 2.
+        writeback_workers: Number of write-back threads. Defaults to 1.
+        report: Output JSON report. Defaults to None.
+        resume: Skip the jobs completed by a previous run of the queue. Defaults to True.
+
+    Returns:
+        List of records (``Name``, ``ExitStatus``, ``StageWait``, ``Runtime``, ``WriteBack``, and ``Manifest``, or ``Skipped``) of the jobs.
+    """
+    data_dir: str = os.path.abspath(data_dir)
+    script: str = os.path.abspath(script)
+    scratch: str = scratch or os.environ.get("TMPDIR", tempfile.gettempdir())
+    prefetch: int = max(int(prefetch), 0)
+
+    os.makedirs(scratch, exist_ok=True)
+    root: str = tempfile.mkdtemp(prefix="dwi_preproc.", dir=scratch)
+
+    records: List[Dict[str, Any]] = [{"Name": job["Name"], "DWI": job["DWI"], "ExitStatus": None} for job in jobs]
+    completed: List[bool] = [resume and _completed(data_dir, job["Name"]) for job in jobs]
+    staged: Dict[int, Future] = {}
+    written: List[Future] = []
+
+    def _stage(i: int) -> None:
+        """Submits the staging of the inputs of a job (once)."""
+        if i < len(jobs) and i not in staged and not completed[i]:
+            job: Dict[str, Any] = jobs[i]
+            imgs: List[str] = [img for img in (job["DWI"], job.get("B0")) if img]
+            staged[i] = stager.submit(stage_inputs, imgs, os.path.join(root, f"{i}.inputs"))
+        return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as stager, ThreadPoolExecutor(max_workers=max(int(writeback_workers), 1)) as writer:
+            for i, job in enumerate(jobs):
+                for n in range(i, i + prefetch + 1):
+                    _stage(n)
+
+                if completed[i]:
+                    records[i].update({"ExitStatus": 0, "Skipped": True})
+                    continue
+
+                t0: float = time.perf_counter()
+                try:
+                    inputs: Dict[str, str] = staged.pop(i).result()
+                except (StagingError, OSError) as error:
+                    records[i].update({"ExitStatus": -1, "Error": f"Staging failed: {error}"})
+                    shutil.rmtree(os.path.join(root, f"{i}.inputs"), ignore_errors=True)
+                    continue
+                records[i]["StageWait"] = round(time.perf_counter() - t0, 3)
+
+                local: str = os.path.join(root, f"{i}.data")
+                os.makedirs(local, exist_ok=True)
+
+                cmd: List[str] = ["bash", script, "--dwi", inputs[job["DWI"]], "--data-dir", local]
+                if job.get("B0"):
+                    cmd.extend(["--B0", inputs[job["B0"]]])
+                cmd.extend(args or [])
+
+                t0: float = time.perf_counter()
+                records[i]["ExitStatus"] = subprocess.run(cmd, cwd=local).returncode
+                records[i]["Runtime"] = round(time.perf_counter() - t0, 3)
+
+                # The staged inputs are no longer needed (the pipeline copies its inputs to its working directory)
+                shutil.rmtree(os.path.join(root, f"{i}.inputs"), ignore_errors=True)
+
+                written.append(writer.submit(_write_back, local, data_dir, job["Name"], records[i]))
+
+            for w in written:
+                w.result()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if report:
+        with open(report, "w") as f:
+            json.dump(records, f, indent=4)
+
+    return records
+
+
+def _write_back(local: str, data_dir: str, name: str, record: Dict[str, Any]) -> None:
+    """Publishes (moves) the local data directory of a run to the shared data directory, then removes it.
+
+    The append-only logs are appended to those of previous runs (if any), and
+    the exit status of the run is recorded in its manifest.
+    """
+    t0: float = time.perf_counter()
+    manifest: str = os.path.join("logs", f"{name}.writeback.json")
+
+    os.makedirs(os.path.join(data_dir, "logs"), exist_ok=True)
+    appended: Dict[str, Dict[str, Any]] = _append_logs(local, data_dir)
+
+    record["Manifest"] = publish(files=[], outdir=data_dir, trees=[(local, ".")], move=True, compress=False, manifest=manifest)
+    update_manifest(record["Manifest"], appended)
+    update_json(record["Manifest"], {"ExitStatus": record["ExitStatus"]})
+    shutil.rmtree(local, ignore_errors=True)
+
+    record["WriteBack"] = round(time.perf_counter() - t0, 3)
+    return None
+
+
+def _append_logs(local: str, data_dir: str) -> Dict[str, Dict[str, Any]]:
+    """Appends the append-only logs of a run to the existing logs of the shared data directory (the local logs are then removed).
+
+    Returns:
+        Dictionary that maps each appended log (relative to the shared data directory) to its manifest record.
+    """
+    records: Dict[str, Dict[str, Any]] = {}
+
+    for src in sorted(glob.glob(os.path.join(local, "logs", "*"))):
+        dst: str = os.path.join(data_dir, "logs", os.path.basename(src))
+        if not src.endswith(_APPEND_LOGS) or not os.path.isfile(dst):
+            continue
+        with open(src, "rb") as fi, open(dst, "ab") as fo:
+            shutil.copyfileobj(fi, fo)
+        os.remove(src)
+        records[os.path.relpath(dst, data_dir)] = _record(dst, method="append")
+
+    return records
+
+
+def _completed(data_dir: str, name: str) -> bool:
+    """Checks if a job was completed by a previous run of the queue (exit status 0, and its written back outputs, other than its logs, still exist)."""
+    manifest: str = os.path.join("logs", f"{name}.writeback.json")
+    data: Dict[str, Any] = read_manifest(os.path.join(data_dir, manifest))
+
+    if data.get("ExitStatus") != 0:
+        return False
+
+    outputs: List[str] = [f for f in data["Files"] if not f.startswith("logs" + os.sep)]
+    return bool(outputs) and is_published(data_dir, outputs, manifest=manifest)
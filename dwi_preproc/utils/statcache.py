@@ -0,0 +1,101 @@
+"""On-disk cache of (small, JSON serializable) values derived from files, keyed on the (device, inode, size, modification time) of the files.
+
+A cached value is used for as long as its files are unchanged, so that they
+are not read again. A copy of a file (or a file that is written again) has
+a new key. Each user of the cache has its own namespace (sub-directory) of
+the cache directory (``DWI_PREPROC_CACHE``, or ``~/.cache/dwi_preproc``).
+"""
+import os
+import json
+import hashlib
+import threading
+
+from typing import Any, Dict, Optional, Union
+
+from commandio.fileio import file
+
+
+def stat_key(files: Dict[str, Union[file, str]], tag: str = "") -> str:
+    """Computes the cache key of some files: a tag (e.g. the version of the cached computation), and the (role, device, inode, size, mtime) of each file.
+
+    Usage example:
+        >>> stat_key({"img": "sub-001_dwi.nii.gz", "bval": "sub-001_dwi.bval"}, tag="dwi_preproc:integrity:v1")
+        "5f1e..."
+
+    Args:
+        files: Dictionary that maps the role of each file to the file.
+        tag: Tag of the key. Defaults to ''.
+
+    Raises:
+        OSError: Exception that is raised if a file does not exist.
+
+    Returns:
+        Hexadecimal digest of the cache key.
+    """
+    h = hashlib.sha256(tag.encode())
+    for role in sorted(files):
+        st: os.stat_result = os.stat(files[role])
+        h.update(f"{role}:{st.st_dev:x}-{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x};".encode())
+    return h.hexdigest()
+
+
+def stat_cache_dir(namespace: str, cache_dir: Optional[str] = None) -> str:
+    """Directory of a namespace of the on-disk cache.
+
+    Args:
+        namespace: Namespace (e.g. ``hashes``).
+        cache_dir: Directory of the cache (overrides the default). Defaults to None (``$DWI_PREPROC_CACHE/<namespace>``, or ``~/.cache/dwi_preproc/<namespace>``). An empty string disables the on-disk cache.
+
+    Returns:
+        Directory of the namespace (an empty string if the on-disk cache is disabled).
+    """
+    if cache_dir is not None:
+        return cache_dir
+    root: str = os.environ.get("DWI_PREPROC_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "dwi_preproc"))
+    return os.path.join(root, namespace) if root else ""
+
+
+def read_stat_cache(key: str, cache_dir: str) -> Any:
+    """Reads a cached value.
+
+    Args:
+        key: Cache key (see ``stat_key``).
+        cache_dir: Directory of the cache (see ``stat_cache_dir``).
+
+    Returns:
+        Cached value (None if the value is not cached, or can not be read).
+    """
+    if not cache_dir:
+        return None
+
+    try:
+        with open(os.path.join(cache_dir, f"{key}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_stat_cache(key: str, value: Any, cache_dir: str) -> None:
+    """Writes a value to the cache (errors are ignored, as the cache is optional).
+
+    Args:
+        key: Cache key (see ``stat_key``).
+        value: JSON serializable value.
+        cache_dir: Directory of the cache (see ``stat_cache_dir``).
+    """
+    if not cache_dir:
+        return None
+
+    cached: str = os.path.join(cache_dir, f"{key}.json")
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write atomically, as several processes (or threads) may cache the same value
+        tmp: str = f"{cached}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp, cached)
+    except OSError:
+        pass
+
+    return None
@@ -2,10 +2,16 @@
 """
 import os
 import json
+import shlex
+import subprocess
 
-from typing import Any, Dict, Union
+from typing import Any, Dict, Optional, Union
 
 from commandio.fileio import file
+from commandio.logutil import LogFile
+
+# Environmental variables of job schedulers that define the number of allocated cores (LSF, SLURM, SGE)
+_SCHEDULER_CORES = ("LSB_DJOB_NUMPROC", "SLURM_CPUS_PER_TASK", "NSLOTS")
 
 def read_json(json_file: Union[str,file]) -> Dict[str, Any]:
     """Reads JavaScript Object Notation (JSON) file into a dictionary.
@@ -60,3 +66,73 @@ def update_json(json_file: Union[str,file], dictionary: Dict[str, Any]) -> str:
     json_file: str = os.path.abspath(json_file)
 
     return json_file
+
+
+def available_cores() -> int:
+    """Determines the number of CPU cores available to the current job.
+
+    The number of cores allocated by the job scheduler (LSF, SLURM, or SGE) is 
+    used if defined, otherwise the number of cores the process may run on.
+
+    Returns:
+        Number of available CPU cores.
+    """
+    for var in _SCHEDULER_CORES:
+        value: str = os.environ.get(var, "")
+        if value.isdigit() and int(value) > 0:
+            return int(value)
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def run_command(
+    cmd_str: str,
+    env: Optional[Dict[str, str]] = None,
+    log: Optional[LogFile] = None,
+    stdout: Optional[Union[file, str]] = None,
+    stderr: Optional[Union[file, str]] = None,
+) -> None:
+    """Runs a command with additional environmental variables, without modifying the environment of this process.
+
+    ``commandio``'s ``Command.run`` updates ``os.environ`` with the environment
+    of the command, which is shared by all threads (and inherited by every
+    later subprocess), so the command is run with a private copy instead.
+
+    Usage example:
+        >>> run_command("eddy_cpu --imain=dwi ...", env={"OMP_NUM_THREADS": "4"}, stdout="Eddy/dwi.eddy.log", stderr="Eddy/dwi.eddy.err")
+
+    Args:
+        cmd_str: Command.
+        env: Additional environmental variables. Defaults to None.
+        log: ``LogFile`` object for logging purposes. Defaults to None.
+        stdout: Output file to write the standard output to. Defaults to None.
+        stderr: Output file to write the standard error to. Defaults to None.
+
+    Raises:
+        RuntimeError: Exception that is raised if the return code of the command is not 0.
+    """
+    if log:
+        log.info(f"Running:\t{cmd_str}")
+
+    p: subprocess.CompletedProcess = subprocess.run(
+        shlex.split(cmd_str), env={**os.environ, **(env or {})}, capture_output=True, text=True
+    )
+
+    for out, text in ((stdout, p.stdout), (stderr, p.stderr)):
+        if out:
+            with open(out, "w") as f:
+                f.write(text)
+
+    if p.returncode != 0:
+        if stdout or stderr:
+            detail: str = "See the standard output and error:\n" + "\n".join(f"\t{f}" for f in (stdout, stderr) if f)
+        else:
+            detail: str = p.stderr
+        if log:
+            log.error(f"Failed:\t{cmd_str} with return code {p.returncode}\n{detail}")
+        raise RuntimeError(f"\nFailed:\t{cmd_str} with return code {p.returncode}\n{detail}")
+
+    return None
@@ -0,0 +1,268 @@
+"""Dependency-aware (early) clean-up of the intermediates of the working directory, and disk usage accounting.
+
+Each intermediate of the working directory (matched by a glob pattern,
+relative to the working directory) is consumed by a set of (downstream)
+pipeline stages. At the end of each stage, the intermediates whose (enabled)
+consumers have all finished are released:
+    * deleted, or
+    * compressed (uncompressed NIFTI images), should they match the keep-list.
+
+The disk usage of the working directory is measured at each stage boundary
+(before the release), and the peak usage is recorded. A per-subject disk
+quota may be enforced.
+"""
+import os
+import json
+import fnmatch
+import shutil
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from commandio.fileio import file
+
+from dwi_preproc.utils.eventlog import emit
+from dwi_preproc.utils.niio import to_nifti_gz
+
+# Pipeline stages (of dwi_preproc.sh), in order
+STAGES: Tuple[str, ...] = (
+    "gather",
+    "prescreen",
+    "denoise",
+    "drift",
+    "b0s",
+    "acqparams",
+    "topup",
+    "eddy",
+    "dtifit",
+    "publish",
+    "qc",
+    "dtitk",
+    "cleanup",
+)
+
+# Intermediates (relative to the working directory), and the stages that consume them.
+# NOTE: the first matching pattern applies. Unmatched files are kept until the (final) clean-up.
+_CONSUMERS: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    # Copied inputs: the DWI (and rPE b0s) are consumed until eddy, the b-table and sidecar until QC
+    ("source/*.nii*", ("prescreen", "denoise", "drift", "b0s", "acqparams", "eddy")),
+    ("source/*", ("eddy", "dtifit", "publish", "qc")),
+    ("Screen/*.nii*", ("denoise", "drift", "b0s", "acqparams", "eddy")),
+    ("Screen/*", ("eddy", "dtifit", "publish", "qc")),
+    ("Denoise/*", ("drift", "b0s", "acqparams", "eddy")),
+    ("Drift/*", ("b0s", "acqparams", "eddy")),
+    # Topup: the field (coefficients, or the field map should the image grid be adjusted) and hifi b0 are consumed by eddy (and the field map by QC)
+    ("Topup/suscept_field_Hz*", ("eddy", "qc")),
+    ("Topup/suscept_corr_B0*", ("eddy",)),
+    ("Topup/hifi*", ("eddy",)),
+    ("Topup/*", ("topup",)),
+    ("N4/*", ("eddy",)),
+    # Eddy: the brain mask and corrected DWI are consumed until QC, the (large) residuals are not consumed downstream
+    ("Eddy/MaskCheck/*", ("eddy",)),
+    ("Eddy/*_hifi_brain_mask*", ("dtifit", "publish", "qc")),
+    ("Eddy/*_hifi_brain.nii*", ("eddy",)),
+    ("Eddy/*B0s_PA*", ("eddy",)),
+    ("Eddy/*.eddy_residuals*", ("eddy",)),
+    ("Eddy/*.eddy_outlier_free_data*", ("eddy",)),
+    ("Eddy/*", ("dtifit", "publish", "qc")),
+    ("Tensor/*", ("publish",)),
+    ("Eddy.qc/*", ("qc",)),
+    ("DTI-TK/*", ("dtitk",)),
+)
+
+# Directories of the working directory that are published (at the publish stage) with --additional
+_ADDITIONAL: Tuple[str, ...] = ("dwi.misc", "Eddy", "Topup")
+
+# Units of disk quotas
+_UNITS: Dict[str, int] = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+class DiskQuotaError(Exception):
+    """Exception intended for working directories that exceed their disk quota."""
+    pass
+
+
+def parse_size(size: Union[int, str]) -> int:
+    """Parses a (disk) size, e.g. ``500M``, or ``20G`` (binary units).
+
+    Args:
+        size: Size (in bytes, or with a K, M, G, or T suffix).
+
+    Returns:
+        Size (in bytes).
+    """
+    size: str = str(size).strip().upper().rstrip("B")
+    unit: str = size[-1] if size and size[-1] in _UNITS else ""
+    return int(float(size[:len(size) - len(unit)]) * _UNITS[unit])
+
+
+def disk_usage(path: str) -> int:
+    """Disk usage of a directory (allocated blocks, hardlinked files are counted once).
+
+    Args:
+        path: Input directory.
+
+    Returns:
+        Disk usage (in bytes).
+    """
+    seen: set = set()
+    total: int = 0
+
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                st: os.stat_result = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+
+    return total
+
+
+def consumers(rel: str, additional: bool = False) -> Union[Tuple[str, ...], None]:
+    """Stages that consume an intermediate.
+
+    Args:
+        rel: Intermediate (relative to the working directory).
+        additional: The (additional) working directories are published (``--additional``). Defaults to False.
+
+    Returns:
+        Tuple of the consuming stages (``None`` if the file is not a known intermediate).
+    """
+    rel: str = rel.replace(os.sep, "/")
+    stages: Union[Tuple[str, ...], None] = None
+
+    for pattern, c in _CONSUMERS:
+        if fnmatch.fnmatchcase(rel, pattern):
+            stages: Tuple[str, ...] = c
+            break
+
+    if stages is not None and additional and rel.split("/")[0] in _ADDITIONAL:
+        stages: Tuple[str, ...] = stages + ("publish",)
+
+    return stages
+
+
+def release(
+    work: str,
+    stage: str,
+    enabled: Optional[Sequence[str]] = None,
+    keep: Optional[Sequence[str]] = None,
+    additional: bool = False,
+    delete: bool = True,
+    quota: Optional[Union[int, str]] = None,
+    ledger: Optional[Union[file, str]] = None,
+) -> Dict[str, Any]:
+    """Releases the intermediates of the working directory whose (enabled) consumers have finished, at the end of a stage.
+
+    Intermediates that match the keep-list are compressed (if they are
+    uncompressed NIFTI images) rather than deleted. At the end of the
+    ``cleanup`` stage, all files (known intermediates, or not) are released.
+    The disk usage (before the release) and the peak disk usage are recorded
+    in the ledger.
+
+    Usage example:
+        >>> usage = release("work/001-001_bval-1000_run-01", stage="eddy", keep=["Eddy/*.eddy_cnr_maps*"], quota="20G",
+        ...                 ledger="logs/sub-001_disk_usage.json")
+        >>> usage["Peak"] >= usage["Used"]
+        True
+
+    Args:
+        work: Working directory.
+        stage: Stage that finished.
+        enabled: Enabled stages (consumers of stages that are not enabled are ignored). Defaults to None (all stages).
+        keep: Keep-list (glob patterns, relative to the working directory). Defaults to None.
+        additional: The (additional) working directories are published (``--additional``). Defaults to False.
+        delete: Delete (or compress) the released intermediates (otherwise, the disk usage is only recorded). Defaults to True.
+        quota: Disk quota of the working directory (e.g. ``20G``). Defaults to None.
+        ledger: JSON ledger of the disk usage. Defaults to None.
+
+    Raises:
+        ValueError: Exception that is raised if the stage is not a pipeline stage.
+        DiskQuotaError: Exception that is raised if the disk usage (after the release) exceeds the quota.
+
+    Returns:
+        Disk usage record (``Stage``, ``Used``, ``Freed``, ``Released``, ``Peak``, and ``PeakStage``).
+    """
+    if stage not in STAGES:
+        raise ValueError(f"Unknown stage: {stage}. Stages: {', '.join(STAGES)}")
+
+    work: str = os.path.abspath(work)
+    enabled: Tuple[str, ...] = tuple(enabled or STAGES)
+    keep: List[str] = list(keep or [])
+    done: int = STAGES.index(stage)
+
+    used: int = disk_usage(work)
+    released: List[str] = []
+
+    if delete:
+        for root, dirs, names in os.walk(work):
+            # Symbolic links to directories are released as files
+            for name in sorted(names + [d for d in dirs if os.path.islink(os.path.join(root, d))]):
+                path: str = os.path.join(root, name)
+                rel: str = os.path.relpath(path, work)
+
+                if stage != "cleanup":
+                    c: Union[Tuple[str, ...], None] = consumers(rel, additional=additional)
+                    # Unknown intermediates, or pending (enabled) consumers
+                    if c is None or any(STAGES.index(s) > done for s in c if s in enabled):
+                        continue
+
+                if any(fnmatch.fnmatchcase(rel.replace(os.sep, "/"), k) for k in keep):
+                    if path.endswith(".nii") and not os.path.islink(path):
+                        to_nifti_gz(src=path, out=f"{path}.gz", remove=True)
+                        released.append(rel)
+                    continue
+
+                os.remove(path)
+                released.append(rel)
+
+        _prune(work)
+
+    after: int = disk_usage(work) if os.path.isdir(work) else 0
+
+    record: Dict[str, Any] = {"Stage": stage, "Used": used, "Freed": max(used - after, 0), "Released": released}
+    # The ledger of a previous run (of the same subject) is reset
+    data: Dict[str, Any] = _read_ledger(ledger) if done > 0 else {}
+
+    if used >= data.get("Peak", 0):
+        data["Peak"], data["PeakStage"] = used, stage
+
+    data.setdefault("Stages", {})[stage] = {k: v for k, v in record.items() if k != "Stage"}
+    if quota:
+        data["Quota"] = parse_size(quota)
+
+    if ledger:
+        tmp: str = f"{ledger}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp, ledger)
+
+    record.update({"Peak": data["Peak"], "PeakStage": data["PeakStage"]})
+    emit("disk", used=used, freed=record["Freed"], peak=data["Peak"])
+
+    if quota and after > parse_size(quota):
+        raise DiskQuotaError(f"Working directory disk usage ({after} bytes) exceeds the quota ({parse_size(quota)} bytes) after stage {stage}: {work}")
+
+    return record
+
+
+def _read_ledger(ledger: Optional[str] = None) -> Dict[str, Any]:
+    """Reads the disk usage ledger (an empty ledger is returned if it does not exist)."""
+    if not ledger:
+        return {}
+    try:
+        with open(ledger) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _prune(work: str) -> None:
+    """Removes the empty directories of the working directory (and the working directory, if empty)."""
+    for root, dirs, names in os.walk(work, topdown=False):
+        if not os.listdir(root):
+            shutil.rmtree(root, ignore_errors=True)
+    return None
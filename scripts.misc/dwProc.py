@@ -0,0 +1,1597 @@
+#!/usr/bin/env python3
+#
+# -*- coding: utf-8 -*-
+'''
+Command line interface to the native (python) processing stages of the
+``dwi_preproc`` package, intended to be called from ``dwi_preproc.sh``.
+Each stage is a sub-command with its own arguments.
+'''
+#
+# title           : dwProc.py
+# description     : Native DWI processing stages
+# author          : Adebayo B. Braimah
+# e-mail          : adebayo.braimah@cchmc.org
+# date            : 2026 10 19 09:41:12
+# version         : 0.0.1
+# usage           : dwProc.py [-h,--help] <stage> [stage options]
+# notes           : Requires the dwi_preproc package (parent directory of this script).
+# python_version  : 3.8
+# ==============================================================================
+
+# Import Modules & Packages
+import os
+import sys
+import json
+import argparse
+
+# Make the dwi_preproc package importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+
+# Define Functions
+
+def b0select(args):
+    '''Selects the most consistent b0s for each phase-encode direction.'''
+    from dwi_preproc.diffusion.dwi.b0select import select_b0s
+
+    imgs = [args.dwi]
+    bvals = [args.bvals]
+
+    if args.b0:
+        imgs.append(args.b0)
+        bvals.append(args.b0_bvals)
+
+    select_b0s(imgs=imgs,
+               bvals=bvals,
+               out=args.out,
+               acqp=args.acqp,
+               max_vols=args.max_vols,
+               n_std=args.n_std,
+               average=not args.no_average,
+               qc_json=args.qc)
+    return None
+
+
+def prescreen(args):
+    '''Screens the DWI for outlier volumes prior to eddy.'''
+    from dwi_preproc.diffusion.dwi.prescreen import screen_volumes
+
+    out = screen_volumes(dwi=args.dwi,
+                         bvals=args.bvals,
+                         bvecs=args.bvecs,
+                         outdir=args.outdir,
+                         index=args.idx,
+                         report=args.report,
+                         n_std=args.n_std,
+                         slice_frac=args.slice_frac,
+                         drop=args.drop)
+
+    # Print the (screened) DWI, bvals, and bvecs
+    print(" ".join(out[:3]))
+    return None
+
+
+def denoise(args):
+    '''Denoises the DWI using MP-PCA.'''
+    from dwi_preproc.diffusion.dwi.denoise import mppca
+
+    out = mppca(dwi=args.dwi,
+                outdir=args.outdir,
+                mask=args.mask,
+                extent=args.extent,
+                n_procs=args.nprocs,
+                mem_limit=args.mem)
+
+    # Print the denoised DWI, and noise map
+    print(" ".join(out))
+    return None
+
+
+def drift(args):
+    '''Corrects the signal drift of the DWI, using its interspersed b0s.'''
+    from dwi_preproc.diffusion.dwi.drift import correct_drift
+    from dwi_preproc.utils.niio import NiiFile
+
+    out = os.path.join(args.outdir, os.path.basename(NiiFile(src=args.dwi).rm_ext()) + "_drift.nii.gz")
+    os.makedirs(args.outdir, exist_ok=True)
+
+    dwi, model = correct_drift(dwi=args.dwi,
+                               bvals=args.bvals,
+                               out=out,
+                               model=args.model,
+                               mask=args.mask,
+                               order=args.order,
+                               b0_thresh=args.b0_thresh)
+
+    with open(model) as f:
+        print(f"Signal drift: {json.load(f)['DriftPercent']}%", file=sys.stderr)
+
+    # Print the drift corrected DWI, and drift model
+    print(f"{dwi} {model}")
+    return None
+
+
+def n4(args):
+    '''Performs bias field correction (w/ ANTs' N4BiasFieldCorrection).'''
+    from dwi_preproc.ants.N4 import n4 as _n4
+
+    out = _n4(img=args.img,
+              outdir=args.outdir,
+              mask=args.mask,
+              shrink_factor=args.shrink,
+              convergence=[int(i) for i in args.convergence.split("x")],
+              threads=args.threads,
+              use_cache=not args.no_cache)
+
+    # Print the corrected image, and bias field
+    print(" ".join(out))
+    return None
+
+
+def qcimg(args):
+    '''Renders QC images (ortho/lightbox PNGs) for one or more subjects.'''
+    from dwi_preproc.qc.render import render_cohort, render_qc
+
+    if args.jobs:
+        # Each line: out_name dwi [fa [v1]] ('-' for missing images)
+        keys = ("out_name", "dwi", "fa", "v1")
+        jobs = []
+        with open(args.jobs) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                job = dict(zip(keys, line.split()))
+                jobs.append({k: v for k, v in job.items() if v != "-"})
+        outputs = render_cohort(jobs=jobs, n_procs=args.nprocs)
+        outputs = [o for out in outputs.values() for o in out]
+    else:
+        if not args.out_name:
+            print("ERROR: Either --out-name or --jobs is required.", file=sys.stderr)
+            sys.exit(1)
+        outputs = render_qc(out_name=args.out_name,
+                            dwi=args.dwi,
+                            fa=args.fa,
+                            v1=args.v1,
+                            vol=args.vol)
+
+    # Print the rendered images
+    print(" ".join(outputs))
+    return None
+
+
+def qcreport(args):
+    '''Builds (or incrementally updates) a cohort QC report.'''
+    from dwi_preproc.qc.report import build_report, find_subjects
+
+    subjects, incomplete, missing_qc = find_subjects(derivative_dir=args.deriv_dir, bval=args.bval)
+
+    for name in missing_qc:
+        print(f"{name} does not have any QC information", file=sys.stderr)
+
+    for name in incomplete:
+        print(f"{name} does not have a complete set of preprocessed dMR image files", file=sys.stderr)
+
+    index, rendered = build_report(subjects=subjects,
+                                   outdir=args.outdir,
+                                   title=args.title or f"{args.bval or 'DWI'} QC",
+                                   n_procs=args.nprocs,
+                                   force=args.force,
+                                   incomplete=incomplete,
+                                   missing_qc=missing_qc)
+
+    print(f"Rendered {len(rendered)} of {len(subjects)} subjects/acquisitions", file=sys.stderr)
+
+    # Print the HTML index
+    print(index)
+    return None
+
+
+def eddyqc(args):
+    '''Computes eddy QC metrics (for a subject, or a cohort).'''
+    from dwi_preproc.qc.eddy import cohort_metrics, eddy_metrics, write_table
+    from dwi_preproc.utils.util import update_json
+
+    if args.jobs:
+        # Each line: name eddy_basename bvals [mask]
+        keys = ("name", "basename", "bvals", "mask")
+        jobs = []
+        with open(args.jobs) as f:
+            for line in f:
+                if line.strip():
+                    jobs.append(dict(zip(keys, line.split())))
+        table = cohort_metrics(jobs=jobs, n_procs=args.nprocs, cache_dir=args.cache_dir)
+        out = write_table(table, args.out)
+    else:
+        if not (args.eddy and args.bvals):
+            print("ERROR: Either --eddy and --bvals, or --jobs are required.", file=sys.stderr)
+            sys.exit(1)
+        metrics = eddy_metrics(basename=args.eddy,
+                               bvals=args.bvals,
+                               mask=args.mask,
+                               cache_dir=args.cache_dir)
+        out = update_json(json_file=args.out, dictionary=metrics)
+
+    # Print the output file
+    print(out)
+    return None
+
+
+def roistats(args):
+    '''Computes the ROI statistics of (tensor) scalar maps (for a cohort).'''
+    from dwi_preproc.diffusion.roistats import cohort_roi_stats, find_maps, read_lut
+    from dwi_preproc.qc.eddy import write_table
+
+    if args.jobs:
+        # Each line: subject metric scalar_map
+        keys = ("subject", "metric", "path")
+        jobs = []
+        with open(args.jobs) as f:
+            for line in f:
+                if line.strip():
+                    jobs.append(dict(zip(keys, line.split())))
+    elif args.deriv_dir:
+        jobs = find_maps(derivative_dir=args.deriv_dir, metrics=args.metrics)
+    else:
+        print("ERROR: Either --jobs, or --deriv-dir is required.", file=sys.stderr)
+        sys.exit(1)
+
+    table = cohort_roi_stats(jobs=jobs,
+                             atlas=args.atlas,
+                             lut=read_lut(args.lut) if args.lut else None,
+                             n_procs=args.nprocs,
+                             cache_dir=args.cache_dir)
+    out = write_table(table, args.out)
+
+    # Print the output table
+    print(out)
+    return None
+
+
+def topup(args):
+    '''Estimates the susceptibility induced distortion field (w/ FSL's topup).'''
+    from dwi_preproc.fsl.fslpy import topup as _topup
+
+    out = _topup(img=args.img,
+                 outdir=args.outdir,
+                 acqp=args.acqp,
+                 fout=args.fout or False,
+                 iout=args.iout or False,
+                 verbose=args.verbose,
+                 config=args.config,
+                 auto_grid=not args.no_auto_grid,
+                 grid_mode=args.grid_mode,
+                 max_adjust=args.max_adjust,
+                 out=args.out)
+
+    # Print the output basename, and the fieldmap and corrected b0s (if written)
+    print(" ".join(o for o in out if o))
+    return None
+
+
+def applytopup(args):
+    '''Applies the susceptibility induced distortion field (w/ FSL's applytopup).'''
+    from dwi_preproc.fsl.fslpy import applytopup as _applytopup
+
+    out = _applytopup(imgs=args.imain.split(","),
+                      acqp=args.acqp,
+                      inindex=[int(i) for i in args.inindex.split(",")],
+                      topup=args.topup,
+                      out=args.out,
+                      method=args.method,
+                      verbose=args.verbose)
+
+    # Print the corrected image
+    print(out)
+    return None
+
+
+def eddy(args):
+    '''Performs eddy current and motion correction (w/ FSL's eddy).'''
+    from dwi_preproc.fsl.fslpy import eddy as _eddy
+
+    out = _eddy(img=args.dwi,
+                bvals=args.bvals,
+                bvecs=args.bvecs,
+                mask=args.mask,
+                acqp=args.acqp,
+                index=args.idx,
+                out=args.out,
+                topup=args.topup,
+                niter=args.niter,
+                fwhm=[int(i) for i in args.fwhm.split(",")],
+                interp=args.interp,
+                repol=args.repol,
+                residuals=args.residuals,
+                cnr_maps=args.cnr_maps,
+                nvoxhp=args.nvoxhp,
+                ol_type=args.ol_type,
+                ol_nstd=args.ol_nstd,
+                estimate_move_by_susceptibility=args.mbs,
+                slspec=args.slspec,
+                mporder=args.mporder,
+                s2v_niter=args.s2v_niter,
+                s2v_lambda=args.s2v_lambda,
+                s2v_interp=args.s2v_interp,
+                use_gpu=args.use_gpu,
+                threads=args.threads,
+                resume=not args.no_resume,
+                verbose=args.verbose)
+
+    # Print the corrected DWI, and rotated bvecs
+    print(" ".join(out))
+    return None
+
+
+def convert(args):
+    '''Converts (intermediate) NIFTI images to compressed NIFTI images.'''
+    from dwi_preproc.utils.niio import to_nifti_gz
+
+    if args.out and len(args.src) > 1:
+        print("ERROR: --out can only be used with a single input image.", file=sys.stderr)
+        sys.exit(1)
+
+    out = [to_nifti_gz(src=src, out=args.out, remove=args.rm) for src in args.src]
+
+    # Print the compressed images
+    print(" ".join(out))
+    return None
+
+
+def export(args):
+    '''Exports the (preprocessed) DWI, and its associated files, to a chunked array store (HDF5/Zarr).'''
+    from dwi_preproc.utils.niio import export_store
+
+    out = export_store(out=args.out,
+                       dwi=args.dwi,
+                       bvals=args.bvals,
+                       bvecs=args.bvecs,
+                       mask=args.mask,
+                       maps=dict(args.map or []),
+                       chunks=[int(i) for i in args.chunks.split(",")],
+                       compresslevel=args.compresslevel)
+
+    # Print the array store
+    print(out)
+    return None
+
+
+def dtitk(args):
+    '''Converts a dtifit tensor image to a DTI-TK compatible tensor image.'''
+    from dwi_preproc.diffusion.dwi.dtitk import fsl_to_dtitk
+
+    out, stats = fsl_to_dtitk(tensor=args.tensor,
+                              out=args.out,
+                              scale=args.scale,
+                              zero_origin=not args.keep_origin)
+
+    if stats["non_spd"] or stats["outliers"]:
+        print(f"{stats['non_spd']} non-SPD, and {stats['outliers']} outlier tensors (of {stats['voxels']}) corrected.", file=sys.stderr)
+
+    # Print the DTI-TK tensor image
+    print(out)
+    return None
+
+
+def synth(args):
+    '''Generates a synthetic (custom BIDS) DWI dataset.'''
+    from dwi_preproc.bench.synth import make_bids_dataset
+
+    # Shells: b-value:volumes pairs (e.g. 0:6,1000:30)
+    shells = {int(b): int(n) for b, n in (i.split(":") for i in args.shells.split(","))}
+
+    dwis = make_bids_dataset(root=args.outdir,
+                             n_subjects=args.subjects,
+                             n_sessions=args.sessions,
+                             shape=tuple(int(i) for i in args.shape.split(",")),
+                             shells=shells,
+                             mb_factor=args.mb,
+                             rpe_b0=not args.no_rpe,
+                             compress=not args.uncompressed,
+                             sidecar=json.loads(args.sidecar) if args.sidecar else None,
+                             seed=args.seed)
+
+    # Print the DWIs of the dataset
+    print("\n".join(dwis))
+    return None
+
+
+def bench(args):
+    '''Runs the benchmark suite, and stores (and optionally compares) the results.'''
+    from dwi_preproc.bench.suite import compare, format_comparison, format_results, run, save_results
+
+    results = run(tier=args.tier, workdir=args.workdir, select=args.select, repeats=args.repeats)
+    out = save_results(results, args.out)
+
+    print(format_results(results), file=sys.stderr)
+
+    if args.compare:
+        print(format_comparison(compare(args.compare, results, threshold=args.threshold)), file=sys.stderr)
+
+    # Print the results file
+    print(out)
+    return None
+
+
+def fslsim(args):
+    '''Installs the FSL tool simulator (stand-in executables) in a simulated FSLDIR.'''
+    from dwi_preproc.fsl.simulator import install, sim_env
+
+    fsldir = install(fsldir=args.fsldir, profile=args.profile)
+
+    # Print the environment (e.g. eval $(dwProc.py fslsim --fsldir fsl_sim))
+    for k, v in sim_env(fsldir, profile=args.profile, trace=args.trace).items():
+        print(f"export {k}={v}")
+    return None
+
+
+def events(args):
+    '''Collects the (structured) events of a pipeline run into a JSON lines log, and a Prometheus textfile.'''
+    from dwi_preproc.utils.eventlog import collect
+
+    n = collect(src=args.src,
+                log=args.log,
+                subject=args.subject,
+                textfile=args.textfile,
+                flush_interval=args.flush_interval)
+
+    print(f"Collected {n} events: {args.log}", file=sys.stderr)
+
+    # Print the event log
+    print(os.path.abspath(args.log))
+    return None
+
+
+def hashsum(args):
+    '''Hashes the (decoded) content of files, using cached hashes of unchanged files.'''
+    from dwi_preproc.utils.hashing import hash_files
+
+    hashes = hash_files(files=args.files,
+                        algorithm=args.algorithm,
+                        cache_dir=args.cache_dir,
+                        max_workers=args.threads)
+
+    # Print the hashes (as sha256sum does)
+    for f, digest in hashes.items():
+        print(f"{digest}  {f}")
+    return None
+
+
+def dedup(args):
+    '''Finds the duplicate (and near-duplicate) DWI acquisitions of a BIDS dataset.'''
+    from dwi_preproc.bids.dedup import dedup_dataset
+
+    report, skip = dedup_dataset(bids_dir=args.bids_dir,
+                                 out=args.out,
+                                 skip_list=args.skip_list,
+                                 threshold=args.threshold,
+                                 n_samples=args.samples,
+                                 across_subjects=args.across_subjects)
+
+    with open(report) as f:
+        print(f"Redundant runs: {json.load(f)['Redundant']}", file=sys.stderr)
+
+    # Print the report (and list of redundant runs)
+    print(report)
+    if skip:
+        print(skip)
+    return None
+
+
+def validate(args):
+    '''Validates the integrity of the (DWI) series of a BIDS dataset (or of the inputs of a run), using the cached verdicts of unchanged files.'''
+    from dwi_preproc.bids.integrity import validate_dataset, validate_files
+
+    if args.bids_dir:
+        report = validate_dataset(bids_dir=args.bids_dir,
+                                  out=args.report,
+                                  invalid_list=args.invalid_list,
+                                  cache_dir=args.cache_dir,
+                                  max_workers=args.threads)
+        errors = report["Errors"]
+        print(f"Validated {report['Series']} series ({report['Checked']} checked, {report['Invalid']} invalid)", file=sys.stderr)
+    else:
+        series = []
+        if args.dwi:
+            series.append((args.dwi, args.bvals, args.bvecs, args.json))
+        series.extend((img, None, None, None) for img in (args.img or []))
+        if not series:
+            sys.exit("validate: --bids-dir, --dwi or --img is required")
+
+        verdicts = validate_files(series, cache_dir=args.cache_dir, max_workers=args.threads)
+        errors = {v["Image"]: v["Errors"] for v in verdicts if not v["Valid"]}
+
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(verdicts, f, indent=4)
+
+    for img, errs in errors.items():
+        for err in errs:
+            print(f"{img}: {err}", file=sys.stderr)
+
+    # Exit with a non-zero status if any series is invalid
+    if errors:
+        sys.exit(1)
+    return None
+
+
+def queue(args):
+    '''Runs a queue of pipeline runs on local scratch, with input prefetch and asynchronous write-back.'''
+    from dwi_preproc.utils.staging import read_jobs, run_queue
+
+    pipeline_args = args.pipeline_args
+    if pipeline_args and pipeline_args[0] == "--":
+        pipeline_args = pipeline_args[1:]
+
+    records = run_queue(jobs=read_jobs(args.jobs),
+                        data_dir=args.data_dir,
+                        script=os.path.join(os.path.dirname(os.path.abspath(__file__)), "dwi_preproc.sh"),
+                        args=pipeline_args,
+                        scratch=args.scratch,
+                        prefetch=args.prefetch,
+                        writeback_workers=args.writeback_threads,
+                        report=args.report,
+                        resume=not args.no_resume)
+
+    for r in records:
+        if r.get("Skipped"):
+            print(f"{r['Name']}: skipped (completed by a previous run)", file=sys.stderr)
+            continue
+        print(f"{r['Name']}: exit status {r['ExitStatus']} (stage wait {r.get('StageWait')} s, runtime {r.get('Runtime')} s, write-back {r.get('WriteBack')} s)", file=sys.stderr)
+
+    # Exit with a non-zero status if any run failed
+    if any(r["ExitStatus"] != 0 for r in records):
+        sys.exit(1)
+    return None
+
+
+def release(args):
+    '''Releases the intermediates of the working directory whose (enabled) consumers have finished, and records the disk usage.'''
+    from dwi_preproc.utils.workspace import DiskQuotaError, release as release_stage
+
+    try:
+        usage = release_stage(work=args.work,
+                              stage=args.stage,
+                              enabled=args.stages.split(",") if args.stages else None,
+                              keep=args.keep.split(",") if args.keep else None,
+                              additional=args.additional,
+                              delete=not args.measure_only,
+                              quota=args.quota,
+                              ledger=args.ledger)
+    except DiskQuotaError as error:
+        sys.exit(f"ERROR: {error}")
+
+    print(f"Stage {usage['Stage']}: {usage['Used']} bytes used, {usage['Freed']} bytes freed ({len(usage['Released'])} files), peak {usage['Peak']} bytes ({usage['PeakStage']})", file=sys.stderr)
+    return None
+
+
+def brainmask(args):
+    '''Estimates the brain mask of a (mean) b0 image natively (a fast alternative to bet), and optionally compares it to a reference (bet) mask.'''
+    from dwi_preproc.diffusion.dwi.brainmask import brain_mask
+
+    brain, mask = brain_mask(img=args.img,
+                             out=args.out,
+                             thresh_scale=args.thresh_scale,
+                             n_erode=args.erode,
+                             ref=args.ref,
+                             overlap=args.overlap)
+
+    if args.ref and args.overlap:
+        with open(args.overlap) as f:
+            print(f"Dice (reference mask): {json.load(f)['Dice']}", file=sys.stderr)
+
+    # Print the brain extracted image and mask
+    print(brain)
+    print(mask)
+    return None
+
+
+def maskoverlap(args):
+    '''Compares a brain mask to a reference brain mask (Dice, Jaccard, and volumes).'''
+    from dwi_preproc.diffusion.dwi.brainmask import mask_overlap
+    from dwi_preproc.utils.util import update_json
+
+    overlap = mask_overlap(mask=args.mask, ref=args.ref)
+    print(f"Dice: {overlap['Dice']}, Jaccard: {overlap['Jaccard']}", file=sys.stderr)
+
+    # Print the overlap JSON file
+    print(update_json(args.out, overlap))
+    return None
+
+
+def publish(args):
+    '''Publishes files (and directories) from the working directory to the output directory.'''
+    from dwi_preproc.utils.publish import publish as _publish
+
+    manifest = _publish(files=args.file or [],
+                        outdir=args.outdir,
+                        trees=args.tree or [],
+                        move=args.move,
+                        compress=not args.no_compress)
+
+    # Print the manifest
+    print(manifest)
+    return None
+
+
+if __name__ == "__main__":
+
+    # Argument Parser
+    parser = argparse.ArgumentParser(description='Native (python) processing stages of the dwi_preproc pipeline.')
+    stages = parser.add_subparsers(dest="stage", metavar="<stage>")
+
+    # b0 selection
+    b0 = stages.add_parser("b0select",
+        help="Select the most consistent b0s of each phase-encode direction for topup.")
+    b0.add_argument("--dwi",
+        type=str,
+        required=True,
+        help="Input DWI.")
+    b0.add_argument("--bvals",
+        type=str,
+        required=True,
+        help="Corresponding b-value file for the DWI.")
+    b0.add_argument("--b0",
+        type=str,
+        default=None,
+        help="Reversed phase encoded (rPE) b0 image.")
+    b0.add_argument("--b0-bvals",
+        type=str,
+        dest="b0_bvals",
+        default=None,
+        help="Corresponding b-value file for the rPE b0 image (all volumes are assumed to be b0s if not provided).")
+    b0.add_argument("--out",
+        type=str,
+        required=True,
+        help="Output b0 image.")
+    b0.add_argument("--acqp",
+        type=str,
+        default=None,
+        help="Acquisition parameter file (used to write a matching datain file with --no-average).")
+    b0.add_argument("--max-vols",
+        type=int,
+        dest="max_vols",
+        default=3,
+        help="Maximum number of b0s selected for each phase-encode direction. [default: 3]")
+    b0.add_argument("--n-std",
+        type=float,
+        dest="n_std",
+        default=3.0,
+        help="Number of robust standard deviations for outlier rejection. [default: 3.0]")
+    b0.add_argument("--no-average",
+        dest="no_average",
+        action="store_true",
+        help="Merge the selected b0s rather than averaging them.")
+    b0.add_argument("--qc",
+        type=str,
+        default=None,
+        help="Output JSON file to record the selection in.")
+    b0.set_defaults(func=b0select)
+
+    # Volume outlier screening
+    ps = stages.add_parser("prescreen",
+        help="Screen the DWI for outlier volumes prior to eddy.")
+    ps.add_argument("--dwi",
+        type=str,
+        required=True,
+        help="Input DWI.")
+    ps.add_argument("--bvals",
+        type=str,
+        required=True,
+        help="Corresponding b-value file for the DWI.")
+    ps.add_argument("--bvecs",
+        type=str,
+        required=True,
+        help="Corresponding b-vector file for the DWI.")
+    ps.add_argument("--outdir",
+        type=str,
+        required=True,
+        help="Output directory.")
+    ps.add_argument("--idx",
+        type=str,
+        default=None,
+        help="Eddy index file to update should volumes be dropped.")
+    ps.add_argument("--report",
+        type=str,
+        default=None,
+        help="Output JSON report. [default: <outdir>/volume_screen.json]")
+    ps.add_argument("--n-std",
+        type=float,
+        dest="n_std",
+        default=4.0,
+        help="Number of robust standard deviations for outlier detection. [default: 4.0]")
+    ps.add_argument("--slice-frac",
+        type=float,
+        dest="slice_frac",
+        default=0.1,
+        help="Fraction of outlier slices for a volume to be flagged. [default: 0.1]")
+    ps.add_argument("--drop",
+        action="store_true",
+        help="Remove the flagged volumes (and their bvals/bvecs).")
+    ps.set_defaults(func=prescreen)
+
+    # MP-PCA denoising
+    dn = stages.add_parser("denoise",
+        help="Denoise the DWI using MP-PCA.")
+    dn.add_argument("--dwi",
+        type=str,
+        required=True,
+        help="Input DWI.")
+    dn.add_argument("--outdir",
+        type=str,
+        required=True,
+        help="Output directory.")
+    dn.add_argument("--mask",
+        type=str,
+        default=None,
+        help="Brain mask (voxels outside of the mask are not denoised).")
+    dn.add_argument("--extent",
+        type=int,
+        default=None,
+        help="Patch size (odd). [default: smallest odd patch size >= 5 with at least as many voxels as volumes]")
+    dn.add_argument("--nprocs",
+        type=int,
+        default=None,
+        help="Number of worker processes. [default: number of CPUs]")
+    dn.add_argument("--mem",
+        type=int,
+        default=2048,
+        help="Memory limit (in MB) for the worker processes. [default: 2048]")
+    dn.set_defaults(func=denoise)
+
+    # Signal drift correction
+    df = stages.add_parser("drift",
+        help="Correct the (global) signal drift of the DWI: a linear, or quadratic, model of the in-mask mean of the interspersed b0s is fitted, and each volume is rescaled (streamed, one volume at a time).")
+    df.add_argument("--dwi",
+        type=str,
+        required=True,
+        help="Input DWI.")
+    df.add_argument("--bvals",
+        type=str,
+        required=True,
+        help="Corresponding b-value file.")
+    df.add_argument("--outdir",
+        type=str,
+        required=True,
+        help="Output directory.")
+    df.add_argument("--model",
+        type=str,
+        default=None,
+        help="Output JSON sidecar of the drift model. [default: <outdir>/<dwi>_drift.json]")
+    df.add_argument("--mask",
+        type=str,
+        default=None,
+        help="Brain mask. [default: brain mask of the mean b0 (estimated natively)]")
+    df.add_argument("--order",
+        type=int,
+        choices=[1, 2],
+        default=2,
+        help="Order of the drift model (1: linear, 2: quadratic). [default: 2]")
+    df.add_argument("--b0-thresh",
+        dest="b0_thresh",
+        type=float,
+        default=50,
+        help="b-values less than or equal to this value are considered to be b0s. [default: 50]")
+    df.set_defaults(func=drift)
+
+    # N4 bias field correction
+    bc = stages.add_parser("n4",
+        help="Bias field correction (w/ ANTs' N4BiasFieldCorrection).")
+    bc.add_argument("--img",
+        type=str,
+        required=True,
+        help="Input image (e.g. the mean b0).")
+    bc.add_argument("--outdir",
+        type=str,
+        required=True,
+        help="Output directory.")
+    bc.add_argument("--mask",
+        type=str,
+        default=None,
+        help="Mask image.")
+    bc.add_argument("--shrink",
+        type=int,
+        default=4,
+        help="Image shrink factor. [default: 4]")
+    bc.add_argument("--convergence",
+        type=str,
+        default="50x50x50x50",
+        help="Number of iterations for each resolution level. [default: 50x50x50x50]")
+    bc.add_argument("--threads",
+        type=int,
+        default=None,
+        help="Number of threads. [default: number of cores allocated by the job scheduler]")
+    bc.add_argument("--no-cache",
+        dest="no_cache",
+        action="store_true",
+        help="Do not use cached outputs.")
+    bc.set_defaults(func=n4)
+
+    # QC images
+    qi = stages.add_parser("qcimg",
+        help="Render QC images (ortho/lightbox PNGs, and FA/V1 RGB overlays).")
+    qi.add_argument("--out-name",
+        type=str,
+        dest="out_name",
+        default=None,
+        help="Output path and file name prefix.")
+    qi.add_argument("--dwi",
+        type=str,
+        default=None,
+        help="Preprocessed DWI.")
+    qi.add_argument("--fa",
+        type=str,
+        default=None,
+        help="FA image.")
+    qi.add_argument("--v1",
+        type=str,
+        default=None,
+        help="V1 image (used for an RGB overlay of the FA image).")
+    qi.add_argument("--vol",
+        type=int,
+        default=0,
+        help="Volume of the DWI to render. [default: 0]")
+    qi.add_argument("--jobs",
+        type=str,
+        default=None,
+        help="Text file with one subject per line: out_name dwi [fa [v1]] ('-' for missing images). Subjects are rendered in parallel.")
+    qi.add_argument("--nprocs",
+        type=int,
+        default=None,
+        help="Number of worker processes (with --jobs). [default: number of CPUs]")
+    qi.set_defaults(func=qcimg)
+
+    # QC report
+    qr = stages.add_parser("qcreport",
+        help="Build (or incrementally update) a cohort QC report.")
+    qr.add_argument("--deriv-dir",
+        type=str,
+        dest="deriv_dir",
+        required=True,
+        help="Parent derivatives directory of the preprocessed subjects.")
+    qr.add_argument("--outdir",
+        type=str,
+        required=True,
+        help="Output directory (manifest, images, and HTML index).")
+    qr.add_argument("--bval",
+        type=str,
+        default=None,
+        help="b-value label of the acquisitions (e.g. b800).")
+    qr.add_argument("--title",
+        type=str,
+        default=None,
+        help="Title of the HTML index. [default: '<bval> QC']")
+    qr.add_argument("--nprocs",
+        type=int,
+        default=None,
+        help="Number of worker processes. [default: number of CPUs]")
+    qr.add_argument("--force",
+        action="store_true",
+        help="Re-render all subjects.")
+    qr.set_defaults(func=qcreport)
+
+    # eddy QC metrics
+    eq = stages.add_parser("eddyqc",
+        help="Compute eddy QC metrics (eddy_quad equivalent) for a subject, or a cohort.")
+    eq.add_argument("--eddy",
+        type=str,
+        default=None,
+        help="Eddy output basename (i.e. eddy's --out argument).")
+    eq.add_argument("--bvals",
+        type=str,
+        default=None,
+        help="Corresponding b-value file.")
+    eq.add_argument("--mask",
+        type=str,
+        default=None,
+        help="Brain mask (used for the CNR metrics).")
+    eq.add_argument("--jobs",
+        type=str,
+        default=None,
+        help="Text file with one subject per line: name eddy_basename bvals [mask]. The metrics are written to a single table.")
+    eq.add_argument("--out",
+        type=str,
+        required=True,
+        help="Output JSON file (subject), or TSV file (cohort, with --jobs).")
+    eq.add_argument("--cache-dir",
+        type=str,
+        dest="cache_dir",
+        default=None,
+        help="Directory used to cache parsed eddy outputs.")
+    eq.add_argument("--nprocs",
+        type=int,
+        default=None,
+        help="Number of worker processes (with --jobs). [default: number of CPUs]")
+    eq.set_defaults(func=eddyqc)
+
+    # ROI statistics
+    rs = stages.add_parser("roistats",
+        help="Compute per-label (atlas) statistics of (tensor) scalar maps for a cohort.")
+    rs.add_argument("--atlas",
+        type=str,
+        required=True,
+        help="Label (atlas) image, on the same grid as the scalar maps.")
+    rs.add_argument("--lut",
+        type=str,
+        default=None,
+        help="Label look-up table (label name).")
+    rs.add_argument("--jobs",
+        type=str,
+        default=None,
+        help="Cohort file, with a line per scalar map: subject metric scalar_map.")
+    rs.add_argument("--deriv-dir",
+        type=str,
+        dest="deriv_dir",
+        default=None,
+        help="Parent derivatives directory (the scalar maps of each Tensor directory are used).")
+    rs.add_argument("--metrics",
+        type=str,
+        nargs="+",
+        default=["FA", "MD"],
+        help="Scalar maps (dtifit output suffixes) used with --deriv-dir. [default: FA MD]")
+    rs.add_argument("--out",
+        type=str,
+        required=True,
+        help="Output (tab delimited) table.")
+    rs.add_argument("--cache-dir",
+        type=str,
+        dest="cache_dir",
+        default=None,
+        help="Directory of the cache of computed statistics.")
+    rs.add_argument("--nprocs",
+        type=int,
+        default=None,
+        help="Number of worker processes. [default: number of CPUs]")
+    rs.set_defaults(func=roistats)
+
+    # topup
+    tp = stages.add_parser("topup",
+        help="Susceptibility induced distortion field estimation (w/ FSL's topup).")
+    tp.add_argument("--img",
+        type=str,
+        required=True,
+        help="Input b0 image (b0s of each phase-encode direction).")
+    tp.add_argument("--acqp",
+        type=str,
+        required=True,
+        help="Acquisition parameter file.")
+    tp.add_argument("--outdir",
+        type=str,
+        required=True,
+        help="Output directory.")
+    tp.add_argument("--out",
+        type=str,
+        default=None,
+        help="Output basename. [default: <outdir>/topup_results]")
+    tp.add_argument("--fout",
+        type=str,
+        default=None,
+        help="Output fieldmap (in Hz).")
+    tp.add_argument("--iout",
+        type=str,
+        default=None,
+        help="Output corrected b0 image.")
+    tp.add_argument("--config",
+        type=str,
+        default=None,
+        help="Configuration file. [default: b02b0 configuration that fits the image grid]")
+    tp.add_argument("--grid-mode",
+        type=str,
+        dest="grid_mode",
+        default="pad",
+        help="Image grid adjustment method ('pad'/'crop'). [default: pad]")
+    tp.add_argument("--max-adjust",
+        type=int,
+        dest="max_adjust",
+        default=2,
+        help="Maximum number of voxels that may be added (or removed) along any axis to fit the subsampling schedule. [default: 2]")
+    tp.add_argument("--no-auto-grid",
+        dest="no_auto_grid",
+        action="store_true",
+        help="Do not fit the image grid to the subsampling schedule.")
+    tp.add_argument("--verbose",
+        action="store_true",
+        help="Enable verbose output.")
+    tp.set_defaults(func=topup)
+
+    # applytopup
+    at = stages.add_parser("applytopup",
+        help="Apply the susceptibility induced distortion field (w/ FSL's applytopup).")
+    at.add_argument("--imain",
+        type=str,
+        required=True,
+        help="Input images (comma separated).")
+    at.add_argument("--acqp",
+        type=str,
+        required=True,
+        help="Acquisition parameter file.")
+    at.add_argument("--inindex",
+        type=str,
+        required=True,
+        help="Row of the acquisition parameter file of each input image (comma separated, 1-based).")
+    at.add_argument("--topup",
+        type=str,
+        required=True,
+        help="Topup output basename.")
+    at.add_argument("--out",
+        type=str,
+        required=True,
+        help="Output image.")
+    at.add_argument("--method",
+        type=str,
+        default="lsr",
+        help="Resampling method ('lsr'/'jac'). [default: lsr]")
+    at.add_argument("--verbose",
+        action="store_true",
+        help="Enable verbose output.")
+    at.set_defaults(func=applytopup)
+
+    # eddy
+    ed = stages.add_parser("eddy",
+        help="Eddy current and motion correction (w/ FSL's eddy).")
+    ed.add_argument("--dwi",
+        type=str,
+        required=True,
+        help="Input DWI.")
+    ed.add_argument("--bvals",
+        type=str,
+        required=True,
+        help="Corresponding b-value file.")
+    ed.add_argument("--bvecs",
+        type=str,
+        required=True,
+        help="Corresponding b-vector file.")
+    ed.add_argument("--mask",
+        type=str,
+        required=True,
+        help="Brain mask.")
+    ed.add_argument("--acqp",
+        type=str,
+        required=True,
+        help="Acquisition parameter file.")
+    ed.add_argument("--idx",
+        type=str,
+        required=True,
+        help="Index file.")
+    ed.add_argument("--out",
+        type=str,
+        required=True,
+        help="Output basename.")
+    ed.add_argument("--topup",
+        type=str,
+        default=None,
+        help="Topup output basename.")
+    ed.add_argument("--mbs",
+        action="store_true",
+        help="Estimate how the susceptibility field changes with movement (requires --topup).")
+    ed.add_argument("--niter",
+        type=int,
+        default=5,
+        help="Number of iterations. [default: 5]")
+    ed.add_argument("--fwhm",
+        type=str,
+        default="0",
+        help="FWHM (mm) for all iterations, or a comma separated value for each iteration. [default: 0]")
+    ed.add_argument("--interp",
+        type=str,
+        default="spline",
+        help="Interpolation model ('spline'/'trilinear'). [default: spline]")
+    ed.add_argument("--repol",
+        action="store_true",
+        help="Replace outlier slices.")
+    ed.add_argument("--residuals",
+        action="store_true",
+        help="Write the residuals.")
+    ed.add_argument("--cnr-maps",
+        dest="cnr_maps",
+        action="store_true",
+        help="Write the shell-wise CNR maps.")
+    ed.add_argument("--nvoxhp",
+        type=int,
+        default=5000,
+        help="Number of voxels used to estimate the hyperparameters. [default: 5000]")
+    ed.add_argument("--ol-type",
+        type=str,
+        dest="ol_type",
+        default="both",
+        help="Outlier grouping ('sw'/'gw'/'both'). [default: both]")
+    ed.add_argument("--ol-nstd",
+        type=float,
+        dest="ol_nstd",
+        default=3,
+        help="Number of standard deviations for a slice to be considered an outlier. [default: 3]")
+    ed.add_argument("--slspec",
+        type=str,
+        default=None,
+        help="Slice specification file (slice-to-volume motion correction).")
+    ed.add_argument("--mporder",
+        type=int,
+        default=0,
+        help="Order of the slice-to-volume movement model (0 disables slice-to-volume motion correction). [default: 0]")
+    ed.add_argument("--s2v-niter",
+        type=int,
+        dest="s2v_niter",
+        default=5,
+        help="Number of iterations of slice-to-volume motion correction. [default: 5]")
+    ed.add_argument("--s2v-lambda",
+        type=int,
+        dest="s2v_lambda",
+        default=1,
+        help="Regularisation weight of slice-to-volume motion correction. [default: 1]")
+    ed.add_argument("--s2v-interp",
+        type=str,
+        dest="s2v_interp",
+        default="trilinear",
+        help="Slice-to-volume interpolation model ('spline'/'trilinear'). [default: trilinear]")
+    ed.add_argument("--use-gpu",
+        dest="use_gpu",
+        action="store_true",
+        help="Use the GPU (CUDA) version of eddy.")
+    ed.add_argument("--threads",
+        type=int,
+        default=None,
+        help="Number of threads. [default: number of cores allocated by the job scheduler]")
+    ed.add_argument("--no-resume",
+        dest="no_resume",
+        action="store_true",
+        help="Run eddy, even if a complete set of outputs exists.")
+    ed.add_argument("--verbose",
+        action="store_true",
+        help="Enable verbose output.")
+    ed.set_defaults(func=eddy)
+
+    # NIFTI conversion
+    cv = stages.add_parser("convert",
+        help="Convert (intermediate) NIFTI images to compressed (.nii.gz) NIFTI images.")
+    cv.add_argument("--src",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Input NIFTI image(s).")
+    cv.add_argument("--out",
+        type=str,
+        default=None,
+        help="Output NIFTI image (single input image only). [default: input image with the .nii.gz extension]")
+    cv.add_argument("--rm",
+        action="store_true",
+        help="Remove the input image(s) once converted.")
+    cv.set_defaults(func=convert)
+
+    # Chunked array store export
+    ex = stages.add_parser("export",
+        help="Export the DWI (and its mask, b-table and maps) to a chunked array store (HDF5: .h5, or Zarr: .zarr).")
+    ex.add_argument("--dwi",
+        type=str,
+        required=True,
+        help="Input (preprocessed) DWI.")
+    ex.add_argument("--out",
+        type=str,
+        required=True,
+        help="Output array store (.h5/.hdf5 requires h5py, .zarr requires zarr).")
+    ex.add_argument("--bvals",
+        type=str,
+        default=None,
+        help="Corresponding b-value file for the DWI.")
+    ex.add_argument("--bvecs",
+        type=str,
+        default=None,
+        help="Corresponding b-vector file for the DWI.")
+    ex.add_argument("--mask",
+        type=str,
+        default=None,
+        help="Brain mask.")
+    ex.add_argument("--map",
+        type=str,
+        nargs=2,
+        action="append",
+        metavar=("NAME", "IMG"),
+        help="Name of an additional (e.g. tensor) map, and its image. May be repeated.")
+    ex.add_argument("--chunks",
+        type=str,
+        default="16,16,16,16",
+        help="Comma separated chunk shape (x,y,z,volumes), where -1 spans the full dimension. [default: 16,16,16,16]")
+    ex.add_argument("--compresslevel",
+        type=int,
+        default=4,
+        help="Compression level (HDF5 only). [default: 4]")
+    ex.set_defaults(func=export)
+
+    # DTI-TK tensor conversion
+    dt = stages.add_parser("dtitk",
+        help="Convert a dtifit tensor image (--save_tensor) to a DTI-TK compatible tensor image (DTI-TK is not required).")
+    dt.add_argument("--tensor",
+        type=str,
+        required=True,
+        help="Input dtifit tensor image.")
+    dt.add_argument("--out",
+        type=str,
+        required=True,
+        help="Output DTI-TK tensor image.")
+    dt.add_argument("--scale",
+        type=float,
+        default=None,
+        help="Scale factor of the diffusivities. [default: 1000 if the diffusivities are in mm^2/s, 1 otherwise]")
+    dt.add_argument("--keep-origin",
+        dest="keep_origin",
+        action="store_true",
+        help="Keep the origin of the image (DTI-TK's fsl_to_dtitk sets it to 0,0,0).")
+    dt.set_defaults(func=dtitk)
+
+    # Synthetic dataset
+    sy = stages.add_parser("synth",
+        help="Generate a synthetic (custom BIDS) DWI dataset.")
+    sy.add_argument("--outdir",
+        type=str,
+        required=True,
+        help="Output (BIDS) directory.")
+    sy.add_argument("--subjects",
+        type=int,
+        default=2,
+        help="Number of subjects. [default: 2]")
+    sy.add_argument("--sessions",
+        type=int,
+        default=1,
+        help="Number of sessions (per subject). [default: 1]")
+    sy.add_argument("--shape",
+        type=str,
+        default="32,32,16",
+        help="Comma separated matrix size (x,y,z). [default: 32,32,16]")
+    sy.add_argument("--shells",
+        type=str,
+        default="0:2,1000:12",
+        help="Comma separated b-value:volumes pairs (0 for b0s). [default: 0:2,1000:12]")
+    sy.add_argument("--mb",
+        type=int,
+        default=1,
+        help="Multi-band factor. [default: 1]")
+    sy.add_argument("--sidecar",
+        type=str,
+        default=None,
+        help="Additional (or overriding) JSON sidecar fields, as a JSON string.")
+    sy.add_argument("--no-rpe",
+        dest="no_rpe",
+        action="store_true",
+        help="Do not write reverse phase encoded b0 images.")
+    sy.add_argument("--uncompressed",
+        action="store_true",
+        help="Write uncompressed (.nii) images.")
+    sy.add_argument("--seed",
+        type=int,
+        default=0,
+        help="Random seed. [default: 0]")
+    sy.set_defaults(func=synth)
+
+    # Benchmarks
+    bm = stages.add_parser("bench",
+        help="Run the benchmark suite on a synthetic dataset, and store the results (per commit).")
+    bm.add_argument("--tier",
+        type=str,
+        default="quick",
+        help="Benchmark tier ('quick'/'large'). [default: quick]")
+    bm.add_argument("--out",
+        type=str,
+        default="bench_results",
+        help="Results directory (results are written to <out>/<tier>/<commit>.json). [default: bench_results]")
+    bm.add_argument("--workdir",
+        type=str,
+        default=None,
+        help="Working directory of the (reused) synthetic dataset. [default: temporary directory]")
+    bm.add_argument("--select",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Names (or name prefixes, e.g. niio) of the benchmarks to run. [default: all benchmarks]")
+    bm.add_argument("--repeats",
+        type=int,
+        default=None,
+        help="Number of timed repeats. [default: that of the tier]")
+    bm.add_argument("--compare",
+        type=str,
+        default=None,
+        help="Results file (JSON) to compare against.")
+    bm.add_argument("--threshold",
+        type=float,
+        default=0.1,
+        help="Relative change above which a benchmark is reported as slower/faster. [default: 0.1]")
+    bm.set_defaults(func=bench)
+
+    # FSL tool simulator
+    fs = stages.add_parser("fslsim",
+        help="Install the FSL tool simulator (stand-in executables of topup, eddy, bet, dtifit, etc.) in a simulated FSLDIR.")
+    fs.add_argument("--fsldir",
+        type=str,
+        required=True,
+        help="Simulated FSLDIR (the executables are installed in <fsldir>/bin).")
+    fs.add_argument("--profile",
+        type=str,
+        default=None,
+        help="Latency/CPU/memory profile: instant, laptop, realistic, or a JSON file. [default: DWI_PREPROC_SIM_PROFILE, or instant]")
+    fs.add_argument("--trace",
+        type=str,
+        default=None,
+        help="JSON lines trace file of the (simulated) tool runs. [default: none]")
+    fs.set_defaults(func=fslsim)
+
+    # Structured event log (collector)
+    ev = stages.add_parser("events",
+        help="Collect the events of a pipeline run (from a named pipe) into a JSON lines log, and a Prometheus textfile.")
+    ev.add_argument("--src",
+        type=str,
+        required=True,
+        help="Input named pipe (FIFO), or file, of events. Events are collected until all of its writers close it.")
+    ev.add_argument("--log",
+        type=str,
+        required=True,
+        help="Output JSON lines event log (appended to).")
+    ev.add_argument("--subject",
+        type=str,
+        default=None,
+        help="Subject (or run) identifier, added to each event (and metric).")
+    ev.add_argument("--textfile",
+        type=str,
+        default=None,
+        help="Output Prometheus textfile (.prom), e.g. in the textfile directory of the node exporter. [default: none]")
+    ev.add_argument("--flush-interval",
+        dest="flush_interval",
+        type=float,
+        default=2.0,
+        help="Maximum time (seconds) that events are buffered before they are written. [default: 2]")
+    ev.set_defaults(func=events)
+
+    # Content hashes
+    hs = stages.add_parser("hashsum",
+        help="Hash the content of files (the decoded header and voxel data of NIFTI images), using cached hashes of unchanged files.")
+    hs.add_argument("files",
+        type=str,
+        nargs="+",
+        help="Input files.")
+    hs.add_argument("--algorithm",
+        type=str,
+        default="sha256",
+        help="Hashing algorithm (any algorithm supported by hashlib). [default: sha256]")
+    hs.add_argument("--cache-dir",
+        dest="cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the on-disk hash cache ('' disables it). [default: $DWI_PREPROC_CACHE/hashes, or ~/.cache/dwi_preproc/hashes]")
+    hs.add_argument("--threads",
+        type=int,
+        default=None,
+        help="Number of threads. [default: number of allocated cores, up to 8]")
+    hs.set_defaults(func=hashsum)
+
+    # Duplicate acquisitions
+    dd = stages.add_parser("dedup",
+        help="Find the duplicate (and near-duplicate) DWI acquisitions of a BIDS dataset, so that batch submissions can skip redundant runs.")
+    dd.add_argument("--bids-dir",
+        dest="bids_dir",
+        type=str,
+        required=True,
+        help="BIDS (raw data) directory.")
+    dd.add_argument("--out",
+        type=str,
+        required=True,
+        help="Output JSON report of the duplicate clusters.")
+    dd.add_argument("--skip-list",
+        dest="skip_list",
+        type=str,
+        default=None,
+        help="Output list of the redundant runs (one path per line).")
+    dd.add_argument("--threshold",
+        type=float,
+        default=0.999,
+        help="Minimum correlation of the sampled volumes of near-duplicates. [default: 0.999]")
+    dd.add_argument("--samples",
+        type=int,
+        default=3,
+        help="Number of (evenly spaced) volumes sampled for the correlation. [default: 3]")
+    dd.add_argument("--across-subjects",
+        dest="across_subjects",
+        action="store_true",
+        help="Also compare the acquisitions of different subjects (and sessions), e.g. to find mislabelled copies.")
+    dd.set_defaults(func=dedup)
+
+    # Integrity validation
+    va = stages.add_parser("validate",
+        help="Validate the integrity of images (gzip CRC/length, and voxel data size), b-tables and JSON sidecars, before any processing. Exits with a non-zero status if any series is invalid.")
+    va.add_argument("--bids-dir",
+        dest="bids_dir",
+        type=str,
+        default=None,
+        help="BIDS (raw data) directory, whose series (images, and their .bval, .bvec and .json sidecars) are validated.")
+    va.add_argument("--dwi",
+        type=str,
+        default=None,
+        help="Input DWI (validated with its b-table, and JSON sidecar).")
+    va.add_argument("--bvals",
+        type=str,
+        default=None,
+        help="Input b-value file of the DWI.")
+    va.add_argument("--bvecs",
+        type=str,
+        default=None,
+        help="Input b-vector file of the DWI.")
+    va.add_argument("--json",
+        type=str,
+        default=None,
+        help="Input JSON sidecar of the DWI.")
+    va.add_argument("--img",
+        type=str,
+        action="append",
+        help="Additional input image (e.g. rPE b0s). May be repeated.")
+    va.add_argument("--report",
+        type=str,
+        default=None,
+        help="Output JSON report.")
+    va.add_argument("--invalid-list",
+        dest="invalid_list",
+        type=str,
+        default=None,
+        help="Output list of the invalid images of the BIDS dataset (one path per line).")
+    va.add_argument("--cache-dir",
+        dest="cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the on-disk verdict cache ('' disables it). [default: $DWI_PREPROC_CACHE/verdicts, or ~/.cache/dwi_preproc/verdicts]")
+    va.add_argument("--threads",
+        type=int,
+        default=None,
+        help="Number of threads. [default: number of allocated cores, up to 8]")
+    va.set_defaults(func=validate)
+
+    # Staged queue
+    qu = stages.add_parser("queue",
+        help="Run a queue of subjects on node-local scratch: the inputs of the next subjects are prefetched, and outputs are written back asynchronously. Arguments after '--' are passed to dwi_preproc.sh.")
+    qu.add_argument("--jobs",
+        type=str,
+        required=True,
+        help="Queue file: one DWI per line, optionally followed by its rPE b0s.")
+    qu.add_argument("--data-dir",
+        dest="data_dir",
+        type=str,
+        required=True,
+        help="Shared data directory, to which the (local) data directory of each run is written back.")
+    qu.add_argument("--scratch",
+        type=str,
+        default=None,
+        help="Node-local scratch directory (e.g. /tmp, or /dev/shm). [default: TMPDIR, or /tmp]")
+    qu.add_argument("--prefetch",
+        type=int,
+        default=2,
+        help="Number of subjects (after the current one) whose inputs are staged in the background. [default: 2]")
+    qu.add_argument("--writeback-threads",
+        dest="writeback_threads",
+        type=int,
+        default=1,
+        help="Number of write-back threads. [default: 1]")
+    qu.add_argument("--report",
+        type=str,
+        default=None,
+        help="Output JSON report (exit status, and staging/runtime/write-back times) of the runs.")
+    qu.add_argument("--no-resume",
+        dest="no_resume",
+        action="store_true",
+        help="Run all subjects, even those completed by a previous run of the queue (their outputs are replaced).")
+    qu.add_argument("pipeline_args",
+        nargs=argparse.REMAINDER,
+        help="Arguments of dwi_preproc.sh (after '--').")
+    qu.set_defaults(func=queue)
+
+    # Early clean-up
+    rl = stages.add_parser("release",
+        help="Release (delete, or compress) the intermediates of the working directory whose (enabled) consumer stages have finished, and record the (peak) disk usage.")
+    rl.add_argument("--work",
+        type=str,
+        required=True,
+        help="Working directory.")
+    rl.add_argument("--stage",
+        type=str,
+        required=True,
+        help="Stage that finished.")
+    rl.add_argument("--stages",
+        type=str,
+        default=None,
+        help="Enabled stages (comma separated). [default: all stages]")
+    rl.add_argument("--keep",
+        type=str,
+        default=None,
+        help="Keep-list: glob patterns (comma separated, relative to the working directory) of intermediates that are compressed rather than deleted.")
+    rl.add_argument("--additional",
+        action="store_true",
+        help="The additional working directories (dwi.misc, Eddy, and Topup) are published.")
+    rl.add_argument("--measure-only",
+        dest="measure_only",
+        action="store_true",
+        help="Only record the disk usage (no intermediates are released).")
+    rl.add_argument("--quota",
+        type=str,
+        default=None,
+        help="Disk quota of the working directory (e.g. 20G). Exits with a non-zero status if it is exceeded.")
+    rl.add_argument("--ledger",
+        type=str,
+        default=None,
+        help="JSON ledger of the (peak) disk usage.")
+    rl.set_defaults(func=release)
+
+    # Native brain mask
+    bk = stages.add_parser("brainmask",
+        help="Estimate the brain mask of a (mean) b0 image natively (thresholding, morphological clean-up, largest connected component, and hole filling), as a fast alternative to bet. Outputs follow the naming of 'bet <in> <out> -m'.")
+    bk.add_argument("--img",
+        type=str,
+        required=True,
+        help="Input (mean) b0 image (4D images are averaged).")
+    bk.add_argument("--out",
+        type=str,
+        required=True,
+        help="Output brain extracted image (the mask is written to <out>_mask).")
+    bk.add_argument("--thresh-scale",
+        dest="thresh_scale",
+        type=float,
+        default=1.0,
+        help="Scale of the (Otsu) intensity threshold: larger values give smaller masks. [default: 1.0]")
+    bk.add_argument("--erode",
+        type=int,
+        default=2,
+        help="Number of erosions (and dilations) used to detach non-brain tissue. [default: 2]")
+    bk.add_argument("--ref",
+        type=str,
+        default=None,
+        help="Reference brain mask (e.g. that of bet) to compare the mask to.")
+    bk.add_argument("--overlap",
+        type=str,
+        default=None,
+        help="Output JSON file of the overlap (Dice, and Jaccard) with the reference mask.")
+    bk.set_defaults(func=brainmask)
+
+    mo = stages.add_parser("maskoverlap",
+        help="Compare a brain mask to a reference brain mask (e.g. native vs. bet): Dice, Jaccard, and volumes.")
+    mo.add_argument("--mask",
+        type=str,
+        required=True,
+        help="Input brain mask.")
+    mo.add_argument("--ref",
+        type=str,
+        required=True,
+        help="Reference brain mask.")
+    mo.add_argument("--out",
+        type=str,
+        required=True,
+        help="Output JSON file of the overlap.")
+    mo.set_defaults(func=maskoverlap)
+
+    # Publishing
+    pb = stages.add_parser("publish",
+        help="Publish files (rename/hardlink/reflink, or checksummed copy) to the output directory, and update its manifest.")
+    pb.add_argument("--outdir",
+        type=str,
+        required=True,
+        help="Output directory.")
+    pb.add_argument("--file",
+        type=str,
+        nargs=2,
+        action="append",
+        metavar=("SRC", "DST"),
+        help="Source file, and its destination (relative to the output directory). May be repeated.")
+    pb.add_argument("--tree",
+        type=str,
+        nargs=2,
+        action="append",
+        metavar=("SRC", "DST"),
+        help="Source directory, and its destination (relative to the output directory). May be repeated.")
+    pb.add_argument("--move",
+        action="store_true",
+        help="Allow the source files to be moved (renamed).")
+    pb.add_argument("--no-compress",
+        dest="no_compress",
+        action="store_true",
+        help="Do not compress uncompressed NIFTI images (.nii) of the published directories.")
+    pb.set_defaults(func=publish)
+
+    args = parser.parse_args()
+
+    # Print help message in the case
+    # of no arguments
+    if args.stage is None:
+        parser.print_help()
+        sys.exit(1)
+
+    args.func(args)
@@ -37,7 +37,7 @@ This pipeline performs the preprocessing in several stages:
 - Stage 4: Eddy current correction & bvector rotation (, if necessary - w/ FSL's eddy)
 - Stage 5: Create FA Maps and other DW image derivatives (w/ FSL's DTI-FIT) [Optional]
 - Stage 6: Quality Control is performed on the specified DW image (w/ FSL's 'eddy_quad') [Optional]
-- Stage 7: Create DTI-TK compatible DTI (Diffusion Tensor Image) files (w/ DTI-TK) [Optional]
+- Stage 7: Create DTI-TK compatible DTI (Diffusion Tensor Image) files (native conversion) [Optional]
 
 Compulsory Arguments:
 
@@ -57,11 +57,11 @@ Optional Arguments:
 -n,--nocleanup    No clean-up; subject working directory is not removed at the completion of the pipeline [Default: disabled]
 --tensor          Performs FSLs DTI-FIT to create FA Maps [Default: disabled]
 --dti-tk          Creates DTI-TK compatible image files from FSL preprocessed data. Automatically activates the '--tensor' flag
-                  NOTE: Requires DTI-TK to be installed. [Default: disabled]
+                  NOTE: The tensor image is converted natively (DTI-TK is not required). [Default: disabled]
 --qc              Perform DWI Quality Control (Requires FSL v6.0.0+) [Default: disabled]
 -f,--fsldir       FSLDIR environmental variable [Default: System defined path]
---fig             Creates vector field overlays on FA Map. NOTE: Requires FSLeyes to be installed and working. This option may be an issue on HPCs.
-                  Simply re-run the pipeline locally once finished. [Default: disabled]
+--fig             Creates vector field overlays on FA Map. NOTE: Images are rendered natively (FSLeyes is not required).
+                  [Default: disabled]
 --additional      Copies additional data to the output directory which includes:
                     - All of FSL's eddy outputs
                     - Miscellaneous DW image information
@@ -118,7 +118,7 @@ This pipeline performs the preprocessing in several stages:
 - Stage 4: Eddy current correction & bvector rotation (, if necessary - w/ FSL's eddy)
 - Stage 5: Create FA Maps and other DW image derivatives (w/ FSL's DTI-FIT) [Optional]
 - Stage 6: Quality Control is performed on the specified DW image (w/ FSL's 'eddy_quad') [Optional]
-- Stage 7: Create DTI-TK compatible DTI (Diffusion Tensor Image) files (w/ DTI-TK) [Optional]
+- Stage 7: Create DTI-TK compatible DTI (Diffusion Tensor Image) files (native conversion) [Optional]
 
 Compulsory Arguments:
 
@@ -137,7 +137,7 @@ Optional Arguments:
 --mb              Multi-band factor used [Default: 1].
 -n,--nocleanup    No clean-up; subject working directory is not removed at the completion of the pipeline [Default: disabled]
 --tensor          Performs FSLs DTI-FIT to create FA Maps [Default: disabled]
---dti-tk          Creates DTI-TK compatible image files from FSL preprocessed data. NOTE: Requires DTI-TK to be installed. [Default: disabled]
+--dti-tk          Creates DTI-TK compatible image files from FSL preprocessed data. NOTE: DTI-TK is not required. [Default: disabled]
 --qc              Perform DWI Quality Control (Requires FSL v6.0.0+) [Default: disabled]
 -f,--fsldir       FSLDIR environmental variable [Default: System defined path]
 --fig             Creates vector field overlays on FA Map [Default: disabled]
@@ -182,9 +182,11 @@ Readout Time (Computation) Arguments:
 
 Topup Specific Arguments (Should a rPE B0 be provided):
 
---config          Configuration file used for Topup. [Default: b02b0.cnf]
+--config          Configuration file used for Topup. [Default: the b02b0 configuration (subsampling schedule) that fits the image dimensions]
 --top_interp      Topup image interpolation model, 'linear' or 'spline'. [Default spline]
 --method          Modulation/Resampling method used in Topup. Valid options include 'lsr' (least-squares resampling) or 'jac' (jacobian modulation). [Default: lsr]
+--b0-select       Rank all b0s (wherever they occur in the DWI, using the bvals) and average only the most consistent b0s of each phase-encode
+                  direction for Topup. The selection is recorded in <work>/dwi.misc/b0_selection.json [Default: disabled]
 
 Eddy Arguments:
 
@@ -195,6 +197,33 @@ Eddy Arguments:
 --repol           Detect and replace outlier slices [Default: disabled]
 --cnr_maps        Write shell-wise cnr-maps [Default: disabled]
 --use-gpu         Enables GPU support of FSL's eddy and thus allows for slice-to-volume (s2v) motion correction [Default: disabled]
+--prescreen       Screens the DWI for outlier volumes (e.g. signal dropout or severe motion) prior to Eddy. The results are written 
+                  to <work>/dwi.misc/volume_screen.json [Default: disabled]
+--drop-outliers   Removes the outlier volumes (and their bvals/bvecs) flagged by the pre-screen. Automatically activates the '--prescreen' flag
+                  [Default: disabled]
+--denoise         Denoises the DWI (w/ MP-PCA) prior to Topup [Default: disabled]
+--denoise-mem     Memory limit (in MB) for the denoising worker processes [Default: 2048]
+--drift           Corrects the (global) signal drift of the DWI, using its interspersed b0s (after denoising). The drift model is written 
+                  to <work>/dwi.misc/signal_drift.json [Default: disabled]
+--drift-order     Order of the signal drift model (1: linear, 2: quadratic) [Default: 2]
+--n4              Bias field corrects the (mean) b0 (w/ ANTs' N4BiasFieldCorrection) and uses it to create the brain mask for Eddy. Should 
+                  Topup be run, the (undistorted) hifi b0 is corrected. NOTE: Requires ANTs to be installed. [Default: disabled]
+--mask-method     Brain masking method of the (mean) b0 for Eddy ('bet'/'native'). The native mask (thresholding, morphological clean-up, 
+                  largest connected component, and hole filling) takes a few seconds. [Default: bet]
+--mask-check      Also runs the other brain masking method, and records the overlap (Dice) of both masks in <work>/dwi.misc/brain_mask_overlap.json 
+                  [Default: disabled]
+--intermediate    File format of the intermediate images in the working directory ('nii.gz'/'nii'). Uncompressed ('nii') intermediates
+                  avoid compressing files that are only read once (FSLOUTPUTTYPE is set accordingly). The outputs are always compressed. [Default: nii.gz]
+--quantize        Stores raw-like intermediate images (e.g. the denoised DWI, and the b0s) as int16 with scaling (scl_slope) [Default: disabled]
+--export          Exports the preprocessed DWI, brain mask, b-table (and tensor maps) to a chunked array store for random-access analyses 
+                  ('h5'/'zarr'). NOTE: Requires the h5py or zarr python package. [Default: disabled]
+--export-chunks   Chunk shape (x,y,z,volumes) of the exported array store [Default: 16,16,16,16]
+--metrics-dir     Directory of the Prometheus textfile (dwi_preproc_<sub>.prom) of the run metrics (e.g. the textfile directory of the 
+                  node exporter). The structured (JSON lines) event log is written to <data-dir>/logs/<sub>.events.jsonl [Default: <data-dir>/logs]
+--keep            Keep-list: glob patterns (comma separated, relative to the working directory, e.g. 'Eddy/*.eddy_cnr_maps*,N4/*') of intermediates
+                  that are retained (compressed) rather than removed, both as soon as their last consumer stage finishes and at the clean-up [Default: none]
+--disk-quota      Disk quota of the working directory (e.g. 20G). Intermediates are removed as soon as their last consumer stage finishes, 
+                  and the pipeline fails should the quota be exceeded. The peak disk usage is recorded in <data-dir>/logs/<sub>.disk_usage.json [Default: none]
 
 Slice-to-volume (s2v) Arguments [Should GPU Processing be enabled]:
 
@@ -257,16 +286,77 @@ echo_blue(){
 
 exit_error(){
   echo_red "${@}"
+  log_event error 1 "" "${*}"
   exit 1
 }
 
+# Current time (UNIX time, with sub-second resolution)
+now(){
+  if [ ! -z "${EPOCHREALTIME}" ]; then
+    echo ${EPOCHREALTIME/,/.}
+  else
+    date +%s.%N
+  fi
+}
+
+# Sends a structured event to the event collector (if it is running)
+# as a single tab separated record: time, event, stage, status, start, text.
+# 
+# Usage: log_event <event> <status> <start time> <text>
+log_event(){
+  if [ -z "${eventsFd}" ]; then
+    return 0
+  elif ! kill -0 ${eventsPid} 2>/dev/null; then
+    # The collector is not running (anymore)
+    eventsFd=""
+    return 0
+  fi
+  printf '%s\t%s\t%s\t%s\t%s\t%s\n' "$(now)" "${1}" "${curStage}" "${2}" "${3}" "${4}" >&${eventsFd} 2>/dev/null || eventsFd=""
+}
+
+# Marks the start of a (named) pipeline stage: the current stage
+# ends, and the stage is added to the events of subsequent commands
+stage_begin(){
+  if [ ! -z "${curStage}" ] && [ ! -z "${releaseArgs}" ]; then
+    release_stage ${curStage}
+  fi
+  curStage=${1}
+  export DWI_PREPROC_STAGE=${curStage}
+  log_event stage_start "" "" ""
+}
+
+# Releases the intermediates of the working directory whose last consumer
+# is (or precedes) the finished stage, and records the disk usage
+# 
+# Usage: release_stage <stage>
+release_stage(){
+  run ${scriptsDir}/dwProc.py release --stage ${1} ${releaseArgs}
+}
+
+# Stops the event collector: writes the remaining events, and the metrics
+close_events(){
+  if [ ! -z "${eventsFd}" ]; then
+    eval "exec ${eventsFd}>&-"
+    eventsFd=""
+  fi
+  if [ ! -z "${eventsPid}" ]; then
+    wait ${eventsPid} 2>/dev/null || true
+    eventsPid=""
+  fi
+  if [ ! -z "${eventsFifo}" ]; then
+    rm -f ${eventsFifo}
+  fi
+}
+
 # Run and log the command
 run_cmd(){
   # stdOut=${outDir}/LogFile.txt
   # stdErr=${outDir}/ErrLog.txt
   echo_blue "${@}"
-  eval ${@} >> ${log} 2>> ${err}
-  if [ ! ${?} -eq 0 ]; then
+  local start=$(now) rc=0
+  eval ${@} >> ${log} 2>> ${err} || rc=${?}
+  log_event command ${rc} ${start} "${*}"
+  if [ ! ${rc} -eq 0 ]; then
     exit_error "${@} : command failed, see error log file for details: ${err}"
   fi
 }
@@ -277,14 +367,31 @@ run()
   # log=${outDir}/LogFile.txt
   # err=${outDir}/ErrLog.txt
   echo "${@}"
-  "${@}" >>${log} 2>>${err}
-  if [ ! ${?} -eq 0 ]; then
+  local start=$(now) rc=0
+  "${@}" >>${log} 2>>${err} || rc=${?}
+  log_event command ${rc} ${start} "${*}"
+  if [ ! ${rc} -eq 0 ]; then
     echo "failed: see log files ${log} ${err} for details"
     exit 1
   fi
   echo "-----------------------"
 }
 
+# Run and log a command whose standard output (e.g. the output
+# files of a dwProc.py stage) is read into the array: captured
+run_capture(){
+  echo "${@}"
+  local start=$(now) rc=0 out=""
+  out=$("${@}" 2>>${err}) || rc=${?}
+  echo "${out}" >>${log}
+  log_event command ${rc} ${start} "${*}"
+  if [ ! ${rc} -eq 0 ]; then
+    exit_error "${*} : command failed, see log files for details: ${log} ${err}"
+  fi
+  captured=( ${out} )
+  echo "-----------------------"
+}
+
 if [ ${#} -lt 1 ]; then
   Usage >&2
   exit 1
@@ -363,7 +470,7 @@ wfs=""
 reconMatPE=""
 qc=false
 tensor=false
-config=${FSLDIR}/etc/flirtsch/b02b0.cnf
+config=""
 scannerType="Philips"
 readTime=0.05
 FSLDIR=$(echo ${FSLDIR})
@@ -372,6 +479,23 @@ verboseLogging=false
 top_interp=spline # linear, spline
 additional=false
 fig=false
+b0Select=false
+prescreen=false
+dropOutliers=false
+denoise=false
+denoiseMem=2048
+drift=false
+driftOrder=2
+n4=false
+maskMethod=bet
+maskCheck=false
+intermediate=nii.gz
+quantize=false
+exportFmt=""
+exportChunks="16,16,16,16"
+metricsDir=""
+keepList=""
+diskQuota=""
 
 # Eddy defaults
 eddy_niter=5
@@ -422,6 +546,23 @@ while [ ${#} -gt 0 ]; do
     --s2v_interp) shift; s2v_interp=${1} ;;
     --readout) shift; readTime=${1} ;;
     --config) shift; config=${1} ;;
+    --b0-select) b0Select=true ;;
+    --prescreen) prescreen=true ;;
+    --drop-outliers) prescreen=true; dropOutliers=true ;;
+    --denoise) denoise=true ;;
+    --denoise-mem) shift; denoiseMem=${1} ;;
+    --drift) drift=true ;;
+    --drift-order) shift; driftOrder=${1} ;;
+    --n4) n4=true ;;
+    --mask-method) shift; maskMethod=${1} ;;
+    --mask-check) maskCheck=true ;;
+    --intermediate) shift; intermediate=${1} ;;
+    --quantize) quantize=true ;;
+    --export) shift; exportFmt=${1} ;;
+    --export-chunks) shift; exportChunks=${1} ;;
+    --metrics-dir) shift; metricsDir=${1} ;;
+    --keep) shift; keepList=${1} ;;
+    --disk-quota) shift; diskQuota=${1} ;;
     --use-gpu) useGPU=true ;;
     --dti-tk) dtITK=true ;;
     --additional) additional=true ;;
@@ -514,17 +655,6 @@ fi
 # Verify That Certain Options Are Available
 #==============================================================================
 
-# Check DTI-TK
-if [ ${dtITK} = "true" ]; then
-  if ! hash fsl_to_dtitk 2>/dev/null; then
-    # Check if DTI-TK is installed.
-    echo_red "ERROR: DTI-TK is not installed. Tensor conversion is not possible. Please run again, but do not use the '--dti-tk' flag."
-    run echo "ERROR: DTI-TK is not installed. Tensor conversion is not possible. Please run again, but do not use the '--dti-tk' flag."
-    exit 1
-  fi
-  DTITKscripts=$(dirname $(which fsl_to_dtitk))
-fi
-
 # Check Eddy
 if [ ${useGPU} = "true" ]; then
   # Check for each release of eddy_cuda
@@ -552,11 +682,16 @@ if [ ${useGPU} = "true" ]; then
   fi
 elif [ ${useGPU} = "false" ]; then
   # Check for each release of eddy (not eddy_correct)
+  ${FSLBIN}/eddy_cpu ; cmd_cpu=${?}
   ${FSLBIN}/eddy_openmp ; cmd_mp=${?}
   ${FSLBIN}/eddy ; cmd=${?}
 
   # Check to see if any release is availabe to use
-  if [ ${cmd_mp} -eq 1 ]; then
+  if [ ${cmd_cpu} -eq 1 ]; then
+    echo_blue "Parallel Processing Enabled"
+    run echo "Parallel Processing Enabled"
+    eddy="eddy_cpu"
+  elif [ ${cmd_mp} -eq 1 ]; then
     echo_blue "Parallel Processing Enabled"
     run echo "Parallel Processing Enabled"
     eddy="eddy_openmp"
@@ -571,15 +706,11 @@ elif [ ${useGPU} = "false" ]; then
   fi
 fi
 
-# Check FSLeyes
-if [ ${fig} = "true" ]; then
-  # Check to see if FSLeyes works from the command line
-  ${FSLBIN}/fsleyes -h; eyes=${?}
-
-  # Check if working 
-  if [ ! ${eyes} -eq 0 ]; then
-    echo_red "ERROR: FSLeyes is not available on this system via the command line. Please run the pipeline without the '--fig' option."
-    run echo "ERROR: FSLeyes is not available on this system via the command line. Please run the pipeline without the '--fig' option."
+# Check ANTs
+if [ ${n4} = "true" ]; then
+  if ! hash N4BiasFieldCorrection 2>/dev/null; then
+    echo_red "ERROR: ANTs is not installed. Bias field correction is not possible. Please run again, but do not use the '--n4' flag."
+    run echo "ERROR: ANTs is not installed. Bias field correction is not possible. Please run again, but do not use the '--n4' flag."
     exit 1
   fi
 fi
@@ -629,6 +760,16 @@ if [ ${bids} = "true" ]; then
   # Define file basenames
   dwi_files=$(remove_ext ${dwi})
 
+  # Validate the original inputs, rather than their copies (which have a new
+  # modification time), so that cached verdicts are used on subsequent runs
+  validateArgs="--dwi ${dwi} --bvals ${bvals} --bvecs ${bvecs}"
+  if [ -f ${dwi_files}.json ]; then
+    validateArgs+=" --json ${dwi_files}.json"
+  fi
+  if [ ${runTopup} = "true" ]; then
+    validateArgs+=" --img ${B0}"
+  fi
+
   # Copy over BIDS related files
   run mv ${outFile} ${work}/source/sub-${sub}_ses-${ses}_run-${run}_BIDS_info.txt
   run cp ${dwi_files}.* ${work}/source
@@ -684,11 +825,11 @@ fi
 #==============================================================================
 
 # Optional Arguments
-if [ ! -f ${config} ] || [ -z ${config} ]; then
-  echo_red "Topup configuration file was not passed as an argument or does not exist. Please check."
-  run echo "Topup configuration file was not passed as an argument or does not exist. Please check."
+if [ ! -z ${config} ] && [ ! -f ${config} ]; then
+  echo_red "Topup configuration file does not exist. Please check."
+  run echo "Topup configuration file does not exist. Please check."
   exit 1
-else
+elif [ ! -z ${config} ]; then
   config=$(realpath ${config})
 fi
 
@@ -747,6 +888,54 @@ else
   exit 1
 fi
 
+# Intermediate image format (of the working directory)
+if [ ${intermediate,,} = "nii.gz" ] || [ ${intermediate,,} = ".nii.gz" ]; then
+  iext=".nii.gz"
+  export FSLOUTPUTTYPE=NIFTI_GZ
+elif [ ${intermediate,,} = "nii" ] || [ ${intermediate,,} = ".nii" ]; then
+  iext=".nii"
+  export FSLOUTPUTTYPE=NIFTI
+else
+  echo_red "${intermediate}: Invalid argument for intermediate image format. Valid arguments include: 'nii.gz',or 'nii'."
+  run echo "${intermediate}: Invalid argument for intermediate image format. Valid arguments include: 'nii.gz',or 'nii'."
+  exit 1
+fi
+
+# Intermediate image policy of the native (python) stages
+export DWI_PREPROC_INTERMEDIATE=${iext#.}
+if [ ${quantize} = "true" ]; then
+  export DWI_PREPROC_QUANTIZE=1
+else
+  export DWI_PREPROC_QUANTIZE=0
+fi
+
+# Chunked array store export format
+if [ ! -z ${exportFmt} ]; then
+  if [ ${exportFmt,,} = "h5" ] || [ ${exportFmt,,} = "zarr" ]; then
+    exportFmt=${exportFmt,,}
+  else
+    echo_red "${exportFmt}: Invalid argument for export format. Valid arguments include: 'h5',or 'zarr'."
+    run echo "${exportFmt}: Invalid argument for export format. Valid arguments include: 'h5',or 'zarr'."
+    exit 1
+  fi
+fi
+
+# Signal drift model order
+if [ ${driftOrder} != "1" ] && [ ${driftOrder} != "2" ]; then
+  echo_red "${driftOrder}: Invalid argument for signal drift model order. Valid arguments include: '1',or '2'."
+  run echo "${driftOrder}: Invalid argument for signal drift model order. Valid arguments include: '1',or '2'."
+  exit 1
+fi
+
+# Brain masking method
+if [ ${maskMethod,,} = "bet" ] || [ ${maskMethod,,} = "native" ]; then
+  maskMethod=${maskMethod,,}
+else
+  echo_red "${maskMethod}: Invalid argument for brain masking method. Valid arguments include: 'bet',or 'native'."
+  run echo "${maskMethod}: Invalid argument for brain masking method. Valid arguments include: 'bet',or 'native'."
+  exit 1
+fi
+
 if [ ! -z ${etl} ]; then
   if ! [[ "${etl}" =~ ^[0-9]+$ ]]; then
           echo_red "ETL argument requires integers only [1-9999999]"
@@ -880,6 +1069,13 @@ if [ ${bids} = "false" ]; then
     run mkdir -p ${work}/source
   fi
 
+  # Validate the original inputs, rather than their copies (which have a new
+  # modification time), so that cached verdicts are used on subsequent runs
+  validateArgs="--dwi ${dwi} --bvals ${bvals} --bvecs ${bvecs}"
+  if [ ${runTopup} = "true" ]; then
+    validateArgs+=" --img ${B0}"
+  fi
+
   # copy files to working directory
   run cp ${dwi} ${work}/source
   run cp ${bvals} ${work}/source
@@ -919,11 +1115,53 @@ unset log err
 log=${dataDir}/logs/${subID}.log
 err=${dataDir}/logs/${subID}.err
 
+# Structured (JSON lines) event log and Prometheus textfile metrics: events
+# are sent to a (local) named pipe, and are written (in batches) by a 
+# background collector, so that logging does not block on network storage
+if [ -z ${metricsDir} ]; then
+  metricsDir=${dataDir}/logs
+fi
+
+run mkdir -p ${metricsDir}
+
+eventsFifo=${TMPDIR:-/tmp}/dwi_preproc.${subID}.$$.events
+rm -f ${eventsFifo}
+mkfifo ${eventsFifo}
+${scriptsDir}/dwProc.py events --src ${eventsFifo} --log ${dataDir}/logs/${subID}.events.jsonl --subject ${subID} \
+  --textfile ${metricsDir}/dwi_preproc_${subID}.prom >>${log} 2>>${err} &
+eventsPid=${!}
+# NOTE: The pipe is opened for reading and writing, so that this does not
+#   block should the collector fail to start
+exec 9<>${eventsFifo}
+eventsFd=9
+export DWI_PREPROC_EVENTS=${eventsFifo}
+trap close_events EXIT
+
+# Dependency-aware (early) clean-up: intermediates of the working directory are
+# released as soon as their last (enabled) consumer stage finishes, unless the
+# keep-list (or --additional) needs them, and the peak disk usage is recorded
+enabledStages="gather,acqparams,eddy,publish,cleanup"
+if [ ${prescreen} = "true" ]; then enabledStages+=",prescreen"; fi
+if [ ${denoise} = "true" ]; then enabledStages+=",denoise"; fi
+if [ ${drift} = "true" ]; then enabledStages+=",drift"; fi
+if [ ${runTopup} = "true" ]; then enabledStages+=",b0s,topup"; fi
+if [ ${tensor} = "true" ]; then enabledStages+=",dtifit"; fi
+if [ ${qc} = "true" ]; then enabledStages+=",qc"; fi
+if [ ${dtITK} = "true" ]; then enabledStages+=",dtitk"; fi
+
+releaseArgs="--work ${work} --stages ${enabledStages} --ledger ${dataDir}/logs/${subID}.disk_usage.json"
+if [ ${cleanup} = "false" ]; then releaseArgs+=" --measure-only"; fi
+if [ ${additional} = "true" ]; then releaseArgs+=" --additional"; fi
+if [ ! -z ${keepList} ]; then releaseArgs+=" --keep ${keepList}"; fi
+if [ ! -z ${diskQuota} ]; then releaseArgs+=" --quota ${diskQuota}"; fi
+
 #
 # DWI Preprocessing: Stage 0 - Gather (BIDS related) Files & Compute
 # DWI/EPI related Variables
 #==============================================================================
 
+stage_begin gather
+
 cd ${work}
 
 # Create directory to store miscellaneous files
@@ -932,6 +1170,10 @@ if [ ! -d ${work}/dwi.misc ]; then
   run mkdir -p ${work}/dwi.misc
 fi
 
+# Validate the integrity of the inputs (e.g. truncated images from interrupted
+# transfers), and the consistency of the b-table, before the (long) processing stages
+run ${scriptsDir}/dwProc.py validate ${validateArgs} --report ${work}/dwi.misc/input_validation.json
+
 if [ ${bids} = "true" ]; then
 
   run cd ${work}/dwi.misc
@@ -968,10 +1210,75 @@ elif [ ${bids} = "false" ]; then
   outDir=${outDir}/sub-${sub}/dwi_run-${run}
 fi
 
+#
+# DWI Preprocessing: Pre-Screen - Volume Outlier Screening [Optional]
+#==============================================================================
+
+stage_begin prescreen
+
+if [ ${prescreen} = "true" ] && [ ! -f ${outDir}/${subID}_dwi.nii.gz ]; then
+  if [ ! -d ${work}/Screen ]; then
+    echo_blue "Making Screen Directory"
+    run mkdir -p ${work}/Screen
+  fi
+
+  screenArgs=""
+  if [ ${dropOutliers} = "true" ]; then
+    screenArgs="--drop"
+  fi
+
+  # Screened DWI, bvals, and bvecs (unchanged unless outliers are dropped)
+  echo_blue "Screening DWI for outlier volumes"
+  run_capture ${scriptsDir}/dwProc.py prescreen --dwi ${dwi} --bvals ${bvals} --bvecs ${bvecs} --outdir ${work}/Screen --report ${work}/dwi.misc/volume_screen.json ${screenArgs}
+  dwi=${captured[0]}
+  bvals=${captured[1]}
+  bvecs=${captured[2]}
+fi
+
+#
+# DWI Preprocessing: Denoise - MP-PCA Denoising [Optional]
+#==============================================================================
+
+stage_begin denoise
+
+if [ ${denoise} = "true" ] && [ ! -f ${outDir}/${subID}_dwi.nii.gz ]; then
+  if [ ! -d ${work}/Denoise ]; then
+    echo_blue "Making Denoise Directory"
+    run mkdir -p ${work}/Denoise
+  fi
+
+  # Denoised DWI, and noise (sigma) map
+  echo_blue "Denoising DWI"
+  run_capture ${scriptsDir}/dwProc.py denoise --dwi ${dwi} --outdir ${work}/Denoise --mem ${denoiseMem}
+  dwi=${captured[0]}
+fi
+
+#
+# DWI Preprocessing: Drift - Signal Drift Correction [Optional]
+#==============================================================================
+
+stage_begin drift
+
+if [ ${drift} = "true" ] && [ ! -f ${outDir}/${subID}_dwi.nii.gz ]; then
+  if [ ! -d ${work}/Drift ]; then
+    echo_blue "Making Drift Directory"
+    run mkdir -p ${work}/Drift
+  fi
+
+  # Drift corrected DWI, and drift model
+  # NOTE: The eddy brain mask is not available yet (it is created after topup),
+  #   so the drift model is fitted within the brain mask of the mean b0
+  echo_blue "Correcting DWI signal drift"
+  run_capture ${scriptsDir}/dwProc.py drift --dwi ${dwi} --bvals ${bvals} --outdir ${work}/Drift --order ${driftOrder} --model ${work}/dwi.misc/signal_drift.json
+  dwi=${captured[0]}
+fi
+
 #
 # DWI Preprocessing: Stage 1 - Make PE-rPE B0s File
 #==============================================================================
 
+stage_begin b0s
+
 cd ${work}
 
 if [ ! -f ${outDir}/${subID}_dwi.nii.gz ]; then
@@ -1004,9 +1311,11 @@ if [ ! -f ${outDir}/${subID}_dwi.nii.gz ]; then
       run mkdir -p ${work}/Topup/tmp_align; cd ${work}/Topup/tmp_align
       run flirt -in ${B0} -ref ${work}/Topup/B0s_PA_num-${numB0s} -omat b02dwi.aff.mat -dof 12
       run aff2rigid b02dwi.aff.mat b02dwi.rigid.mat
-      run applywarp --in=${B0} --out=b02dwi.rigid.nii.gz --ref=${work}/Topup/B0s_PA_num-${numB0s} --premat=b02dwi.rigid.mat
+      run applywarp --in=${B0} --out=b02dwi.rigid${iext} --ref=${work}/Topup/B0s_PA_num-${numB0s} --premat=b02dwi.rigid.mat
       run rm ${B0}
-      run mv b02dwi.rigid.nii.gz ${B0}
+      # applywarp writes the intermediate extension, which need not match that of the B0
+      B0=$(remove_ext ${B0})${iext}
+      run mv b02dwi.rigid${iext} ${B0}
       run cd ${work}/Topup
       run rm -rf ${work}/Topup/tmp_align
       # Disable FSL's python environment
@@ -1014,10 +1323,15 @@ if [ ! -f ${outDir}/${subID}_dwi.nii.gz ]; then
     fi
 
     # Merge B0s
-    run ${FSLBIN}/fslmaths ${B0} -Tmean ${work}/Topup/mean_B0s_AP.nii.gz
-    run ${FSLBIN}/fslmaths ${work}/Topup/B0s_PA_num-${numB0s}.nii.gz  -Tmean ${work}/Topup/mean_B0s_PA.nii.gz
-    # run ${FSLBIN}/fslmerge -t ${work}/Topup/B0s ${work}/Topup/mean_B0s_PA.nii.gz ${B0}
-    run ${FSLBIN}/fslmerge -t ${work}/Topup/B0s ${work}/Topup/mean_B0s_PA.nii.gz ${work}/Topup/mean_B0s_AP.nii.gz
+    if [ ${b0Select} = "true" ]; then
+      # Average the most consistent B0s of each PE direction
+      run ${scriptsDir}/dwProc.py b0select --dwi ${dwi} --bvals ${bvals} --b0 ${B0} --out ${work}/Topup/B0s${iext} --qc ${work}/dwi.misc/b0_selection.json
+    else
+      run ${FSLBIN}/fslmaths ${B0} -Tmean ${work}/Topup/mean_B0s_AP${iext}
+      run ${FSLBIN}/fslmaths ${work}/Topup/B0s_PA_num-${numB0s}${iext}  -Tmean ${work}/Topup/mean_B0s_PA${iext}
+      # run ${FSLBIN}/fslmerge -t ${work}/Topup/B0s ${work}/Topup/mean_B0s_PA.nii.gz ${B0}
+      run ${FSLBIN}/fslmerge -t ${work}/Topup/B0s ${work}/Topup/mean_B0s_PA${iext} ${work}/Topup/mean_B0s_AP${iext}
+    fi
 
     cd ${work}
   fi
@@ -1028,6 +1342,8 @@ fi
 # Files (Used in Topup & Eddy)
 #==============================================================================
 
+stage_begin acqparams
+
 # Calculate Readout Time
 # Unless the Readout Time is
 # already given or
@@ -1083,23 +1399,46 @@ run ${scriptsDir}/dwInfo.py --info idx --dwi ${dwi} --idx ${idx}
 # Correction (w/ Topup)
 #==============================================================================
 
+stage_begin topup
+
 if [ ! -f ${outDir}/${subID}_dwi.nii.gz ]; then
   if [ ${runTopup} = "true" ]; then
     # Perform Field Distortion Estimation
     run cd ${work}/Topup
 
     # Run Topup
-    run ${FSLBIN}/topup --imain=${work}/Topup/B0s --datain=${param} --config=${FSLDIR}/etc/flirtsch/b02b0.cnf --out=${work}/Topup/suscept_corr_B0 --fout=${work}/Topup/suscept_field_Hz --iout=${work}/Topup/unwarped_B0s --scale=1 --verbose
+    # NOTE: The b02b0 configuration (subsampling schedule) is selected by dwProc.py topup
+    #   (unless --config is provided), and the b0s are padded to fit it should their
+    #   dimensions not be divisible by its subsampling levels (the fieldmap and corrected
+    #   b0s are restored to the original image grid, and applytopup and eddy are fit to
+    #   the same grid).
+    topupArgs=""
+    if [ ! -z ${config} ]; then
+      topupArgs="--config ${config}"
+    fi
+
+    run ${scriptsDir}/dwProc.py topup --img ${work}/Topup/B0s${iext} --acqp ${param} --outdir ${work}/Topup \
+      --out ${work}/Topup/suscept_corr_B0 --fout ${work}/Topup/suscept_field_Hz --iout ${work}/Topup/unwarped_B0s ${topupArgs} --verbose
 
     # split B0s used for topup
-    run ${FSLBIN}/fslsplit ${work}/Topup/B0s.nii.gz diff_B0 -t
+    run ${FSLBIN}/fslsplit ${work}/Topup/B0s${iext} diff_B0 -t
 
     # Rename B0s
-    run mv diff_B0*0.nii.gz B0_PA.nii.gz
-    run mv diff_B0*1.nii.gz B0_AP.nii.gz
+    run mv diff_B0*0${iext} B0_PA${iext}
+    run mv diff_B0*1${iext} B0_AP${iext}
 
     # Apply Topup
-    run ${FSLBIN}/applytopup --imain=B0_PA.nii.gz,B0_AP.nii.gz --datain=${param} --inindex=1,2 --topup=${work}/Topup/suscept_corr_B0 --method=lsr --out=${work}/Topup/hifi --verbose
+    run ${scriptsDir}/dwProc.py applytopup --imain B0_PA${iext},B0_AP${iext} --acqp ${param} --inindex 1,2 \
+      --topup ${work}/Topup/suscept_corr_B0 --method lsr --out ${work}/Topup/hifi${iext} --verbose
+
+    # Bias field correct the (undistorted) hifi b0, which the eddy brain mask is
+    # created from (so that the mask matches the geometry of the topup corrected data).
+    # NOTE: N4 is run after (not concurrently with) topup, as it requires the hifi b0,
+    #   and the number of threads is selected (allocated cores) by dwProc.py n4.
+    if [ ${n4} = "true" ]; then
+      run mkdir -p ${work}/N4
+      run ${scriptsDir}/dwProc.py n4 --img ${work}/Topup/hifi${iext} --outdir ${work}/N4
+    fi
 
     run cd ${work}
   fi
@@ -1109,6 +1448,8 @@ fi
 # DWI Preprocessing: Stage 4 - DWI Eddy Current Correction (w/ Eddy)
 #==============================================================================
 
+stage_begin eddy
+
 if [ ! -f ${outDir}/${subID}_dwi.nii.gz ] && [ ! -f ${outDir}/${subID}_dwi.bvec ]; then
   # Make Eddy working directory
   if [ ! -d ${work}/Eddy ]; then
@@ -1125,81 +1466,86 @@ if [ ! -f ${outDir}/${subID}_dwi.nii.gz ] && [ ! -f ${outDir}/${subID}_dwi.bvec
     run ${FSLBIN}/fslroi ${dwi} ${work}/Eddy/B0s_PA_num-${numB0s} --tmin ${numB0s}
 
     # Take Mean of B0s
-    run ${FSLBIN}/fslmaths ${work}/Eddy/B0s_PA_num-${numB0s}.nii.gz  -Tmean ${work}/Eddy/mean_B0s_PA.nii.gz
+    run ${FSLBIN}/fslmaths ${work}/Eddy/B0s_PA_num-${numB0s}${iext}  -Tmean ${work}/Eddy/mean_B0s_PA${iext}
 
-    # Create Brain Mask
-    run bet ${work}/Eddy/mean_B0s_PA ${work}/Eddy/${subID}_hifi_brain -m -R
+    # Bias field correct the mean B0 (number of threads selected by dwProc.py n4)
+    if [ ${n4} = "true" ]; then
+      run mkdir -p ${work}/N4
+      run ${scriptsDir}/dwProc.py n4 --img ${work}/Eddy/mean_B0s_PA${iext} --outdir ${work}/N4
+    fi
+  fi
+
+  # Create Brain Mask
+  if [ ${runTopup} = "true" ] && [ ${n4} = "true" ]; then
+    maskSrc=${work}/N4/hifi_n4
   elif [ ${runTopup} = "true" ]; then
-    # Create Brain Mask
-    run bet ${work}/Topup/hifi ${work}/Eddy/${subID}_hifi_brain -m -R
+    maskSrc=${work}/Topup/hifi
+  elif [ ${n4} = "true" ]; then
+    maskSrc=${work}/N4/mean_B0s_PA_n4
+  else
+    maskSrc=${work}/Eddy/mean_B0s_PA
   fi
 
-  # Define eddy as a function depending on whether GPU is enabled
+  if [ ${maskMethod} = "native" ]; then
+    run ${scriptsDir}/dwProc.py brainmask --img ${maskSrc}${iext} --out ${work}/Eddy/${subID}_hifi_brain
+  else
+    run bet ${maskSrc} ${work}/Eddy/${subID}_hifi_brain -m -R
+  fi
+
+  # Compare the brain mask to that of the other method
+  if [ ${maskCheck} = "true" ]; then
+    run mkdir -p ${work}/Eddy/MaskCheck
+    if [ ${maskMethod} = "native" ]; then
+      run bet ${maskSrc} ${work}/Eddy/MaskCheck/${subID}_bet_brain -m -R
+      checkMask=${work}/Eddy/MaskCheck/${subID}_bet_brain_mask${iext}
+    else
+      run ${scriptsDir}/dwProc.py brainmask --img ${maskSrc}${iext} --out ${work}/Eddy/MaskCheck/${subID}_native_brain
+      checkMask=${work}/Eddy/MaskCheck/${subID}_native_brain_mask${iext}
+    fi
+    run ${scriptsDir}/dwProc.py maskoverlap --mask ${work}/Eddy/${subID}_hifi_brain_mask${iext} --ref ${checkMask} \
+      --out ${work}/dwi.misc/brain_mask_overlap.json
+  fi
+
+  # Eddy options (validated, and the eddy executable and number
+  # of threads selected, by dwProc.py eddy)
+  eddyArgs="--niter ${eddy_niter} --fwhm ${eddy_fwhm} --interp ${eddy_interp} --nvoxhp 5000 --ol-type both --ol-nstd 3"
+
   if [ ${useGPU} = "true" ]; then
-    # Define Eddy function
-    # eddy () { ${FSLBIN}/${eddy} "${@}" ; }
-    # eddy_corr+="eddy "
-    eddy_corr+="${FSLBIN}/${eddy} "
+    eddyArgs+=" --use-gpu"
     if [ ${mporder} -gt 0 ]; then
-      # Determine if slice-to-volume (s2v) is used
-      s2vArg=( mporder s2v_niter s2v_lambda s2v_interp slspec )
-      s2vVar=( ${mporder} ${s2v_niter} ${s2v_lambda} ${s2v_interp} ${slspec} )
-      for ((i = 0; i < ${#s2vArg[@]}; i++)); do
-        eddy_corr+="--${s2vArg[$i]}=${s2vVar[$i]} "
-      done
+      # Slice-to-volume (s2v) motion correction
+      eddyArgs+=" --mporder ${mporder} --s2v-niter ${s2v_niter} --s2v-lambda ${s2v_lambda} --s2v-interp ${s2v_interp} --slspec ${slspec}"
     fi
-  elif [ ${useGPU} = "false" ]; then
-    # Define Eddy function
-    # eddy () { ${FSLBIN}/${eddy} "${@}" ; }
-    # eddy_corr+="eddy "
-    eddy_corr+="${FSLBIN}/${eddy} "
   fi
 
   # Main Eddy Arguments/Parameters
   if [ ${runTopup} = "true" ]; then
     out_dwi=${work}/Eddy/${subID}_eddy_dist_corr
-    # eddy_corr+="--topup=${work}/Topup/suscept_corr_B0 "
-    eddy_corr+="--topup=${work}/Topup/suscept_corr_B0 --estimate_move_by_susceptibility --mbs_niter=20 --mbs_ksp=10 --mbs_lambda=10 "
+    eddyArgs+=" --topup ${work}/Topup/suscept_corr_B0 --mbs"
   else
     out_dwi=${work}/Eddy/${subID}_eddy_corr
   fi
 
-  eddy_corr+="--imain=${dwi}  --bvecs=${bvecs} --bvals=${bvals} " # DWI specific files
-  eddy_corr+="--mask=${work}/Eddy/${subID}_hifi_brain_mask --acqp=${param} --index=${idx} " # DWI mask and parameter files
-  eddy_corr+="--out=${out_dwi} --verbose "
-
   # (Additional) Eddy Specific Optional Arguments/Parameters
-  if [[ ! -z ${eddy_niter} ]]; then
-    eddy_corr+="--niter=${eddy_niter} "
-  fi
-
-  if [[ ! -z ${eddy_fwhm} ]]; then
-    eddy_corr+="--fwhm=${eddy_fwhm} "
-  fi
-
-  if [ ! -z ${eddy_interp} ]; then
-    eddy_corr+="--interp=${eddy_interp} "
-  fi
-
   if [ ${eddy_residuals} = "true" ]; then
-    eddy_corr+="--residuals "
+    eddyArgs+=" --residuals"
   fi
 
   # Replace outliers
   if [ ${eddy_repol} = "true" ]; then
-    eddy_corr+="--repol "
+    eddyArgs+=" --repol"
   fi
 
   if [ ${eddy_cnr} = "true" ]; then
-    eddy_corr+="--cnr_maps "
+    eddyArgs+=" --cnr-maps"
   fi
 
   # Perform Eddy Current & Motion Correction
-  # run ${eddy_corr}
-  run ${eddy_corr} --nvoxhp=5000 --ol_type=both  --ol_nstd=3 # --very_verbose --dont_mask_output
-
-  bvec=$(ls *rotated_bvecs*)
-  bvec=$(realpath ${bvec})
+  # NOTE: eddy is not run again if a complete set of outputs 
+  #   exists for the same inputs and options (e.g. an interrupted batch)
+  echo_blue "Performing eddy current and motion correction"
+  run_capture ${scriptsDir}/dwProc.py eddy --dwi ${dwi} --bvals ${bvals} --bvecs ${bvecs} --mask ${work}/Eddy/${subID}_hifi_brain_mask${iext} --acqp ${param} --idx ${idx} --out ${out_dwi} --verbose ${eddyArgs}
+  bvec=${captured[1]}
 elif [ -f ${outDir}/${subID}_dwi.nii.gz ] && [ -f ${outDir}/${subID}_dwi.bvec ]; then
   out_dwi=${outDir}/${subID}_dwi
   bvec=${outDir}/${subID}_dwi.bvec
@@ -1209,6 +1555,8 @@ fi
 # DWI Preprocessing: Stage 5 - Create FA Maps & Associated Data (w/ DTI-FIT)
 #==============================================================================
 
+stage_begin dtifit
+
 if [ ${tensor} = "true" ] && [ ! -d ${outDir}/Tensor ]; then
   # Make output directory
   if [ ! -d ${work}/Tensor ]; then
@@ -1268,10 +1616,12 @@ fi
 # fi
 
 #
-# DWI Preprocessing: Stage 8 - Copy Files From Working Directory 
-# to Output Directory
+# DWI Preprocessing: Stage 8 - Publish Files From Working Directory 
+# to Output Directory (rename/hardlink/reflink, or checksummed copy)
 #==============================================================================
 
+stage_begin publish
+
 run cd ${work}
 
 if [ ${bids} = "true" ]; then
@@ -1285,11 +1635,12 @@ if [ ${bids} = "true" ]; then
   fi
 
   if [ ! -f ${outDir}/${subID}_dwi.nii.gz ] && [ ! -f ${outDir}/${subID}_dwi.bvec ]; then
-    # Copy preprocessed DW image associated files to output directory
-    run cp ${bvals} ${outDir}/${subID}_dwi.bval
-    run cp ${bvec} ${outDir}/${subID}_dwi.bvec
-    run cp ${out_dwi}.nii.gz ${outDir}/${subID}_dwi.nii.gz
-    run cp ${dwi_json} ${outDir}/${subID}_dwi.json
+    # Publish preprocessed DW image associated files to output directory
+    run ${scriptsDir}/dwProc.py publish --outdir ${outDir} \
+      --file ${bvals} ${subID}_dwi.bval \
+      --file ${bvec} ${subID}_dwi.bvec \
+      --file ${out_dwi}${iext} ${subID}_dwi.nii.gz \
+      --file ${dwi_json} ${subID}_dwi.json
   fi
 elif [ ${bids} = "false" ]; then
   # Define output directory
@@ -1302,10 +1653,11 @@ elif [ ${bids} = "false" ]; then
   fi
 
   if [ ! -f ${outDir}/${subID}_dwi.nii.gz ] && [ ! -f ${outDir}/${subID}_dwi.bvec ]; then
-    # Copy preprocessed DW image associated files to output directory
-    run cp ${bvals} ${outDir}/${subID}_dwi.bval
-    run cp ${bvec} ${outDir}/${subID}_dwi.bvec
-    run cp ${out_dwi}.nii.gz ${outDir}/${subID}_dwi.nii.gz
+    # Publish preprocessed DW image associated files to output directory
+    run ${scriptsDir}/dwProc.py publish --outdir ${outDir} \
+      --file ${bvals} ${subID}_dwi.bval \
+      --file ${bvec} ${subID}_dwi.bvec \
+      --file ${out_dwi}${iext} ${subID}_dwi.nii.gz
   fi
 fi
 
@@ -1330,14 +1682,28 @@ fi
 # fi
 
 if [ ${tensor} = "true" ] && [ ! -d ${outDir}/Tensor ]; then
-  run cp -r ${work}/Tensor ${outDir}
+  # Uncompressed intermediates are compressed as they are published
+  run ${scriptsDir}/dwProc.py publish --outdir ${outDir} --tree ${work}/Tensor Tensor
+fi
+
+if [ ! -z ${exportFmt} ] && [ ! -e ${outDir}/${subID}_dwi.${exportFmt} ]; then
+  # Export to a chunked array store (voxel time-series and per-volume reads)
+  exportArgs=""
+  if [ -f ${work}/Eddy/${subID}_hifi_brain_mask${iext} ]; then
+    exportArgs="--mask ${work}/Eddy/${subID}_hifi_brain_mask${iext}"
+  fi
+  if [ ${tensor} = "true" ]; then
+    for map in FA MD L1 L2 L3 MO S0; do
+      exportArgs="${exportArgs} --map ${map} ${outDir}/Tensor/${fit}_${map}.nii.gz"
+    done
+  fi
+  run ${scriptsDir}/dwProc.py export --dwi ${outDir}/${subID}_dwi.nii.gz --bvals ${outDir}/${subID}_dwi.bval --bvecs ${outDir}/${subID}_dwi.bvec \
+    --chunks ${exportChunks} --out ${outDir}/${subID}_dwi.${exportFmt} ${exportArgs}
 fi
 
 if [ ${fig} = "true" ] && [ ${tensor} = "true" ]; then
-  ov1="fsleyes render --scene=ortho -hc -of=${outDir}/Tensor/${subID}_FA_ortho.png ${outDir}/Tensor/${fit}_FA.nii.gz ${outDir}/Tensor/${fit}_V1.nii.gz -ot rgbvector"   # Overlay with orthongal views
-  ov2="fsleyes render --scene=lightbox -hc -of=${outDir}/Tensor/${subID}_FA_lightbox.png ${outDir}/Tensor/${fit}_FA.nii.gz ${outDir}/Tensor/${fit}_V1.nii.gz -ot rgbvector"  # Overlay with lightbox view
-  run ${ov1} & # Create FA map Overlays
-  run ${ov2} & # Create FA map Overlays
+  # Create FA map (V1 RGB) overlays (ortho and lightbox views)
+  run ${scriptsDir}/dwProc.py qcimg --out-name ${outDir}/Tensor/${subID} --fa ${outDir}/Tensor/${fit}_FA.nii.gz --v1 ${outDir}/Tensor/${fit}_V1.nii.gz
 fi
 
 # if [ ${dtITK} = "true" ] && [ ! -d ${outDir}/DTI-TK ]; then
@@ -1345,21 +1711,23 @@ fi
 # fi
 
 if [ ${additional} = "true" ] && [ ! -d ${outDir}/dwi.misc ] && [ -d ${work}/dwi.misc ]; then
-  run cp -r ${work}/dwi.misc ${outDir}
+  run ${scriptsDir}/dwProc.py publish --outdir ${outDir} --tree ${work}/dwi.misc dwi.misc
 fi
 
 if [ ${additional} = "true" ] && [ ! -d ${outDir}/Eddy ] && [ -d ${work}/Eddy ]; then
-  run cp -r ${work}/Eddy ${outDir}
+  run ${scriptsDir}/dwProc.py publish --outdir ${outDir} --tree ${work}/Eddy Eddy
 fi
 
 if [ ${additional} = "true" ] && [ ${runTopup} = "true" ] && [ ! -d ${outDir}/Topup ] && [ -d ${work}/Topup ]; then
-  run cp -r ${work}/Topup ${outDir}
+  run ${scriptsDir}/dwProc.py publish --outdir ${outDir} --tree ${work}/Topup Topup
 fi
 
 #
 # DWI Preprocessing: Stage 6 - QC (eddy_quad)
 #==============================================================================
 
+stage_begin qc
+
 # Enable FSL's python environment
 source ${FSLDIR}/fslpython/bin/activate
 
@@ -1374,54 +1742,52 @@ elif [ ${qc} = "true" ] && [ ! -d ${outDir}/Eddy.qc ] && [ ${runTopup} = "false"
   run ${FSLBIN}/eddy_quad ${out_dwi} --eddyIdx ${idx} --eddyParams ${param} --mask ${work}/Eddy/${subID}_hifi_brain_mask --bvals ${bvals} --bvecs ${bvec} --output-dir ${work}/Eddy.qc --slspec ${slspec}
 fi
 
-# Copy Option Specific directories to output directory
+# Native (eddy_quad equivalent) QC metrics - used for cohort-level comparisons
 if [ ${qc} = "true" ] && [ ! -d ${outDir}/Eddy.qc ]; then
-  run cp -r ${work}/Eddy.qc ${outDir}
+  mkdir -p ${work}/Eddy.qc
+  run ${scriptsDir}/dwProc.py eddyqc --eddy ${out_dwi} --bvals ${bvals} --mask ${work}/Eddy/${subID}_hifi_brain_mask${iext} --out ${work}/Eddy.qc/${subID}_eddy_metrics.json
+fi
+
+# Publish Option Specific directories to output directory
+if [ ${qc} = "true" ] && [ ! -d ${outDir}/Eddy.qc ]; then
+  run ${scriptsDir}/dwProc.py publish --outdir ${outDir} --tree ${work}/Eddy.qc Eddy.qc
 fi
 
 # Disable FSL's python environment
 conda deactivate
 
 #
-# DWI Preprocessing: Stage 7 - Create DTI-TK Images (DTI-TK)
+# DWI Preprocessing: Stage 7 - Create DTI-TK Images (native conversion)
 #==============================================================================
 
+stage_begin dtitk
+
 if [ ${dtITK} = "true" ] && [ ! -d ${outDir}/DTI-TK ]; then
-  # Uses DTI-TK to convert
-  # FSL FA maps and eigenvectors
-  # to DTI-TK's format.
-  if [ ! -d ${outDir}/DTI-TK ]; then
+  # Natively converts FSL's (dtifit) tensor image
+  # to DTI-TK's format (DTI-TK is not required).
+  if [ ! -d ${work}/DTI-TK ]; then
     echo_blue "Making Subject DTI-TK Directory"
-    run mkdir -p ${outDir}/DTI-TK
+    run mkdir -p ${work}/DTI-TK
   fi
 
-  run cd ${outDir}/Tensor
-  files=( $(ls *${fit}*.nii*) )
-
-  for file in ${files[@]}; do
-    run cp -r ${file} ${outDir}/DTI-TK
-  done
-
-  run cd ${outDir}/DTI-TK
-  run ${DTITKscripts}/fsl_to_dtitk ${fit}
-
-  for file in ${files[@]}; do
-    run rm ${file}
-  done
-fi
-
-if [ ${dtITK} = "true" ] && [ ! -d ${outDir}/DTI-TK ]; then
-  run cp -r ${work}/DTI-TK ${outDir}
+  run ${scriptsDir}/dwProc.py dtitk --tensor ${outDir}/Tensor/${fit}_tensor.nii.gz --out ${work}/DTI-TK/${fit}_dtitk.nii.gz
+  run ${scriptsDir}/dwProc.py publish --outdir ${outDir} --tree ${work}/DTI-TK DTI-TK
 fi
 
 #
 # DWI Preprocessing: Stage 9 - Clean-up (Remove subject working directory)
 #==============================================================================
 
+stage_begin cleanup
+
 if [ ${cleanup} = "true" ]; then
   echo_blue "Removing subject working directory"
-  run rm -rf ${work}
 fi
 
+# Remove the remaining files of the working directory (except those of
+# the keep-list), and record the final disk usage
+release_stage cleanup
+
 echo "dwi_preproc completed for sub-${sub}" >> ${log}
+log_event completed 0 "" "sub-${sub}"
 echo_green "dwi_preproc completed for sub-${sub}"
@@ -56,6 +56,31 @@ s2v_lambda=1
 wall=1000
 mem=10000
 
+# Redundant (duplicate) runs to skip, written by:
+#   dwProc.py dedup --bids-dir ${source} --out ${scripts_dir}/misc.info/dwi.data.info/duplicates.json --skip-list ${skip_list}
+skip_list=${scripts_dir}/misc.info/dwi.data.info/duplicates.skip.txt
+
+is_redundant(){
+  [ -f ${skip_list} ] && grep -qxF "${1}" ${skip_list}
+}
+
+# Invalid (truncated/corrupt, or inconsistent) runs to skip, written by:
+#   dwProc.py validate --bids-dir ${source} --report ${scripts_dir}/misc.info/dwi.data.info/validation.json --invalid-list ${invalid_list}
+invalid_list=${scripts_dir}/misc.info/dwi.data.info/invalid.txt
+
+is_invalid(){
+  [ -f ${invalid_list} ] && grep -qxF "${1}" ${invalid_list}
+}
+
+# Staged queues: each b-value group is run as a single job (on one node), rather
+# than one job per subject. The inputs of the next subjects are prefetched to
+# node-local scratch, and outputs are written back asynchronously (see dwProc.py queue)
+staged=false
+prefetch=2
+queue_800=${scripts_dir}/misc.info/dwi.data.info/b800.queue.txt
+queue_2000=${scripts_dir}/misc.info/dwi.data.info/b2000.queue.txt
+rm -f ${queue_800} ${queue_2000}
+
 # create arrays
 mapfile -t dwi_800_b0 < ${in_800_b0}
 mapfile -t dwi_800 < ${in_800}
@@ -65,10 +90,26 @@ mapfile -t dwi_2000 < ${in_2000}
 
 # b2000
 for ((i=0; i < ${#dwi_2000[@]}; i++)); do
+  if is_redundant ${source}/${dwi_2000[$i]}; then
+    echo "Skipping redundant (duplicate) run: ${dwi_2000[$i]}"
+    continue
+  fi
+  if is_invalid ${source}/${dwi_2000[$i]} || is_invalid ${source}/${dwi_2000_b0[$i]}; then
+    echo "Skipping invalid (truncated/corrupt) run: ${dwi_2000[$i]}"
+    continue
+  fi
+  if [ ${staged} = "true" ]; then
+    echo "${source}/${dwi_2000[$i]} ${source}/${dwi_2000_b0[$i]}" >> ${queue_2000}
+    continue
+  fi
   sub=$(echo $(basename $(dirname $(dirname $(dirname ${dwi_2000[$i]})))) | sed "s@sub-@@g")
   bsub -J ${sub}_2000 -n 1 -W ${wall} -M ${mem} -R "rusage[gpu=1]" -q gpu-nodes ${scripts_dir}/dwi_preproc.sh --dwi ${source}/${dwi_2000[$i]} --B0 ${source}/${dwi_2000_b0[$i]} --BIDS --data-dir ${data_2000} --residuals --repol --cnr_maps --use-gpu --niter ${niter} --fwhm ${fwhm} --mporder ${mporder} --s2v_niter ${s2v_niter} --s2v_lambda ${s2v_lambda} --tensor --qc --additional # --fig
 done
 
+if [ ${staged} = "true" ] && [ -s ${queue_2000} ]; then
+  bsub -J queue_2000 -n 1 -W $(( wall * $(wc -l < ${queue_2000}) )) -M ${mem} -R "rusage[gpu=1]" -q gpu-nodes python3 ${scripts_dir}/dwProc.py queue --jobs ${queue_2000} --data-dir ${data_2000} --prefetch ${prefetch} --report ${data_2000}/logs/queue.json -- --BIDS --residuals --repol --cnr_maps --use-gpu --niter ${niter} --fwhm ${fwhm} --mporder ${mporder} --s2v_niter ${s2v_niter} --s2v_lambda ${s2v_lambda} --tensor --qc --additional # --fig
+fi
+
 # # args
 # niter=8
 # fwhm="10,8,4,2,0,0,0,0"
@@ -81,8 +122,24 @@ done
 
 # b800
 for ((i=0; i < ${#dwi_800[@]}; i++)); do
+  if is_redundant ${source}/${dwi_800[$i]}; then
+    echo "Skipping redundant (duplicate) run: ${dwi_800[$i]}"
+    continue
+  fi
+  if is_invalid ${source}/${dwi_800[$i]} || is_invalid ${source}/${dwi_800_b0[$i]}; then
+    echo "Skipping invalid (truncated/corrupt) run: ${dwi_800[$i]}"
+    continue
+  fi
+  if [ ${staged} = "true" ]; then
+    echo "${source}/${dwi_800[$i]} ${source}/${dwi_800_b0[$i]}" >> ${queue_800}
+    continue
+  fi
   sub=$(echo $(basename $(dirname $(dirname $(dirname ${dwi_800[$i]})))) | sed "s@sub-@@g")
   bsub -J ${sub}_800 -n 1 -W ${wall} -M ${mem} -R "rusage[gpu=1]" -q gpu-nodes ${scripts_dir}/dwi_preproc.sh --dwi ${source}/${dwi_800[$i]} --B0 ${source}/${dwi_800_b0[$i]} --BIDS --data-dir ${data_800} --residuals --repol --cnr_maps --use-gpu --niter ${niter} --fwhm ${fwhm} --mporder ${mporder} --s2v_niter ${s2v_niter} --s2v_lambda ${s2v_lambda} --tensor --qc --additional # --fig
 done 
 
+if [ ${staged} = "true" ] && [ -s ${queue_800} ]; then
+  bsub -J queue_800 -n 1 -W $(( wall * $(wc -l < ${queue_800}) )) -M ${mem} -R "rusage[gpu=1]" -q gpu-nodes python3 ${scripts_dir}/dwProc.py queue --jobs ${queue_800} --data-dir ${data_800} --prefetch ${prefetch} --report ${data_800}/logs/queue.json -- --BIDS --residuals --repol --cnr_maps --use-gpu --niter ${niter} --fwhm ${fwhm} --mporder ${mporder} --s2v_niter ${s2v_niter} --s2v_lambda ${s2v_lambda} --tensor --qc --additional # --fig
+fi
+
 
@@ -0,0 +1,5 @@
+"""Test configuration: the tests are run against the source tree (the package is not installed)."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+"""Tests of the ``eddy`` wrapper (``dwi_preproc.fsl.fslpy.eddy``), run against the simulated (stand-in) executable."""
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+from typing import Dict
+
+from dwi_preproc.fsl.fslpy import eddy
+from dwi_preproc.fsl.simulator import install, sim_env
+
+
+@pytest.fixture
+def sim(tmp_path, monkeypatch) -> str:
+    """Installs the stand-in ``eddy`` (and its ``eddy_cpu`` alias), and puts it on the system path."""
+    fsldir: str = install(str(tmp_path / "fsl_sim"), profile="instant", tools=["eddy", "eddy_cpu"])
+
+    for k, v in sim_env(fsldir, profile="instant").items():
+        monkeypatch.setenv(k, v)
+    monkeypatch.setenv("FSLOUTPUTTYPE", "NIFTI_GZ")
+    monkeypatch.delenv("OMP_NUM_THREADS", raising=False)
+
+    return fsldir
+
+
+def _inputs(d: str, n_vols: int = 4, n_bvals: int = 4) -> Dict[str, str]:
+    """Writes the inputs of ``eddy`` (a DWI, mask, b-values and vectors, acquisition parameters, and index)."""
+    files: Dict[str, str] = {k: os.path.join(d, v) for k, v in (("img", "dwi.nii.gz"), ("mask", "mask.nii.gz"), ("bvals", "dwi.bval"),
+                                                                 ("bvecs", "dwi.bvec"), ("acqp", "acqp.txt"), ("index", "index.txt"))}
+
+    nib.save(nib.Nifti1Image(np.random.default_rng(0).uniform(100, 200, size=(8, 8, 4, n_vols)).astype(np.float32), np.eye(4)), files["img"])
+    nib.save(nib.Nifti1Image(np.ones((8, 8, 4), dtype=np.uint8), np.eye(4)), files["mask"])
+    np.savetxt(files["bvals"], [[0] + [1000] * (n_bvals - 1)], fmt="%d")
+    np.savetxt(files["bvecs"], np.tile([[1], [0], [0]], n_bvals), fmt="%d")
+    np.savetxt(files["acqp"], [[0, 1, 0, 0.05]], fmt="%g")
+    np.savetxt(files["index"], [[1] * n_vols], fmt="%d")
+
+    return files
+
+
+def test_eddy_stdout(sim, tmp_path):
+    out: str = str(tmp_path / "Eddy" / "eddy_corrected")
+    corrected, bvecs = eddy(out=out, verbose=True, **_inputs(str(tmp_path)))
+
+    assert os.path.exists(corrected) and os.path.exists(bvecs)
+    assert os.path.exists(f"{out}.eddy.log")
+    assert os.path.exists(f"{out}.eddy.err")
+
+    # The number of threads is set in the environment of eddy only
+    assert "OMP_NUM_THREADS" not in os.environ
+
+
+def test_eddy_failure(sim, tmp_path):
+    out: str = str(tmp_path / "Eddy" / "eddy_corrected")
+
+    with pytest.raises(RuntimeError, match=r"eddy_corrected\.eddy\.err"):
+        eddy(out=out, **_inputs(str(tmp_path), n_bvals=3))
+
+    with open(f"{out}.eddy.err") as f:
+        assert "number of b-values" in f.read()
@@ -0,0 +1,104 @@
+"""Tests of the ``N4BiasFieldCorrection`` wrapper (``dwi_preproc.ants.N4``), run against the simulated (stand-in) executable."""
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from dwi_preproc.ants.N4 import n4, n4_submit
+from dwi_preproc.fsl.simulator import install, max_concurrency, read_trace, sim_env
+
+_ITK_ENV: str = "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+
+
+@pytest.fixture
+def sim(tmp_path, monkeypatch) -> Dict[str, str]:
+    """Installs the stand-in ``N4BiasFieldCorrection`` (each run lasts ~0.2 s), and puts it on the system path."""
+    profile: str = str(tmp_path / "profile.json")
+    with open(profile, "w") as f:
+        f.write('{"base": "instant", "cpu": 0.0, "tools": {"N4BiasFieldCorrection": {"seconds": 0.2}}}')
+
+    trace: str = str(tmp_path / "trace.jsonl")
+    fsldir: str = install(str(tmp_path / "fsl_sim"), tools=["N4BiasFieldCorrection"])
+
+    for k, v in sim_env(fsldir, profile=profile, trace=trace).items():
+        monkeypatch.setenv(k, v)
+    monkeypatch.delenv(_ITK_ENV, raising=False)
+    monkeypatch.delenv("OMP_NUM_THREADS", raising=False)
+
+    return {"fsldir": fsldir, "trace": trace}
+
+
+def _image(path: str, seed: int = 0) -> str:
+    """Writes a (random) 3D image."""
+    data: np.ndarray = np.random.default_rng(seed).uniform(100, 200, size=(8, 8, 4)).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    return path
+
+
+def test_n4_outputs(sim, tmp_path):
+    img: str = _image(str(tmp_path / "mean_b0.nii.gz"))
+    corrected, bias = n4(img=img, outdir=str(tmp_path / "N4"))
+
+    assert os.path.basename(corrected) == "mean_b0_n4.nii.gz"
+    assert os.path.basename(bias) == "mean_b0_n4_bias.nii.gz"
+
+    data: np.ndarray = np.asarray(nib.load(img).dataobj)
+    field: np.ndarray = np.asarray(nib.load(bias).dataobj)
+    np.testing.assert_allclose(np.asarray(nib.load(corrected).dataobj) * field, data, rtol=1e-5)
+
+
+def test_n4_cached(sim, tmp_path):
+    img: str = _image(str(tmp_path / "mean_b0.nii.gz"))
+    n4(img=img, outdir=str(tmp_path / "N4"))
+    n4(img=img, outdir=str(tmp_path / "N4"))
+
+    assert len(read_trace(sim["trace"])) == 1
+
+
+def test_n4_threads(sim, tmp_path, monkeypatch):
+    monkeypatch.delenv("LSB_DJOB_NUMPROC", raising=False)
+    monkeypatch.setenv("SLURM_CPUS_PER_TASK", "3")
+    n4(img=_image(str(tmp_path / "mean_b0.nii.gz")), outdir=str(tmp_path / "N4"))
+
+    # The number of threads defaults to the number of cores allocated by the job scheduler
+    assert read_trace(sim["trace"])[0]["threads"] == 3
+
+
+def test_n4_submit_concurrent(sim, tmp_path):
+    imgs: List[str] = [_image(str(tmp_path / f"b0_{i}.nii.gz"), seed=i) for i in range(4)]
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        jobs = [n4_submit(img=img, outdir=str(tmp_path / f"N4_{i}"), threads=i + 1, executor=pool) for i, img in enumerate(imgs)]
+        outputs = [job.result(timeout=60) for job in jobs]
+
+    assert all(os.path.exists(f) for out in outputs for f in out)
+
+    runs: List[Dict] = read_trace(sim["trace"])
+    assert len(runs) == 4
+    assert max_concurrency(runs) > 1
+
+    # Each job runs with its own number of threads, and the environment of this process is not modified
+    threads: Dict[str, int] = {r["argv"][r["argv"].index("-i") + 1]: r["threads"] for r in runs}
+    assert threads == {img: i + 1 for i, img in enumerate(imgs)}
+    assert _ITK_ENV not in os.environ
+
+
+def test_n4_submit_shared_executor(sim, tmp_path):
+    img: str = _image(str(tmp_path / "mean_b0.nii.gz"))
+    corrected, _ = n4_submit(img=img, outdir=str(tmp_path / "N4")).result(timeout=60)
+
+    assert os.path.exists(corrected)
+
+
+def test_n4_failure(sim, tmp_path):
+    with pytest.raises(RuntimeError, match="Failed"):
+        n4(img=_image(str(tmp_path / "mean_b0.nii.gz")), outdir=str(tmp_path / "N4"), mask=_mask(str(tmp_path / "mask.nii.gz")))
+
+
+def _mask(path: str) -> str:
+    """Writes a mask whose dimensions do not match those of the test images."""
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 4), dtype=np.uint8), np.eye(4)), path)
+    return path
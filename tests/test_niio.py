@@ -0,0 +1,35 @@
+"""Tests of the streamed reads (and writes) of the volumes of 4D NIFTI images (``dwi_preproc.utils.niio``)."""
+import numpy as np
+import nibabel as nib
+import pytest
+
+from dwi_preproc.utils.niio import extract_volumes, iter_volumes
+
+
+def _image(path: str) -> str:
+    """Writes a 4D image, in which each volume is filled with its index."""
+    data: np.ndarray = np.broadcast_to(np.arange(5, dtype=np.float32), (4, 4, 2, 5)).copy()
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    return path
+
+
+def test_iter_volumes(tmp_path):
+    src: str = _image(str(tmp_path / "dwi.nii.gz"))
+
+    assert [v.mean() for v in iter_volumes(src, idx=[0, 2, 4])] == [0, 2, 4]
+    assert len(list(iter_volumes(src))) == 5
+
+    # Unsorted (or duplicate) indices are rejected, rather than yielded in another order
+    for idx in ([4, 2], [1, 1]):
+        with pytest.raises(ValueError, match="ascending order"):
+            list(iter_volumes(src, idx=idx))
+
+
+def test_extract_volumes(tmp_path):
+    src: str = _image(str(tmp_path / "dwi.nii.gz"))
+    out: str = extract_volumes(src, str(tmp_path / "subset.nii.gz"), idx=np.array([1, 3]))
+
+    assert np.asarray(nib.load(out).dataobj).mean(axis=(0, 1, 2)).tolist() == [1, 3]
+
+    with pytest.raises(ValueError, match="ascending order"):
+        extract_volumes(src, str(tmp_path / "unsorted.nii.gz"), idx=[3, 1])
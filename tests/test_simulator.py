@@ -0,0 +1,49 @@
+"""Tests of the simulated (stand-in) ``FSL`` tools used to realign the reverse phase encoded b0 (``dwi_preproc.sh``)."""
+import os
+import subprocess
+import numpy as np
+import nibabel as nib
+import pytest
+
+from typing import Dict, List
+
+from dwi_preproc.fsl.simulator import install, sim_env
+
+_TOOLS: List[str] = ["remove_ext", "flirt", "aff2rigid", "applywarp"]
+
+
+@pytest.fixture
+def env(tmp_path) -> Dict[str, str]:
+    """Installs the stand-in tools, and returns the environment of the subprocesses that run them."""
+    fsldir: str = install(str(tmp_path / "fsl_sim"), profile="instant", tools=_TOOLS)
+    return {**os.environ, **sim_env(fsldir, profile="instant"), "FSLOUTPUTTYPE": "NIFTI"}
+
+
+def _run(cmd: List[str], env: Dict[str, str], cwd: str) -> str:
+    """Runs a (simulated) tool, and returns its standard output."""
+    return subprocess.run(cmd, env=env, cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+
+
+def test_remove_ext(env, tmp_path):
+    out: str = _run(["remove_ext", "a/dwi.nii.gz", "b0.nii", "bvals"], env=env, cwd=str(tmp_path))
+    assert out == "a/dwi b0 bvals"
+
+
+def test_realign_b0(env, tmp_path):
+    b0: str = str(tmp_path / "b0.nii.gz")
+    ref: str = str(tmp_path / "ref.nii.gz")
+    nib.save(nib.Nifti1Image(np.random.default_rng(0).uniform(100, 200, size=(10, 10, 6, 2)).astype(np.float32), np.eye(4)), b0)
+    nib.save(nib.Nifti1Image(np.ones((8, 8, 4), dtype=np.float32), np.eye(4)), ref)
+
+    _run(["flirt", "-in", b0, "-ref", ref, "-omat", "b02dwi.aff.mat", "-dof", "12"], env=env, cwd=str(tmp_path))
+    _run(["aff2rigid", "b02dwi.aff.mat", "b02dwi.rigid.mat"], env=env, cwd=str(tmp_path))
+    _run(["applywarp", f"--in={b0}", "--out=b02dwi.rigid.nii", f"--ref={ref}", "--premat=b02dwi.rigid.mat"], env=env, cwd=str(tmp_path))
+
+    rigid: np.ndarray = np.loadtxt(str(tmp_path / "b02dwi.rigid.mat"))
+    np.testing.assert_allclose(rigid[:3, :3], np.eye(3), atol=1e-6)
+
+    out: nib.Nifti1Image = nib.load(str(tmp_path / "b02dwi.rigid.nii"))
+    assert out.shape == (8, 8, 4, 2)
+
+    # The centres of the fields of view are aligned (by a translation of one voxel)
+    np.testing.assert_allclose(np.asarray(out.dataobj), np.asarray(nib.load(b0).dataobj)[1:9, 1:9, 1:5])
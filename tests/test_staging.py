@@ -0,0 +1,84 @@
+"""Tests of the staged queue of pipeline runs (``dwi_preproc.utils.staging``), run with a stand-in pipeline script."""
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+from typing import Any, Dict, List
+
+from dwi_preproc.utils.staging import read_jobs, run_queue
+
+# Stand-in pipeline: logs each run, writes an output, and exits with the status in the STATUS file
+_SCRIPT: str = """
+while [ ${#} -gt 0 ]; do
+  case "${1}" in
+    --data-dir) shift; dataDir=${1} ;;
+  esac
+  shift
+done
+mkdir -p ${dataDir}/logs ${dataDir}/derivatives/sub-001
+echo "run" >> ${dataDir}/logs/sub-001.log
+echo '{"event": "run"}' >> ${dataDir}/logs/sub-001.events.jsonl
+echo "output" > ${dataDir}/derivatives/sub-001/sub-001_dwi.nii.gz
+exit $(cat {status})
+"""
+
+
+@pytest.fixture
+def queue(tmp_path) -> Dict[str, str]:
+    """Writes the stand-in pipeline script, and a queue of a single DWI."""
+    status: str = str(tmp_path / "STATUS")
+    script: str = str(tmp_path / "pipeline.sh")
+    with open(script, "w") as f:
+        f.write(_SCRIPT.replace("{status}", status))
+
+    dwi: str = str(tmp_path / "rawdata" / "sub-001_dwi.nii.gz")
+    os.makedirs(os.path.dirname(dwi))
+    nib.save(nib.Nifti1Image(np.zeros((2, 2, 2, 2), dtype=np.float32), np.eye(4)), dwi)
+
+    jobs: str = str(tmp_path / "queue.txt")
+    with open(jobs, "w") as f:
+        f.write(dwi + "\n")
+
+    return {"script": script, "status": status, "jobs": jobs, "data_dir": str(tmp_path / "data"), "scratch": str(tmp_path / "scratch")}
+
+
+def _run(queue: Dict[str, str], status: int, **kwargs) -> List[Dict[str, Any]]:
+    """Runs the queue (the pipeline exits with some status)."""
+    with open(queue["status"], "w") as f:
+        f.write(f"{status}\n")
+    return run_queue(read_jobs(queue["jobs"]), data_dir=queue["data_dir"], script=queue["script"], scratch=queue["scratch"], **kwargs)
+
+
+def _read(queue: Dict[str, str], name: str) -> str:
+    with open(os.path.join(queue["data_dir"], name)) as f:
+        return f.read()
+
+
+def test_resubmitted_queue(queue):
+    assert _run(queue, status=1)[0]["ExitStatus"] == 1
+
+    # A failed job is run again, and its logs are appended to those of the previous run
+    assert _run(queue, status=0)[0]["ExitStatus"] == 0
+    assert _read(queue, "logs/sub-001.log") == "run\nrun\n"
+    assert _read(queue, "logs/sub-001.events.jsonl").count("\n") == 2
+
+    # A completed job is skipped
+    record: Dict[str, Any] = _run(queue, status=1)[0]
+    assert record["ExitStatus"] == 0 and record["Skipped"]
+    assert _read(queue, "logs/sub-001.log") == "run\nrun\n"
+
+
+def test_no_resume(queue):
+    _run(queue, status=0)
+    assert not _run(queue, status=0, resume=False)[0].get("Skipped")
+    assert _read(queue, "logs/sub-001.log") == "run\nrun\n"
+
+
+def test_missing_outputs(queue):
+    _run(queue, status=0)
+    os.remove(os.path.join(queue["data_dir"], "derivatives", "sub-001", "sub-001_dwi.nii.gz"))
+
+    # The outputs of a completed job no longer exist: the job is run again
+    assert not _run(queue, status=0)[0].get("Skipped")
+    assert os.path.exists(os.path.join(queue["data_dir"], "derivatives", "sub-001", "sub-001_dwi.nii.gz"))
@@ -0,0 +1,86 @@
+"""Tests of the stat-keyed on-disk cache (``dwi_preproc.utils.statcache``), and of its users."""
+import os
+import shutil
+import numpy as np
+import nibabel as nib
+
+from dwi_preproc.bids.integrity import validate_series
+from dwi_preproc.utils import hashing
+from dwi_preproc.utils.statcache import read_stat_cache, stat_cache_dir, stat_key, write_stat_cache
+
+
+def _image(path: str) -> str:
+    """Writes a (random) 4D image."""
+    nib.save(nib.Nifti1Image(np.random.default_rng(0).uniform(0, 100, size=(4, 4, 2, 3)).astype(np.float32), np.eye(4)), path)
+    return path
+
+
+def test_stat_key(tmp_path):
+    src: str = _image(str(tmp_path / "dwi.nii.gz"))
+    key: str = stat_key({"img": src}, tag="v1")
+
+    assert key == stat_key({"img": src}, tag="v1")
+    assert key != stat_key({"img": src}, tag="v2")
+
+    # A copy of a file has a new key
+    assert key != stat_key({"img": shutil.copy(src, str(tmp_path / "copy.nii.gz"))}, tag="v1")
+
+
+def test_stat_cache_dir(monkeypatch):
+    monkeypatch.setenv("DWI_PREPROC_CACHE", "/tmp/cache")
+
+    assert stat_cache_dir("hashes") == "/tmp/cache/hashes"
+    assert stat_cache_dir("hashes", cache_dir="") == ""
+
+
+def test_read_write(tmp_path):
+    cache_dir: str = str(tmp_path / "cache")
+
+    assert read_stat_cache("key", cache_dir) is None
+    write_stat_cache("key", {"Errors": []}, cache_dir)
+
+    assert read_stat_cache("key", cache_dir) == {"Errors": []}
+    assert os.listdir(cache_dir) == ["key.json"]
+
+    # The on-disk cache is disabled
+    write_stat_cache("key", "value", "")
+    assert read_stat_cache("key", "") is None
+
+
+def test_content_hash_cached(tmp_path, monkeypatch):
+    src: str = _image(str(tmp_path / "dwi.nii.gz"))
+    cache_dir: str = str(tmp_path / "hashes")
+    digest: str = hashing.content_hash(src, cache_dir=cache_dir)
+
+    # Hashes are read from the on-disk cache (rather than the image)
+    monkeypatch.setattr(hashing, "_HASHES", {})
+    monkeypatch.setattr(hashing, "hash_image", None)
+
+    assert hashing.content_hash(src, cache_dir=cache_dir) == digest
+
+
+def test_validate_series_cached(tmp_path):
+    src: str = _image(str(tmp_path / "dwi.nii.gz"))
+    np.savetxt(str(tmp_path / "dwi.bval"), [[0, 1000, 1000]], fmt="%d")
+    np.savetxt(str(tmp_path / "dwi.bvec"), np.tile([[1], [0], [0]], 3), fmt="%d")
+
+    kwargs = dict(bval=str(tmp_path / "dwi.bval"), bvec=str(tmp_path / "dwi.bvec"), cache_dir=str(tmp_path / "verdicts"))
+    first = validate_series(src, **kwargs)
+    second = validate_series(src, **kwargs)
+
+    assert first["Valid"] and not first["Cached"]
+    assert second["Valid"] and second["Cached"]
+
+
+def test_content_hash_scaling(tmp_path):
+    data: np.ndarray = np.arange(64, dtype=np.int16).reshape(4, 4, 4)
+    srcs = []
+    for slope in (1.0, 2.0):
+        nii: nib.Nifti1Image = nib.Nifti1Image(data, np.eye(4))
+        nii.header.set_slope_inter(slope, 0.0)
+        srcs.append(str(tmp_path / f"slope-{slope}.nii.gz"))
+        nib.save(nii, srcs[-1])
+
+    # Images that only differ in their scaling (scl_slope) have different hashes
+    assert np.asarray(nib.load(srcs[1]).dataobj).max() == 2 * np.asarray(nib.load(srcs[0]).dataobj).max()
+    assert hashing.content_hash(srcs[0], cache_dir="") != hashing.content_hash(srcs[1], cache_dir="")
@@ -0,0 +1,80 @@
+"""Tests of the ``topup`` and ``applytopup`` wrappers (``dwi_preproc.fsl.fslpy``) on an image grid that is fit to the subsampling schedule, run against the simulated (stand-in) executables."""
+import os
+import json
+import numpy as np
+import nibabel as nib
+import pytest
+
+from typing import List
+
+from dwi_preproc.fsl.fslpy import applytopup, eddy, topup
+from dwi_preproc.fsl.simulator import install, read_trace, sim_env
+
+
+@pytest.fixture
+def sim(tmp_path, monkeypatch) -> str:
+    """Installs the stand-in ``topup``, ``applytopup`` and ``eddy``, and puts them on the system path."""
+    trace: str = str(tmp_path / "trace.jsonl")
+    fsldir: str = install(str(tmp_path / "fsl_sim"), profile="instant", tools=["topup", "applytopup", "eddy", "eddy_cpu"])
+
+    for k, v in sim_env(fsldir, profile="instant", trace=trace).items():
+        monkeypatch.setenv(k, v)
+    monkeypatch.setenv("FSLOUTPUTTYPE", "NIFTI_GZ")
+
+    return trace
+
+
+def _image(path: str, shape: tuple) -> str:
+    """Writes a (random) image."""
+    nib.save(nib.Nifti1Image(np.random.default_rng(0).uniform(100, 200, size=shape).astype(np.float32), np.eye(4)), path)
+    return path
+
+
+def test_topup_odd_grid(sim, tmp_path):
+    outdir: str = str(tmp_path / "Topup")
+    acqp: str = str(tmp_path / "acqp.txt")
+    np.savetxt(acqp, [[0, 1, 0, 0.05], [0, -1, 0, 0.05]], fmt="%g")
+
+    b0s: str = _image(str(tmp_path / "B0s.nii.gz"), (9, 9, 5, 2))
+    out, fmap, iout = topup(img=b0s, outdir=outdir, acqp=acqp, fout=f"{outdir}/suscept_field_Hz", iout=True, out=f"{outdir}/suscept_corr_B0")
+
+    assert out == f"{outdir}/suscept_corr_B0"
+    assert nib.load(fmap).shape == (9, 9, 5)
+    assert nib.load(iout).shape == (9, 9, 5, 2)
+
+    with open(f"{out}_grid.json") as f:
+        assert json.load(f)["Dims"] == [9, 9, 5]
+
+    # The inputs of applytopup are fit to the grid of the field coefficients, and the output is restored
+    imgs: List[str] = [_image(str(tmp_path / f"B0_{pe}.nii.gz"), (9, 9, 5)) for pe in ("PA", "AP")]
+    hifi: str = applytopup(imgs=imgs, acqp=acqp, inindex=[1, 2], topup=out, out=f"{outdir}/hifi.nii.gz")
+
+    assert nib.load(hifi).shape == (9, 9, 5)
+
+    # eddy uses the fieldmap (on the grid of the DWI) in place of the field coefficients
+    files = {k: str(tmp_path / v) for k, v in (("bvals", "dwi.bval"), ("bvecs", "dwi.bvec"), ("index", "index.txt"))}
+    np.savetxt(files["bvals"], [[0, 1000, 1000]], fmt="%d")
+    np.savetxt(files["bvecs"], np.tile([[1], [0], [0]], 3), fmt="%d")
+    np.savetxt(files["index"], [[1] * 3], fmt="%d")
+
+    eddy(img=_image(str(tmp_path / "dwi.nii.gz"), (9, 9, 5, 3)), mask=_image(str(tmp_path / "mask.nii.gz"), (9, 9, 5)), acqp=acqp,
+         out=str(tmp_path / "Eddy" / "eddy_corr"), topup=out, estimate_move_by_susceptibility=True, **files)
+
+    argv: List[str] = [r for r in read_trace(sim) if r["tool"] == "eddy_cpu"][0]["argv"]
+    assert f"--field={outdir}/suscept_field_Hz" in argv
+    assert not any(a.startswith("--topup") for a in argv)
+
+
+def test_topup_even_grid(sim, tmp_path):
+    outdir: str = str(tmp_path / "Topup")
+    acqp: str = str(tmp_path / "acqp.txt")
+    np.savetxt(acqp, [[0, 1, 0, 0.05], [0, -1, 0, 0.05]], fmt="%g")
+
+    out, fmap, _ = topup(img=_image(str(tmp_path / "B0s.nii.gz"), (8, 8, 4, 2)), outdir=outdir, acqp=acqp)
+
+    # The image grid is not adjusted: no grid record (or fieldmap) is written
+    assert fmap is None
+    assert not os.path.exists(f"{out}_grid.json")
+
+    hifi: str = applytopup(imgs=[_image(str(tmp_path / "B0_PA.nii.gz"), (8, 8, 4))], acqp=acqp, inindex=[1], topup=out, out=f"{outdir}/hifi.nii.gz")
+    assert nib.load(hifi).shape == (8, 8, 4)